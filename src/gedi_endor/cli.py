@@ -0,0 +1,88 @@
+# cli.py
+
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# The step packages (step1_gedi, step2_eo, ...) and orchestrator.py import each
+# other as top-level modules, so the modules directory has to be importable.
+MODULES_DIR = Path(__file__).resolve().parent / "modules"
+
+
+def load_config(path):
+    """
+    Load a pipeline configuration from a YAML (.yml/.yaml) or JSON file.
+
+    Returns:
+        dict configuration in the same layout the orchestrator expects.
+    """
+    path = Path(path)
+    with open(path, "r") as f:
+        if path.suffix.lower() in (".yml", ".yaml"):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="gedi-endor",
+        description="GEDI ENDOR pipeline runner.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_p = sub.add_parser("run", help="Run the Step 2 EO pipeline for one AOI.")
+    run_p.add_argument("config", help="Path to a YAML or JSON configuration file.")
+    run_p.add_argument("--sources", nargs="+", help="Override eo.sources from the config.")
+    run_p.add_argument("--dry-run", action="store_true",
+                       help="Load the config and resolve source plugins without running anything.")
+
+    batch_p = sub.add_parser("batch", help="Run the pipeline for a collection of AOIs with shared downloads.")
+    batch_p.add_argument("config", help="Path to a YAML or JSON configuration file with a `batch` section.")
+    batch_p.add_argument("--workers", type=int, help="Override batch.workers from the config.")
+    return parser
+
+
+def main(argv=None):
+    t0 = time.perf_counter()
+    args = build_parser().parse_args(argv)
+
+    if str(MODULES_DIR) not in sys.path:
+        sys.path.insert(0, str(MODULES_DIR))
+
+    cfg = load_config(args.config)
+    if getattr(args, "sources", None):
+        cfg["eo"]["sources"] = args.sources
+
+    from orchestrator import orchestrator
+    from step2_eo.registry import check_sources
+
+    logger.info(f"Startup took {time.perf_counter() - t0:.3f}s")
+
+    if args.command == "batch":
+        from batch_orchestrator import batch_orchestrator
+        if args.workers:
+            cfg["batch"]["workers"] = args.workers
+        report = batch_orchestrator(cfg)
+        return 1 if report["failed_aois"] else 0
+
+    if args.dry_run:
+        t1 = time.perf_counter()
+        problems = check_sources(cfg["eo"]["sources"])
+        logger.info(f"Resolved {len(cfg['eo']['sources'])} sources in {time.perf_counter() - t1:.3f}s")
+        for source, msg in problems.items():
+            logger.error(f"{source}: {msg}")
+        return 1 if problems else 0
+
+    orchestrator(cfg)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# modules/batch_orchestrator.py
+
+import copy
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import geopandas as gpd
+from shapely import STRtree
+from shapely.ops import unary_union
+
+from memory_budget import memory_budget
+from orchestrator import orchestrator
+from step2_eo.registry import get_planner
+from step2_eo.cache import local_path, ensure_local
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+def load_aois(cfg):
+    """
+    Read the AOI collection of a batch run.
+
+    Returns:
+        List of (aoi_id, shapely geometry in EPSG:4326) tuples.
+    """
+    batch_cfg = cfg["batch"]
+    aois = gpd.read_file(batch_cfg["aois"])
+    if aois.crs is None:
+        aois.set_crs("EPSG:4326", inplace=True)
+    aois = aois.to_crs(epsg=4326)
+
+    id_field = batch_cfg.get("id_field")
+    ids = aois[id_field].astype(str) if id_field else aois.index.astype(str)
+    return list(zip(ids, aois.geometry))
+
+
+def plan_batch(cfg, aois):
+    """
+    Plan the union of granules/tiles required by all AOIs.
+
+    Each source with a planner is searched once over the union of the AOIs;
+    every returned granule/tile is then assigned to the AOIs its footprint
+    intersects. References without a footprint are assigned to every AOI.
+
+    Returns:
+        Dict of source -> list of reference dicts, each with an extra
+        "aois" list of AOI ids.
+    """
+    geoms = [geom for _, geom in aois]
+    union = unary_union(geoms)
+    tree = STRtree(geoms)
+
+    plan = {}
+    for source in cfg["eo"]["sources"]:
+        try:
+            planner = get_planner(source)
+        except ImportError as e:
+            logger.error(f"Cannot plan {source}: missing dependency ({e}). Skipping.")
+            continue
+        if planner is None:
+            logger.info(f"{source} has no planner; it will be fetched per AOI.")
+            continue
+
+        refs = planner(cfg, union)
+        for ref in refs:
+            if ref.get("footprint") is None:
+                ref["aois"] = [aoi_id for aoi_id, _ in aois]
+            else:
+                hits = tree.query(ref["footprint"], predicate="intersects")
+                ref["aois"] = [aois[i][0] for i in sorted(hits)]
+        plan[source] = [ref for ref in refs if ref["aois"]]
+        logger.info(f"Planned {len(plan[source])} {source} files for {len(aois)} AOIs")
+    return plan
+
+
+def fetch_plan(cfg, plan):
+    """
+    Download every planned file once into the shared cache.
+
+    Returns:
+        Dict of source -> statistics (files, references, bytes) used for
+        the deduplication report. Files that fail to download are dropped
+        from the plan.
+    """
+    cache_cfg = {"cache_dir": cfg["batch"]["cache_dir"]}
+    stats = {}
+
+    for source, refs in plan.items():
+        s = {"unique_files": 0, "references": 0, "failed": 0,
+             "unique_bytes": 0, "naive_bytes": 0, "downloaded_bytes": 0}
+        kept = []
+        for ref in refs:
+            path = local_path(cache_cfg, source, ref, None)
+            try:
+                downloaded = ensure_local(ref["url"], path, **ref.get("download", {}))
+            except Exception as e:
+                logger.warning(f"Failed to fetch {source} {ref['key']}: {e}")
+                s["failed"] += 1
+                continue
+            size = path.stat().st_size
+            s["unique_files"] += 1
+            s["references"] += len(ref["aois"])
+            s["unique_bytes"] += size
+            s["naive_bytes"] += size * len(ref["aois"])
+            if downloaded:
+                s["downloaded_bytes"] += size
+            kept.append(ref)
+        s["bytes_saved"] = s["naive_bytes"] - s["unique_bytes"]
+        plan[source] = kept
+        stats[source] = s
+        logger.info(
+            f"{source}: {s['unique_files']} files serve {s['references']} AOI references, "
+            f"{s['bytes_saved'] / 1e9:.2f} GB saved by deduplication"
+        )
+    return stats
+
+
+def aoi_config(cfg, aoi_id, geom, plan):
+    """Build the single-AOI configuration used to fan out one batch member."""
+    aoi_dir = Path(cfg["batch"].get("work_dir", Path(cfg["output_dir"]) / "aois")) / aoi_id
+    aoi_dir.mkdir(parents=True, exist_ok=True)
+    aoi_path = aoi_dir / "aoi.geojson"
+    gpd.GeoDataFrame({"aoi_id": [aoi_id]}, geometry=[geom], crs="EPSG:4326").to_file(aoi_path, driver="GeoJSON")
+
+    aoi_cfg = copy.deepcopy({k: v for k, v in cfg.items() if k != "batch"})
+    aoi_cfg["geography"] = str(aoi_path)
+    aoi_cfg["input_dir"] = str(Path(cfg["input_dir"]) / aoi_id)
+    aoi_cfg["output_dir"] = str(Path(cfg["output_dir"]) / aoi_id)
+    aoi_cfg["cache_dir"] = cfg["batch"]["cache_dir"]
+    # Files are already cached, so download settings (sessions) are not passed on
+    aoi_cfg["plan"] = {
+        source: [{k: v for k, v in ref.items() if k != "download"} for ref in refs if aoi_id in ref["aois"]]
+        for source, refs in plan.items()
+    }
+    return aoi_cfg
+
+
+def batch_orchestrator(cfg):
+    """
+    Run the Step 2 EO pipeline for a collection of AOIs with shared,
+    deduplicated granule and tile downloads.
+
+    Args:
+        cfg: dict-like configuration, as for orchestrator(), plus:
+            - batch:
+                - aois: path to a multi-feature GeoJSON/Shapefile of AOIs
+                - id_field: attribute holding the AOI id (default: feature index)
+                - cache_dir: shared granule/tile cache
+                - work_dir: where per-AOI geometries are written (optional)
+                - workers: number of AOIs processed in parallel (default 1)
+            - memory_budget: optional memory limit for the whole batch; each
+              AOI pipeline gets an equal share (budget / workers)
+    Returns:
+        Report dict (also written to output_dir/batch_report.json).
+    """
+    logger.info("Starting batch orchestrator...")
+
+    aois = load_aois(cfg)
+    logger.info(f"Loaded {len(aois)} AOIs")
+
+    # Plan once, fetch each granule/tile once
+    plan = plan_batch(cfg, aois)
+    stats = fetch_plan(cfg, plan)
+
+    # Fan out per-AOI clipping and compute
+    workers = cfg["batch"].get("workers", 1)
+    aoi_cfgs = {aoi_id: aoi_config(cfg, aoi_id, geom, plan) for aoi_id, geom in aois}
+    budget = memory_budget(cfg)
+    if budget is not None:
+        for aoi_cfg in aoi_cfgs.values():
+            aoi_cfg["memory_budget"] = budget // max(workers, 1)
+        logger.info(f"Memory budget: {budget // max(workers, 1) / 1024**2:.0f} MB per AOI")
+    failed = {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(orchestrator, aoi_cfg): aoi_id for aoi_id, aoi_cfg in aoi_cfgs.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"AOI {futures[future]} failed: {e}")
+                    failed[futures[future]] = str(e)
+    else:
+        for aoi_id, aoi_cfg in aoi_cfgs.items():
+            logger.info(f"Processing AOI {aoi_id}")
+            try:
+                orchestrator(aoi_cfg)
+            except Exception as e:
+                logger.error(f"AOI {aoi_id} failed: {e}")
+                failed[aoi_id] = str(e)
+
+    total_saved = sum(s["bytes_saved"] for s in stats.values())
+    report = {
+        "aois": len(aois),
+        "failed_aois": failed,
+        "sources": stats,
+        "bytes_saved": total_saved,
+    }
+    report_path = Path(cfg["output_dir"]) / "batch_report.json"
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    logger.info(f"Deduplication saved {total_saved / 1e9:.2f} GB across {len(aois)} AOIs")
+    logger.info(f"Batch report written to {report_path}")
+    logger.info("Batch processing completed.")
+    return report
@@ -0,0 +1,99 @@
+# modules/chunked.py
+
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Root attribute set once every chunk of a store written by region is in place
+COMPLETE_ATTR = "complete"
+
+# Metadata files rewritten whenever a Zarr store (v3 or v2) is rewritten or appended to
+_METADATA_FILES = ("zarr.json", ".zmetadata", ".zattrs", ".zgroup")
+
+
+# -----------------------------
+# Process pool
+# -----------------------------
+def map_tasks(func, tasks, workers):
+    """
+    [func(*task) for task in tasks], over `workers` processes when there is
+    more than one worker and task. func must be importable (module level).
+    """
+    if workers > 1 and len(tasks) > 1:
+        # "spawn" rather than fork: thread pools started in the parent
+        # (zarr/dask I/O, OpenMP/BLAS, torch) do not survive a fork
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return list(pool.map(func, *zip(*tasks)))
+    return [func(*task) for task in tasks]
+
+
+# -----------------------------
+# Chunk windows
+# -----------------------------
+def store_chunks(da):
+    """Dimension -> chunk length of a variable as stored (its full size when unchunked)."""
+    return dict(zip(da.dims, da.encoding.get("chunks") or da.shape))
+
+
+def chunk_windows(shape, chunks):
+    """(y slice, x slice) of every (chy, chx) chunk of a (ny, nx) grid, row by row."""
+    (ny, nx), (chy, chx) = shape, chunks
+    return [(slice(r, min(r + chy, ny)), slice(c, min(c + chx, nx)))
+            for r in range(0, ny, chy) for c in range(0, nx, chx)]
+
+
+def select_time(ds, variables, time_sel=None):
+    """Variables of a store, at the time step nearest to time_sel when they have a time dimension."""
+    sub = ds[variables]
+    if time_sel is not None and "time" in sub.dims:
+        sub = sub.sel(time=np.datetime64(pd.Timestamp(time_sel)), method="nearest")
+    return sub
+
+
+# -----------------------------
+# Completion markers
+# -----------------------------
+def store_stamp(path):
+    """Latest modification time of a store's root metadata (changes on every rewrite or append)."""
+    path = Path(path)
+    times = [path.stat().st_mtime] + [(path / f).stat().st_mtime for f in _METADATA_FILES if (path / f).exists()]
+    return max(times)
+
+
+def mark_complete(path, source_stamp=None):
+    """
+    Flag a store filled chunk by chunk as complete; call after its last
+    region write. source_stamp (store_stamp of the input, taken before
+    reading it) lets is_complete tell when the input changed since.
+    """
+    import zarr
+
+    group = zarr.open_group(str(path), mode="r+")
+    group.attrs[COMPLETE_ATTR] = {"source_stamp": source_stamp}
+    zarr.consolidate_metadata(str(path))
+
+
+def is_complete(path, source_stamp=None):
+    """
+    True when the store at path was marked complete (from the same input
+    state when source_stamp is given); half-written stores of an
+    interrupted run are not.
+    """
+    import zarr
+
+    if not Path(path).exists():
+        return False
+    try:
+        marker = zarr.open_group(str(path), mode="r").attrs.get(COMPLETE_ATTR)
+    except Exception:
+        return False
+    if not marker:
+        return False
+    return source_stamp is None or marker.get("source_stamp") == source_stamp
@@ -0,0 +1,133 @@
+# modules/memory_budget.py
+
+import logging
+import math
+import os
+import re
+import sys
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+_UNITS = {"": 1, "b": 1, "k": 1024, "kb": 1024, "m": 1024**2, "mb": 1024**2,
+          "g": 1024**3, "gb": 1024**3, "t": 1024**4, "tb": 1024**4}
+
+# Working copies of a block assumed while it is processed (decoded array,
+# DataFrame, index columns, groupby/filter temporaries)
+DEFAULT_COPIES = 4
+
+
+def parse_size(value):
+    """
+    Bytes of a size given as a number (bytes) or a string such as "512MB",
+    "4 GB" or "1.5g" (binary units). None, 0 and "" mean no limit (None).
+    """
+    if value in (None, 0, ""):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([a-zA-Z]*)\s*", str(value))
+    if not match or match.group(2).lower() not in _UNITS:
+        raise ValueError(f"Cannot parse memory size {value!r}")
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def memory_budget(cfg):
+    """
+    Memory budget of a run in bytes, or None when unlimited.
+
+    The budget (cfg["memory_budget"]) bounds the working memory a stage uses
+    for data on top of the interpreter and its libraries, summed over the
+    stage's worker processes. Stages run one after the other, so each gets
+    the whole budget.
+    """
+    return parse_size(cfg.get("memory_budget"))
+
+
+def with_budget(cfg, budget):
+    """Shallow copy of cfg with memory_budget set to `budget` bytes."""
+    out = dict(cfg)
+    out["memory_budget"] = budget
+    return out
+
+
+def batch_rows(budget, bytes_per_row, copies=DEFAULT_COPIES, minimum=1, maximum=None):
+    """
+    Rows (pixels, records, time steps...) to process at once so that
+    `copies` working copies of a batch fit in `budget` bytes.
+    Without a budget the maximum (or everything) is returned.
+    """
+    if budget is None or bytes_per_row <= 0:
+        return maximum
+    rows = max(minimum, int(budget // (bytes_per_row * copies)))
+    return min(rows, maximum) if maximum is not None else rows
+
+
+def tile_size(budget, bytes_per_pixel, copies=DEFAULT_COPIES, multiple=16, minimum=64, maximum=4096):
+    """Square tile side (a multiple of `multiple` pixels) that fits `budget`."""
+    if budget is None:
+        return maximum
+    side = int(math.sqrt(budget / (bytes_per_pixel * copies)))
+    side = side // multiple * multiple
+    return int(min(max(side, minimum), maximum))
+
+
+def budget_workers(workers, budget, bytes_per_worker, worker_limit=None):
+    """
+    Cap a worker count by CPU count, so that every worker gets at least
+    `bytes_per_worker` of the budget, and, given a hard per-worker memory
+    limit (`worker_limit` bytes), so that that many limits fit in the memory
+    currently available. "auto"/None/0 start from all cores.
+    """
+    if workers in (None, 0, "auto"):
+        workers = os.cpu_count() or 1
+    workers = max(1, min(int(workers), os.cpu_count() or 1))
+    caps = []
+    if budget is not None and bytes_per_worker > 0:
+        caps.append(("the memory budget", budget // bytes_per_worker))
+    if worker_limit:
+        try:
+            import psutil
+            caps.append(("available memory", psutil.virtual_memory().available // worker_limit))
+        except ImportError:
+            pass
+    for reason, fit in caps:
+        fit = max(1, int(fit))
+        if fit < workers:
+            logger.info(f"Reducing workers {workers} -> {fit} to fit {reason}")
+            workers = fit
+    return workers
+
+
+# -----------------------------
+# Measurement
+# -----------------------------
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes.
+
+    Read from VmHWM on Linux: unlike ru_maxrss, it starts afresh when a
+    process is spawned (exec), instead of carrying over the parent's peak.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -1,13 +1,8 @@
 # modules/orchestrator.py
 
 import logging
-from pathlib import Path
-from datetime import datetime
 
-# Step 2 EO modules
-from step2_eo.fetch import run as fetch_eo
-from step2_eo.compute import run as compute_eo
-from step2_eo.gedi_filter import run as filter_gedi
+from memory_budget import memory_budget, with_budget
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -29,12 +24,30 @@ def orchestrator(cfg):
                 - composites: list of temporal composites, e.g., ["median","mean"]
                 - phenology_windows: list of (start, end) tuples for temporal windows
                 - gedi_filters: dict with GEDI product-specific filter criteria
+                - reduce: optional spectral reduction of EMIT/PACE (see spectral_reduce)
+                - speckle: optional S1 speckle filtering (see speckle)
             - input_dir: path to raw EO data
             - output_dir: path to processed EO outputs
+            - memory_budget: optional memory limit for data, e.g. "8GB". It is
+              resolved to bytes once and passed to every stage, which sizes
+              its chunks, batches and worker counts to stay under it
     """
+    # Stage modules are imported here, not at module level, so that importing
+    # the orchestrator (e.g. from the CLI) stays cheap. Source SDKs are only
+    # imported by the fetch registry when a source is requested.
+    from step2_eo.fetch import run as fetch_eo
+    from step2_eo.compute import run as compute_eo
+    from step2_eo.gedi_filter import run as filter_gedi
+    from step2_eo.spectral_reduce import run as reduce_spectra
+    from step2_eo.speckle import run as filter_speckle
 
     logger.info("Starting Step 2 EO orchestrator...")
 
+    budget = memory_budget(cfg)
+    if budget is not None:
+        cfg = with_budget(cfg, budget)
+        logger.info(f"Memory budget: {budget / 1024**2:.0f} MB per stage")
+
     # -----------------------------
     # Step 2a: Fetch EO datasets
     # -----------------------------
@@ -49,7 +62,21 @@ def orchestrator(cfg):
         filter_gedi(cfg)
 
     # -----------------------------
-    # Step 2c: Compute indices & composites
+    # Step 2c: Reduce hyperspectral bands to components
+    # -----------------------------
+    if "reduce" in cfg["eo"]:
+        logger.info("Reducing hyperspectral EO data to spectral components...")
+        reduce_spectra(cfg)
+
+    # -----------------------------
+    # Step 2d: Speckle-filter Sentinel-1 stacks
+    # -----------------------------
+    if "S1" in cfg["eo"]["sources"] and "speckle" in cfg["eo"]:
+        logger.info("Filtering Sentinel-1 speckle...")
+        filter_speckle(cfg)
+
+    # -----------------------------
+    # Step 2e: Compute indices & composites
     # -----------------------------
     logger.info("Computing EO indices and temporal composites...")
     compute_eo(cfg)
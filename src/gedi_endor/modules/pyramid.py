@@ -0,0 +1,372 @@
+# modules/pyramid.py
+
+import glob
+import logging
+import math
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import map_tasks
+from memory_budget import DEFAULT_COPIES, memory_budget, tile_size
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+RESAMPLING = ("mean", "mode", "nearest")
+
+# Chunk side of the coarsest level written by each pass, and the largest
+# base tile read at once
+MIN_CHUNK = 256
+MAX_TILE = 2048
+
+
+# -----------------------------
+# 2x2 reductions
+# -----------------------------
+def default_resampling(da):
+    """mean for floating-point variables, mode for integer/boolean (class, flag, count) maps."""
+    return "mean" if np.issubdtype(da.dtype, np.floating) else "mode"
+
+
+def level_dtype(dtype, method):
+    if method == "mean" and not np.issubdtype(dtype, np.floating):
+        return np.dtype(np.float32)
+    return np.dtype(dtype)
+
+
+def _pad_even(a, **kwargs):
+    pad_y, pad_x = a.shape[-2] % 2, a.shape[-1] % 2
+    if not (pad_y or pad_x):
+        return a
+    return np.pad(a, [(0, 0)] * (a.ndim - 2) + [(0, pad_y), (0, pad_x)], **kwargs)
+
+
+def _blocks(a):
+    """(..., h, w) -> (..., h/2, w/2, 4) values of the 2x2 blocks (h, w even)."""
+    *lead, h, w = a.shape
+    b = a.reshape(*lead, h // 2, 2, w // 2, 2)
+    return np.moveaxis(b, -3, -2).reshape(*lead, h // 2, w // 2, 4)
+
+
+def reduce2(a, method):
+    """
+    Halve the last two (y, x) axes of an array. Odd edges are reduced from
+    the pixels that exist.
+
+    - mean: mean of the valid (non-NaN) pixels of each 2x2 block
+    - mode: most frequent valid value of the block (ties: first in row-major
+      order, i.e. the nearest one wins)
+    - nearest: top-left pixel of the block
+    """
+    if method == "nearest":
+        return a[..., ::2, ::2]
+    if method == "mean":
+        a = _pad_even(a.astype(level_dtype(a.dtype, method), copy=False), constant_values=np.nan)
+        with warnings.catch_warnings():
+            # all-NaN blocks stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmean(_blocks(a), axis=-1).astype(a.dtype, copy=False)
+    if method == "mode":
+        valid = np.ones(a.shape, dtype=bool)
+        if np.issubdtype(a.dtype, np.floating):
+            valid = ~np.isnan(a)
+        v = _blocks(_pad_even(a, mode="edge"))
+        m = _blocks(_pad_even(valid, constant_values=False))
+        counts = ((v[..., :, None] == v[..., None, :]) & m[..., None, :]).sum(axis=-1)
+        counts[~m] = -1
+        pick = np.argmax(counts, axis=-1)[..., None]
+        return np.take_along_axis(v, pick, axis=-1)[..., 0]
+    raise ValueError(f"Unknown resampling {method!r}; expected one of {RESAMPLING}")
+
+
+# -----------------------------
+# Level grids
+# -----------------------------
+def n_levels(shape, min_chunk=MIN_CHUNK):
+    """Levels needed until the coarsest level fits in one min_chunk x min_chunk chunk."""
+    n = 0
+    while max(math.ceil(s / 2**n) for s in shape) > min_chunk:
+        n += 1
+    return n
+
+
+def level_coords(values, factor):
+    """Pixel-centre coordinates of a regular axis coarsened by `factor` (same outer corner)."""
+    n = math.ceil(len(values) / factor)
+    if len(values) < 2:
+        return np.asarray(values)[:n]
+    d = values[1] - values[0]
+    return values[0] + (factor - 1) / 2 * d + np.arange(n) * factor * d
+
+
+def level_spatial_ref(spatial_ref, factor):
+    """spatial_ref coordinate with its GeoTransform pixel size scaled by `factor`."""
+    out = spatial_ref.copy()
+    gt = out.attrs.get("GeoTransform")
+    if gt:
+        g = [float(v) for v in str(gt).split()]
+        g[1], g[2], g[4], g[5] = (v * factor for v in (g[1], g[2], g[4], g[5]))
+        out.attrs["GeoTransform"] = " ".join(repr(v) for v in g)
+    return out
+
+
+def pass_plan(levels, tile, min_chunk):
+    """
+    Passes of the builder as (source level, [levels written]) pairs.
+
+    A pass reads tiles of `tile` pixels of its source level once and
+    reduces each tile down through the next log2(tile / min_chunk) levels,
+    writing every level's block. The coarsest level of a pass is the source
+    of the next, so the base level is read exactly once.
+    """
+    per_pass = int(math.log2(tile // min_chunk))
+    return [(start, list(range(start + 1, min(start + per_pass, levels) + 1)))
+            for start in range(0, levels, per_pass)]
+
+
+def level_chunk(level, tile, min_chunk):
+    """Chunk side of a level: the size of one source tile's block, so passes write whole chunks."""
+    per_pass = int(math.log2(tile // min_chunk))
+    return tile >> ((level - 1) % per_pass + 1)
+
+
+def _tile(budget, bytes_per_pixel, min_chunk, tile=None):
+    """Base tile side: min_chunk * 2**k, at least two levels per pass, fitting the budget."""
+    if tile is None:
+        tile = tile_size(budget, bytes_per_pixel, copies=DEFAULT_COPIES, multiple=min_chunk,
+                         minimum=2 * min_chunk, maximum=MAX_TILE)
+    return min_chunk * 2 ** max(1, int(math.log2(max(tile // min_chunk, 1))))
+
+
+def tile_windows(shape, tile, regions=None):
+    """
+    (y slice, x slice) of every tile of a level, or only of the tiles
+    overlapping `regions` (list of ((y0, y1), (x0, x1)) pixel bounds).
+    """
+    ny, nx = shape
+    if regions is None:
+        rows, cols = range(0, ny, tile), range(0, nx, tile)
+        keys = [(r, c) for r in rows for c in cols]
+    else:
+        keys = set()
+        for (y0, y1), (x0, x1) in regions:
+            for r in range(y0 // tile * tile, min(y1, ny), tile):
+                for c in range(x0 // tile * tile, min(x1, nx), tile):
+                    keys.add((r, c))
+        keys = sorted(keys)
+    return [(slice(r, min(r + tile, ny)), slice(c, min(c + tile, nx))) for r, c in keys]
+
+
+def _coarsen_regions(regions, factor):
+    return [((y0 // factor, math.ceil(y1 / factor)), (x0 // factor, math.ceil(x1 / factor)))
+            for (y0, y1), (x0, x1) in regions]
+
+
+# -----------------------------
+# Chunked engine
+# -----------------------------
+def _pyramid_task(source, group, out_path, levels, methods, windows):
+    """Read some tiles of the source level once and write their blocks of the next levels; runs in a worker."""
+    with xr.open_zarr(source, group=group) as ds:
+        for ys, xs in windows:
+            block = {v: ds[v].transpose(..., "y", "x").isel(y=ys, x=xs) for v in methods}
+            dims = {v: da.dims for v, da in block.items()}
+            block = {v: da.values for v, da in block.items()}
+            for k, level in enumerate(levels, 1):
+                block = {v: reduce2(a, methods[v]) for v, a in block.items()}
+                h, w = next(iter(block.values())).shape[-2:]
+                y0, x0 = ys.start >> k, xs.start >> k
+                out = xr.Dataset({v: (dims[v], a) for v, a in block.items()})
+                out.to_zarr(out_path, group=str(level), region={"y": slice(y0, y0 + h), "x": slice(x0, x0 + w)})
+    return len(windows)
+
+
+def _write_templates(base, out_path, methods, levels, tile, min_chunk, attrs):
+    """Root attributes and a metadata-only template group per level."""
+    import dask.array as dsa
+
+    xr.Dataset(attrs=attrs).to_zarr(out_path, mode="w")
+    for level in range(1, levels + 1):
+        factor = 2**level
+        chunk = level_chunk(level, tile, min_chunk)
+        coords = {"y": level_coords(base["y"].values, factor), "x": level_coords(base["x"].values, factor)}
+        shape = (len(coords["y"]), len(coords["x"]))
+        data = {}
+        for v, method in methods.items():
+            da = base[v].transpose(..., "y", "x")
+            lead = {d: base.sizes[d] for d in da.dims[:-2]}
+            coords.update({d: base[d].values for d in lead if d in base.coords})
+            data[v] = (da.dims, dsa.zeros((*lead.values(), *shape), dtype=level_dtype(da.dtype, method),
+                                          chunks=(*lead.values(), chunk, chunk)), da.attrs)
+        template = xr.Dataset(data, coords=coords, attrs={"level": level, "factor": factor})
+        if "spatial_ref" in base.variables:
+            template = template.assign_coords(spatial_ref=level_spatial_ref(base["spatial_ref"], factor))
+        template.to_zarr(out_path, group=str(level), mode="w", compute=False)
+
+
+def build_pyramid(base_path, out_path, variables=None, resampling=None, levels=None,
+                  tile=None, min_chunk=MIN_CHUNK, regions=None, workers=1, budget=None):
+    """
+    Build (or update) the overview levels of a y/x Zarr store.
+
+    Level k halves level k-1 along y and x with the variable's resampling
+    (default: mean for floats, mode for integers). Levels are written as
+    groups "1", "2", ... of `out_path`; level 0 is the base store itself,
+    referenced in the root "multiscales" attribute.
+
+    With `regions` (list of {"y": [y0, y1], "x": [x0, x1]} base pixel
+    bounds that were rewritten), only the tiles of every level that cover
+    them are rebuilt, provided the existing pyramid was built from a base
+    of the same shape with the same settings; otherwise the whole pyramid
+    is rebuilt.
+
+    Returns:
+        Number of base tiles read.
+    """
+    base_path, out_path = Path(base_path), Path(out_path)
+    with xr.open_zarr(base_path) as base:
+        variables = variables or [v for v in base.data_vars if {"y", "x"} <= set(base[v].dims)]
+        methods = {v: (resampling or {}).get(v) or default_resampling(base[v]) for v in variables}
+        bad = {m for m in methods.values() if m not in RESAMPLING}
+        if bad:
+            raise ValueError(f"Unknown resampling {sorted(bad)}; expected one of {RESAMPLING}")
+        shape = (base.sizes["y"], base.sizes["x"])
+        levels = n_levels(shape, min_chunk) if levels is None else levels
+        bytes_per_pixel = sum(base[v].dtype.itemsize * base[v].size // (shape[0] * shape[1]) for v in variables)
+        tile = _tile(budget, bytes_per_pixel, min_chunk, tile)
+        attrs = {
+            "multiscales": [{
+                "datasets": [{"path": str(base_path.resolve()), "level": 0, "factor": 1}]
+                            + [{"path": str(k), "level": k, "factor": 2**k} for k in range(1, levels + 1)],
+                "resampling": methods,
+                "shape": list(shape),
+                "tile": tile,
+                "min_chunk": min_chunk,
+            }]
+        }
+
+        if regions is not None and not _matches(out_path, attrs):
+            logger.info(f"{out_path.name} does not match {base_path.name}; rebuilding all levels")
+            regions = None
+        if regions is None:
+            _write_templates(base, out_path, methods, levels, tile, min_chunk, attrs)
+        else:
+            regions = [(tuple(r["y"]), tuple(r["x"])) for r in regions]
+
+    n_tiles = 0
+    for source_level, written in pass_plan(levels, tile, min_chunk):
+        if source_level == 0:
+            source, group, source_shape, source_regions = str(base_path), None, shape, regions
+        else:
+            factor = 2**source_level
+            source, group = str(out_path), str(source_level)
+            source_shape = tuple(math.ceil(s / factor) for s in shape)
+            source_regions = None if regions is None else _coarsen_regions(regions, factor)
+        windows = tile_windows(source_shape, tile, source_regions)
+        n_tasks = max(1, min(len(windows), workers * 4))
+        groups = [windows[k::n_tasks] for k in range(n_tasks)]
+        n = sum(map_tasks(_pyramid_task, [(source, group, str(out_path), written, methods, g) for g in groups if g],
+                     workers))
+        logger.info(f"Levels {written[0]}-{written[-1]} of {out_path.name}: {n} tiles of level {source_level}")
+        n_tiles += n if source_level == 0 else 0
+    return n_tiles
+
+
+def _matches(out_path, attrs):
+    """Whether an existing pyramid store was built with the same grid and settings."""
+    if not Path(out_path).exists():
+        return False
+    with xr.open_zarr(out_path) as existing:
+        old = (existing.attrs.get("multiscales") or [{}])[0]
+    new = attrs["multiscales"][0]
+    return all(old.get(key) == new[key] for key in ("datasets", "resampling", "shape", "tile", "min_chunk"))
+
+
+def open_level(pyramid_path, level):
+    """Dataset of one pyramid level (0 opens the base store)."""
+    if level == 0:
+        with xr.open_zarr(pyramid_path) as root:
+            return xr.open_zarr(root.attrs["multiscales"][0]["datasets"][0]["path"])
+    return xr.open_zarr(pyramid_path, group=str(level))
+
+
+def run(cfg):
+    """
+    Multiscale overview pyramids of gridded outputs (trait maps, composites,
+    uncertainty layers...), for viewing and QA without reading every base
+    chunk.
+
+    Each input is read once, tile by tile; every tile is reduced 2x2 level
+    after level in memory and each level's block is written by region into
+    its group of the pyramid store, so tiles are processed independently in
+    a process pool. Levels coarser than the tile allows are built by the
+    same pass from the coarsest level written so far. Variables without y/x
+    dimensions are not included.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - pyramid:
+                - inputs: Zarr stores (list of paths and/or glob patterns)
+                - output_dir: directory of the pyramid stores (default: next
+                  to each input); a store is written as <name>_pyramid.zarr
+                - variables: variables to include (default: all on y/x)
+                - resampling: optional {variable: "mean"|"mode"|"nearest"}
+                  (default: mean for floats, mode for integers)
+                - levels: number of overview levels (default: until the
+                  coarsest level fits in one chunk)
+                - min_chunk: chunk side of the coarsest level of each pass
+                  (default 256)
+                - tile: base tile side read at once (default: from
+                  memory_budget, at most 2048)
+                - regions: optional list of {"y": [y0, y1], "x": [x0, x1]}
+                  base pixel bounds rewritten since the last build; only
+                  the tiles covering them are rebuilt
+                - workers: process count (default 1)
+            - memory_budget: optional memory limit, e.g. "8GB"
+    Returns:
+        List of pyramid store paths.
+    """
+    logger.info("Starting pyramid builder...")
+
+    pyr_cfg = cfg["pyramid"]
+    inputs = [pyr_cfg["inputs"]] if isinstance(pyr_cfg["inputs"], (str, Path)) else pyr_cfg["inputs"]
+    paths = []
+    for pattern in inputs:
+        paths += sorted(glob.glob(str(pattern))) or [str(pattern)]
+    workers = pyr_cfg.get("workers", 1)
+    budget = memory_budget(cfg)
+    if budget is not None:
+        budget //= max(workers, 1)
+
+    written = []
+    for path in paths:
+        path = Path(path)
+        out_dir = Path(pyr_cfg["output_dir"]) if pyr_cfg.get("output_dir") else path.parent
+        out_path = out_dir / f"{path.stem}_pyramid.zarr"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        t0 = time.perf_counter()
+        n = build_pyramid(path, out_path, variables=pyr_cfg.get("variables"),
+                          resampling=pyr_cfg.get("resampling"), levels=pyr_cfg.get("levels"),
+                          tile=pyr_cfg.get("tile"), min_chunk=pyr_cfg.get("min_chunk", MIN_CHUNK),
+                          regions=pyr_cfg.get("regions"), workers=workers, budget=budget)
+        logger.info(f"Built pyramid of {path.name} from {n} base tiles in {time.perf_counter() - t0:.1f}s "
+                    f"-> {out_path}")
+        written.append(out_path)
+    return written
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "pyramid": {
+            "inputs": ["data/predictions/agbd_uncertainty.zarr", "data/control/*_trends.zarr"],
+            "output_dir": "data/pyramids",
+            "resampling": {"mk_trend": "mode", "n_obs": "nearest"},
+            "workers": 4,
+        },
+        "memory_budget": "4GB",
+    }
+    run(dummy_cfg)
@@ -1,29 +1,56 @@
 # modules/step1_gedi/fetch.py
 
-import os
+import json
 import logging
 from pathlib import Path
-from harmony import Client  # assuming harmony-py is installed
-from datetime import datetime
+
+from .harmony import HARMONY_ROOT, LEDGER_NAME, job_specs, manager_from_cfg
 
 # Setup logger
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+
+def aoi_subset(aoi_path, use_shape=False):
+    """AOI as a (west, south, east, north) bbox and, with use_shape, a GeoJSON dict."""
+    import geopandas as gpd
+
+    gdf = gpd.read_file(aoi_path)
+    gdf = gdf.to_crs("EPSG:4326") if gdf.crs is not None else gdf.set_crs("EPSG:4326")
+    shape = json.loads(gdf.to_json()) if use_shape else None
+    return tuple(gdf.total_bounds), shape
+
+
 def run(cfg):
     """
     Fetch GEDI data for the specified AOI, products, fields, and timeframe.
 
+    Harmony subsets every product server-side to the AOI, the timeframe and
+    the requested fields, so only the matching shots are downloaded. One job
+    is submitted per product and time slice; jobs are polled concurrently
+    and their result files streamed to disk as soon as they are listed. Job
+    state is kept in a ledger in the output directory, so a rerun resumes
+    unfinished jobs and downloads instead of submitting again.
+
     Args:
         cfg: OmegaConf / dict-like configuration containing:
             - geography: path to AOI (GeoJSON/shapefile)
+            - input_dir: raw GEDI directory (results go to <input_dir>/<product>/)
             - gedi:
                 - products: list of GEDI short names, e.g., ["GEDI02_B", "GEDI02_A"]
                 - fields: list of fields to fetch, e.g., ["rh98", "pai", "fhd_normal"]
                 - filters: dict of filter parameters (quality_flag, sensitivity, etc.)
                 - timeframe: dict with 'start' and 'end' dates, e.g., {"start": "2019-01-01", "end": "2024-12-31"}
+                - harmony (optional):
+                    - root: Harmony URL (default https://harmony.earthdata.nasa.gov)
+                    - slice: pandas frequency of the time slices (default "MS", monthly)
+                    - shape: subset by the AOI polygon instead of its bbox (default False)
+                    - format: output MIME type (default: the service's native format)
+                    - max_jobs / max_downloads: concurrency limits (default 8 / 4)
+                    - poll_interval: seconds between job status requests (default 10)
+                    - timeout: seconds before a job is given up on (default 3600)
     Returns:
-        None (saves raw GEDI data to raw/ folder)
+        Dict of job key -> error for jobs that did not complete (rerun to resume).
     """
     logger.info("Starting GEDI fetch...")
 
@@ -32,8 +59,9 @@ def run(cfg):
     fields = cfg["gedi"]["fields"]
     filters = cfg["gedi"]["filters"]
     timeframe = cfg["gedi"]["timeframe"]
+    harmony_cfg = cfg["gedi"].get("harmony", {})
 
-    output_dir = Path("../../../data/raw/gedi")  # relative to module
+    output_dir = Path(cfg.get("input_dir", "data/raw/gedi"))
     output_dir.mkdir(parents=True, exist_ok=True)
 
     logger.info(f"AOI: {aoi_path}")
@@ -41,18 +69,19 @@ def run(cfg):
     logger.info(f"Fields: {fields}")
     logger.info(f"Filters: {filters}")
     logger.info(f"Timeframe: {timeframe}")
+    logger.info(f"Harmony: {harmony_cfg.get('root', HARMONY_ROOT)}")
     logger.info(f"Saving raw GEDI data to: {output_dir.resolve()}")
 
-    # Initialize Harmony client
-    client = Client()
+    bbox, shape = aoi_subset(aoi_path, use_shape=harmony_cfg.get("shape", False))
+    specs = job_specs(products, timeframe, variables=fields, bbox=bbox, shape=shape,
+                      freq=harmony_cfg.get("slice", "MS"), output_format=harmony_cfg.get("format"))
+    logger.info(f"{len(specs)} subsetting jobs ({len(products)} products)")
 
-    for product in products:
-        logger.info(f"Fetching GEDI product: {product}")
-        # TODO: replace with actual Harmony API call
-        # Example: result = client.query(product, aoi_path, start_date, end_date, fields)
-        # Save to file
-        filename = output_dir / f"{product}_{timeframe['start']}_{timeframe['end']}.parquet"
-        # TODO: save 'result' to filename
-        logger.info(f"Fetched data for {product} would be saved to {filename}")
+    manager = manager_from_cfg(harmony_cfg, output_dir)
+    failed = manager.run(specs)
 
+    logger.info(f"Job states: {manager.ledger.summary()} (ledger: {output_dir / LEDGER_NAME})")
+    if failed:
+        logger.warning(f"{len(failed)} job(s) did not complete; rerun to resume them.")
     logger.info("GEDI fetch completed.")
+    return failed
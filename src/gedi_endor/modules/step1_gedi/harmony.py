@@ -0,0 +1,318 @@
+# modules/step1_gedi/harmony.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+HARMONY_ROOT = "https://harmony.earthdata.nasa.gov"
+
+# Harmony job states after which a job's links no longer change; jobs that
+# ended without results are submitted again by the next run
+TERMINAL_STATES = ("successful", "complete_with_errors", "failed", "canceled")
+DONE_STATES = ("successful", "complete_with_errors")
+
+LEDGER_NAME = "_harmony_jobs.json"
+
+
+# -----------------------------
+# Job specs
+# -----------------------------
+def time_slices(start, end, freq="MS"):
+    """
+    Split [start, end] into consecutive (start, end) ISO date pairs at `freq`
+    boundaries (pandas offset alias, default month start).
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    edges = [start] + [t for t in pd.date_range(start, end, freq=freq) if t > start] + [end + pd.Timedelta(days=1)]
+    return [(a.strftime("%Y-%m-%d"), (b - pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+            for a, b in zip(edges[:-1], edges[1:])]
+
+
+def job_specs(products, timeframe, variables=None, bbox=None, shape=None, freq="MS", output_format=None):
+    """
+    One subsetting job per product and time slice.
+
+    Returns:
+        List of spec dicts with a stable `key` (product + slice) used by the ledger.
+    """
+    specs = []
+    for product in products:
+        for start, end in time_slices(timeframe["start"], timeframe["end"], freq):
+            specs.append({
+                "key": f"{product}_{start}_{end}",
+                "product": product,
+                "start": start,
+                "end": end,
+                "variables": list(variables or []),
+                "bbox": list(bbox) if bbox is not None else None,
+                "shape": shape,
+                "format": output_format,
+            })
+    return specs
+
+
+# -----------------------------
+# Job ledger
+# -----------------------------
+class JobLedger:
+    """
+    Persisted state of every job of a fetch, keyed by spec key:
+        job_id, status, progress, message, and files {name: {"url", "done"}}.
+
+    The ledger is rewritten atomically after every change, so an interrupted
+    run resumes by polling the jobs it had submitted and downloading only
+    the files not marked done, instead of submitting again.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.jobs = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.jobs = json.load(f)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.jobs, f, indent=1)
+        tmp.replace(self.path)
+
+    def entry(self, key):
+        return self.jobs.setdefault(key, {"job_id": None, "status": None, "progress": 0, "files": {}})
+
+    def is_complete(self, key):
+        job = self.jobs.get(key)
+        return (job is not None and job["status"] in DONE_STATES
+                and all(f["done"] for f in job["files"].values()))
+
+    def summary(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+
+# -----------------------------
+# Job manager
+# -----------------------------
+class HarmonyJobManager:
+    """
+    Submits Harmony subsetting jobs, polls them concurrently and streams their
+    result files to disk as soon as Harmony lists them.
+
+    All jobs run on one asyncio event loop with one HTTP session: at most
+    `max_jobs` jobs are in flight (submitted and being polled) and at most
+    `max_downloads` files are downloaded at once. Downloads start while a
+    job is still running, as Harmony adds result links granule by granule.
+
+    Args:
+        output_dir: directory for result files (one sub-directory per product)
+        ledger: JobLedger
+        root: Harmony root URL (a local mock for tests, see harmony_mock.py)
+        token: Earthdata bearer token; otherwise username/password basic auth
+        max_jobs / max_downloads: concurrency limits
+        poll_interval: seconds between status requests of a job
+        chunk_size: bytes per streamed download read
+    """
+
+    def __init__(self, output_dir, ledger, root=HARMONY_ROOT, token=None, username=None, password=None,
+                 max_jobs=8, max_downloads=4, poll_interval=10.0, timeout=3600.0, chunk_size=1 << 20):
+        self.output_dir = Path(output_dir)
+        self.ledger = ledger
+        self.root = root.rstrip("/")
+        self.token = token
+        self.username = username
+        self.password = password
+        self.max_jobs = max_jobs
+        self.max_downloads = max_downloads
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    # ---- HTTP ----
+    def _session(self):
+        import aiohttp
+
+        headers, auth = {}, None
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        elif self.username and self.password:
+            auth = aiohttp.BasicAuth(self.username, self.password)
+        return aiohttp.ClientSession(headers=headers, auth=auth, raise_for_status=True,
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_read=300))
+
+    def _request(self, spec):
+        """(method, url, params, form) of the OGC coverages request for a spec."""
+        collections = "parameter_vars" if spec["variables"] else "all"
+        url = f"{self.root}/{spec['product']}/ogc-api-coverages/1.0.0/collections/{collections}/coverage/rangeset"
+        params = [("forceAsync", "true"), ("subset", f'time("{spec["start"]}T00:00:00Z":"{spec["end"]}T23:59:59Z")')]
+        params += [("variable", v) for v in spec["variables"]]
+        if spec["bbox"] is not None:
+            west, south, east, north = spec["bbox"]
+            params += [("subset", f"lon({west}:{east})"), ("subset", f"lat({south}:{north})")]
+        if spec.get("format"):
+            params.append(("format", spec["format"]))
+        if spec.get("shape") is None:
+            return "GET", url, params, None
+
+        import aiohttp
+
+        form = aiohttp.FormData()
+        for name, value in params:
+            form.add_field(name, value)
+        form.add_field("shapefile", json.dumps(spec["shape"]), filename="aoi.geojson",
+                       content_type="application/geo+json")
+        return "POST", url, None, form
+
+    async def submit(self, session, spec):
+        method, url, params, form = self._request(spec)
+        async with session.request(method, url, params=params, data=form) as resp:
+            job = await resp.json()
+        logger.info(f"{spec['key']}: submitted job {job['jobID']}")
+        return job
+
+    async def status(self, session, job_id):
+        """Job status with the data links of every result page."""
+        url = f"{self.root}/jobs/{job_id}"
+        async with session.get(url) as resp:
+            job = await resp.json()
+        links = list(job.get("links", []))
+        next_page = next((l["href"] for l in links if l.get("rel") == "next"), None)
+        while next_page:
+            async with session.get(next_page) as resp:
+                page = await resp.json()
+            links += page.get("links", [])
+            next_page = next((l["href"] for l in page.get("links", []) if l.get("rel") == "next"), None)
+        job["data_links"] = [l["href"] for l in links if l.get("rel") == "data"]
+        return job
+
+    async def download(self, session, url, dest):
+        """Stream `url` to `dest` through a .part file renamed on completion."""
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(dest.name + ".part")
+        async with session.get(url) as resp:
+            with open(tmp, "wb") as f:
+                async for block in resp.content.iter_chunked(self.chunk_size):
+                    f.write(block)
+        tmp.replace(dest)
+
+    # ---- Per job ----
+    async def _fetch_file(self, session, key, name, url, download_slots):
+        entry = self.ledger.entry(key)
+        dest = self.output_dir / entry["product"] / name
+        async with download_slots:
+            if not dest.exists():
+                await self.download(session, url, dest)
+                logger.info(f"{key}: downloaded {name}")
+        entry["files"][name]["done"] = True
+        self.ledger.save()
+
+    async def _poll(self, session, key, entry, download_slots, downloads):
+        """Poll a job until it ends, queueing a download for every newly listed result."""
+        queued = set()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            job = await self.status(session, entry["job_id"])
+            entry.update(status=job.get("status"), progress=job.get("progress", 0), message=job.get("message"))
+            for url in job["data_links"]:
+                name = Path(urlparse(url).path).name
+                if name not in entry["files"]:
+                    entry["files"][name] = {"url": url, "done": False}
+            for name, f in entry["files"].items():
+                if not f["done"] and name not in queued:
+                    queued.add(name)
+                    downloads.append(asyncio.create_task(
+                        self._fetch_file(session, key, name, f["url"], download_slots)))
+            self.ledger.save()
+            if entry["status"] in TERMINAL_STATES:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{key}: job {entry['job_id']} still {entry['status']} after {self.timeout}s")
+            await asyncio.sleep(self.poll_interval)
+
+    async def run_job(self, session, spec, job_slots, download_slots):
+        """Submit (or resume) one job, poll it and download its results."""
+        key = spec["key"]
+        entry = self.ledger.entry(key)
+        entry["product"] = spec["product"]
+        downloads = []
+
+        try:
+            async with job_slots:
+                if entry["status"] in TERMINAL_STATES and entry["status"] not in DONE_STATES:
+                    entry.update(job_id=None, files={})
+                if entry["job_id"] is None:
+                    job = await self.submit(session, spec)
+                    entry.update(job_id=job["jobID"], status=job.get("status"), submitted=time.time())
+                    self.ledger.save()
+                else:
+                    logger.info(f"{key}: resuming job {entry['job_id']} ({entry['status']})")
+                await self._poll(session, key, entry, download_slots, downloads)
+            # The job slot is free again while its last downloads finish
+            await asyncio.gather(*downloads)
+        except BaseException:
+            for task in downloads:
+                task.cancel()
+            raise
+
+        if entry["status"] != "successful":
+            logger.warning(f"{key}: job {entry['job_id']} ended {entry['status']}: {entry.get('message')}")
+        else:
+            logger.info(f"{key}: {len(entry['files'])} file(s) complete")
+        return entry
+
+    async def run_async(self, specs):
+        job_slots = asyncio.Semaphore(self.max_jobs)
+        download_slots = asyncio.Semaphore(self.max_downloads)
+        pending = [s for s in specs if not self.ledger.is_complete(s["key"])]
+        logger.info(f"{len(specs) - len(pending)} job(s) already complete, {len(pending)} to run")
+        async with self._session() as session:
+            results = await asyncio.gather(
+                *(self.run_job(session, spec, job_slots, download_slots) for spec in pending),
+                return_exceptions=True,
+            )
+        failed = {}
+        for spec, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(f"{spec['key']}: {result!r}")
+                failed[spec["key"]] = repr(result)
+            elif result["status"] not in DONE_STATES:
+                failed[spec["key"]] = f"{result['status']}: {result.get('message')}"
+        return failed
+
+    def run(self, specs):
+        """
+        Run every spec not yet complete in the ledger.
+
+        Returns:
+            Dict of spec key -> error for jobs that raised or ended without
+            results (they stay in the ledger and are resumed or resubmitted
+            by the next run).
+        """
+        return asyncio.run(self.run_async(specs))
+
+
+def manager_from_cfg(harmony_cfg, output_dir):
+    """HarmonyJobManager with options from cfg["gedi"]["harmony"] and Earthdata credentials from the environment."""
+    return HarmonyJobManager(
+        output_dir,
+        JobLedger(Path(output_dir) / LEDGER_NAME),
+        root=harmony_cfg.get("root", HARMONY_ROOT),
+        token=os.getenv("EARTHDATA_TOKEN"),
+        username=os.getenv("EARTHDATA_USERNAME"),
+        password=os.getenv("EARTHDATA_PASSWORD"),
+        max_jobs=harmony_cfg.get("max_jobs", 8),
+        max_downloads=harmony_cfg.get("max_downloads", 4),
+        poll_interval=harmony_cfg.get("poll_interval", 10.0),
+        timeout=harmony_cfg.get("timeout", 3600.0),
+    )
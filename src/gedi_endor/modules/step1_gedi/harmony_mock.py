@@ -0,0 +1,143 @@
+# modules/step1_gedi/harmony_mock.py
+
+import asyncio
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+class MockHarmony:
+    """
+    Local stand-in for the Harmony API, for testing HarmonyJobManager
+    without Earthdata credentials or network access.
+
+    Serves the endpoints the manager uses:
+        GET/POST /{collection}/ogc-api-coverages/1.0.0/collections/{vars}/coverage/rangeset
+        GET      /jobs/{job_id}           (results paged `page_size` links at a time)
+        GET      /results/{job_id}/{name}
+    Every status request of a job advances it by one granule, so results
+    appear while the job is still running. Submitted requests are kept in
+    `requests` for assertions.
+
+    Args:
+        granules_per_job: result files per job
+        file_size: bytes per result file
+        fail_products: collections whose jobs end "failed"
+        page_size: data links per status page
+    """
+
+    def __init__(self, granules_per_job=3, file_size=1 << 16, fail_products=(), page_size=2):
+        self.granules_per_job = granules_per_job
+        self.file_size = file_size
+        self.fail_products = set(fail_products)
+        self.page_size = page_size
+        self.jobs = {}
+        self.requests = []
+        self.downloads = []
+        self._runner = None
+        self.url = None
+
+    def _job_json(self, request, job_id, page=1):
+        job = self.jobs[job_id]
+        base = str(request.url.origin())
+        names = [f"{job['product']}_{job_id[:8]}_{i:03d}.h5" for i in range(job["done"])]
+        start = (page - 1) * self.page_size
+        links = [{"href": f"{base}/results/{job_id}/{n}", "rel": "data", "title": n,
+                  "type": "application/x-hdf5"} for n in names[start:start + self.page_size]]
+        if start + self.page_size < len(names):
+            links.append({"href": f"{base}/jobs/{job_id}?page={page + 1}", "rel": "next"})
+        return {
+            "jobID": job_id,
+            "status": job["status"],
+            "progress": int(100 * job["done"] / self.granules_per_job),
+            "message": job["message"],
+            "links": links,
+        }
+
+    async def _submit(self, request):
+        from aiohttp import web
+
+        params = list(request.query.items())
+        if request.method == "POST":
+            form = await request.post()
+            params += [(k, v if isinstance(v, str) else v.file.read().decode()) for k, v in form.items()]
+        job_id = str(uuid.uuid4())
+        product = request.match_info["collection"]
+        self.jobs[job_id] = {"product": product, "status": "running", "done": 0, "message": "The job is being processed"}
+        self.requests.append({"job_id": job_id, "product": product, "variables": request.match_info["variables"],
+                              "method": request.method, "params": params})
+        return web.json_response(self._job_json(request, job_id))
+
+    async def _status(self, request):
+        from aiohttp import web
+
+        job_id = request.match_info["job_id"]
+        if job_id not in self.jobs:
+            raise web.HTTPNotFound()
+        page = int(request.query.get("page", 1))
+        job = self.jobs[job_id]
+        if page == 1 and job["status"] == "running":
+            if job["product"] in self.fail_products:
+                job.update(status="failed", message="Mock failure")
+            else:
+                job["done"] = min(job["done"] + 1, self.granules_per_job)
+                if job["done"] == self.granules_per_job:
+                    job.update(status="successful", message="The job has completed successfully")
+        return web.json_response(self._job_json(request, job_id, page))
+
+    async def _result(self, request):
+        from aiohttp import web
+
+        self.downloads.append(request.match_info["name"])
+        return web.Response(body=b"\0" * self.file_size, content_type="application/x-hdf5")
+
+    async def start(self, host="127.0.0.1", port=0):
+        from aiohttp import web
+
+        app = web.Application()
+        rangeset = "/{collection}/ogc-api-coverages/1.0.0/collections/{variables}/coverage/rangeset"
+        app.router.add_get(rangeset, self._submit)
+        app.router.add_post(rangeset, self._submit)
+        app.router.add_get("/jobs/{job_id}", self._status)
+        app.router.add_get("/results/{job_id}/{name}", self._result)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        logger.info(f"Mock Harmony listening on {self.url}")
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def demo(output_dir="data/raw/gedi_mock", products=("GEDI02_A", "GEDI02_B")):
+    """Run the job manager end to end against the mock (used as a smoke test)."""
+    from step1_gedi.harmony import HarmonyJobManager, JobLedger, LEDGER_NAME, job_specs
+
+    async def main():
+        mock = MockHarmony()
+        root = await mock.start()
+        try:
+            manager = HarmonyJobManager(output_dir, JobLedger(f"{output_dir}/{LEDGER_NAME}"), root=root,
+                                        poll_interval=0.05)
+            specs = job_specs(products, {"start": "2019-04-01", "end": "2019-06-30"},
+                              variables=["rh", "quality_flag"], bbox=(-106, 39, -104, 41))
+            failed = await manager.run_async(specs)
+        finally:
+            await mock.stop()
+        logger.info(f"{len(mock.requests)} jobs, {len(mock.downloads)} downloads, failed: {failed}")
+        return mock, failed
+
+    return asyncio.run(main())
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step1_gedi.harmony_mock
+    demo()
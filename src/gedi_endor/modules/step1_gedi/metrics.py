@@ -0,0 +1,233 @@
+# modules/step1_gedi/metrics.py
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Beer-Lambert extinction coefficient used by the GEDI L2B cover product
+GEDI_K = 0.5
+
+
+# -----------------------------
+# Profile columns
+# -----------------------------
+def profile_matrix(column, dtype=np.float32):
+    """
+    View a fixed-size-list column (e.g. rh, pavd_z, pai_z) as a 2-D array.
+
+    Returns:
+        (n_shots, profile_length) array of `dtype`; null profiles are NaN rows.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    k = column.type.list_size
+    values = column.values.slice(column.offset * k, len(column) * k)
+    out = values.to_numpy(zero_copy_only=False).astype(dtype, copy=False).reshape(len(column), k)
+    if column.null_count:
+        out = out.copy()
+        out[column.is_null().to_numpy(zero_copy_only=False)] = np.nan
+    return out
+
+
+# -----------------------------
+# RH metrics
+# -----------------------------
+def rh_at(rh, q):
+    """
+    Relative height at any percentile, interpolated between the 101 RH values.
+
+    Args:
+        rh: (n, 101) RH profile
+        q: percentile or sequence of percentiles in [0, 100]
+
+    Returns:
+        (n,) for a scalar q, (n, len(q)) otherwise.
+    """
+    q_arr = np.clip(np.atleast_1d(np.asarray(q, dtype=np.float64)), 0, 100)
+    lo = np.floor(q_arr).astype(np.int64)
+    hi = np.minimum(lo + 1, 100)
+    frac = (q_arr - lo).astype(rh.dtype)
+    out = rh[:, lo] * (1 - frac) + rh[:, hi] * frac
+    return out[:, 0] if np.ndim(q) == 0 else out
+
+
+def energy_above(rh, height):
+    """
+    Canopy cover proxy from RH: fraction of waveform energy returned above `height` m.
+
+    The percentile at which the (monotonic) RH profile crosses `height` is
+    found per shot by counting and interpolating, without a per-shot search.
+    """
+    n, k = rh.shape
+    idx = (rh <= height).sum(axis=1)
+    lo = np.clip(idx - 1, 0, k - 1)
+    hi = np.clip(idx, 0, k - 1)
+    rows = np.arange(n)
+    h_lo, h_hi = rh[rows, lo], rh[rows, hi]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        step = np.where(h_hi > h_lo, (height - h_lo) / (h_hi - h_lo), 0.0)
+    pct = np.where(idx == 0, 0.0, np.where(idx >= k, k - 1, lo + np.clip(step, 0, 1)))
+    out = 1.0 - pct / (k - 1)
+    return np.where(np.isnan(rh).any(axis=1), np.nan, out).astype(np.float32)
+
+
+def rh_entropy(rh, dz=1.0):
+    """
+    Entropy of the vertical energy distribution implied by an RH profile.
+
+    Each of the 100 intervals between consecutive percentiles carries 1% of
+    the energy and falls in the dz-thick height bin of its midpoint (heights
+    below ground go to the first bin). RH is monotonic, so the bins of a shot
+    are sorted and the energy per bin is the length of each run of equal bin
+    indices; runs are found for all shots at once on the flattened array.
+    """
+    n, k = rh.shape
+    mid = 0.5 * (rh[:, 1:] + rh[:, :-1])
+    bins = (np.fmax(mid, 0) / dz).astype(np.int32)
+    starts = np.ones(bins.shape, dtype=bool)
+    starts[:, 1:] = bins[:, 1:] != bins[:, :-1]
+    pos = np.flatnonzero(starts)
+    run_length = np.diff(np.append(pos, bins.size))
+    # -p ln p for every possible run length, looked up instead of recomputed
+    p = np.arange(1, k) / (k - 1)
+    plogp = np.concatenate([[0.0], -p * np.log(p)])
+    h = np.bincount(pos // (k - 1), weights=plogp[run_length], minlength=n)
+    return np.where(np.isnan(mid).any(axis=1), np.nan, h).astype(np.float32)
+
+
+# -----------------------------
+# Profile diversity and cover
+# -----------------------------
+def profile_entropy(profile):
+    """
+    Shannon entropy of each row of a non-negative vertical profile.
+
+    Applied to pavd_z this is the foliage height diversity (FHD) index.
+    Negative and NaN values count as zero; empty profiles give NaN.
+    """
+    p = np.where(np.isfinite(profile) & (profile > 0), profile, 0).astype(np.float32)
+    total = p.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p /= total
+        h = -(p * np.log(p, out=np.zeros_like(p), where=p > 0)).sum(axis=1)
+    return np.where(total[:, 0] > 0, h, np.nan).astype(np.float32)
+
+
+def cover_from_pai(pai, k=GEDI_K):
+    """Canopy cover from plant area index, 1 - exp(-k * PAI); works on pai or pai_z."""
+    return (1.0 - np.exp(-k * np.clip(pai, 0, None))).astype(np.float32)
+
+
+def metric_name(prefix, value, unit=""):
+    """Column name for a parametrised metric, e.g. rh97.5 -> rh97_5."""
+    return f"{prefix}{value:g}{unit}".replace(".", "_")
+
+
+def derive_metrics(table, metrics_cfg):
+    """
+    Compute derived metrics for every shot of an Arrow table.
+
+    Returns:
+        dict of column name -> float32 array.
+    """
+    out = {}
+    rh_col = metrics_cfg.get("rh_column", "rh")
+    if rh_col in table.column_names:
+        rh = profile_matrix(table[rh_col])
+        percentiles = metrics_cfg.get("percentiles", [])
+        if percentiles:
+            values = rh_at(rh, percentiles)
+            for j, q in enumerate(percentiles):
+                out[metric_name("rh", q)] = values[:, j].astype(np.float32)
+        for h in metrics_cfg.get("cover_heights", []):
+            out[metric_name("cover_above_", h, "m")] = energy_above(rh, h)
+        if metrics_cfg.get("rh_entropy", False):
+            out["entropy_rh"] = rh_entropy(rh, dz=metrics_cfg.get("dz", 1.0))
+
+    k = metrics_cfg.get("k", GEDI_K)
+    pavd_col = metrics_cfg.get("pavd_column", "pavd_z")
+    if pavd_col in table.column_names:
+        out["fhd_pavd"] = profile_entropy(profile_matrix(table[pavd_col]))
+    pai_z_col = metrics_cfg.get("pai_z_column", "pai_z")
+    if pai_z_col in table.column_names:
+        pai_z = profile_matrix(table[pai_z_col])
+        # pai_z is cumulative from the top of the canopy down to each height
+        out["cover_pai"] = cover_from_pai(pai_z[:, 0], k)
+        for h in metrics_cfg.get("cover_z_heights", []):
+            i = int(h // metrics_cfg.get("pai_z_dz", 5.0))
+            if i < pai_z.shape[1]:
+                out[metric_name("cover_z", h, "m")] = cover_from_pai(pai_z[:, i], k)
+    return out
+
+
+def run(cfg):
+    """
+    Derive RH, cover and profile-diversity metrics from GEDI profile columns.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - gedi.metrics:
+                - input: GEDI Parquet file or directory with profile columns
+                - output: output directory (one part-*.parquet per batch)
+                - percentiles: RH percentiles to derive, e.g. [25, 50, 97.5]
+                - cover_heights: heights (m) for energy-above-height cover proxies
+                - rh_entropy: add the entropy of the RH energy profile (default False)
+                - dz: bin size (m) for rh_entropy (default 1.0)
+                - cover_z_heights: heights (m) for cover from pai_z (pai_z_dz default 5.0)
+                - rh_column / pavd_column / pai_z_column: default rh / pavd_z / pai_z
+                - k: extinction coefficient (default 0.5)
+                - batch_size: shots per batch (default 500,000)
+    Returns:
+        Path to the output dataset directory.
+    """
+    logger.info("Starting GEDI metric derivation...")
+
+    metrics_cfg = cfg["gedi"]["metrics"]
+    batch_size = metrics_cfg.get("batch_size", 500_000)
+    output_dir = Path(metrics_cfg["output"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    dataset = pads.dataset(str(metrics_cfg["input"]), format="parquet")
+    wanted = ["shot_number"] + [
+        metrics_cfg.get(key, default)
+        for key, default in (("rh_column", "rh"), ("pavd_column", "pavd_z"), ("pai_z_column", "pai_z"))
+    ]
+    columns = [c for c in wanted if c in dataset.schema.names]
+    logger.info(f"Reading {columns} in batches of {batch_size}")
+
+    n_total = 0
+    for part, batch in enumerate(dataset.to_batches(columns=columns, batch_size=batch_size)):
+        table = pa.Table.from_batches([batch])
+        derived = derive_metrics(table, metrics_cfg)
+        out = {"shot_number": table["shot_number"]}
+        out.update({name: pa.array(values) for name, values in derived.items()})
+
+        out_file = output_dir / f"part-{part:05d}.parquet"
+        pq.write_table(pa.table(out), out_file)
+        n_total += table.num_rows
+        logger.info(f"Wrote {table.num_rows} shots ({len(derived)} metrics) to {out_file}")
+
+    logger.info(f"GEDI metric derivation completed: {n_total} shots -> {output_dir}")
+    return output_dir
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "gedi": {
+            "metrics": {
+                "input": "data/processed/eo/gedi/GEDI_L2A",
+                "output": "data/processed/eo/gedi/metrics",
+                "percentiles": [25, 50, 75, 95, 98],
+                "cover_heights": [2, 5],
+                "rh_entropy": True,
+            }
+        }
+    }
+    run(dummy_cfg)
@@ -1,12 +1,216 @@
 # modules/step1_gedi/stage.py
 
 import logging
+import re
 from pathlib import Path
-import pandas as pd
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# Orbit + sub-orbit granule id shared by the L2A/L2B/L4A files of one granule,
+# e.g. GEDI02_A_2019108002011_O01959_01_T03909_02_003_01_V002 -> O01959_01
+GRANULE_KEY = re.compile(r"_(O\d+_\d+)_")
+
+# Float columns kept in float64 when downcasting (geolocation and time need it)
+FLOAT64_COLUMNS = re.compile(r"(lat|lon|delta_time)")
+
+
+def read_projected(file, columns):
+    """Read only the requested columns that exist in a Parquet file."""
+    available = set(pq.read_schema(file).names)
+    return pq.read_table(file, columns=[c for c in columns if c in available])
+
+
+# -----------------------------
+# Product join
+# -----------------------------
+def granule_key(path):
+    match = GRANULE_KEY.search(Path(path).name)
+    return match.group(1) if match else Path(path).stem
+
+
+def discover_granules(input_dir, products):
+    """
+    Group Parquet files of several products by granule.
+
+    Returns:
+        Dict of granule key -> {product: path}, in granule key order.
+    """
+    granules = {}
+    for product in products:
+        for file in sorted((Path(input_dir) / product).glob("*.parquet")):
+            granules.setdefault(granule_key(file), {})[product] = file
+    return dict(sorted(granules.items()))
+
+
+def match_sorted(left_keys, right_keys):
+    """
+    Merge step of a sorted-merge join on unique keys.
+
+    Args:
+        left_keys, right_keys: sorted uint64 key arrays.
+
+    Returns:
+        int64 positions into right_keys for every left key, -1 where absent.
+    """
+    if len(right_keys) == 0:
+        return np.full(len(left_keys), -1, dtype=np.int64)
+    pos = np.searchsorted(right_keys, left_keys)
+    pos = np.minimum(pos, len(right_keys) - 1)
+    return np.where(right_keys[pos] == left_keys, pos, -1)
+
+
+def sort_by_shot(table):
+    keys = table.column("shot_number").to_numpy()
+    order = np.argsort(keys, kind="stable")
+    return table.take(pa.array(order)), keys[order]
+
+
+def target_type(field, col_min, col_max):
+    """Compact Arrow type for a column given its global min/max."""
+    t = field.type
+    if field.name == "shot_number":
+        return pa.uint64()
+    if pa.types.is_floating(t):
+        return pa.float64() if FLOAT64_COLUMNS.search(field.name) else pa.float32()
+    if pa.types.is_integer(t) and col_min is not None:
+        for candidate in (pa.uint8(), pa.uint16(), pa.uint32(), pa.int8(), pa.int16(), pa.int32()):
+            info = np.iinfo(candidate.to_pandas_dtype())
+            if info.min <= col_min and col_max <= info.max:
+                return candidate
+    return t
+
+
+def plan_schema(granules, product_columns):
+    """
+    Decide the output schema from Parquet footers only (no data is read):
+    column order follows the product order, columns repeated in later
+    products are taken from the first one, integers get the smallest type
+    that fits the min/max statistics of every row group. A column missing
+    statistics in any row group keeps its source type.
+    """
+    fields, seen = [], set()
+    for product, columns in product_columns.items():
+        stats, unknown, schema = {}, set(), None
+        for files in granules.values():
+            if product not in files:
+                continue
+            meta = pq.ParquetFile(files[product]).metadata
+            schema = schema or meta.schema.to_arrow_schema()
+            for rg in range(meta.num_row_groups):
+                row_group = meta.row_group(rg)
+                for ci in range(row_group.num_columns):
+                    col = row_group.column(ci)
+                    name = col.path_in_schema
+                    s = col.statistics
+                    if s is None or not s.has_min_max:
+                        unknown.add(name)
+                        continue
+                    if not isinstance(s.min, (int, np.integer)):
+                        continue
+                    lo, hi = stats.get(name, (s.min, s.max))
+                    stats[name] = (min(lo, s.min), max(hi, s.max))
+        if schema is None:
+            logger.warning(f"No files found for {product}")
+            continue
+        for name in columns:
+            if name in seen or name not in schema.names:
+                continue
+            seen.add(name)
+            lo, hi = (None, None) if name in unknown else stats.get(name, (None, None))
+            fields.append(pa.field(name, target_type(schema.field(name), lo, hi)))
+    if "shot_number" not in seen:
+        fields.insert(0, pa.field("shot_number", pa.uint64()))
+    return pa.schema(fields)
+
+
+def join_granule(files, product_columns, schema, how="inner"):
+    """
+    Join the products of one granule on shot_number.
+
+    The first product listed is the left side; with how="inner" only shots
+    present in every product are kept, with how="left" missing values are null.
+    """
+    products = [p for p in product_columns if p in files]
+    base = products[0]
+    left, left_keys = sort_by_shot(read_projected(files[base], ["shot_number"] + product_columns[base]))
+    columns = {name: left.column(name) for name in left.column_names}
+
+    keep = np.ones(len(left_keys), dtype=bool)
+    for product in products[1:]:
+        wanted = [c for c in product_columns[product] if c not in columns]
+        right, right_keys = sort_by_shot(read_projected(files[product], ["shot_number"] + wanted))
+        pos = match_sorted(left_keys, right_keys)
+        found = pos >= 0
+        keep &= found
+        take = pa.array(np.where(found, pos, 0), mask=~found)
+        for name in wanted:
+            if name in right.column_names:
+                columns[name] = right.column(name).take(take)
+
+    missing = [p for p in product_columns if p not in files]
+    if how == "inner" and missing:
+        keep[:] = False
+
+    table = pa.table({f.name: columns[f.name] if f.name in columns else pa.nulls(len(left_keys), f.type)
+                      for f in schema})
+    if how == "inner":
+        table = table.filter(pa.array(keep))
+    return table.cast(schema)
+
+
+def run_join(cfg):
+    """
+    Stage GEDI L2A/L2B/L4A as one analysis-ready table joined on shot_number.
+
+    Granules are processed one at a time: each product's Parquet file is
+    read with column projection, sorted by shot_number and merged, and the
+    result is appended to a single Parquet file with a compact, fixed schema.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - input_dir: filtered GEDI data, one sub-directory per product
+            - stage_dir: output directory
+            - gedi.join:
+                - products: dict of product -> list of columns to keep
+                - how: "inner" (default) or "left" (first product is left side)
+                - output: output file name (default "gedi_joined.parquet")
+    Returns:
+        Path to the joined Parquet file.
+    """
+    join_cfg = cfg["gedi"]["join"]
+    product_columns = join_cfg["products"]
+    how = join_cfg.get("how", "inner")
+    output_dir = Path(cfg["stage_dir"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir / join_cfg.get("output", "gedi_joined.parquet")
+
+    granules = discover_granules(cfg["input_dir"], product_columns)
+    logger.info(f"Joining {list(product_columns)} over {len(granules)} granules ({how})")
+    schema = plan_schema(granules, product_columns)
+    logger.info(f"Output schema: {schema}")
+
+    n_rows = 0
+    with pq.ParquetWriter(output_file, schema) as writer:
+        for key, files in granules.items():
+            if how == "inner" and len(files) < len(product_columns):
+                logger.warning(f"Granule {key} lacks {set(product_columns) - set(files)}, skipping.")
+                continue
+            if how == "left" and next(iter(product_columns)) not in files:
+                continue
+            table = join_granule(files, product_columns, schema, how=how)
+            writer.write_table(table)
+            n_rows += table.num_rows
+            logger.info(f"Granule {key}: {table.num_rows} joined shots")
+
+    logger.info(f"Staged {n_rows} shots to {output_file}")
+    return output_file
+
+
 def run(cfg):
     """
     Stage GEDI data: select fields and save ready for downstream processing.
@@ -16,12 +220,18 @@ def run(cfg):
             - input_dir: path to filtered GEDI data
             - stage_dir: path to save staged GEDI data
             - gedi.fields: list of fields to retain
+            - gedi.join: optional product join spec (see run_join)
             - naming_convention: string template for output filenames
     Returns:
         None (saves staged GEDI data)
     """
     logger.info("Starting GEDI staging...")
 
+    if "join" in cfg["gedi"]:
+        run_join(cfg)
+        logger.info("GEDI staging completed.")
+        return
+
     input_dir = Path(cfg["input_dir"])
     output_dir = Path(cfg["stage_dir"])
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -35,10 +245,8 @@ def run(cfg):
 
     for file in input_dir.glob("*.parquet"):
         logger.info(f"Processing file: {file.name}")
-        df = pd.read_parquet(file)
-
-        # Keep only the requested fields if they exist in the dataframe
-        df_staged = df[[col for col in fields_to_retain if col in df.columns]]
+        # Keep only the requested fields if they exist in the file
+        df_staged = read_projected(file, fields_to_retain).to_pandas()
 
         # Build output filename
         product_name = file.stem.split("_")[0]
@@ -0,0 +1,252 @@
+# modules/step2_eo/aoi.py
+
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import shapely
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# (lat, lon) column pairs used by the GEDI products, in order of preference;
+# each may also appear under a "geolocation/" prefix
+LAT_LON_COLUMNS = [
+    ("lat_lowestmode", "lon_lowestmode"),            # L2A, L2B, L4A
+    ("latitude_bin0", "longitude_bin0"),             # L1B
+    ("latitude_lastbin", "longitude_lastbin"),       # L1B
+    ("lat_highestreturn", "lon_highestreturn"),      # L2A
+    ("latitude", "longitude"),
+    ("lat", "lon"),
+]
+
+# Rasterized AOI masks kept per run (one per distinct target grid), and AOI
+# contexts kept per process (a batch run goes through one AOI after another)
+MASK_CACHE_SIZE = 32
+CONTEXT_CACHE_SIZE = 4
+
+# Above this many polygon parts, candidates are found with a longitude sweep
+# instead of scanning every point against every part's bounding box
+SWEEP_MIN_PARTS = 8
+
+
+def find_lat_lon(columns):
+    """Return the (lat, lon) column names present in `columns`, or None."""
+    columns = set(columns)
+    for lat, lon in LAT_LON_COLUMNS:
+        for prefix in ("", "geolocation/"):
+            if prefix + lat in columns and prefix + lon in columns:
+                return prefix + lat, prefix + lon
+    return None
+
+
+class AOIPointFilter:
+    """
+    Exact point-in-AOI test for large coordinate arrays.
+
+    The AOI is split into its polygon parts, each prepared once. Points are
+    first cut down with the AOI bounding box, then matched to the parts
+    whose bounding boxes hold them, and only those candidates go through
+    shapely's vectorized contains_xy. For many-part AOIs the candidates are
+    sorted by longitude once, so each part only scans its own longitude strip.
+    """
+
+    def __init__(self, geom):
+        self.geom = geom
+        self.bounds = geom.bounds
+        self.parts = [p for p in shapely.get_parts(geom) if not p.is_empty]
+        for part in self.parts:
+            shapely.prepare(part)
+        self.part_bounds = shapely.bounds(self.parts) if self.parts else np.empty((0, 4))
+
+    def mask(self, lon, lat):
+        """Boolean mask of points (WGS84 lon/lat arrays) inside the AOI."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        inside = np.zeros(lon.shape, dtype=bool)
+
+        minx, miny, maxx, maxy = self.bounds
+        cand = np.flatnonzero((lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy))
+        if len(cand) == 0:
+            return inside
+        x, y = lon[cand], lat[cand]
+
+        sweep = len(self.parts) >= SWEEP_MIN_PARTS
+        if sweep:
+            order = np.argsort(x, kind="stable")
+            x_sorted = x[order]
+        for part, (pminx, pminy, pmaxx, pmaxy) in zip(self.parts, self.part_bounds):
+            if sweep:
+                strip = order[np.searchsorted(x_sorted, pminx, side="left"):np.searchsorted(x_sorted, pmaxx, side="right")]
+                sel = strip[(y[strip] >= pminy) & (y[strip] <= pmaxy)]
+            else:
+                sel = np.flatnonzero((x >= pminx) & (x <= pmaxx) & (y >= pminy) & (y <= pmaxy))
+            sel = sel[~inside[cand[sel]]]
+            if len(sel):
+                inside[cand[sel[shapely.contains_xy(part, x[sel], y[sel])]]] = True
+        return inside
+
+    def filter_table(self, table):
+        """
+        Keep the rows of a GEDI Arrow table that fall inside the AOI.
+
+        The lat/lon columns are found among the known GEDI variants; tables
+        without any are returned unchanged.
+        """
+        names = find_lat_lon(table.column_names)
+        if names is None:
+            logger.warning("No lat/lon columns found, AOI filter skipped.")
+            return table
+        lat_col, lon_col = names
+        keep = self.mask(table[lon_col].to_numpy(), table[lat_col].to_numpy())
+        return table.filter(pa.array(keep))
+
+
+# -----------------------------
+# Shared AOI context
+# -----------------------------
+class AOIContext:
+    """
+    The AOI of a run, loaded once and shared by every fetcher.
+
+    Holds the AOI as a GeoDataFrame, its dissolved EPSG:4326 geometry and
+    bounds, and a point filter for GEDI shots. Reprojections are cached
+    per CRS and rasterized masks per target grid (CRS, transform, shape),
+    so scenes, bands and granules on the same grid share one
+    rasterization instead of each going through rio.clip.
+    """
+
+    def __init__(self, gdf):
+        if gdf.crs is None:
+            gdf = gdf.set_crs("EPSG:4326")
+        self.gdf = gdf
+        self._by_crs = {}
+        self._masks = OrderedDict()
+        self.geom = self.to_crs("EPSG:4326").geometry.unary_union
+        self.bounds = self.geom.bounds
+        self._points = None
+
+    @classmethod
+    def from_file(cls, path):
+        import geopandas as gpd
+        return cls(gpd.read_file(path))
+
+    @staticmethod
+    def _crs_key(crs):
+        from pyproj import CRS
+        return CRS.from_user_input(crs).to_wkt()
+
+    def to_crs(self, crs):
+        """The AOI GeoDataFrame in `crs`, reprojected once per CRS."""
+        key = self._crs_key(crs)
+        if key not in self._by_crs:
+            self._by_crs[key] = self.gdf.to_crs(crs)
+        return self._by_crs[key]
+
+    @property
+    def points(self):
+        """AOIPointFilter for WGS84 point arrays (GEDI shots)."""
+        if self._points is None:
+            self._points = AOIPointFilter(self.geom)
+        return self._points
+
+    def mask(self, crs, transform, shape):
+        """Boolean (rows, cols) mask, True inside the AOI, for one target grid."""
+        key = (self._crs_key(crs), tuple(transform)[:6], tuple(shape))
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        from rasterio.features import geometry_mask
+        geoms = [g for g in self.to_crs(crs).geometry if g is not None and not g.is_empty]
+        mask = geometry_mask(geoms, out_shape=tuple(shape), transform=transform, invert=True)
+        self._masks[key] = mask
+        if len(self._masks) > MASK_CACHE_SIZE:
+            self._masks.popitem(last=False)
+        return mask
+
+    def clip(self, obj, drop=True):
+        """
+        Mask an xarray object with rio georeferencing to the AOI.
+
+        Drop-in for obj.rio.clip(aoi geometries, aoi crs, drop=drop): pixels
+        whose centre is outside the AOI become nodata (NaN for floats), and
+        with drop=True the result is cut to the AOI's row/column window.
+        """
+        import xarray as xr
+
+        crs = obj.rio.crs or "EPSG:4326"
+        ydim, xdim = obj.rio.y_dim, obj.rio.x_dim
+        mask = self.mask(crs, obj.rio.transform(), (obj.sizes[ydim], obj.sizes[xdim]))
+        if not mask.any():
+            raise ValueError("AOI does not overlap the raster")
+
+        if drop:
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            obj = obj.isel({ydim: window[0], xdim: window[1]})
+            mask = mask[window]
+
+        inside = xr.DataArray(mask, dims=(ydim, xdim))
+        nodata = getattr(obj.rio, "nodata", None) if isinstance(obj, xr.DataArray) else None
+        if nodata is not None and not np.issubdtype(obj.dtype, np.floating):
+            return obj.where(inside, nodata)
+        return obj.where(inside)
+
+
+_CONTEXTS = {}
+
+
+def load_aoi(cfg):
+    """
+    AOI context for cfg["geography"], built once per process and file version.
+
+    Every fetcher of a run calls this and gets the same context back, so the
+    AOI file is read, dissolved and reprojected once per run.
+    """
+    path = Path(cfg["geography"]).resolve()
+    key = (str(path), path.stat().st_mtime_ns)
+    if key not in _CONTEXTS:
+        logger.info(f"Loading AOI from {path}")
+        _CONTEXTS[key] = AOIContext.from_file(path)
+        while len(_CONTEXTS) > CONTEXT_CACHE_SIZE:
+            del _CONTEXTS[next(iter(_CONTEXTS))]
+    return _CONTEXTS[key]
+
+
+def benchmark(n_points=1_000_000, n_parts=(1, 8, 64), seed=0):
+    """
+    Time AOIPointFilter.mask on random points over irregular (multi)polygon AOIs.
+
+    Returns:
+        dict of n_parts -> points per second.
+    """
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-106.0, -104.0, n_points)
+    lat = rng.uniform(39.0, 41.0, n_points)
+    rates = {}
+    for n in n_parts:
+        centres = rng.uniform([-105.9, 39.1], [-104.1, 40.9], (n, 2))
+        radius = 0.6 / np.sqrt(n)
+        angles = np.linspace(0, 2 * np.pi, 65)[:-1]
+        polys = []
+        for cx, cy in centres:
+            r = radius * rng.uniform(0.5, 1.0, len(angles))
+            polys.append(shapely.Polygon(np.c_[cx + r * np.cos(angles), cy + r * np.sin(angles)]))
+        geom = shapely.MultiPolygon(polys) if n > 1 else polys[0]
+
+        aoi_filter = AOIPointFilter(geom)
+        t0 = time.perf_counter()
+        inside = aoi_filter.mask(lon, lat)
+        elapsed = time.perf_counter() - t0
+        rates[n] = n_points / elapsed
+        logger.info(f"{n} parts: {inside.sum()} of {n_points} points inside, {rates[n] / 1e6:.2f}M points/s")
+    return rates
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,67 @@
+# modules/step2_eo/cache.py
+
+import logging
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# -----------------------------
+# Granule / tile references
+# -----------------------------
+# Planners (plan_<source> functions in the fetch modules) describe what a source
+# needs for an AOI as a list of reference dicts:
+#   key:       unique id of the granule/tile within the source
+#   name:      file name (relative path) under the source's cache directory
+#   url:       http(s):// or s3:// location
+#   footprint: shapely geometry (EPSG:4326) or None if unknown
+#   download:  optional keyword arguments for ensure_local (auth / session)
+# plus any source-specific metadata (scene id, band, product, acquisition time).
+
+
+def planned_refs(cfg, source):
+    """Return the references planned for `source` by a batch run, or None."""
+    return cfg.get("plan", {}).get(source)
+
+
+def local_path(cfg, source, ref, default_dir):
+    """
+    Where a referenced file lives on disk: the shared cache when cfg["cache_dir"]
+    is set, otherwise the fetcher's own directory.
+    """
+    cache_dir = cfg.get("cache_dir")
+    base = Path(cache_dir) / source.lower() if cache_dir else Path(default_dir)
+    return base / ref["name"]
+
+
+def ensure_local(url, dest, session=None, auth=None):
+    """
+    Download `url` to `dest` unless it is already there.
+
+    Downloads go to a `.part` file that is renamed on completion, so an
+    interrupted download never leaves a truncated file in a shared cache.
+
+    Returns:
+        True if the file was downloaded, False if it was already present.
+    """
+    dest = Path(dest)
+    if dest.exists():
+        return False
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + ".part")
+
+    logger.info(f"Downloading {url} -> {dest}")
+    if url.startswith("s3://"):
+        import s3fs
+        s3fs.S3FileSystem(anon=True).get(url, str(tmp))
+    else:
+        getter = session.get if session is not None else requests.get
+        with getter(url, auth=auth, stream=True) as r:
+            r.raise_for_status()
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+    tmp.replace(dest)
+    return True
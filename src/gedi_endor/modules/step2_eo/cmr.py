@@ -0,0 +1,95 @@
+# modules/step2_eo/cmr.py
+
+import logging
+import os
+
+import requests
+from shapely.geometry import mapping, box, Polygon
+from shapely.geometry.polygon import orient
+from shapely.ops import unary_union
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+EARTHDATA_USERNAME = os.getenv("EARTHDATA_USERNAME")
+EARTHDATA_PASSWORD = os.getenv("EARTHDATA_PASSWORD")
+
+# Granules per CMR page (the CMR maximum)
+CMR_PAGE_SIZE = 2000
+
+
+def query_cmr(aoi_geom, start_date, end_date, collection_shortname="LANDSAT_8_C2_L2"):
+    """
+    Query NASA CMR for granules of a collection over AOI and time frame.
+
+    Args:
+        aoi_geom: shapely geometry; anything but a single polygon is searched
+                  by its convex hull
+        start_date: 'YYYY-MM-DD'
+        end_date: 'YYYY-MM-DD'
+        collection_shortname: CMR collection short name
+
+    Returns:
+        List of granule metadata dicts
+    """
+    logger.info(f"Querying CMR for {collection_shortname} from {start_date} to {end_date}...")
+
+    cmr_url = "https://cmr.earthdata.nasa.gov/search/granules.json"
+    if aoi_geom.geom_type != "Polygon":
+        aoi_geom = aoi_geom.convex_hull
+    aoi_geom = orient(aoi_geom, sign=1.0)  # CMR expects counter-clockwise rings
+    polygon_wkt = mapping(aoi_geom)["coordinates"][0]
+    polygon_str = ",".join([f"{x},{y}" for x, y in polygon_wkt])
+
+    params = {
+        "short_name": collection_shortname,
+        "temporal": f"{start_date}T00:00:00Z,{end_date}T23:59:59Z",
+        "polygon": polygon_str,
+        "page_size": CMR_PAGE_SIZE,
+        "sort_key": "-start_date",
+    }
+
+    # Page with CMR-Search-After until all CMR-Hits are fetched
+    granules, headers, hits = [], {}, None
+    while True:
+        response = requests.get(cmr_url, params=params, headers=headers,
+                                auth=(EARTHDATA_USERNAME, EARTHDATA_PASSWORD))
+        response.raise_for_status()
+        hits = int(response.headers.get("CMR-Hits", 0))
+        page = response.json().get("feed", {}).get("entry", [])
+        granules += page
+        search_after = response.headers.get("CMR-Search-After")
+        if not page or len(granules) >= hits or not search_after:
+            break
+        headers = {"CMR-Search-After": search_after}
+
+    if len(granules) != hits:
+        raise RuntimeError(f"CMR returned {len(granules)} of {hits} {collection_shortname} granules")
+    logger.info(f"Found {len(granules)} granules")
+    return granules
+
+
+def granule_links(granule, suffix):
+    """Return the HTTP data links of a CMR granule whose href ends with `suffix`."""
+    return [
+        link["href"] for link in granule.get("links", [])
+        if link.get("href", "").startswith("http") and link["href"].endswith(suffix)
+    ]
+
+
+def granule_footprint(granule):
+    """
+    Build a shapely footprint from the `polygons`/`boxes` fields of a CMR granule.
+
+    Returns:
+        shapely geometry in EPSG:4326, or None if the granule has no spatial metadata.
+    """
+    parts = []
+    for rings in granule.get("polygons", []):
+        # CMR lists "lat lon lat lon ..." for the outer ring first
+        coords = [float(v) for v in rings[0].split()]
+        parts.append(Polygon(zip(coords[1::2], coords[0::2])))
+    for bbox in granule.get("boxes", []):
+        south, west, north, east = (float(v) for v in bbox.split())
+        parts.append(box(west, south, east, north))
+    return unary_union(parts) if parts else None
@@ -1,12 +1,17 @@
 # modules/step2_eo/compute.py
 
 import logging
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import pandas as pd
 import numpy as np
 import xarray as xr
-import rioxarray
-from scipy.optimize import least_squares
+
+from memory_budget import DEFAULT_COPIES, batch_rows, budget_workers, memory_budget
+from .manifest import MANIFEST_NAME, is_incremental, load_manifest, save_manifest, pending_windows
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -22,6 +27,8 @@ def beer_lambert_model(x, y, wl, alpha_lw):
 
 def invert_liquid_water(rfl_meas, wl, abs_co_w, lw_init=(0.02,0.3,0.0002),
                         lw_bounds=([0,0.5],[0,1.0],[-0.0004,0.0004])):
+    from scipy.optimize import least_squares  # only needed for EMIT runs
+
     x_opt = least_squares(
         fun=beer_lambert_model,
         x0=lw_init,
@@ -34,16 +41,37 @@ def invert_liquid_water(rfl_meas, wl, abs_co_w, lw_init=(0.02,0.3,0.0002),
     )
     return x_opt.x
 
+# Wavelength window (nm) of the liquid water absorption feature fitted for CWC
+EMIT_CWC_WINDOW = (850, 1100)
+
+def select_emit_bands(ds, window=EMIT_CWC_WINDOW):
+    """
+    Keep the good EMIT bands inside the CWC fitting window.
+
+    Selection happens on the lazily opened store, so only the band chunks
+    holding these bands are read, not the full 285-band cube.
+    """
+    if "wavelengths" not in ds.coords:
+        return ds
+    wl = ds["wavelengths"].values
+    keep = (wl >= window[0]) & (wl <= window[1])
+    if "good_wavelengths" in ds.coords:
+        keep &= ds["good_wavelengths"].values > 0
+    return ds.isel(band=np.flatnonzero(keep))
+
 def compute_emit_cwc(df):
-    if 'reflectance' not in df.columns:
+    if 'reflectance' not in df.columns or 'wavelengths' not in df.columns:
         return df
-    wl = np.arange(400, 2500, 5)
+    # One row per pixel, one column per wavelength; only fully observed pixels are fitted
+    spectra = df.set_index(["time", "y", "x", "wavelengths"])["reflectance"].unstack("wavelengths").dropna()
+    wl = spectra.columns.values.astype(float)
     abs_co_w = np.ones_like(wl) * 0.001  # Placeholder: replace with actual water absorption
-    cwc, intercept, slope = invert_liquid_water(df['reflectance'].values, wl, abs_co_w)
-    df['CWC'] = cwc
-    df['EWT'] = cwc  # scale if needed
-    logger.info("Computed EMIT CWC/EWT")
-    return df
+    fits = np.array([invert_liquid_water(r, wl, abs_co_w) for r in spectra.values]).reshape(-1, 3)
+    out = spectra.index.to_frame(index=False)
+    out['CWC'] = fits[:, 0]
+    out['EWT'] = fits[:, 0]  # scale if needed
+    logger.info(f"Computed EMIT CWC/EWT for {len(out)} pixels")
+    return out
 
 # -----------------------------
 # PACE Indices
@@ -100,6 +128,22 @@ def compute_dem(df):
         logger.info("Computed DEM slope")
     return df
 
+# Source -> index function. Sources without an entry (e.g. GEDI) pass through.
+INDEX_FUNCTIONS = {
+    "EMIT": compute_emit_cwc,
+    "PACE": compute_pace_indices,
+    "S1": compute_s1_indices,
+    "S2": compute_optical_indices,
+    "Landsat": compute_optical_indices,
+    "DEM": compute_dem,
+}
+
+# Source -> band selection applied to the opened store before it is loaded,
+# so sources with many bands only read what their index function uses.
+BAND_SELECTIONS = {
+    "EMIT": select_emit_bands,
+}
+
 # -----------------------------
 # Temporal composites
 # -----------------------------
@@ -122,17 +166,153 @@ def apply_temporal_composites(df, composites, phenology_windows):
             else:
                 continue
             df_comp = df_comp.reset_index()
-            df_comp.attrs["window_start"] = str(win_start)
-            df_comp.attrs["window_end"] = str(win_end)
+            df_comp.attrs["window_start"] = win_start.strftime("%Y-%m-%d")
+            df_comp.attrs["window_end"] = win_end.strftime("%Y-%m-%d")
             df_comp.attrs["composite_type"] = comp
             composite_dfs.append(df_comp)
 
     return composite_dfs
 
+# -----------------------------
+# Per-file processing
+# -----------------------------
+def step_bytes(ds):
+    """Approximate DataFrame bytes of one time step of a store (8 bytes per cell)."""
+    per_step = 1
+    for dim, size in ds.sizes.items():
+        if dim != "time":
+            per_step *= size
+    # data variables plus the index columns and the derived index columns
+    return per_step * (len(ds.data_vars) + len(ds.sizes) + 8) * 8
+
+
+def time_batches(ds, budget=None):
+    """Slices over the time steps of a store, sized to fit the memory budget."""
+    if "time" not in ds.dims:
+        return [slice(None)]
+    n_time = ds.sizes["time"]
+    step = batch_rows(budget, step_bytes(ds), maximum=n_time)
+    return [slice(t, t + step) for t in range(0, n_time, step)]
+
+
+def process_file(source, zarr_file, src_out_dir, composites, phenology_windows, budget=None):
+    """
+    Compute indices (and temporal composites) for one input Zarr store.
+
+    Output names are derived from the input name only, so serial and
+    parallel runs write identical files.
+
+    The store is read in batches of time steps sized to `budget`
+    (bytes; default: all steps at once). Index functions work per pixel and
+    composites per time step, so batching does not change the results.
+
+    Returns:
+        List of written output paths.
+    """
+    logger.info(f"Processing {zarr_file.name}")
+    ds = xr.open_zarr(zarr_file)
+    select_bands = BAND_SELECTIONS.get(source)
+    if select_bands is not None:
+        ds = select_bands(ds)
+    batches = time_batches(ds, budget)
+    if len(batches) > 1:
+        logger.info(f"{zarr_file.name}: {len(batches)} batches of {batches[0].stop} time steps")
+
+    index_func = INDEX_FUNCTIONS.get(source)
+    composite = source not in ["GEDI","DEM"] and phenology_windows
+    parts = {}
+    zarr_out = src_out_dir / zarr_file.name
+    for k, batch in enumerate(batches):
+        sub = ds.isel(time=batch) if "time" in ds.dims else ds
+        df = sub.to_dataframe().reset_index()
+
+        # Compute indices
+        if index_func is not None:
+            df = index_func(df)
+
+        # Temporal composites for non-GEDI/DEM
+        if composite:
+            for df_comp in apply_temporal_composites(df, composites, phenology_windows):
+                key = (df_comp.attrs["window_start"], df_comp.attrs["window_end"], df_comp.attrs["composite_type"])
+                parts.setdefault(key, []).append(df_comp)
+        else:
+            df_xr = df.set_index("time").to_xarray()
+            if k == 0:
+                df_xr.to_zarr(zarr_out, mode="w")
+            else:
+                df_xr.to_zarr(zarr_out, append_dim="time")
+        del df
+
+    written = []
+    if composite:
+        for (window_start, window_end, comp_type), frames in parts.items():
+            df_comp = pd.concat(frames, ignore_index=True)
+            df_xr = df_comp.set_index("time").to_xarray()
+            window_start = window_start.replace("-", "")
+            window_end = window_end.replace("-", "")
+            zarr_out = src_out_dir / f"{zarr_file.stem}_{comp_type}_{window_start}_{window_end}.zarr"
+            df_xr.to_zarr(zarr_out, mode="w")
+            written.append(zarr_out)
+            logger.info(f"Saved {comp_type} composite for {window_start}-{window_end} to {zarr_out}")
+    else:
+        written.append(zarr_out)
+        logger.info(f"Saved computed features to {zarr_out}")
+    return written
+
+
+def _init_worker(memory_limit_bytes):
+    """
+    Process-pool initializer: one BLAS/OpenMP thread per worker so that N
+    workers use N cores, and an address-space limit so that a worker
+    exceeding its memory budget fails with MemoryError instead of taking
+    the machine (and the other workers) down.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+    if memory_limit_bytes:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+        except (ImportError, ValueError, OSError) as e:
+            logger.warning(f"Could not apply per-worker memory limit: {e}")
+
+
 # -----------------------------
 # Compute orchestrator
 # -----------------------------
 def run(cfg):
+    """
+    Compute EO indices and temporal composites for every fetched file.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - input_dir / output_dir
+            - eo:
+                - sources, composites, phenology_windows
+                - compute (optional):
+                    - workers: process count; 1 (default) runs serially,
+                      "auto" uses all cores
+                    - worker_memory_gb: per-worker memory budget
+                    - recycle_after: files per worker process before it is
+                      replaced, bounding leaked memory (default 8)
+                    - spectral: dict of source -> "bands" (default) or
+                      "components" to compute from the spectral components
+                      written by spectral_reduce instead of the raw bands
+                - speckle: when set, S1 features are computed from the
+                  speckle-filtered stores written by speckle.run
+                - incremental: only recompute files with pending acquisitions
+                  in the source manifest, and only the composite windows those
+                  acquisitions fall in (sources without a manifest are
+                  recomputed in full)
+            - memory_budget: optional total memory for the stage (e.g. "4GB");
+              workers are capped so each can hold a time step of the largest
+              store, and files are read in time batches of each worker's share
+    Returns:
+        Summary dict with per-item status, counts and timing.
+    """
     input_dir = Path(cfg["input_dir"])
     output_dir = Path(cfg["output_dir"])
     output_dir.mkdir(parents=True, exist_ok=True)
@@ -141,44 +321,167 @@ def run(cfg):
     sources = eo_cfg["sources"]
     composites = eo_cfg.get("composites", ["median"])
     phenology_windows = eo_cfg.get("phenology_windows", [])
+    compute_cfg = eo_cfg.get("compute", {})
+    memory_gb = compute_cfg.get("worker_memory_gb")
+    memory_limit_bytes = int(memory_gb * 1024**3) if memory_gb else None
+    spectral = compute_cfg.get("spectral", {})
 
+    # (source, file) work items in a fixed order
+    items = []
+    manifests = {}
     for source in sources:
-        src_in_dir = input_dir / source.lower()
+        # The fetch manifest stays in the raw source directory; derived
+        # stores (components, filtered) keep the raw store names
+        raw_dir = input_dir / source.lower()
+        src_in_dir = raw_dir
         src_out_dir = output_dir / source.lower()
+        if spectral.get(source, "bands") == "components":
+            src_in_dir = src_in_dir / "components"
+            src_out_dir = src_out_dir / "components"
+        if source == "S1" and "speckle" in eo_cfg:
+            src_in_dir = src_in_dir / "filtered"
         src_out_dir.mkdir(parents=True, exist_ok=True)
 
-        for zarr_file in src_in_dir.glob("*.zarr"):
-            logger.info(f"Processing {zarr_file.name}")
-            ds = xr.open_zarr(zarr_file)
-            df = ds.to_dataframe().reset_index()
-
-            # Compute indices
-            if source == "EMIT":
-                df = compute_emit_cwc(df)
-            elif source == "PACE":
-                df = compute_pace_indices(df)
-            elif source == "S1":
-                df = compute_s1_indices(df)
-            elif source in ["S2", "Landsat"]:
-                df = compute_optical_indices(df)
-            elif source == "DEM":
-                df = compute_dem(df)
-
-            # Temporal composites for non-GEDI/DEM
-            if source not in ["GEDI","DEM"] and phenology_windows:
-                composite_dfs = apply_temporal_composites(df, composites, phenology_windows)
-                for df_comp in composite_dfs:
-                    df_xr = df_comp.set_index("time").to_xarray()
-                    window_start = df_comp.attrs["window_start"].replace("-", "")
-                    window_end = df_comp.attrs["window_end"].replace("-", "")
-                    comp_type = df_comp.attrs["composite_type"]
-                    zarr_out = src_out_dir / f"{zarr_file.stem}_{comp_type}_{window_start}_{window_end}.zarr"
-                    df_xr.to_zarr(zarr_out, mode="w")
-                    logger.info(f"Saved {comp_type} composite for {window_start}-{window_end} to {zarr_out}")
-            else:
-                df_xr = df.set_index("time").to_xarray()
-                zarr_out = src_out_dir / zarr_file.name
-                df_xr.to_zarr(zarr_out, mode="w")
-                logger.info(f"Saved computed features to {zarr_out}")
+        manifest = None
+        if is_incremental(cfg) and (raw_dir / MANIFEST_NAME).exists():
+            manifest = load_manifest(raw_dir)
+            manifests[source] = (raw_dir, manifest)
+            pending_files = {e["file"] for e in manifest["pending"]}
+
+        for zarr_file in sorted(src_in_dir.glob("*.zarr")):
+            windows = phenology_windows
+            if manifest is not None:
+                if zarr_file.name not in pending_files:
+                    continue
+                if source not in ["GEDI", "DEM"] and phenology_windows:
+                    windows = pending_windows(manifest["pending"], zarr_file.name, phenology_windows)
+                    if not windows:
+                        logger.info(f"{zarr_file.name}: new data touches no composite window")
+                        continue
+                logger.info(f"{zarr_file.name}: recomputing {len(windows)} window(s)")
+            items.append((source, zarr_file, src_out_dir, composites, windows))
+
+    budget = memory_budget(cfg)
+    largest = 0
+    if budget is not None and items:
+        for source, zarr_file in {item[:2] for item in items}:
+            with xr.open_zarr(zarr_file) as ds:
+                select_bands = BAND_SELECTIONS.get(source)
+                largest = max(largest, step_bytes(select_bands(ds) if select_bands else ds))
+    workers = budget_workers(compute_cfg.get("workers", 1), budget, largest * DEFAULT_COPIES,
+                             worker_limit=memory_limit_bytes)
+    worker_budget = None
+    if budget is not None and items:
+        worker_budget = budget // workers
+        logger.info(f"Memory budget {budget / 1024**2:.0f} MB: {worker_budget / 1024**2:.0f} MB per worker")
+    items = [item + (worker_budget,) for item in items]
+    logger.info(f"Computing {len(items)} files with {workers} worker(s)")
 
+    t0 = time.perf_counter()
+    results = {}
+    if workers > 1 and len(items) > 1:
+        # "spawn" rather than fork: zarr/dask keep background threads that do
+        # not survive a fork.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(memory_limit_bytes,),
+                                 max_tasks_per_child=compute_cfg.get("recycle_after", 8)) as pool:
+            futures = {pool.submit(process_file, *item): item for item in items}
+            for future in as_completed(futures):
+                source, zarr_file = futures[future][:2]
+                try:
+                    results[(source, zarr_file.name)] = ("ok", future.result())
+                except Exception as e:
+                    logger.error(f"Failed {source} {zarr_file.name}: {e!r}")
+                    results[(source, zarr_file.name)] = ("failed", repr(e))
+                logger.info(f"[{len(results)}/{len(items)}] {source} {zarr_file.name} done")
+    else:
+        for item in items:
+            source, zarr_file = item[:2]
+            try:
+                results[(source, zarr_file.name)] = ("ok", process_file(*item))
+            except Exception as e:
+                logger.error(f"Failed {source} {zarr_file.name}: {e!r}")
+                results[(source, zarr_file.name)] = ("failed", repr(e))
+
+    elapsed = time.perf_counter() - t0
+    failed = sorted(key for key, (status, _) in results.items() if status == "failed")
+
+    # Pending acquisitions are cleared once their file computed successfully;
+    # failed files stay pending and are retried on the next run
+    for source, (raw_dir, manifest) in manifests.items():
+        failed_files = {name for src, name in failed if src == source}
+        manifest["pending"] = [e for e in manifest["pending"] if e["file"] in failed_files]
+        save_manifest(raw_dir, manifest)
+    summary = {
+        "items": len(items),
+        "ok": len(items) - len(failed),
+        "failed": [f"{source}/{name}" for source, name in failed],
+        "workers": workers,
+        "elapsed_s": elapsed,
+        "items_per_s": len(items) / elapsed if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        f"Computed {summary['ok']}/{summary['items']} files in {elapsed:.1f}s "
+        f"({summary['items_per_s']:.2f} files/s, {workers} workers), {len(failed)} failed"
+    )
     logger.info("EO feature computation completed.")
+    return summary
+
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def synthetic_s2(path, n_time=24, size=128, seed=0):
+    """Random S2 reflectance store (B3/B4/B8/B11, one chunk per time step) at `path`."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2019-01-01", periods=n_time, freq=f"{365 // n_time}D")
+    ds = xr.Dataset(
+        {b: (("time", "y", "x"), rng.uniform(0.01, 0.5, (n_time, size, size)).astype(np.float32))
+         for b in ("B3", "B4", "B8", "B11")},
+        coords={"time": times, "y": np.arange(size)[::-1] * 10.0, "x": np.arange(size) * 10.0},
+    )
+    ds.chunk({"time": 1, "y": size, "x": size}).to_zarr(path, mode="w")
+
+
+def benchmark(n_files=8, n_time=24, size=128, workers=(1, 4), seed=0):
+    """
+    Time run() over synthetic S2 stores with each worker count and check
+    that every run writes the same files with the same contents.
+
+    Returns:
+        dict of worker count -> files per second.
+    """
+    rates = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for k in range(n_files):
+            synthetic_s2(Path(tmp) / "raw" / "s2" / f"s2_tile{k:02d}.zarr", n_time, size, seed=seed + k)
+        outputs = {}
+        for n in workers:
+            cfg = {
+                "input_dir": str(Path(tmp) / "raw"),
+                "output_dir": str(Path(tmp) / f"out_{n}"),
+                "eo": {
+                    "sources": ["S2"],
+                    "composites": ["median", "mean"],
+                    "phenology_windows": [("2019-01-01", "2019-06-30"), ("2019-07-01", "2019-12-31")],
+                    "compute": {"workers": n},
+                },
+            }
+            summary = run(cfg)
+            rates[n] = summary["items_per_s"]
+            logger.info(f"{summary['workers']} workers: {rates[n]:.2f} files/s")
+            outputs[n] = sorted((Path(tmp) / f"out_{n}" / "s2").glob("*.zarr"))
+
+        first = workers[0]
+        for n in workers[1:]:
+            names = [p.name for p in outputs[n]]
+            assert names == [p.name for p in outputs[first]], f"{n} workers wrote different files"
+            for a, b in zip(outputs[first], outputs[n]):
+                assert xr.open_zarr(a).load().equals(xr.open_zarr(b).load()), f"{b.name} differs"
+        logger.info(f"All worker counts wrote the same {len(outputs[first])} stores")
+    return rates
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step2_eo.compute
+    benchmark()
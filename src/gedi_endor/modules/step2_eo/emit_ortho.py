@@ -0,0 +1,179 @@
+# modules/step2_eo/emit_ortho.py
+
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rioxarray
+import xarray as xr
+from affine import Affine
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Reflectance fill value of the EMIT L2A products
+EMIT_FILL = -9999.0
+
+# Acquisition time in EMIT granule names,
+# e.g. EMIT_L2A_RFL_001_20230801T183541_2321312_008.nc -> 20230801T183541
+EMIT_TIME = re.compile(r"_(\d{8}T\d{6})_")
+
+
+def emit_time(name):
+    """Acquisition time of an EMIT granule from its file name, or None."""
+    match = EMIT_TIME.search(Path(name).name)
+    return pd.Timestamp(match.group(1)) if match else None
+
+
+# -----------------------------
+# Geometry lookup table
+# -----------------------------
+class EmitGLT:
+    """
+    The geometry lookup table (GLT) of an EMIT scene.
+
+    EMIT granules hold reflectance in sensor geometry (downtrack, crosstrack,
+    bands) plus, for every cell of a north-up output grid, the 1-based
+    (crosstrack, downtrack) index of the sensor pixel that fills it (0 where
+    no pixel does). The grid is given by the `geotransform` (GDAL order)
+    and `spatial_ref` attributes of the granule.
+    """
+
+    def __init__(self, glt_x, glt_y, transform, crs):
+        self.glt_x = np.asarray(glt_x, dtype=np.int64)
+        self.glt_y = np.asarray(glt_y, dtype=np.int64)
+        self.valid = (self.glt_x > 0) & (self.glt_y > 0)
+        self.transform = transform
+        self.crs = crs
+
+    @classmethod
+    def from_granule(cls, path):
+        with xr.open_dataset(path, group="location") as loc, xr.open_dataset(path) as root:
+            transform = Affine.from_gdal(*[float(v) for v in root.attrs["geotransform"]])
+            return cls(loc["glt_x"].values, loc["glt_y"].values, transform, root.attrs["spatial_ref"])
+
+    @property
+    def shape(self):
+        return self.valid.shape
+
+    def crop(self, aoi):
+        """
+        Restrict the GLT to an AOIContext (see aoi.py): cells outside the AOI
+        become invalid and the grid is cut to the AOI's row/column window.
+        """
+        inside = self.valid & aoi.mask(self.crs, self.transform, self.shape)
+        if not inside.any():
+            raise ValueError("AOI does not overlap the scene")
+        rows = np.flatnonzero(inside.any(axis=1))
+        cols = np.flatnonzero(inside.any(axis=0))
+        window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        cropped = EmitGLT(self.glt_x[window], self.glt_y[window],
+                          self.transform * Affine.translation(cols[0], rows[0]), self.crs)
+        cropped.valid &= inside[window]
+        return cropped
+
+    @property
+    def x(self):
+        t = self.transform
+        return t.c + (np.arange(self.shape[1]) + 0.5) * t.a
+
+    @property
+    def y(self):
+        t = self.transform
+        return t.f + (np.arange(self.shape[0]) + 0.5) * t.e
+
+
+# -----------------------------
+# Orthorectification
+# -----------------------------
+def orthorectify(path, zarr_path, aoi=None, band_chunk=32, tile=512, time=None):
+    """
+    Orthorectify an EMIT L2A reflectance granule into a gridded Zarr store.
+
+    The output grid is processed in strips of `tile` rows. For each strip
+    only the downtrack lines its GLT cells point to are read, `band_chunk`
+    bands at a time, and gathered onto the grid with one fancy-indexing
+    take per band chunk. Peak memory is one (lines, crosstrack, band_chunk)
+    slab plus one (band_chunk, tile, columns) output block, independent of
+    the number of bands.
+
+    The store holds `reflectance` (time, band, y, x) in float32 with NaN
+    for fill and for cells outside the scene/AOI, chunked (1, band_chunk,
+    tile, tile) so that readers selecting a few bands only read those
+    chunks, and `wavelengths`, `fwhm` and `good_wavelengths` along `band`.
+
+    Args:
+        path: EMIT L2A RFL netCDF granule
+        zarr_path: output store (overwritten)
+        aoi: optional AOIContext to crop and mask the grid with
+        band_chunk: bands per output chunk and per read
+        tile: output chunk size in rows/columns
+        time: acquisition time (default: parsed from the file name)
+
+    Returns:
+        Path to the written store.
+    """
+    import dask.array as da
+
+    zarr_path = Path(zarr_path)
+    glt = EmitGLT.from_granule(path)
+    if aoi is not None:
+        glt = glt.crop(aoi)
+    ny, nx = glt.shape
+    time = pd.Timestamp(time) if time is not None else emit_time(path)
+    if time is not None and time.tzinfo is not None:
+        time = time.tz_convert(None)
+
+    with xr.open_dataset(path, mask_and_scale=False) as root, \
+            xr.open_dataset(path, group="sensor_band_parameters") as sbp:
+        reflectance = root["reflectance"]
+        line_dim, cross_dim, band_dim = reflectance.dims
+        n_cross = reflectance.sizes[cross_dim]
+        n_bands = reflectance.sizes[band_dim]
+        fill = float(reflectance.attrs.get("_FillValue", EMIT_FILL))
+
+        # Metadata-only template: coordinates are written now, data chunks by region
+        dims = ("time", "band", "y", "x")
+        template = xr.Dataset(
+            {"reflectance": (dims, da.full((1, n_bands, ny, nx), np.nan, dtype=np.float32,
+                                           chunks=(1, band_chunk, tile, tile)))},
+            coords={
+                "time": [time if time is not None else pd.NaT],
+                "band": np.arange(n_bands),
+                "y": glt.y,
+                "x": glt.x,
+                **{name: ("band", sbp[name].values) for name in ("wavelengths", "fwhm", "good_wavelengths")
+                   if name in sbp},
+            },
+        ).rio.write_crs(glt.crs).rio.write_transform(glt.transform)
+        template.to_zarr(zarr_path, mode="w", compute=False)
+
+        for r0 in range(0, ny, tile):
+            r1 = min(r0 + tile, ny)
+            valid = glt.valid[r0:r1]
+            if not valid.any():
+                continue
+            rows, cols = np.nonzero(valid)
+            lines = glt.glt_y[r0:r1][valid] - 1
+            first, last = int(lines.min()), int(lines.max()) + 1
+            # Flat (line, crosstrack) position of every valid cell within the slab
+            take = (lines - first) * n_cross + (glt.glt_x[r0:r1][valid] - 1)
+
+            for b0 in range(0, n_bands, band_chunk):
+                b1 = min(b0 + band_chunk, n_bands)
+                slab = reflectance.isel({line_dim: slice(first, last), band_dim: slice(b0, b1)}).values
+                values = slab.reshape(-1, b1 - b0)[take].astype(np.float32, copy=False)
+                values[values == fill] = np.nan
+
+                block = np.full((1, b1 - b0, r1 - r0, nx), np.nan, dtype=np.float32)
+                block[0, :, rows, cols] = values
+                xr.Dataset({"reflectance": (dims, block)}).to_zarr(
+                    zarr_path,
+                    region={"time": slice(0, 1), "band": slice(b0, b1), "y": slice(r0, r1), "x": slice(0, nx)},
+                )
+            logger.debug(f"{Path(path).name}: rows {r0}-{r1} of {ny} from lines {first}-{last}")
+
+    logger.info(f"Orthorectified {Path(path).name}: {ny} x {nx} cells, {n_bands} bands -> {zarr_path}")
+    return zarr_path
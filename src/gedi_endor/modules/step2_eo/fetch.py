@@ -1,35 +1,43 @@
 # modules/step2_eo/fetch.py
 
-from .fetch_s1 import fetch_s1
-from .fetch_s2 import fetch_s2
-from .fetch_landsat import fetch_landsat
-from .fetch_gedi import fetch_gedi
-from .fetch_pace import fetch_pace
-from .fetch_emit import fetch_emit
-from .fetch_dem import fetch_dem
-from .gedi_filter import run as filter_gedi
+import logging
+
+from .aoi import load_aoi
+from .registry import FETCHERS, get_fetcher
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
 
 def run(cfg):
     """
     Unified EO fetch orchestrator. Calls individual fetch scripts per source.
     Applies GEDI filters automatically after fetch.
+
+    Fetchers are looked up in the source registry (see registry.py) and only
+    imported when requested. A source whose SDK is not installed is skipped
+    with an error instead of aborting the whole run.
+
+    The AOI is loaded once here (see aoi.load_aoi); every fetcher gets the
+    same context back, with its reprojections and raster masks cached.
     """
     sources = cfg["eo"]["sources"]
+    aoi = load_aoi(cfg)
+    logger.info(f"AOI bounds (EPSG:4326): {aoi.bounds}")
+
+    for source in sources:
+        if source not in FETCHERS:
+            logger.warning(f"No fetcher registered for source '{source}', skipping.")
+            continue
+        try:
+            fetcher = get_fetcher(source)
+        except ImportError as e:
+            logger.error(f"Cannot fetch {source}: missing dependency ({e}). Skipping.")
+            continue
+
+        fetcher(cfg)
 
-    if "GEDI" in sources:
-        fetch_gedi(cfg)
-        # Apply filters right after fetch
-        filter_gedi(cfg)
-
-    if "S1" in sources:
-        fetch_s1(cfg)
-    if "S2" in sources:
-        fetch_s2(cfg)
-    if "Landsat" in sources:
-        fetch_landsat(cfg)
-    if "PACE" in sources:
-        fetch_pace(cfg)
-    if "EMIT" in sources:
-        fetch_emit(cfg)
-    if "DEM" in sources:
-        fetch_dem(cfg)
+        if source == "GEDI":
+            # Apply filters right after fetch
+            from .gedi_filter import run as filter_gedi
+            filter_gedi(cfg)
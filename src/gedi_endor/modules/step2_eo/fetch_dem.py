@@ -1,15 +1,57 @@
 # modules/step2_eo/fetch_dem.py
 
 import logging
+import math
 from pathlib import Path
 import xarray as xr
 import rioxarray
-import geopandas as gpd
-import s3fs
+from rioxarray.merge import merge_arrays
+from shapely.geometry import box
+
+from .aoi import load_aoi
+from .cache import planned_refs, local_path, ensure_local
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# AWS S3 path for USGS 10m DEM tiles
+DEM_BUCKET = "s3://usgs-dem-10m/"  # Placeholder, replace with actual AWS USGS DEM bucket
+
+
+def plan_dem(cfg, geom):
+    """
+    List the 1x1 degree DEM tiles intersecting `geom`.
+
+    Tiles are named after their north-west corner (e.g. n40w106), like the
+    USGS 1/3 arc-second 3DEP tiles.
+
+    Args:
+        cfg: dict-like configuration (uses cfg["dem"]["product"])
+        geom: shapely geometry in EPSG:4326
+
+    Returns:
+        List of reference dicts (see cache.py), one per tile.
+    """
+    dem_product = cfg.get("dem", {}).get("product", "USGS_10m_DEM")
+    minx, miny, maxx, maxy = geom.bounds
+
+    refs = []
+    for lat in range(math.floor(miny), max(math.ceil(maxy), math.floor(miny) + 1)):
+        for lon in range(math.floor(minx), max(math.ceil(maxx), math.floor(minx) + 1)):
+            tile = box(lon, lat, lon + 1, lat + 1)
+            if not tile.intersects(geom):
+                continue
+            north = lat + 1
+            name = f"{'n' if north >= 0 else 's'}{abs(north):02d}{'w' if lon < 0 else 'e'}{abs(lon):03d}"
+            refs.append({
+                "key": name,
+                "name": f"{dem_product}/{name}.tif",
+                "url": f"{DEM_BUCKET}{dem_product}/{name}.tif",
+                "footprint": tile,
+            })
+    return refs
+
+
 def fetch_dem(cfg):
     """
     Fetch 10m USGS DEM from AWS, clip to AOI, and save as Zarr.
@@ -23,28 +65,31 @@ def fetch_dem(cfg):
     """
     logger.info("Starting DEM fetch from AWS...")
 
-    aoi_path = cfg["geography"]
     dem_product = cfg.get("dem", {}).get("product", "USGS_10m_DEM")
     output_dir = Path(cfg["output_dir"]) / "dem"
     output_dir.mkdir(parents=True, exist_ok=True)
     output_file = output_dir / f"{dem_product}.zarr"
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    logger.info(f"AOI loaded: {aoi_path}")
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
 
-    # AWS S3 path for USGS 10m DEM tiles
-    s3_bucket = "s3://usgs-dem-10m/"  # Placeholder, replace with actual AWS USGS DEM bucket
-    s3 = s3fs.S3FileSystem(anon=True)
+    # Tiles intersecting the AOI (a batch run hands over its plan instead)
+    refs = planned_refs(cfg, "DEM")
+    if refs is None:
+        refs = plan_dem(cfg, aoi.geom)
+    if not refs:
+        logger.warning("No DEM tiles intersect the AOI.")
+        return
 
-    # TODO: implement spatial filtering by AOI bounds
-    # For now, this example opens one tile (replace with loop over tiles intersecting AOI)
-    example_tile = f"{s3_bucket}dem_tile_example.tif"
-    with s3.open(example_tile, mode="rb") as f:
-        dem = rioxarray.open_rasterio(f)
+    tiles = []
+    for ref in refs:
+        path = local_path(cfg, "DEM", ref, output_dir / "tiles")
+        ensure_local(ref["url"], path)
+        tiles.append(rioxarray.open_rasterio(path))
+    dem = tiles[0] if len(tiles) == 1 else merge_arrays(tiles)
 
     # Clip to AOI geometry
-    dem_clipped = dem.rio.clip(aoi.geometry, aoi.crs, drop=True)
+    dem_clipped = aoi.clip(dem)
 
     # Save as Zarr
     dem_clipped.to_dataset(name="DEM").to_zarr(output_file, mode="w")
@@ -1,66 +1,118 @@
 # modules/step2_eo/fetch_emit.py
 
 import logging
+import os
 from pathlib import Path
-import intake
-import xarray as xr
-import rioxarray
-import geopandas as gpd
+
+from .aoi import load_aoi
+from .cmr import query_cmr, granule_links, granule_footprint
+from .cache import planned_refs, local_path, ensure_local
+from .emit_ortho import orthorectify
+from .manifest import is_incremental, load_manifest, save_manifest, new_refs, record
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+EARTHDATA_USERNAME = os.getenv("EARTHDATA_USERNAME")
+EARTHDATA_PASSWORD = os.getenv("EARTHDATA_PASSWORD")
+
+
+def _emit_cfg(cfg):
+    emit_cfg = dict(cfg["eo"].get("EMIT", {}))
+    emit_cfg.setdefault("timeframe", cfg["eo"].get("timeframe"))
+    return emit_cfg
+
+
+def plan_emit(cfg, geom):
+    """
+    List the EMIT L2A reflectance granules that intersect `geom`.
+
+    Only the reflectance file of each granule is planned (not the
+    uncertainty or mask files).
+
+    Args:
+        cfg: dict-like configuration (uses cfg["eo"]["EMIT"] short_name and timeframe)
+        geom: shapely geometry in EPSG:4326
+
+    Returns:
+        List of reference dicts (see cache.py), one per granule.
+    """
+    emit_cfg = _emit_cfg(cfg)
+    timeframe = emit_cfg["timeframe"]
+    short_name = emit_cfg.get("short_name", "EMITL2ARFL")
+
+    refs = []
+    for granule in query_cmr(geom, timeframe["start"], timeframe["end"], collection_shortname=short_name):
+        for url in granule_links(granule, ".nc"):
+            if "_RFL_" not in Path(url).name:
+                continue
+            refs.append({
+                "key": Path(url).name,
+                "name": Path(url).name,
+                "url": url,
+                "footprint": granule_footprint(granule),
+                "time": granule.get("time_start"),
+                "download": {"auth": (EARTHDATA_USERNAME, EARTHDATA_PASSWORD)},
+            })
+    return refs
+
 
 def fetch_emit(cfg):
     """
-    Fetch EMIT L2A Reflectance (EMITL2ARFL) data for given AOI and timeframe,
-    store as Zarr for later CWC/EWT computation.
+    Fetch EMIT L2A Reflectance (EMITL2ARFL) granules for given AOI and timeframe
+    and orthorectify them with their GLT into gridded Zarr stores for later
+    CWC/EWT computation.
 
     Args:
         cfg: dict-like configuration containing:
             - geography: AOI GeoJSON/Shapefile
             - eo:
                 - timeframe: dict with 'start' and 'end'
+                - EMIT (optional):
+                    - short_name: CMR collection (default EMITL2ARFL)
+                    - band_chunk: bands per Zarr chunk and per read (default 32)
+                    - tile: Zarr chunk size in rows/columns (default 512)
             - output_dir: base directory to store raw EMIT data
     """
     logger.info("Starting EMIT fetch...")
 
-    aoi_path = cfg["geography"]
-    timeframe = cfg["eo"]["timeframe"]
+    emit_cfg = _emit_cfg(cfg)
     output_dir = Path(cfg["output_dir"]) / "emit"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    if aoi.crs is None:
-        aoi.set_crs("EPSG:4326", inplace=True)
-
-    # Access EMIT L2A Reflectance catalog via short name
-    short_name = "EMITL2ARFL"
-    catalog_url = f"https://opendap.earthdata.nasa.gov/podaac-ops/EMIT_L2A_Reflectance/catalog.yaml"
-
-    logger.info(f"Accessing EMIT catalog for short name {short_name}: {catalog_url}")
-    try:
-        cat = intake.open_catalog(catalog_url)
-        ds = cat[short_name].to_dask()  # dask-backed xarray Dataset
-    except KeyError:
-        logger.error(f"Short name {short_name} not found in catalog.")
-        return
-    except Exception as e:
-        logger.error(f"Failed to open catalog: {e}")
-        return
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
 
-    # Filter by timeframe
-    ds = ds.sel(time=slice(timeframe["start"], timeframe["end"]))
+    # Plan granules (a batch run hands over its plan instead of re-searching)
+    refs = planned_refs(cfg, "EMIT")
+    if refs is None:
+        refs = plan_emit(cfg, aoi.geom)
 
-    # Clip to AOI
-    ds = ds.rio.write_crs("EPSG:4326", inplace=True)
-    ds_clipped = ds.rio.clip(aoi.geometry.apply(lambda x: x.__geo_interface__), aoi.crs)
+    incremental = is_incremental(cfg)
+    if incremental:
+        manifest = load_manifest(output_dir)
+        refs = new_refs(manifest, refs)
+
+    if not refs:
+        logger.warning("No EMIT granules to process.")
+        return
 
-    # Save raw data as Zarr
-    zarr_path = output_dir / f"{short_name}_{timeframe['start']}_{timeframe['end']}.zarr"
-    ds_clipped.to_zarr(zarr_path, mode="w")
-    logger.info(f"Saved raw EMIT data to Zarr: {zarr_path}")
+    for ref in refs:
+        zarr_path = output_dir / f"{Path(ref['name']).stem}.zarr"
+        try:
+            path = local_path(cfg, "EMIT", ref, output_dir / "granules")
+            ensure_local(ref["url"], path, **ref.get("download", {}))
+            orthorectify(
+                path, zarr_path, aoi=aoi,
+                band_chunk=emit_cfg.get("band_chunk", 32), tile=emit_cfg.get("tile", 512),
+                time=ref.get("time"),
+            )
+        except Exception as e:
+            logger.warning(f"Failed to orthorectify {ref['key']}: {e}")
+            continue
+        if incremental:
+            record(manifest, [ref], zarr_path.name)
+            save_manifest(output_dir, manifest)
 
     logger.info("EMIT fetch completed.")
 
@@ -73,4 +125,4 @@ if __name__ == "__main__":
         },
         "output_dir": "data/raw/eo"
     }
-    run(dummy_cfg)
+    fetch_emit(dummy_cfg)
@@ -3,40 +3,84 @@
 import os
 import logging
 from pathlib import Path
+import numpy as np
 import pandas as pd
-import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime
 from typing import List
-import requests
 import h5py
 
+from .aoi import load_aoi, find_lat_lon
+from .cmr import query_cmr, granule_links, granule_footprint
+from .cache import planned_refs, local_path, ensure_local
+from .manifest import is_incremental, load_manifest, save_manifest, new_refs, record
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# Config product names -> CMR collection short names
+GEDI_SHORT_NAMES = {
+    "GEDI_L1B": "GEDI01_B",
+    "GEDI_L2A": "GEDI02_A",
+    "GEDI_L2B": "GEDI02_B",
+    "GEDI_L4A": "GEDI_L4A_AGB_Density_V2_1_2056",
+}
 
-def download_gedi_granule(granule_url: str, out_path: Path):
-    """Download a GEDI granule from LP DAAC to the specified path."""
-    logger.info(f"Downloading GEDI granule: {granule_url}")
-    response = requests.get(granule_url, stream=True)
-    response.raise_for_status()
-    with open(out_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-    logger.info(f"Saved granule to {out_path}")
 
+def read_gedi_hdf5(file_path: Path, items_to_extract: List[str], profile_dtype: str = "float32") -> pa.Table:
+    """
+    Extract selected datasets from a GEDI HDF5 file into an Arrow table.
 
-def read_gedi_hdf5(file_path: Path, items_to_extract: List[str]) -> pd.DataFrame:
-    """Extract selected datasets from a GEDI HDF5 file into a Pandas DataFrame."""
+    Per-shot datasets become plain columns. 2-D datasets (one profile per
+    shot, e.g. the 101 RH percentiles or the L2B pavd_z/pai_z profiles) are
+    kept aligned with their shots as fixed-size-list columns of `profile_dtype`.
+    """
     data = {}
     with h5py.File(file_path, "r") as f:
         for item in items_to_extract:
             try:
                 key = item.lstrip("/")
-                data[key] = f[key][:].flatten()
+                values = f[key][:]
             except KeyError:
                 logger.warning(f"{item} not found in {file_path.name}, skipping.")
-    df = pd.DataFrame(data)
-    return df
+                continue
+            if values.ndim == 2:
+                flat = pa.array(values.astype(profile_dtype, copy=False).ravel())
+                data[key] = pa.FixedSizeListArray.from_arrays(flat, values.shape[1])
+            else:
+                data[key] = pa.array(values.ravel())
+    return pa.table(data)
+
+
+def plan_gedi(cfg, geom):
+    """
+    List the GEDI granules of every configured product that intersect `geom`.
+
+    Args:
+        cfg: dict-like configuration (uses cfg["eo"]["gedi"] products and timeframe)
+        geom: shapely geometry in EPSG:4326
+
+    Returns:
+        List of reference dicts (see cache.py), one per product granule.
+    """
+    gedi_cfg = cfg["eo"]["gedi"]
+    timeframe = gedi_cfg["timeframe"]
+
+    refs = []
+    for product in gedi_cfg["products"]:
+        short_name = GEDI_SHORT_NAMES.get(product, product)
+        for granule in query_cmr(geom, timeframe["start"], timeframe["end"], collection_shortname=short_name):
+            for url in granule_links(granule, ".h5"):
+                refs.append({
+                    "key": f"{product}/{Path(url).name}",
+                    "name": f"{product}/{Path(url).name}",
+                    "url": url,
+                    "footprint": granule_footprint(granule),
+                    "product": product,
+                    "time": granule.get("time_start"),
+                })
+    return refs
 
 
 def fetch_gedi(cfg):
@@ -46,60 +90,70 @@ def fetch_gedi(cfg):
     Args:
         cfg: dict-like configuration containing:
             - geography: path to AOI GeoJSON/Shapefile
-            - eo -> gedi: GEDI-specific config (products, items_to_extract, timeframe)
+            - eo -> gedi: GEDI-specific config (products, items_to_extract, timeframe,
+              optional profile_dtype "float32"/"float16" for RH and pavd_z/pai_z profiles)
             - output_dir: base directory to save raw GEDI data
     """
     logger.info("Starting GEDI fetch...")
 
-    aoi_path = cfg["geography"]
     gedi_cfg = cfg["eo"]["gedi"]  # <--- updated to use eo -> gedi
     products = gedi_cfg["products"]
     items_dict = gedi_cfg["items_to_extract"]
     timeframe = gedi_cfg["timeframe"]
+    profile_dtype = gedi_cfg.get("profile_dtype", "float32")
     base_output_dir = Path(cfg["output_dir"])
     base_output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    aoi_bounds = aoi.total_bounds  # minx, miny, maxx, maxy
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
+
+    # Plan granules (a batch run hands over its plan instead of re-searching)
+    refs = planned_refs(cfg, "GEDI")
+    if refs is None:
+        refs = plan_gedi(cfg, aoi.geom)
 
     for product in products:
         product_dir = base_output_dir / product
         product_dir.mkdir(parents=True, exist_ok=True)
 
         items_to_extract = items_dict.get(product, [])
-        granule_list = []  # Placeholder: list of URLs for GEDI granules
+        product_refs = [ref for ref in refs if ref["product"] == product]
+
+        # Incremental runs skip granules already stored
+        incremental = is_incremental(cfg)
+        if incremental:
+            manifest = load_manifest(product_dir)
+            product_refs = new_refs(manifest, product_refs)
 
-        logger.info(f"Fetching {product} granules within timeframe {timeframe['start']} to {timeframe['end']}")
+        logger.info(f"Fetching {len(product_refs)} {product} granules within timeframe {timeframe['start']} to {timeframe['end']}")
 
-        for granule_url in granule_list:
-            granule_name = Path(granule_url).name
-            granule_path = product_dir / granule_name
-            download_gedi_granule(granule_url, granule_path)
+        for ref in product_refs:
+            granule_name = Path(ref["name"]).name
+            granule_path = local_path(cfg, "GEDI", ref, base_output_dir)
+            ensure_local(ref["url"], granule_path)
 
-            df = read_gedi_hdf5(granule_path, items_to_extract)
+            table = read_gedi_hdf5(granule_path, items_to_extract, profile_dtype=profile_dtype)
 
             # Filter by timeframe if timestamp exists
-            if "shot_number" in df.columns and "sensing_time" in df.columns:
-                df["sensing_time"] = pd.to_datetime(df["sensing_time"])
-                df = df[
-                    (df["sensing_time"] >= pd.to_datetime(timeframe["start"])) &
-                    (df["sensing_time"] <= pd.to_datetime(timeframe["end"]))
-                ]
-
-            # Filter by AOI if lat/lon exist
-            if set(["latitude_bin0", "longitude_bin0"]).issubset(df.columns):
-                df = df[
-                    (df["longitude_bin0"] >= aoi_bounds[0]) & 
-                    (df["longitude_bin0"] <= aoi_bounds[2]) &
-                    (df["latitude_bin0"] >= aoi_bounds[1]) &
-                    (df["latitude_bin0"] <= aoi_bounds[3])
-                ]
+            keep = np.ones(table.num_rows, dtype=bool)
+            if "shot_number" in table.column_names and "sensing_time" in table.column_names:
+                sensing_time = pd.to_datetime(table["sensing_time"].to_numpy())
+                keep &= (sensing_time >= pd.to_datetime(timeframe["start"])) & (sensing_time <= pd.to_datetime(timeframe["end"]))
+
+            # Filter by the exact AOI polygon if any lat/lon column pair exists
+            lat_lon = find_lat_lon(table.column_names)
+            if lat_lon is not None:
+                keep &= aoi.points.mask(table[lat_lon[1]].to_numpy(), table[lat_lon[0]].to_numpy())
+            else:
+                logger.warning(f"No lat/lon columns in {granule_name}, AOI filter skipped.")
 
             # Save filtered granule as Parquet
             out_file = product_dir / f"{granule_name.replace('.h5','.parquet')}"
-            df.to_parquet(out_file, index=False)
+            pq.write_table(table.filter(pa.array(keep)), out_file)
             logger.info(f"Saved filtered GEDI data to {out_file}")
+            if incremental:
+                record(manifest, [ref], out_file.name)
+                save_manifest(product_dir, manifest)
 
     logger.info("GEDI fetch completed.")
 
@@ -113,8 +167,9 @@ if __name__ == "__main__":
                 "items_to_extract": {
                     "GEDI_L1B": ["/geolocation/latitude_bin0","/geolocation/longitude_bin0","/shot_number","/geolocation/elevation_bin0"],
                     "GEDI_L2A": ["/shot_number","/quality_flag","/elev_lowestmode","/lat_lowestmode","/lon_lowestmode","/rh"],
-                    "GEDI_L2B": ["geolocation/lat_lowestmode","geolocation/lon_lowestmode","rh100","pai","fhd_normal"]
+                    "GEDI_L2B": ["geolocation/lat_lowestmode","geolocation/lon_lowestmode","rh100","pai","fhd_normal","pavd_z","pai_z"]
                 },
+                "profile_dtype": "float16",
                 "timeframe": {"start": "2019-01-01", "end": "2019-12-31"}
             }
         },
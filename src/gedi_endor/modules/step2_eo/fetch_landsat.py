@@ -2,16 +2,14 @@
 
 import logging
 from pathlib import Path
-import geopandas as gpd
 import rioxarray
 import xarray as xr
-import requests
-from shapely.geometry import mapping
-import json
 import os
-from datetime import datetime
-from urllib.parse import quote
-import rasterio
+
+from .aoi import load_aoi
+from .cmr import query_cmr, granule_links, granule_footprint
+from .cache import planned_refs, local_path, ensure_local
+from .manifest import is_incremental, load_manifest, save_manifest, new_refs, record
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -20,61 +18,40 @@ EARTHDATA_USERNAME = os.getenv("EARTHDATA_USERNAME")
 EARTHDATA_PASSWORD = os.getenv("EARTHDATA_PASSWORD")
 
 
-def query_cmr(aoi_geom, start_date, end_date, collection_shortname="LANDSAT_8_C2_L2"):
+def plan_landsat(cfg, geom):
     """
-    Query NASA CMR for Landsat 8 Surface Reflectance granules over AOI and time frame.
+    List the Landsat band files needed to cover `geom`.
 
     Args:
-        aoi_geom: GeoJSON geometry (polygon)
-        start_date: 'YYYY-MM-DD'
-        end_date: 'YYYY-MM-DD'
-        collection_shortname: Landsat 8 SR collection
+        cfg: dict-like configuration (uses cfg["landsat"] products and timeframe)
+        geom: shapely geometry in EPSG:4326
 
     Returns:
-        List of granule metadata dicts
+        List of reference dicts (see cache.py), one per scene and band.
     """
-    logger.info(f"Querying CMR for {collection_shortname} from {start_date} to {end_date}...")
-    
-    cmr_url = "https://cmr.earthdata.nasa.gov/search/granules.json"
-    polygon_wkt = mapping(aoi_geom)["coordinates"][0]
-    polygon_str = " ".join([f"{x} {y}" for x, y in polygon_wkt])
-    
-    params = {
-        "short_name": collection_shortname,
-        "temporal": f"{start_date}T00:00:00Z,{end_date}T23:59:59Z",
-        "polygon": polygon_str,
-        "page_size": 2000,
-        "sort_key": "-start_date",
-    }
-    
-    response = requests.get(cmr_url, params=params, auth=(EARTHDATA_USERNAME, EARTHDATA_PASSWORD))
-    response.raise_for_status()
-    results = response.json()
-    
-    granules = results.get("feed", {}).get("entry", [])
-    logger.info(f"Found {len(granules)} granules")
-    return granules
-
+    timeframe = cfg["landsat"]["timeframe"]
+    products = cfg["landsat"]["products"]
 
-def download_band(granule, band_name, output_dir):
-    """
-    Download a specific band of a granule and return as xarray.DataArray
-    """
-    for link in granule.get("links", []):
-        if link.get("title", "").endswith(f"{band_name}.TIF") and "http" in link.get("href", ""):
-            url = link["href"]
-            local_path = Path(output_dir) / f"{granule['title']}_{band_name}.tif"
-            if not local_path.exists():
-                logger.info(f"Downloading {band_name} to {local_path}")
-                r = requests.get(url, auth=(EARTHDATA_USERNAME, EARTHDATA_PASSWORD), stream=True)
-                r.raise_for_status()
-                with open(local_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024 * 1024):
-                        f.write(chunk)
-            # Load with rioxarray
-            arr = rioxarray.open_rasterio(local_path, masked=True)
-            return arr
-    return None
+    refs = []
+    for granule in query_cmr(geom, timeframe["start"], timeframe["end"]):
+        scene_id = granule["title"]
+        footprint = granule_footprint(granule)
+        for band in products:
+            urls = granule_links(granule, f"{band}.TIF")
+            if not urls:
+                logger.warning(f"Band {band} not found for granule {scene_id}")
+                continue
+            refs.append({
+                "key": f"{scene_id}_{band}",
+                "name": f"{scene_id}_{band}.tif",
+                "url": urls[0],
+                "footprint": footprint,
+                "scene": scene_id,
+                "band": band,
+                "time": granule.get("time_start"),
+                "download": {"auth": (EARTHDATA_USERNAME, EARTHDATA_PASSWORD)},
+            })
+    return refs
 
 
 def fetch_landsat(cfg):
@@ -83,39 +60,46 @@ def fetch_landsat(cfg):
     """
     logger.info("Starting Landsat fetch...")
 
-    aoi_path = cfg["geography"]
-    timeframe = cfg["landsat"]["timeframe"]
-    products = cfg["landsat"]["products"]
     output_dir = Path(cfg["output_dir"]) / "landsat"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    if len(aoi) != 1:
-        logger.warning("Multiple geometries found, using first one.")
-    geom = aoi.geometry.iloc[0]
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
 
-    # Query CMR
-    granules = query_cmr(geom, timeframe["start"], timeframe["end"])
+    # Plan band files (a batch run hands over its plan instead of re-searching)
+    refs = planned_refs(cfg, "Landsat")
+    if refs is None:
+        refs = plan_landsat(cfg, aoi.geom)
 
-    for granule in granules:
-        scene_id = granule["title"]
+    # Incremental runs skip scenes already stored
+    incremental = is_incremental(cfg)
+    if incremental:
+        manifest = load_manifest(output_dir)
+        refs = new_refs(manifest, refs)
+
+    scenes = {}
+    for ref in refs:
+        scenes.setdefault(ref["scene"], []).append(ref)
+
+    for scene_id, scene_refs in scenes.items():
         logger.info(f"Processing granule {scene_id}")
         da_list = []
-        for band in products:
-            da = download_band(granule, band, output_dir)
-            if da is not None:
-                # Clip to AOI
-                da_clipped = da.rio.clip([geom], aoi.crs, drop=True)
-                da_list.append(da_clipped)
-            else:
-                logger.warning(f"Band {band} not found for granule {scene_id}")
+        for ref in scene_refs:
+            path = local_path(cfg, "Landsat", ref, output_dir)
+            ensure_local(ref["url"], path, **ref.get("download", {}))
+            da = rioxarray.open_rasterio(path, masked=True)
+            # Clip to AOI (bands on the same grid share one rasterized mask)
+            da_clipped = aoi.clip(da)
+            da_list.append(da_clipped.rename(ref["band"]))
 
         if da_list:
             ds = xr.merge(da_list)
             zarr_path = output_dir / f"{scene_id}.zarr"
             ds.to_zarr(zarr_path, mode="w")
             logger.info(f"Saved granule to {zarr_path}")
+            if incremental:
+                record(manifest, scene_refs, zarr_path.name)
+                save_manifest(output_dir, manifest)
 
     logger.info("Landsat fetch completed.")
 
@@ -1,68 +1,205 @@
 # modules/step2_eo/fetch_pace.py
 
 import logging
+import os
+import shutil
 from pathlib import Path
-import intake
+import numpy as np
+import pandas as pd
 import xarray as xr
-import rioxarray
-import geopandas as gpd
+
+from .aoi import load_aoi
+from .cmr import query_cmr, granule_links, granule_footprint
+from .cache import planned_refs, local_path, ensure_local
+from .manifest import is_incremental, load_manifest, save_manifest, new_refs, record
+from .swath_grid import TargetGrid, SwathBinner, write_time_step, state_path
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+EARTHDATA_USERNAME = os.getenv("EARTHDATA_USERNAME")
+EARTHDATA_PASSWORD = os.getenv("EARTHDATA_PASSWORD")
+
+# Output variable -> [swath variable, wavelength in nm] (or just the variable
+# name for 2-D products). Defaults cover the bands compute_pace_indices uses.
+DEFAULT_PACE_BANDS = {
+    "p495": ["rhos", 495], "p530": ["rhos", 530], "p550": ["rhos", 550],
+    "p570": ["rhos", 570], "pGreen1": ["rhos", 555], "pRed": ["rhos", 665],
+    "p705": ["rhos", 705], "p800": ["rhos", 800],
+}
+
+
+def _pace_cfg(cfg):
+    pace_cfg = dict(cfg["eo"].get("PACE", {}))
+    pace_cfg.setdefault("timeframe", cfg["eo"].get("timeframe"))
+    return pace_cfg
+
+
+def plan_pace(cfg, geom):
+    """
+    List the PACE OCI L2 granules that intersect `geom`.
+
+    Args:
+        cfg: dict-like configuration (uses cfg["eo"]["PACE"] short_name and timeframe)
+        geom: shapely geometry in EPSG:4326
+
+    Returns:
+        List of reference dicts (see cache.py), one per granule.
+    """
+    pace_cfg = _pace_cfg(cfg)
+    timeframe = pace_cfg["timeframe"]
+    short_name = pace_cfg.get("short_name", "PACE_OCI_L2_SFREFL")
+
+    refs = []
+    for granule in query_cmr(geom, timeframe["start"], timeframe["end"], collection_shortname=short_name):
+        for url in granule_links(granule, ".nc"):
+            refs.append({
+                "key": Path(url).name,
+                "name": Path(url).name,
+                "url": url,
+                "footprint": granule_footprint(granule),
+                "time": granule.get("time_start"),
+                "download": {"auth": (EARTHDATA_USERNAME, EARTHDATA_PASSWORD)},
+            })
+    return refs
+
+
+def iter_swath_blocks(path, bands, flag_mask=0, weight_variable=None, lines_per_block=512):
+    """
+    Read a PACE OCI L2 granule in blocks of scan lines.
+
+    Only the navigation arrays, the selected wavelengths of the requested
+    variables and the optional flag/weight variables are read.
+
+    Yields:
+        (lon, lat, values, weights) per block: flat (n,) coordinates,
+        (n, n_bands) float32 values with flagged pixels set to NaN, and
+        (n,) weights or None.
+    """
+    with xr.open_dataset(path, group="navigation_data") as nav, \
+            xr.open_dataset(path, group="geophysical_data") as geo:
+        wavelengths = None
+        if any(not isinstance(spec, str) for spec in bands.values()):
+            with xr.open_dataset(path, group="sensor_band_parameters") as sbp:
+                wavelengths = sbp["wavelength_3d"].values
+
+        selections = []
+        for spec in bands.values():
+            if isinstance(spec, str):
+                selections.append((spec, {}))
+            else:
+                variable, wavelength = spec
+                band_dim = [d for d in geo[variable].dims if d not in ("number_of_lines", "pixels_per_line")][0]
+                selections.append((variable, {band_dim: int(np.argmin(np.abs(wavelengths - wavelength)))}))
+
+        n_lines = nav.sizes["number_of_lines"]
+        for start in range(0, n_lines, lines_per_block):
+            lines = {"number_of_lines": slice(start, start + lines_per_block)}
+            lon = nav["longitude"].isel(lines).values.ravel()
+            lat = nav["latitude"].isel(lines).values.ravel()
+            values = np.stack([
+                geo[variable].isel({**lines, **index}).values.ravel().astype(np.float32)
+                for variable, index in selections
+            ], axis=1)
+            if flag_mask and "l2_flags" in geo:
+                flagged = (geo["l2_flags"].isel(lines).values.ravel().astype(np.int64) & int(flag_mask)) != 0
+                values[flagged] = np.nan
+            weights = None
+            if weight_variable:
+                weights = geo[weight_variable].isel(lines).values.ravel().astype(np.float64)
+            yield lon, lat, values, weights
+
 
 def fetch_pace(cfg):
     """
-    Fetch PACE L2 hyperspectral EO data using short name PACE_OCI_L2_LANDVI,
-    for a given AOI and timeframe, store as Zarr.
+    Fetch PACE OCI L2 swath granules and bin them onto a regular grid over the
+    AOI, accumulating a time-stamped Zarr cube for compute_pace_indices.
+
+    Granules are binned one at a time (in blocks of scan lines), with one
+    time step per acquisition day; granules of the same day are averaged
+    into the same step.
 
     Args:
         cfg: dict-like configuration containing:
             - geography: AOI GeoJSON/Shapefile
             - eo:
-                - products: list of desired PACE indices (Car, CCI, PRI, CIRE, mARI)
                 - timeframe: dict with 'start' and 'end'
+                - PACE (optional):
+                    - short_name: CMR collection (default PACE_OCI_L2_SFREFL)
+                    - bands: output name -> [variable, wavelength nm] or variable
+                      (default DEFAULT_PACE_BANDS)
+                    - resolution: grid cell size in CRS units (default 0.01)
+                    - crs: grid CRS (default EPSG:4326)
+                    - flag_mask: l2_flags bits that reject a pixel (default 0)
+                    - weight_variable: per-pixel weight for a quality-weighted mean
+                    - time_step: pandas frequency for time stamps (default "D")
             - output_dir: base directory to store raw PACE data
     """
     logger.info("Starting PACE fetch...")
 
-    aoi_path = cfg["geography"]
-    products = cfg["eo"]["products"]  # indices will be computed later
-    timeframe = cfg["eo"]["timeframe"]
+    pace_cfg = _pace_cfg(cfg)
+    timeframe = pace_cfg["timeframe"]
+    bands = pace_cfg.get("bands", DEFAULT_PACE_BANDS)
+    time_step = pace_cfg.get("time_step", "D")
     output_dir = Path(cfg["output_dir"]) / "pace"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    if aoi.crs is None:
-        aoi.set_crs("EPSG:4326", inplace=True)
-
-    # Access NASA PACE OCI L2 catalog via short name
-    short_name = "PACE_OCI_L2_LANDVI"
-    catalog_url = f"https://opendap.earthdata.nasa.gov/podaac-ops/PACE_L2_LANDVI/catalog.yaml"
-
-    logger.info(f"Accessing PACE catalog for short name {short_name}: {catalog_url}")
-    try:
-        cat = intake.open_catalog(catalog_url)
-        ds = cat[short_name].to_dask()  # dask-backed xarray Dataset
-    except KeyError:
-        logger.error(f"Short name {short_name} not found in catalog.")
-        return
-    except Exception as e:
-        logger.error(f"Failed to open catalog: {e}")
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
+    grid = TargetGrid.for_aoi(aoi, pace_cfg.get("resolution", 0.01), crs=pace_cfg.get("crs", "EPSG:4326"))
+    logger.info(f"PACE grid: {grid.ny} x {grid.nx} cells of {grid.res} ({grid.crs})")
+
+    # Plan granules (a batch run hands over its plan instead of re-searching)
+    refs = planned_refs(cfg, "PACE")
+    if refs is None:
+        refs = plan_pace(cfg, aoi.geom)
+
+    incremental = is_incremental(cfg)
+    if incremental:
+        manifest = load_manifest(output_dir)
+        refs = new_refs(manifest, refs)
+        zarr_path = output_dir / "pace_l2_grid.zarr"
+    else:
+        zarr_path = output_dir / f"pace_l2_grid_{timeframe['start']}_{timeframe['end']}.zarr"
+        for stale in (zarr_path, state_path(zarr_path)):
+            if stale.exists():
+                shutil.rmtree(stale)
+
+    if not refs:
+        logger.warning("No PACE granules to process.")
         return
 
-    # Filter by timeframe
-    ds = ds.sel(time=slice(timeframe["start"], timeframe["end"]))
+    # Granules in time order, grouped into time steps
+    refs = sorted(refs, key=lambda r: pd.Timestamp(r["time"]))
+    steps = {}
+    for ref in refs:
+        step = pd.Timestamp(ref["time"]).tz_localize(None).floor(time_step)
+        steps.setdefault(step, []).append(ref)
 
-    # Clip to AOI
-    ds = ds.rio.write_crs("EPSG:4326", inplace=True)
-    ds_clipped = ds.rio.clip(aoi.geometry.apply(lambda x: x.__geo_interface__), aoi.crs)
+    for step, step_refs in steps.items():
+        binner = SwathBinner(grid, bands)
+        done = []
+        for ref in step_refs:
+            try:
+                path = local_path(cfg, "PACE", ref, output_dir / "granules")
+                ensure_local(ref["url"], path, **ref.get("download", {}))
+                for lon, lat, values, weights in iter_swath_blocks(
+                    path, bands, flag_mask=pace_cfg.get("flag_mask", 0),
+                    weight_variable=pace_cfg.get("weight_variable"),
+                ):
+                    binner.add(grid.cells(lon, lat), values, weights)
+                done.append(ref)
+            except Exception as e:
+                logger.warning(f"Failed to grid {ref['key']}: {e}")
 
-    # Save raw data as Zarr
-    zarr_path = output_dir / f"{short_name}_{timeframe['start']}_{timeframe['end']}.zarr"
-    ds_clipped.to_zarr(zarr_path, mode="w")
-    logger.info(f"Saved raw PACE data to Zarr: {zarr_path}")
+        if binner.empty:
+            logger.info(f"{step:%Y-%m-%d}: no valid pixels over the AOI")
+        else:
+            write_time_step(zarr_path, binner, step)
+            logger.info(f"{step:%Y-%m-%d}: gridded {len(done)} granule(s) into {zarr_path}")
+        if incremental:
+            record(manifest, done, zarr_path.name)
+            save_manifest(output_dir, manifest)
 
     logger.info("PACE fetch completed.")
 
@@ -71,9 +208,9 @@ if __name__ == "__main__":
     dummy_cfg = {
         "geography": "data/test_aoi.geojson",
         "eo": {
-            "products": ["Car", "CCI", "PRI", "CIRE", "mARI"],  # indices to compute later
-            "timeframe": {"start": "2023-01-01", "end": "2023-12-31"}
+            "timeframe": {"start": "2024-06-01", "end": "2024-09-30"},
+            "PACE": {"resolution": 0.01, "flag_mask": 0},
         },
         "output_dir": "data/raw/eo"
     }
-    run(dummy_cfg)
+    fetch_pace(dummy_cfg)
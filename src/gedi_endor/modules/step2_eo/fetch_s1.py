@@ -2,29 +2,125 @@
 
 import logging
 from pathlib import Path
-import geopandas as gpd
 import asf_search as asf
+import dask
+import numpy as np
 import rioxarray
 import xarray as xr
-from shapely.geometry import mapping
+from shapely.geometry import shape
+
+from memory_budget import memory_budget, tile_size
+
+from .aoi import load_aoi
+from .cache import planned_refs, local_path, ensure_local
+from .manifest import is_incremental, load_manifest, save_manifest, new_refs, record
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+_session = None
+
+
+def get_session():
+    """ASF download session, authenticated once per process."""
+    global _session
+    if _session is None:
+        # Auth with .netrc automatically
+        _session = asf.ASFSession().auth_with_creds()
+    return _session
+
+
+def plan_s1(cfg, geom):
+    """
+    List the Sentinel-1 RTC scenes intersecting `geom`.
+
+    Args:
+        cfg: dict-like configuration (uses cfg["eo"]["S1"] timeframe)
+        geom: shapely geometry in EPSG:4326
+
+    Returns:
+        List of reference dicts (see cache.py), one per scene.
+    """
+    timeframe = cfg["eo"]["S1"].get("timeframe", {})
+    start = timeframe.get("start", "2019-01-01")
+    end = timeframe.get("end", "2019-12-31")
+
+    # Search ASF
+    logger.info(f"Searching ASF Sentinel-1 RTC scenes from {start} to {end} ...")
+    results = asf.geo_search(
+        intersectsWith=geom.wkt,
+        platform=asf.PLATFORM.SENTINEL1,
+        processingLevel="RTC/GRD",  # adjust if needed (e.g. "RTC")
+        start=start,
+        end=end,
+        maxResults=500,
+    )
+
+    refs = []
+    for rec in results:
+        props = rec.properties
+        refs.append({
+            "key": props["fileName"],
+            "name": props["fileName"],
+            "url": props["url"],
+            "footprint": shape(rec.geometry) if rec.geometry else None,
+            "time": props.get("startTime"),
+            "download": {"session": get_session()},
+        })
+    return refs
+
+
+def align_to_store(combined, existing):
+    """
+    Reindex new scenes onto the y/x grid of an existing store, NaN outside
+    their footprint, so appending never rewrites the stored coordinates.
+
+    Raises:
+        ValueError: if the scenes are not on the store's pixel grid
+    """
+    matched = {}
+    for d in ("y", "x"):
+        stored, new = existing.get_index(d), combined.get_index(d)
+        step = float(stored[1] - stored[0]) if len(stored) > 1 else None
+        # Pixel centres on the same grid differ by float noise at most
+        tolerance = 1e-3 * abs(step) if step else 1e-6
+        if step and len(new) > 1 and abs(float(new[1] - new[0]) - step) > tolerance:
+            raise ValueError(f"Scene {d} spacing {float(new[1] - new[0])} differs from the stored {step}")
+        indexer = new.get_indexer(stored, method="nearest", tolerance=tolerance)
+        if (indexer < 0).all():
+            raise ValueError(f"Scenes do not overlap the stored {d} pixel grid")
+        dropped = len(new) - len(np.unique(indexer[indexer >= 0]))
+        if dropped:
+            logger.warning(f"Dropping {dropped} scene {d} positions outside the stored grid")
+        matched[d] = indexer
+
+    aligned = combined.isel(y=np.maximum(matched["y"], 0), x=np.maximum(matched["x"], 0))
+    aligned = aligned.assign_coords(y=existing["y"].values, x=existing["x"].values)
+    inside = xr.DataArray(matched["y"] >= 0, dims="y") & xr.DataArray(matched["x"] >= 0, dims="x")
+    aligned = aligned.where(inside)
+    for d in ("y", "x"):
+        if not np.array_equal(aligned[d].values, existing[d].values):
+            raise ValueError(f"Scenes do not match the stored {d} coordinates")
+    return aligned
+
 
 def fetch_s1(cfg):
     """
     Fetch Sentinel-1 RTC scenes from ASF, clip to AOI, save as Zarr.
 
+    Scenes are opened lazily in square tiles and written tile by tile, so
+    no scene is held in memory whole. With cfg["memory_budget"] the tile
+    size is chosen to fit it and tiles are written one at a time;
+    otherwise 2048-pixel tiles are written with dask's threads.
+
     Authentication:
         Uses Earthdata credentials stored in ~/.netrc (Linux/Mac)
         or C:\\Users\\<User>\\_netrc (Windows).
     """
     logger.info("Starting Sentinel-1 fetch → zarr...")
 
-    # Load AOI
-    aoi = gpd.read_file(cfg["geography"]).to_crs(epsg=4326)
-    aoi_wkt = aoi.geometry.unary_union.wkt
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
 
     # Config
     s1_cfg = cfg["eo"]["S1"]
@@ -32,68 +128,90 @@ def fetch_s1(cfg):
     start = timeframe.get("start", "2019-01-01")
     end = timeframe.get("end", "2019-12-31")
 
-    output_dir = Path(cfg["output_dir"]) / "S1"
+    output_dir = Path(cfg["output_dir"]) / "s1"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Search ASF
-    logger.info(f"Searching ASF Sentinel-1 RTC scenes from {start} to {end} ...")
-    results = asf.geo_search(
-        intersectsWith=aoi_wkt,
-        platform=asf.PLATFORM.SENTINEL1,
-        processingLevel="RTC/GRD",  # adjust if needed (e.g. "RTC")
-        start=start,
-        end=end,
-        maxResults=500,
-    )
+    # Plan scenes (a batch run hands over its plan instead of re-searching)
+    refs = planned_refs(cfg, "S1")
+    if refs is None:
+        refs = plan_s1(cfg, aoi.geom)
 
-    if not results:
+    if not refs:
         logger.warning("No Sentinel-1 scenes found for given AOI/timeframe.")
         return
 
-    logger.info(f"Found {len(results)} candidate scenes")
+    logger.info(f"Found {len(refs)} candidate scenes")
+
+    # Incremental runs append new acquisitions to one stable store instead
+    # of rewriting a {start}_{end} store
+    incremental = is_incremental(cfg)
+    if incremental:
+        manifest = load_manifest(output_dir)
+        refs = new_refs(manifest, refs)
+        if not refs:
+            logger.info("Sentinel-1 store is up to date.")
+            return
 
-    # Auth with .netrc automatically
-    session = asf.ASFSession().auth_with_creds()
+    budget = memory_budget(cfg)
+    # float32 pixels; a budget is spent one tile at a time
+    tile = tile_size(budget, bytes_per_pixel=4, maximum=2048)
+    if budget is not None:
+        logger.info(f"Memory budget {budget / 1024**2:.0f} MB: {tile} x {tile} pixel tiles")
 
     ds_list = []
+    fetched = []
 
-    for rec in results:
+    for ref in refs:
         try:
-            # Download file
-            rec.download(path=str(output_dir), session=session)
-
-            # Determine local file path
-            local_path = output_dir / rec.properties.get("fileName", "")
-            if not local_path.exists():
-                logger.warning(f"Could not find downloaded file for {rec}. Skipping.")
-                continue
+            # Download file (no-op if already in the cache)
+            local_file = local_path(cfg, "S1", ref, output_dir)
+            ensure_local(ref["url"], local_file, **ref.get("download", {}))
 
-            # Open raster
-            xr_ds = rioxarray.open_rasterio(local_path)
+            # Open raster (lazily, one dask chunk per tile)
+            xr_ds = rioxarray.open_rasterio(local_file, chunks={"band": 1, "y": tile, "x": tile})
 
             # Clip to AOI
-            clipped = xr_ds.rio.clip(aoi.geometry.apply(mapping), crs="EPSG:4326")
+            clipped = aoi.clip(xr_ds)
 
             # Add time dimension
-            acq_time = rec.properties.get("startTime")
-            clipped = clipped.expand_dims(time=[acq_time])
+            clipped = clipped.expand_dims(time=[ref["time"]])
 
             ds_list.append(clipped)
+            fetched.append(ref)
 
         except Exception as e:
-            logger.warning(f"Failed to process {rec}: {e}")
+            logger.warning(f"Failed to process {ref['key']}: {e}")
             continue
 
     if not ds_list:
         logger.warning("No datasets processed successfully.")
         return
 
-    # Combine scenes along time dimension
-    combined = xr.concat(ds_list, dim="time")
+    # Combine scenes along time dimension (lazy; Zarr chunks = one tile of one scene)
+    combined = xr.concat(ds_list, dim="time").sortby("time")
+    combined = combined.chunk({"time": 1, "band": 1, "y": tile, "x": tile})
 
     # Save as Zarr
-    zarr_path = output_dir / f"s1_timeseries_{start}_{end}.zarr"
-    logger.info(f"Saving Zarr dataset to {zarr_path}")
-    combined.to_zarr(zarr_path, mode="w")
+    scheduler = {"scheduler": "synchronous"} if budget is not None else {}
+    with dask.config.set(**scheduler):
+        if incremental:
+            zarr_path = output_dir / "s1_timeseries.zarr"
+            if zarr_path.exists():
+                logger.info(f"Appending {len(ds_list)} scenes to {zarr_path}")
+                # Appended tiles must line up with the store's existing chunks
+                with xr.open_zarr(zarr_path) as existing:
+                    var = next(iter(existing.data_vars.values()))
+                    chunks = dict(zip(var.dims, var.encoding.get("chunks") or var.shape))
+                    combined = align_to_store(combined, existing)
+                combined = combined.chunk({d: c for d, c in chunks.items() if d != "time"})
+                combined.to_zarr(zarr_path, append_dim="time")
+            else:
+                combined.to_zarr(zarr_path, mode="w")
+            record(manifest, fetched, zarr_path.name)
+            save_manifest(output_dir, manifest)
+        else:
+            zarr_path = output_dir / f"s1_timeseries_{start}_{end}.zarr"
+            logger.info(f"Saving Zarr dataset to {zarr_path}")
+            combined.to_zarr(zarr_path, mode="w")
 
     logger.info("Sentinel-1 fetch complete.")
@@ -2,12 +2,13 @@
 
 import logging
 from pathlib import Path
-import geopandas as gpd
 import xarray as xr
 import rioxarray
 import numpy as np
 from sentinelhub import SHConfig, BBox, CRS, SentinelHubRequest, DataCollection, bbox_to_dimensions
 
+from .aoi import load_aoi
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
@@ -25,16 +26,14 @@ def fetch_s2(cfg):
     """
     logger.info("Starting Sentinel-2 fetch using Sentinel Hub API...")
 
-    aoi_path = cfg["geography"]
     timeframe = cfg["s2"]["timeframe"]
     products = cfg["s2"]["products"]
     output_dir = Path(cfg["output_dir"]) / "s2"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load AOI
-    aoi = gpd.read_file(aoi_path)
-    aoi = aoi.to_crs(epsg=4326)
-    bbox = BBox(bbox=aoi.total_bounds, crs=CRS.WGS84)
+    # Load AOI (shared by all fetchers of the run)
+    aoi = load_aoi(cfg)
+    bbox = BBox(bbox=aoi.bounds, crs=CRS.WGS84)
 
     # Sentinel Hub config (make sure your client ID & secret are set)
     config = SHConfig()
@@ -83,7 +82,7 @@ def fetch_s2(cfg):
     ds.rio.write_crs("EPSG:4326", inplace=True)
 
     # Clip to AOI
-    ds_clipped = ds.rio.clip(aoi.geometry, aoi.crs, drop=True)
+    ds_clipped = aoi.clip(ds)
 
     # Save as Zarr
     zarr_file = output_dir / f"s2_{timeframe['start']}_{timeframe['end']}.zarr"
@@ -2,13 +2,20 @@
 
 import logging
 from pathlib import Path
+import numpy as np
 import pandas as pd
-import zarr
-import xarray as xr
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from memory_budget import memory_budget
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
+# Decoded row groups held per budget: the table, the filter columns as
+# pandas, the filtered copy, the writer's page buffers and allocator slack
+FILTER_COPIES = 6
+
 
 def filter_gedi_df(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
     """
@@ -30,6 +37,65 @@ def filter_gedi_df(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
     return df
 
 
+def filter_gedi_table(table: pa.Table, filters: dict) -> pa.Table:
+    """
+    Arrow counterpart of filter_gedi_df.
+
+    Only the filtered columns are converted to pandas to evaluate the
+    conditions; rows are then selected on the Arrow table, so profile
+    columns (fixed-size lists such as rh or pavd_z) keep their layout.
+    """
+    keep = np.ones(table.num_rows, dtype=bool)
+    for col, func in filters.items():
+        if col in table.column_names:
+            keep &= np.asarray(func(table[col].to_pandas()), dtype=bool)
+        else:
+            logger.warning(f"Column {col} not in table, skipping filter.")
+    return table.filter(pa.array(keep))
+
+
+def row_group_batches(meta, budget=None):
+    """
+    Consecutive row groups of a Parquet file grouped so that each group's
+    decoded size fits `budget` bytes (all row groups at once without a
+    budget). A row group is the smallest unit read.
+    """
+    sizes = [meta.row_group(i).total_byte_size for i in range(meta.num_row_groups)]
+    limit = budget // FILTER_COPIES if budget is not None else float("inf")
+    groups, current, size = [], [], 0
+    for i, s in enumerate(sizes):
+        if current and size + s > limit:
+            groups.append(current)
+            current, size = [], 0
+        current.append(i)
+        size += s
+    if current:
+        groups.append(current)
+    return groups
+
+
+def filter_parquet(file, out_file, filters, budget=None):
+    """
+    Filter one Parquet file into out_file, reading groups of row groups
+    that fit `budget` bytes (default: the whole file at once). The filters
+    work row by row, so the output does not depend on the grouping.
+
+    Returns:
+        (rows read, rows kept)
+    """
+    pf = pq.ParquetFile(file)
+    n_rows, kept = pf.metadata.num_rows, 0
+    with pq.ParquetWriter(out_file, pf.schema_arrow) as writer:
+        for groups in row_group_batches(pf.metadata, budget):
+            table = filter_gedi_table(pf.read_row_groups(groups), filters)
+            writer.write_table(table)
+            kept += table.num_rows
+            del table
+            # Hand freed buffers back to the OS so the budget holds for RSS
+            pa.default_memory_pool().release_unused()
+    return n_rows, kept
+
+
 def run(cfg):
     """
     Filter GEDI data according to user specifications.
@@ -39,12 +105,15 @@ def run(cfg):
             - input_dir: path to raw GEDI data (Parquet/Zarr)
             - output_dir: path to save filtered GEDI data
             - product_filters: dict mapping product -> dict of column -> filter function
+            - memory_budget: optional memory for the stage (e.g. "1GB"); files
+              are filtered in record batches that fit it
     """
     input_dir = Path(cfg["input_dir"])
     output_dir = Path(cfg["output_dir"])
     output_dir.mkdir(parents=True, exist_ok=True)
 
     product_filters = cfg.get("product_filters", {})
+    budget = memory_budget(cfg)
 
     # Process each product
     for product_dir in input_dir.iterdir():
@@ -60,13 +129,9 @@ def run(cfg):
         # Process each file in product directory
         for file in product_dir.glob("*.parquet"):
             logger.info(f"Filtering {file.name}")
-            df = pd.read_parquet(file)
-            df_filtered = filter_gedi_df(df, filters)
-
-            # Save filtered output
             out_file = output_product_dir / file.name
-            df_filtered.to_parquet(out_file, index=False)
-            logger.info(f"Saved filtered data to {out_file}")
+            n_rows, kept = filter_parquet(file, out_file, filters, budget)
+            logger.info(f"Saved filtered data to {out_file} ({kept}/{n_rows} rows kept)")
 
 
 if __name__ == "__main__":
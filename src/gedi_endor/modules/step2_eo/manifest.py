@@ -0,0 +1,77 @@
+# modules/step2_eo/manifest.py
+
+import json
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+MANIFEST_NAME = "_manifest.json"
+
+# -----------------------------
+# Per-source acquisition manifest
+# -----------------------------
+# Each raw source directory keeps a manifest of what has been fetched:
+#   acquisitions: {acquisition key: {"time": ISO time, "file": output file name}}
+#   pending:      acquisitions fetched but not yet picked up by compute.run
+# Incremental fetches skip keys already listed; incremental compute only
+# touches pending files and the composite windows their times fall in.
+
+
+def is_incremental(cfg):
+    return bool(cfg["eo"].get("incremental", False))
+
+
+def load_manifest(source_dir):
+    path = Path(source_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {"acquisitions": {}, "pending": []}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(source_dir, manifest):
+    """Write the manifest atomically next to the source's outputs."""
+    path = Path(source_dir) / MANIFEST_NAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    tmp.replace(path)
+
+
+def new_refs(manifest, refs):
+    """Return the planned references whose key is not in the manifest yet."""
+    known = manifest["acquisitions"]
+    fresh = [ref for ref in refs if ref["key"] not in known]
+    logger.info(f"{len(refs) - len(fresh)} acquisitions already stored, {len(fresh)} new")
+    return fresh
+
+
+def record(manifest, refs, file_name):
+    """Register fetched references as stored in `file_name` and pending compute."""
+    for ref in refs:
+        entry = {"time": str(ref.get("time")) if ref.get("time") is not None else None, "file": file_name}
+        manifest["acquisitions"][ref["key"]] = entry
+        manifest["pending"].append(entry)
+
+
+def pending_windows(pending, file_name, phenology_windows):
+    """
+    Composite windows touched by the pending acquisitions of one file.
+
+    Acquisitions without a time touch every window.
+    """
+    times = [e["time"] for e in pending if e["file"] == file_name]
+    if any(t is None for t in times):
+        return list(phenology_windows)
+    times = pd.to_datetime(times, utc=True).tz_localize(None)
+    touched = []
+    for win_start, win_end in phenology_windows:
+        lo, hi = pd.to_datetime(win_start), pd.to_datetime(win_end)
+        if ((times >= lo) & (times <= hi)).any():
+            touched.append((win_start, win_end))
+    return touched
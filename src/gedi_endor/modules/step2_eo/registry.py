@@ -0,0 +1,92 @@
+# modules/step2_eo/registry.py
+
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# -----------------------------
+# Source plugin table
+# -----------------------------
+# Source name -> "module:function". Leading-dot modules are resolved relative to
+# this package. Nothing is imported until a source is requested, so a GEDI-only
+# or DEM-only run never touches the Sentinel Hub / ASF / intake SDKs.
+FETCHERS = {
+    "GEDI": ".fetch_gedi:fetch_gedi",
+    "S1": ".fetch_s1:fetch_s1",
+    "S2": ".fetch_s2:fetch_s2",
+    "Landsat": ".fetch_landsat:fetch_landsat",
+    "PACE": ".fetch_pace:fetch_pace",
+    "EMIT": ".fetch_emit:fetch_emit",
+    "DEM": ".fetch_dem:fetch_dem",
+}
+
+# Source name -> planner listing the granules/tiles a geometry needs (see
+# cache.py). Sources without a planner (S2 is served by a request API rather
+# than files) are fetched per AOI in batch runs.
+PLANNERS = {
+    "GEDI": ".fetch_gedi:plan_gedi",
+    "S1": ".fetch_s1:plan_s1",
+    "Landsat": ".fetch_landsat:plan_landsat",
+    "PACE": ".fetch_pace:plan_pace",
+    "EMIT": ".fetch_emit:plan_emit",
+    "DEM": ".fetch_dem:plan_dem",
+}
+
+
+def register_source(name, target, planner=None):
+    """
+    Register (or override) the fetch function for an EO source.
+
+    Args:
+        name: source name as used in cfg["eo"]["sources"], e.g. "S1".
+        target: "module:function" string, e.g. "my_pkg.fetch_planet:fetch_planet".
+        planner: optional "module:function" string for the source's planner.
+    """
+    FETCHERS[name] = target
+    if planner is not None:
+        PLANNERS[name] = planner
+
+
+def resolve(target):
+    """Import a "module:function" target and return the function."""
+    module_name, func_name = target.split(":")
+    module = importlib.import_module(module_name, package=__package__)
+    return getattr(module, func_name)
+
+
+def get_fetcher(source):
+    """
+    Return the fetch function for a source, importing its module on first use.
+
+    Raises:
+        KeyError: if the source is not registered.
+        ImportError: if the source's module (or one of its SDKs) is missing.
+    """
+    if source not in FETCHERS:
+        raise KeyError(f"Unknown EO source '{source}'. Registered sources: {sorted(FETCHERS)}")
+    return resolve(FETCHERS[source])
+
+
+def get_planner(source):
+    """Return the planner for a source, or None if it has none."""
+    if source not in PLANNERS:
+        return None
+    return resolve(PLANNERS[source])
+
+
+def check_sources(sources):
+    """
+    Try to resolve every requested source without running it.
+
+    Returns:
+        Dict of source -> error message for sources that cannot be loaded.
+    """
+    problems = {}
+    for source in sources:
+        try:
+            get_fetcher(source)
+        except (KeyError, ImportError) as e:
+            problems[source] = str(e)
+    return problems
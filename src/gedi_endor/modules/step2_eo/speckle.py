@@ -0,0 +1,333 @@
+# modules/step2_eo/speckle.py
+
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import chunk_windows, is_complete, map_tasks, mark_complete, store_chunks, store_stamp
+from memory_budget import DEFAULT_COPIES, budget_workers, memory_budget
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+METHODS = ("lee", "quegan")
+
+# Equivalent number of looks of Sentinel-1 IW GRDH, the default speckle level
+DEFAULT_LOOKS = 4.4
+
+# Variables of gridded stores that are not backscatter
+NON_BACKSCATTER = ("count", "spatial_ref")
+
+
+# -----------------------------
+# Vectorized filters
+# -----------------------------
+def local_moments(img, size):
+    """
+    Mean and variance of the valid (finite) pixels in every size x size
+    window of the last two axes, from running-sum (uniform) filters.
+
+    Pixels beyond the array and NaN pixels are left out of the windows, so
+    a block read with a halo gives the same values as the whole raster.
+    """
+    from scipy.ndimage import uniform_filter
+
+    footprint = (1,) * (img.ndim - 2) + (size, size)
+    valid = np.isfinite(img)
+    x = np.where(valid, img, 0.0).astype(np.float64)
+    frac = uniform_filter(valid.astype(np.float64), footprint, mode="constant")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = uniform_filter(x, footprint, mode="constant") / frac
+        var = uniform_filter(x * x, footprint, mode="constant") / frac - mean * mean
+    mean[frac < 0.5 / size**2] = np.nan
+    return mean, np.maximum(var, 0.0)
+
+
+def lee_filter(img, size=7, looks=DEFAULT_LOOKS):
+    """
+    Lee (1980) filter of linear-power backscatter over the last two axes:
+    the local mean plus the share of the deviation from it that exceeds
+    the multiplicative speckle variance (1 / looks).
+    """
+    mean, var = local_moments(img, size)
+    cu2 = 1.0 / looks
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var_x = (var - mean * mean * cu2) / (1.0 + cu2)
+        weight = np.clip(np.where(var > 0, var_x / var, 0.0), 0.0, 1.0)
+    out = mean + weight * (img - mean)
+    out[~np.isfinite(img)] = np.nan
+    return out
+
+
+def quegan_filter(stack, size=7, looks=DEFAULT_LOOKS, spatial="boxcar"):
+    """
+    Multi-temporal filter of Quegan & Yu (2001) along axis 0 (time):
+
+        J_t = E[I_t] / N * sum_k I_k / E[I_k]
+
+    where E is a spatial estimate of the local mean (boxcar mean, or the
+    Lee filter with spatial="lee") and the sum runs over the N valid dates
+    of each pixel. Speckle drops by up to N times while each date keeps its
+    own local mean.
+    """
+    if spatial == "lee":
+        local = lee_filter(stack, size, looks)
+    else:
+        local = local_moments(stack, size)[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = stack / local
+    ratio[~np.isfinite(ratio)] = np.nan
+    count = np.sum(np.isfinite(ratio), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_ratio = np.nansum(ratio, axis=0) / count
+    out = local * mean_ratio
+    out[~np.isfinite(stack)] = np.nan
+    return out
+
+
+def filter_block(block, method, size, looks, spatial="boxcar", db=False):
+    """Filter a (time, ..., y, x) block; dB input is filtered in linear power."""
+    if db:
+        block = 10.0 ** (block / 10.0)
+    if method == "quegan" and block.shape[0] > 1:
+        out = quegan_filter(block, size, looks, spatial)
+    else:
+        out = lee_filter(block, size, looks)
+    if db:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = 10.0 * np.log10(out)
+    return out.astype(np.float32)
+
+
+# -----------------------------
+# Chunked engine
+# -----------------------------
+def backscatter_variables(ds):
+    return [v for v in ds.data_vars if v not in NON_BACKSCATTER and {"y", "x"} <= set(ds[v].dims)]
+
+
+def _filter_task(path, out_path, variables, windows, opts):
+    """Read some chunks with a halo, filter them and write the interiors; runs in a worker."""
+    halo = opts["window"] // 2
+    with xr.open_zarr(path) as ds:
+        ny, nx = ds.sizes["y"], ds.sizes["x"]
+        for ys, xs in windows:
+            r0, r1 = max(ys.start - halo, 0), min(ys.stop + halo, ny)
+            c0, c1 = max(xs.start - halo, 0), min(xs.stop + halo, nx)
+            inner = (slice(ys.start - r0, ys.stop - r0), slice(xs.start - c0, xs.stop - c0))
+            out = {}
+            for v in variables:
+                da = ds[v].transpose(..., "y", "x")
+                block = da.isel(y=slice(r0, r1), x=slice(c0, c1)).values.astype(np.float64)
+                filtered = filter_block(block, opts["method"], opts["window"], opts["looks"],
+                                        opts["spatial"], opts["db"])
+                out[v] = (da.dims, filtered[(..., *inner)])
+            xr.Dataset(out).to_zarr(out_path, region={"y": ys, "x": xs})
+    return len(windows)
+
+
+def filter_store(path, out_path, method="quegan", window=7, looks=DEFAULT_LOOKS, spatial="boxcar",
+                 db=False, tile=None, workers=1, budget=None):
+    """
+    Write the speckle-filtered cube of an S1 time-series store.
+
+    Every variable on y/x (time-stacked, with any band dimension) is
+    filtered chunk by chunk: each chunk is read with all of its dates and a
+    halo of window // 2 pixels, so the output does not depend on the
+    chunking. The output has the input's variables, coordinates and chunks.
+
+    Returns:
+        Number of chunks filtered.
+    """
+    import dask.array as dsa
+
+    if method not in METHODS:
+        raise ValueError(f"Unknown speckle filter {method!r}; expected one of {METHODS}")
+    with xr.open_zarr(path) as ds:
+        variables = backscatter_variables(ds)
+        if method == "quegan" and "time" not in ds.dims:
+            logger.warning(f"{Path(path).name} has no time dimension; using the Lee filter")
+            method = "lee"
+        enc = store_chunks(ds[variables[0]])
+        chunks = (tile or enc["y"], tile or enc["x"])
+        shape = (ds.sizes["y"], ds.sizes["x"])
+
+        if budget is not None:
+            halo_pixels = (chunks[0] + window) * (chunks[1] + window)
+            block_bytes = max(ds[v].size // (shape[0] * shape[1]) for v in variables) * halo_pixels * 8
+            workers = budget_workers(workers, budget, block_bytes * DEFAULT_COPIES)
+
+        # Metadata-only template with the input's coordinates, filled chunk by chunk
+        data = {}
+        for v in variables:
+            da = ds[v].transpose(..., "y", "x")
+            var_chunks = tuple({"y": chunks[0], "x": chunks[1]}.get(d, enc.get(d, da.sizes[d])) for d in da.dims)
+            data[v] = (da.dims, dsa.zeros(da.shape, dtype=np.float32, chunks=var_chunks), da.attrs)
+        coords = {c: ds[c] for c in ds[variables].coords}
+        template = xr.Dataset(data, coords=coords, attrs={
+            **ds.attrs, "speckle_filter": method, "speckle_window": window, "speckle_looks": looks})
+        template.to_zarr(out_path, mode="w", compute=False)
+
+    windows = chunk_windows(shape, chunks)
+    n_tasks = max(1, min(len(windows), workers * 4))
+    groups = [windows[k::n_tasks] for k in range(n_tasks)]
+    opts = {"method": method, "window": window, "looks": looks, "spatial": spatial, "db": db}
+    return sum(map_tasks(_filter_task, [(str(path), str(out_path), variables, g, opts) for g in groups], workers))
+
+
+def run(cfg):
+    """
+    Speckle-filter the Sentinel-1 time-series stores.
+
+    Filtered stores are written to <input_dir>/s1/filtered/ with the name
+    of their source store; compute.run reads them instead of the raw
+    backscatter when eo.speckle is configured. A filtered store is marked
+    complete after its last chunk; stores with a complete filtered copy of
+    the current source are skipped, half-written ones are redone.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - input_dir: path to raw EO data
+            - eo.speckle:
+                - method: "quegan" (multi-temporal, default) or "lee"
+                - window: filter window size in pixels (default 7)
+                - looks: equivalent number of looks of the input (default 4.4)
+                - spatial: local mean estimator of the Quegan filter,
+                  "boxcar" (default) or "lee"
+                - db: input backscatter is in dB (default False: linear power)
+                - tile: chunk size override in pixels (default: store chunks)
+                - workers: process count (default 1)
+            - memory_budget: optional total memory for the stage (e.g. "4GB");
+              workers are capped so each can hold a chunk's time series
+    Returns:
+        List of filtered store paths.
+    """
+    logger.info("Starting Sentinel-1 speckle filtering...")
+
+    sp_cfg = cfg["eo"]["speckle"]
+    src_dir = Path(cfg["input_dir"]) / "s1"
+    out_dir = src_dir / "filtered"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    budget = memory_budget(cfg)
+
+    written = []
+    for store in sorted(src_dir.glob("*.zarr")):
+        out_path = out_dir / store.name
+        stamp = store_stamp(store)
+        if is_complete(out_path, stamp):
+            continue
+        t0 = time.perf_counter()
+        n = filter_store(store, out_path, method=sp_cfg.get("method", "quegan"), window=sp_cfg.get("window", 7),
+                         looks=sp_cfg.get("looks", DEFAULT_LOOKS), spatial=sp_cfg.get("spatial", "boxcar"),
+                         db=sp_cfg.get("db", False), tile=sp_cfg.get("tile"),
+                         workers=sp_cfg.get("workers", 1), budget=budget)
+        mark_complete(out_path, stamp)
+        logger.info(f"Filtered {n} chunks of {store.name} in {time.perf_counter() - t0:.1f}s -> {out_path}")
+        written.append(out_path)
+
+    logger.info("Speckle filtering completed.")
+    return written
+
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def naive_lee(img, size=7, looks=DEFAULT_LOOKS):
+    """Per-pixel reference of lee_filter for a (y, x) image: explicit window loops."""
+    half = size // 2
+    cu2 = 1.0 / looks
+    out = np.full(img.shape, np.nan)
+    for i in range(img.shape[0]):
+        for j in range(img.shape[1]):
+            if not np.isfinite(img[i, j]):
+                continue
+            w = img[max(i - half, 0):i + half + 1, max(j - half, 0):j + half + 1]
+            w = w[np.isfinite(w)]
+            m, v = w.mean(), w.var()
+            k = min(max((v - m * m * cu2) / (1 + cu2) / v, 0.0), 1.0) if v > 0 else 0.0
+            out[i, j] = m + k * (img[i, j] - m)
+    return out
+
+
+def synthetic_stack(n_time=24, size=512, looks=DEFAULT_LOOKS, patch=32, seed=0):
+    """
+    Speckled VV/VH-like stack: piecewise-constant backscatter patches with
+    a seasonal cycle, times unit-mean gamma speckle of `looks` looks.
+
+    Returns:
+        (stack, truth), both (n_time, size, size) linear power.
+    """
+    rng = np.random.default_rng(seed)
+    n = size // patch + 1
+    base = rng.uniform(0.01, 0.3, (n, n)).repeat(patch, 0).repeat(patch, 1)[:size, :size]
+    season = 1 + 0.3 * np.sin(np.linspace(0, 2 * np.pi, n_time, endpoint=False))
+    truth = base[None] * season[:, None, None]
+    stack = truth * rng.gamma(looks, 1 / looks, truth.shape)
+    return stack.astype(np.float32), truth.astype(np.float32)
+
+
+def benchmark(n_time=24, size=512, window=7, tile=128, workers=(1, 4), check=48, seed=0):
+    """
+    Time the filters on a synthetic speckled stack, check lee_filter
+    against the per-pixel reference on a check x check corner, and report
+    the speckle reduction (ENL of the interior of one patch) and error
+    against the noise-free backscatter.
+
+    Returns:
+        dict of label -> pixel-dates per second.
+    """
+    stack, truth = synthetic_stack(n_time, size, seed=seed)
+    rates = {}
+
+    corner = stack[0, :check, :check].astype(np.float64)
+    t0 = time.perf_counter()
+    ref = naive_lee(corner, window)
+    rates["naive lee"] = corner.size / (time.perf_counter() - t0)
+    err = np.nanmax(np.abs(lee_filter(corner, window) - ref) / ref)
+    logger.info(f"Lee: max relative difference to reference {err:.2e}")
+
+    # interior of the first patch, away from its edges
+    def enl(img):
+        p = img[..., 8:24, 8:24]
+        return float(np.mean(p.mean(axis=(-2, -1)) ** 2 / p.var(axis=(-2, -1))))
+
+    def rmse(img):
+        return float(np.sqrt(np.nanmean((img / truth - 1) ** 2)))
+
+    logger.info(f"Raw: ENL {enl(stack):.1f}, relative RMSE {rmse(stack):.3f}")
+    for method in METHODS:
+        t0 = time.perf_counter()
+        out = filter_block(stack.astype(np.float64), method, window, DEFAULT_LOOKS)
+        rates[method] = stack.size / (time.perf_counter() - t0)
+        logger.info(f"{method}: ENL {enl(out):.1f}, relative RMSE {rmse(out):.3f}, "
+                    f"{rates[method] / 1e6:.2f}M pixel-dates/s ({rates[method] / rates['naive lee']:.0f}x reference)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = Path(tmp) / "s1_synthetic.zarr"
+        coords = {"time": np.arange(n_time), "y": np.arange(size)[::-1] + 0.5, "x": np.arange(size) + 0.5}
+        xr.Dataset({"VV": (("time", "y", "x"), stack)}, coords=coords).chunk(
+            {"time": 1, "y": tile, "x": tile}).to_zarr(store)
+        for n in workers:
+            t0 = time.perf_counter()
+            filter_store(store, Path(tmp) / f"filtered_{n}.zarr", window=window, workers=n)
+            rates[f"{n} workers"] = stack.size / (time.perf_counter() - t0)
+            logger.info(f"Store, {n} workers: {rates[f'{n} workers'] / 1e6:.2f}M pixel-dates/s")
+        chunked = xr.open_zarr(Path(tmp) / f"filtered_{workers[0]}.zarr")["VV"].values
+        whole = filter_block(stack.astype(np.float64), "quegan", window, DEFAULT_LOOKS)
+        logger.info(f"Chunked vs whole-raster filter: max relative difference "
+                    f"{np.nanmax(np.abs(chunked - whole) / whole):.2e}")
+    return rates
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "input_dir": "data/raw/eo",
+        "eo": {
+            "speckle": {"method": "quegan", "window": 7, "workers": 4},
+        },
+    }
+    run(dummy_cfg)
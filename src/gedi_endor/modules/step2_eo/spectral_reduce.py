@@ -0,0 +1,388 @@
+# modules/step2_eo/spectral_reduce.py
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import chunk_windows, is_complete, map_tasks, mark_complete, store_chunks, store_stamp
+from memory_budget import DEFAULT_COPIES, budget_workers, memory_budget
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Variables of gridded stores that are not spectral bands
+NON_SPECTRAL = ("count", "spatial_ref")
+
+
+# -----------------------------
+# Hyperspectral stores
+# -----------------------------
+def spectral_array(ds, variable=None):
+    """
+    The spectral cube of a gridded store as a lazy (time, band, y, x) DataArray.
+
+    EMIT stores hold one `reflectance` variable with a band dimension (bands
+    flagged bad in `good_wavelengths` are dropped); PACE stores hold one
+    (time, y, x) variable per band, which are stacked along `band`.
+    """
+    if variable is None and "reflectance" in ds.data_vars:
+        variable = "reflectance"
+    if variable is not None:
+        cube = ds[variable]
+        band_dim = next(d for d in cube.dims if d not in ("time", "y", "x"))
+        cube = cube.rename({band_dim: "band"}) if band_dim != "band" else cube
+        if "good_wavelengths" in cube.coords:
+            cube = cube.isel(band=np.flatnonzero(cube["good_wavelengths"].values > 0))
+        return cube.transpose("time", "band", "y", "x")
+    names = [v for v in ds.data_vars if v not in NON_SPECTRAL and ds[v].dims == ("time", "y", "x")]
+    return xr.concat([ds[v] for v in names], dim="band").assign_coords(band=names)
+
+
+def band_labels(cube):
+    if "wavelengths" in cube.coords:
+        return np.array([f"{w:g}" for w in cube["wavelengths"].values])
+    return np.array([str(b) for b in cube["band"].values])
+
+
+def cube_windows(ds, cube):
+    """(time, y slice, x slice) of every spatial chunk of the store."""
+    first = next(v for v in ds.data_vars if v not in NON_SPECTRAL)
+    chunks = store_chunks(ds[first])
+    shape = (cube.sizes["y"], cube.sizes["x"])
+    return [(t, ys, xs) for t in range(cube.sizes["time"])
+            for ys, xs in chunk_windows(shape, (chunks.get("y", shape[0]), chunks.get("x", shape[1])))]
+
+
+# -----------------------------
+# Streaming moments
+# -----------------------------
+class SpectralMoments:
+    """
+    Running first and second moments of pixel spectra, plus the second
+    moments of neighbour differences (the noise estimate MNF needs).
+
+    Moments of different chunks are merged by addition, so chunks can be
+    reduced in any order and on any number of workers, and the result is
+    the exact covariance of every pixel seen.
+    """
+
+    def __init__(self, n_bands):
+        self.n = 0
+        self.sum = np.zeros(n_bands)
+        self.outer = np.zeros((n_bands, n_bands))
+        self.noise_n = 0
+        self.noise_outer = np.zeros((n_bands, n_bands))
+
+    def add_block(self, block, max_pixels=None, rng=None):
+        """
+        Add a (band, rows, cols) block. Pixels with any NaN band are skipped;
+        with `max_pixels`, a random subset of the valid pixels is used.
+        """
+        n_bands = block.shape[0]
+        x = block.reshape(n_bands, -1).T.astype(np.float64)
+        x = x[np.isfinite(x).all(axis=1)]
+        # Horizontal neighbour differences: signal cancels, noise doubles in variance
+        d = (block[:, :, 1:] - block[:, :, :-1]).reshape(n_bands, -1).T.astype(np.float64)
+        d = d[np.isfinite(d).all(axis=1)]
+        if max_pixels is not None:
+            rng = rng or np.random.default_rng()
+            if len(x) > max_pixels:
+                x = x[rng.choice(len(x), max_pixels, replace=False)]
+            if len(d) > max_pixels:
+                d = d[rng.choice(len(d), max_pixels, replace=False)]
+        self.n += len(x)
+        self.sum += x.sum(axis=0)
+        self.outer += x.T @ x
+        self.noise_n += len(d)
+        self.noise_outer += d.T @ d
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.sum += other.sum
+        self.outer += other.outer
+        self.noise_n += other.noise_n
+        self.noise_outer += other.noise_outer
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.n
+
+    @property
+    def covariance(self):
+        return (self.outer - self.n * np.outer(self.mean, self.mean)) / max(self.n - 1, 1)
+
+    @property
+    def noise_covariance(self):
+        return self.noise_outer / max(2 * self.noise_n, 1)
+
+
+# -----------------------------
+# Fitted transform
+# -----------------------------
+class SpectralTransform:
+    """
+    Linear projection of spectra onto k components: (x - mean) @ components.T.
+
+    method="pca" uses the leading eigenvectors of the covariance; "mnf"
+    (minimum noise fraction) solves the generalized eigenproblem of the
+    covariance against the noise covariance, so components are ordered by
+    signal-to-noise rather than variance and have unit noise variance.
+    """
+
+    def __init__(self, mean, components, eigenvalues, method, bands):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.eigenvalues = np.asarray(eigenvalues, dtype=np.float64)
+        self.method = str(method)
+        self.bands = np.asarray(bands).astype(str)
+
+    @property
+    def k(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, moments, k, method="pca", bands=None):
+        from scipy.linalg import eigh
+
+        cov = moments.covariance
+        if method == "pca":
+            values, vectors = eigh(cov)
+        elif method == "mnf":
+            noise = moments.noise_covariance
+            # Small ridge keeps the noise covariance positive definite for flat bands
+            noise = noise + np.eye(len(noise)) * 1e-9 * max(np.trace(noise) / len(noise), 1e-12)
+            values, vectors = eigh(cov, noise)
+        else:
+            raise ValueError(f"Unknown reduction method '{method}'")
+        order = np.argsort(values)[::-1][:k]
+        bands = bands if bands is not None else np.arange(len(cov))
+        return cls(moments.mean, vectors[:, order].T, values[order], method, bands)
+
+    def explained_ratio(self, moments):
+        """Share of the total variance (pca) carried by each component."""
+        return self.eigenvalues / np.trace(moments.covariance)
+
+    def transform(self, x):
+        """Project (n, bands) spectra to (n, k) float32; rows with NaN stay NaN."""
+        out = (np.asarray(x, dtype=np.float32) - self.mean) @ self.components.T
+        return out.astype(np.float32, copy=False)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components, eigenvalues=self.eigenvalues,
+                 method=self.method, bands=self.bands)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["mean"], f["components"], f["eigenvalues"], f["method"].item(), f["bands"])
+
+
+# -----------------------------
+# Worker tasks
+# -----------------------------
+def _moments_task(paths_windows, variable, max_pixels, seed):
+    """Moments of a list of (store, window) chunks; runs in a worker process."""
+    moments, rng = None, np.random.default_rng(seed)
+    for path, (t, ys, xs) in paths_windows:
+        with xr.open_zarr(path) as ds:
+            block = spectral_array(ds, variable).isel(time=t, y=ys, x=xs).values
+        moments = moments or SpectralMoments(block.shape[0])
+        moments.add_block(block, max_pixels=max_pixels, rng=rng)
+    return moments
+
+
+def _project_task(path, out_path, variable, windows, transform_path):
+    """Project chunks of one store and write them into its component store."""
+    transform = SpectralTransform.load(transform_path)
+    with xr.open_zarr(path) as ds:
+        cube = spectral_array(ds, variable)
+        for t, ys, xs in windows:
+            block = cube.isel(time=t, y=ys, x=xs).values
+            n_bands, rows, cols = block.shape
+            comps = transform.transform(block.reshape(n_bands, -1).T)
+            comps = comps.T.reshape(1, transform.k, rows, cols)
+            xr.Dataset({"components": (("time", "component", "y", "x"), comps)}).to_zarr(
+                out_path, region={"time": slice(t, t + 1), "component": slice(0, transform.k), "y": ys, "x": xs},
+            )
+    return len(windows)
+
+
+# -----------------------------
+# Fit / project
+# -----------------------------
+def fit_transform(stores, k=16, method="pca", variable=None, sample_fraction=1.0,
+                  max_pixels_per_chunk=20_000, workers=1, seed=0):
+    """
+    Fit a SpectralTransform over sampled chunks of one or more stores.
+
+    A random `sample_fraction` of all chunks (at least one) is read, each
+    capped at `max_pixels_per_chunk` valid pixels; chunks are reduced to
+    moments in `workers` processes and merged.
+    """
+    rng = np.random.default_rng(seed)
+    chunks, bands = [], None
+    for path in stores:
+        with xr.open_zarr(path) as ds:
+            cube = spectral_array(ds, variable)
+            labels = band_labels(cube)
+            if bands is not None and not np.array_equal(bands, labels):
+                raise ValueError(f"{path} has different bands than the other stores")
+            bands = labels
+            chunks.extend((str(path), w) for w in cube_windows(ds, cube))
+    keep = rng.random(len(chunks)) < sample_fraction
+    keep[rng.integers(len(chunks))] = True
+    chunks = [c for c, kept in zip(chunks, keep) if kept]
+    logger.info(f"Fitting {method} (k={k}) on {len(chunks)} chunks of {len(stores)} store(s), {len(bands)} bands")
+
+    n_tasks = max(1, min(len(chunks), workers * 4))
+    tasks = [(chunks[i::n_tasks], variable, max_pixels_per_chunk, seed + i) for i in range(n_tasks)]
+    moments = None
+    for part in map_tasks(_moments_task, tasks, workers):
+        moments = part if moments is None else moments.merge(part)
+    if moments.n <= len(bands):
+        raise ValueError(f"Only {moments.n} valid pixels sampled for {len(bands)} bands")
+
+    transform = SpectralTransform.fit(moments, min(k, len(bands)), method=method, bands=bands)
+    if method == "pca":
+        ratio = transform.explained_ratio(moments)
+        logger.info(f"{transform.k} components explain {ratio.sum():.1%} of the variance")
+    return transform
+
+
+def project_store(path, out_path, transform_path, variable=None, workers=1):
+    """
+    Write the components of every chunk of a store to a float32 Zarr store
+    with the same grid and chunking: components (time, component, y, x).
+    """
+    import dask.array as da
+
+    transform = SpectralTransform.load(transform_path)
+    with xr.open_zarr(path) as ds:
+        cube = spectral_array(ds, variable)
+        windows = cube_windows(ds, cube)
+        chy = windows[0][1].stop - windows[0][1].start
+        chx = windows[0][2].stop - windows[0][2].start
+        shape = (cube.sizes["time"], transform.k, cube.sizes["y"], cube.sizes["x"])
+        template = xr.Dataset(
+            {"components": (("time", "component", "y", "x"),
+                            da.full(shape, np.nan, dtype=np.float32, chunks=(1, transform.k, chy, chx)))},
+            coords={"time": ds["time"].values, "component": np.arange(transform.k),
+                    "y": ds["y"].values, "x": ds["x"].values},
+            attrs={"method": transform.method, "transform": Path(transform_path).name},
+        )
+        if "spatial_ref" in ds.variables:
+            template = template.assign_coords(spatial_ref=ds["spatial_ref"])
+        template.to_zarr(out_path, mode="w", compute=False)
+
+    # One task per row of chunks (per time step): rows write disjoint chunks
+    rows = {}
+    for w in windows:
+        rows.setdefault((w[0], w[1].start), []).append(w)
+    tasks = [(str(path), str(out_path), variable, row, str(transform_path)) for row in rows.values()]
+    n = sum(map_tasks(_project_task, tasks, workers))
+    logger.info(f"Projected {n} chunks of {Path(path).name} -> {out_path}")
+    return out_path
+
+
+# -----------------------------
+# Orchestrator
+# -----------------------------
+def run(cfg):
+    """
+    Reduce hyperspectral EMIT/PACE stores to a few spectral components.
+
+    One transform is fitted per source over all of its stores, so the
+    components of different scenes and dates are comparable. It is saved
+    next to the component stores and reused by later runs unless `refit`
+    is set. Component stores are marked complete after their last chunk;
+    stores with complete components of the current source are skipped.
+
+    Component stores are written to <input_dir>/<source>/components/ with
+    the name of their source store; compute.run reads them instead of the
+    raw bands for sources listed in eo.compute.spectral, and the point
+    sampler takes them like any other feature store.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - input_dir: path to raw EO data
+            - eo.reduce:
+                - sources: sources to reduce (default ["EMIT", "PACE"])
+                - k: number of components (default 16)
+                - method: "pca" (default) or "mnf"
+                - variable: spectral variable (default: reflectance, or all band variables)
+                - sample_fraction: share of chunks used for fitting (default 0.25)
+                - max_pixels_per_chunk: pixels sampled per chunk (default 20,000)
+                - workers: process count (default 1)
+                - refit: fit again even if a transform is saved (default False)
+                - seed: sampling seed (default 0)
+            - memory_budget: optional total memory for the stage (e.g. "4GB");
+              workers are capped so each can hold a few spectral chunks
+    Returns:
+        Dict of source -> list of component store paths.
+    """
+    logger.info("Starting spectral reduction...")
+
+    reduce_cfg = cfg["eo"]["reduce"]
+    k = reduce_cfg.get("k", 16)
+    method = reduce_cfg.get("method", "pca")
+    variable = reduce_cfg.get("variable")
+    budget = memory_budget(cfg)
+
+    written = {}
+    for source in reduce_cfg.get("sources", ["EMIT", "PACE"]):
+        src_dir = Path(cfg["input_dir"]) / source.lower()
+        stores = sorted(src_dir.glob("*.zarr"))
+        if not stores:
+            logger.warning(f"No {source} stores to reduce in {src_dir}")
+            continue
+        out_dir = src_dir / "components"
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        workers = reduce_cfg.get("workers", 1)
+        if budget is not None:
+            with xr.open_zarr(stores[0]) as ds:
+                cube = spectral_array(ds, variable)
+                t, ys, xs = cube_windows(ds, cube)[0]
+                chunk_bytes = cube.sizes["band"] * (ys.stop - ys.start) * (xs.stop - xs.start) * 8
+            workers = budget_workers(workers, budget, chunk_bytes * DEFAULT_COPIES)
+
+        transform_path = out_dir / f"{source.lower()}_{method}{k}.npz"
+        if reduce_cfg.get("refit", False) or not transform_path.exists():
+            transform = fit_transform(
+                stores, k=k, method=method, variable=variable,
+                sample_fraction=reduce_cfg.get("sample_fraction", 0.25),
+                max_pixels_per_chunk=reduce_cfg.get("max_pixels_per_chunk", 20_000),
+                workers=workers, seed=reduce_cfg.get("seed", 0),
+            )
+            transform.save(transform_path)
+            logger.info(f"Saved {source} transform to {transform_path}")
+            stale = True
+        else:
+            logger.info(f"Reusing {source} transform {transform_path}")
+            stale = False
+
+        written[source] = []
+        for store in stores:
+            out_path = out_dir / store.name
+            stamp = store_stamp(store)
+            if not stale and is_complete(out_path, stamp):
+                continue
+            written[source].append(project_store(store, out_path, transform_path, variable=variable, workers=workers))
+            mark_complete(out_path, stamp)
+
+    logger.info("Spectral reduction completed.")
+    return written
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "input_dir": "data/raw/eo",
+        "eo": {
+            "reduce": {"sources": ["EMIT"], "k": 16, "method": "mnf", "workers": 4},
+        },
+    }
+    run(dummy_cfg)
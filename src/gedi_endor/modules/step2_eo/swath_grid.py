@@ -0,0 +1,188 @@
+# modules/step2_eo/swath_grid.py
+
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rioxarray
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+# -----------------------------
+# Target grid
+# -----------------------------
+class TargetGrid:
+    """
+    A regular north-up grid: `res` sized cells from (west, north), ny x nx.
+
+    Bounds are snapped outwards to multiples of `res`, so grids built for the
+    same AOI and resolution always line up across runs and granules.
+    """
+
+    def __init__(self, bounds, res, crs="EPSG:4326"):
+        minx, miny, maxx, maxy = bounds
+        self.res = float(res)
+        self.crs = crs
+        self.west = math.floor(minx / self.res) * self.res
+        self.north = math.ceil(maxy / self.res) * self.res
+        self.nx = max(1, math.ceil((maxx - self.west) / self.res))
+        self.ny = max(1, math.ceil((self.north - miny) / self.res))
+        self.n_cells = self.nx * self.ny
+
+        self._transformer = None
+        from pyproj import CRS
+        if not CRS.from_user_input(crs).is_geographic:
+            from pyproj import Transformer
+            self._transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+    @classmethod
+    def for_aoi(cls, aoi, res, crs="EPSG:4326"):
+        """Grid covering an AOIContext (see aoi.py) in `crs`."""
+        return cls(aoi.to_crs(crs).total_bounds, res, crs=crs)
+
+    @property
+    def x(self):
+        return self.west + (np.arange(self.nx) + 0.5) * self.res
+
+    @property
+    def y(self):
+        return self.north - (np.arange(self.ny) + 0.5) * self.res
+
+    def cells(self, lon, lat):
+        """Flat cell index (row * nx + col) of WGS84 points, -1 off the grid."""
+        x, y = (lon, lat) if self._transformer is None else self._transformer.transform(lon, lat)
+        col = np.floor((np.asarray(x) - self.west) / self.res)
+        row = np.floor((self.north - np.asarray(y)) / self.res)
+        ok = (col >= 0) & (col < self.nx) & (row >= 0) & (row < self.ny)
+        return np.where(ok, row * self.nx + col, -1).astype(np.int64)
+
+
+# -----------------------------
+# Binning
+# -----------------------------
+class SwathBinner:
+    """
+    Accumulates swath pixels of several bands onto a TargetGrid.
+
+    Sums, weight sums and counts are kept per (band, cell) and updated with
+    one bincount per call for all bands, so granules (or line blocks of a
+    granule) can be added one at a time in bounded memory. Without weights
+    the result is the plain mean; with weights (e.g. a quality score or
+    inverse variance) it is the weighted mean.
+    """
+
+    def __init__(self, grid, names):
+        self.grid = grid
+        self.names = list(names)
+        n_bands = len(self.names)
+        self.sum = np.zeros((n_bands, grid.n_cells), dtype=np.float64)
+        self.wsum = np.zeros((n_bands, grid.n_cells), dtype=np.float64)
+        self.count = np.zeros((n_bands, grid.n_cells), dtype=np.int64)
+
+    def add(self, cells, values, weights=None):
+        """
+        Args:
+            cells: (n,) flat cell indices from TargetGrid.cells
+            values: (n, n_bands) pixel values; NaN pixels are skipped per band
+            weights: optional (n,) non-negative pixel weights
+        """
+        n_bands, n_cells = self.sum.shape
+        valid = (cells >= 0)[:, None] & np.isfinite(values)
+        if weights is not None:
+            valid &= (np.isfinite(weights) & (weights > 0))[:, None]
+        flat = (np.arange(n_bands)[None, :] * n_cells + cells[:, None])[valid]
+        if flat.size == 0:
+            return
+        size = n_bands * n_cells
+        counts = np.bincount(flat, minlength=size).reshape(n_bands, n_cells)
+        v = values[valid].astype(np.float64)
+        if weights is None:
+            self.sum += np.bincount(flat, weights=v, minlength=size).reshape(n_bands, n_cells)
+            self.wsum += counts
+        else:
+            w = np.broadcast_to(weights[:, None], values.shape)[valid].astype(np.float64)
+            self.sum += np.bincount(flat, weights=v * w, minlength=size).reshape(n_bands, n_cells)
+            self.wsum += np.bincount(flat, weights=w, minlength=size).reshape(n_bands, n_cells)
+        self.count += counts
+
+    @property
+    def empty(self):
+        return not self.count.any()
+
+    def datasets(self, time):
+        """
+        One time step as xarray Datasets (time, y, x).
+
+        Returns:
+            (cube, weights): the cube holds a float32 mean per band and
+            `count` (pixels in the cell, max over bands); weights holds the
+            per-band weight sums needed to merge later granules into the step.
+        """
+        g = self.grid
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(self.wsum > 0, self.sum / self.wsum, np.nan).astype(np.float32)
+        shape = (1, g.ny, g.nx)
+        coords = {"time": [pd.Timestamp(time)], "y": g.y, "x": g.x}
+        data = {name: (("time", "y", "x"), mean[i].reshape(shape)) for i, name in enumerate(self.names)}
+        data["count"] = (("time", "y", "x"), self.count.max(axis=0).astype(np.int32).reshape(shape))
+        cube = xr.Dataset(data, coords=coords).rio.write_crs(g.crs)
+        weights = xr.Dataset(
+            {name: (("time", "y", "x"), self.wsum[i].astype(np.float32).reshape(shape)) for i, name in enumerate(self.names)},
+            coords=coords,
+        )
+        return cube, weights
+
+
+def state_path(zarr_path):
+    """Sidecar store with the merge weights of a gridded cube (kept out of compute's *.zarr glob)."""
+    zarr_path = Path(zarr_path)
+    return zarr_path.parent / "_state" / f"{zarr_path.stem}_weights.zarr"
+
+
+def write_time_step(zarr_path, binner, time, chunk=512):
+    """
+    Write one binned time step into a time-stamped Zarr cube.
+
+    A new time stamp is appended along `time`. A time stamp already in the
+    store (a later granule of the same day, e.g. from an incremental run) is
+    merged with the stored step using the stored weights and rewritten in place.
+    """
+    zarr_path = Path(zarr_path)
+    weights_path = state_path(zarr_path)
+    cube, weights = binner.datasets(time)
+    names = binner.names
+    encoding = {v: {"chunks": (1, chunk, chunk)} for v in names + ["count"]}
+
+    if not zarr_path.exists():
+        cube.to_zarr(zarr_path, mode="w", encoding=encoding)
+        weights.to_zarr(weights_path, mode="w", encoding={v: encoding[v] for v in names})
+        return
+
+    store = xr.open_zarr(zarr_path)
+    times = pd.to_datetime(store["time"].values)
+    t = pd.Timestamp(time)
+    if t not in times:
+        cube.to_zarr(zarr_path, append_dim="time")
+        weights.to_zarr(weights_path, append_dim="time")
+        return
+
+    i = int(times.get_loc(t))
+    old = store.isel(time=slice(i, i + 1)).load()
+    old_w = xr.open_zarr(weights_path).isel(time=slice(i, i + 1)).load()
+    merged, merged_w = {}, {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name in names:
+            w_old = np.nan_to_num(old_w[name].values)
+            w_new = np.nan_to_num(weights[name].values)
+            total = w_old + w_new
+            acc = np.nan_to_num(old[name].values) * w_old + np.nan_to_num(cube[name].values) * w_new
+            merged[name] = (("time", "y", "x"), np.where(total > 0, acc / total, np.nan).astype(np.float32))
+            merged_w[name] = (("time", "y", "x"), total.astype(np.float32))
+    merged["count"] = (("time", "y", "x"), old["count"].values + cube["count"].values)
+    xr.Dataset(merged).to_zarr(zarr_path, region={"time": slice(i, i + 1)})
+    xr.Dataset(merged_w).to_zarr(weights_path, region={"time": slice(i, i + 1)})
@@ -0,0 +1,339 @@
+# modules/step3_autocorr/folds.py
+
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+METHODS = ("square", "hex", "kmeans")
+
+# Folds are recorded as bits of the uint32 buffer column
+MAX_FOLDS = 32
+
+# Largest dense cell index range mapped with bincount instead of np.unique
+DENSE_KEYS = 50_000_000
+
+# Shots used to fit the k-means cluster centres
+KMEANS_SAMPLE = 200_000
+
+
+# -----------------------------
+# Coordinates
+# -----------------------------
+def metric_xy(lon, lat, crs=None):
+    """
+    Shot coordinates in metres: in `crs` if given, else in the UTM zone of
+    the shots' centre (fine for AOI-sized extents; pass an equal-area CRS
+    for continental ones).
+    """
+    from pyproj import CRS, Transformer
+
+    if crs is None:
+        from pyproj.aoi import AreaOfInterest
+        from pyproj.database import query_utm_crs_info
+
+        lon_c, lat_c = float(np.median(lon)), float(np.median(lat))
+        info = query_utm_crs_info(datum_name="WGS 84",
+                                  area_of_interest=AreaOfInterest(lon_c, lat_c, lon_c, lat_c))[0]
+        crs = f"{info.auth_name}:{info.code}"
+    transformer = Transformer.from_crs("EPSG:4326", CRS.from_user_input(crs), always_xy=True)
+    x, y = transformer.transform(lon, lat)
+    return np.column_stack([x, y]), crs
+
+
+def _compact(key):
+    """Dense 0..n-1 ids of int64 keys (and the count of each id)."""
+    key = key - key.min()
+    if key.max() < DENSE_KEYS:
+        counts = np.bincount(key)
+        ids = np.cumsum(counts > 0) - 1
+        return ids[key], counts[counts > 0]
+    _, ids, counts = np.unique(key, return_inverse=True, return_counts=True)
+    return ids, counts
+
+
+def _cell_key(i, j):
+    i, j = i - i.min(), j - j.min()
+    return i.astype(np.int64) * (int(j.max()) + 1) + j
+
+
+# -----------------------------
+# Spatial blocks
+# -----------------------------
+def square_cells(xy, size):
+    """(column, row) of the size x size grid cell of every point."""
+    ij = np.floor(xy / size).astype(np.int64)
+    return ij[:, 0], ij[:, 1]
+
+
+def hex_cells(xy, size):
+    """
+    Axial (q, r) of the pointy-top hexagon of every point, for hexagons
+    whose centres are `size` apart (cube-coordinate rounding).
+    """
+    radius = size / np.sqrt(3)
+    q = (np.sqrt(3) / 3 * xy[:, 0] - xy[:, 1] / 3) / radius
+    r = (2 / 3 * xy[:, 1]) / radius
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def kmeans_cells(xy, n_clusters, seed=0):
+    """Nearest of n_clusters k-means centres (fitted on a sample of the points)."""
+    from scipy.spatial import cKDTree
+    from sklearn.cluster import MiniBatchKMeans
+
+    rng = np.random.default_rng(seed)
+    sample = xy[rng.choice(len(xy), min(len(xy), KMEANS_SAMPLE), replace=False)]
+    km = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, random_state=seed, batch_size=4096).fit(sample)
+    _, nearest = cKDTree(km.cluster_centers_).query(xy, workers=-1)
+    return nearest.astype(np.int64), np.zeros(len(xy), dtype=np.int64)
+
+
+def spatial_blocks(xy, method="square", size=5000.0, n_clusters=None, seed=0):
+    """
+    Block id (0..n_blocks-1) and shot count of every block.
+
+    size is the square side or hexagon spacing in metres; k-means uses
+    n_clusters (default: extent area / size^2).
+    """
+    if method == "square":
+        i, j = square_cells(xy, size)
+    elif method == "hex":
+        i, j = hex_cells(xy, size)
+    elif method == "kmeans":
+        if n_clusters is None:
+            extent = np.ptp(xy, axis=0)
+            n_clusters = max(2, int(extent[0] * extent[1] / size**2))
+        i, j = kmeans_cells(xy, min(n_clusters, len(xy)), seed)
+    else:
+        raise ValueError(f"Unknown block method {method!r}; expected one of {METHODS}")
+    return _compact(_cell_key(i, j))
+
+
+# -----------------------------
+# Fold balancing
+# -----------------------------
+def target_bins(target, bins=10):
+    """Quantile bin of every shot's target (NaN targets go to an extra bin)."""
+    finite = np.isfinite(target)
+    edges = np.nanquantile(target[finite], np.linspace(0, 1, bins + 1)[1:-1]) if finite.any() else []
+    out = np.searchsorted(edges, target, side="right")
+    out[~finite] = bins
+    return out, bins + 1
+
+
+def assign_folds(hist, k, seed=0):
+    """
+    Greedy assignment of blocks to k folds balancing shot counts and target
+    distribution.
+
+    Blocks are placed largest first (random order among equal sizes) into
+    the fold whose per-bin counts would end up closest, in squared
+    distance, to an equal 1/k share of every bin: with fold counts H and
+    block counts h that is the fold minimizing h . (H - goal).
+
+    Args:
+        hist: (n_blocks, n_bins) shot count of every block per target bin
+    Returns:
+        (n_blocks,) fold of every block.
+    """
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(hist)), -hist.sum(axis=1)))
+    goal = hist.sum(axis=0) / k
+    fold_hist = np.zeros((k, hist.shape[1]))
+    folds = np.empty(len(hist), dtype=np.int8)
+    for b in order:
+        f = int(np.argmin((fold_hist - goal) @ hist[b]))
+        folds[b] = f
+        fold_hist[f] += hist[b]
+    return folds
+
+
+# -----------------------------
+# Buffer exclusion
+# -----------------------------
+def near_cells(cells, ref, shape):
+    """
+    Mask of the points whose grid cell is, or touches, a cell holding a
+    ref point. With buffer-sized cells, these are the only points that can
+    lie within the buffer of a ref point: a cheap filter ahead of the
+    exact KD-tree query.
+
+    Args:
+        cells: (n, 2) integer cell of every point
+        ref: boolean mask of the reference points
+        shape: shape of the cell grid
+    """
+    occupied = np.zeros((shape[0] + 2, shape[1] + 2), dtype=bool)
+    occupied[cells[ref, 0] + 1, cells[ref, 1] + 1] = True
+    near = np.zeros(shape, dtype=bool)
+    for di in range(3):
+        for dj in range(3):
+            near |= occupied[di:di + shape[0], dj:dj + shape[1]]
+    return near[cells[:, 0], cells[:, 1]]
+
+
+def buffer_mask(xy, folds, k, buffer):
+    """
+    uint32 bitmask of the folds whose test shots lie within `buffer` metres
+    of each shot: bit f set means the shot is dropped from training in fold f.
+    """
+    from scipy.spatial import cKDTree
+
+    mask = np.zeros(len(xy), dtype=np.uint32)
+    cells = np.floor((xy - xy.min(axis=0)) / buffer).astype(np.int64)
+    shape = tuple(cells.max(axis=0) + 1)
+    dense = shape[0] * shape[1] <= DENSE_KEYS
+    for f in range(k):
+        test = folds == f
+        if not test.any():
+            continue
+        cand, ref = ~test, test
+        if dense:
+            # Only test shots next to a training shot can be within the buffer of one
+            cand = cand & near_cells(cells, test, shape)
+            ref = ref & near_cells(cells, ~test, shape)
+        cand = np.flatnonzero(cand)
+        if len(cand):
+            dist, _ = cKDTree(xy[ref]).query(xy[cand], distance_upper_bound=buffer, workers=-1)
+            mask[cand[np.isfinite(dist)]] |= np.uint32(1 << f)
+    return mask
+
+
+def fold_masks(folds, buffer, f):
+    """(train, test) boolean masks of fold f from the fold and buffer columns."""
+    test = np.asarray(folds) == f
+    excluded = (np.asarray(buffer, dtype=np.uint32) >> np.uint32(f)) & np.uint32(1)
+    return ~test & (excluded == 0), test
+
+
+def make_folds(xy, k=5, method="square", size=5000.0, n_clusters=None, target=None, bins=10,
+               buffer=0.0, seed=0):
+    """
+    Spatially blocked CV folds of shots at metric coordinates xy.
+
+    Returns:
+        dict of block (int32), fold (int8) and buffer (uint32 bitmask, see
+        buffer_mask) arrays, one value per shot.
+    """
+    if not 2 <= k <= MAX_FOLDS:
+        raise ValueError(f"k must be between 2 and {MAX_FOLDS}")
+    t0 = time.perf_counter()
+    block, counts = spatial_blocks(xy, method, size, n_clusters, seed)
+    t1 = time.perf_counter()
+    if target is not None:
+        tbin, n_bins = target_bins(np.asarray(target, dtype=np.float64), bins)
+    else:
+        tbin, n_bins = np.zeros(len(xy), dtype=np.int64), 1
+    hist = np.bincount(block * n_bins + tbin, minlength=len(counts) * n_bins).reshape(len(counts), n_bins)
+    block_fold = assign_folds(hist, k, seed)
+    folds = block_fold[block]
+    t2 = time.perf_counter()
+    mask = buffer_mask(xy, folds, k, buffer) if buffer and buffer > 0 else np.zeros(len(xy), dtype=np.uint32)
+    t3 = time.perf_counter()
+    logger.info(f"{len(xy)} shots in {len(counts)} {method} blocks ({t1 - t0:.2f}s), "
+                f"{k} folds ({t2 - t1:.2f}s), buffer {buffer:g} m ({t3 - t2:.2f}s)")
+    return {"block": block.astype(np.int32), "fold": folds, "buffer": mask}
+
+
+def fold_summary(folds, k, target=None, buffer=None):
+    """Per-fold test count, target mean/std and share of the training shots removed by the buffer."""
+    rows = []
+    for f in range(k):
+        train, test = fold_masks(folds, buffer if buffer is not None else np.zeros(len(folds)), f)
+        row = {"fold": f, "test": int(test.sum()), "train": int(train.sum()),
+               "buffered": float(1 - train.sum() / max((~test).sum(), 1))}
+        if target is not None:
+            row["target_mean"] = float(np.nanmean(target[test]))
+            row["target_std"] = float(np.nanstd(target[test]))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def run(cfg):
+    """
+    Spatially blocked cross-validation folds for GEDI shots.
+
+    Shots are projected to metres and assigned to blocks (a square or
+    hexagonal grid, or k-means clusters); blocks are dealt to folds so
+    that every fold gets about the same number of shots in every target
+    quantile. With a buffer, training shots within that distance of a
+    fold's test shots are flagged (KD-tree query) so they can be left out
+    of that fold's training set. Everything is array arithmetic over all
+    shots, so folds can be regenerated per experiment.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - autocorr.folds:
+                - shots: GEDI Parquet file or directory
+                - output: output Parquet file (shot_number, block, fold, buffer)
+                - k: number of folds (default 5)
+                - method: "square" (default), "hex" or "kmeans"
+                - block_size: square side / hexagon spacing in metres (default 5000)
+                - n_clusters: k-means clusters (default: extent area / block_size^2)
+                - target: optional column whose distribution is balanced across folds
+                - bins: target quantile bins (default 10)
+                - buffer: exclusion distance around test shots in metres (default 0)
+                - crs: metric CRS (default: UTM zone of the shots' centre)
+                - seed: default 0
+                - lat_column / lon_column: default lat_lowestmode / lon_lowestmode
+    Returns:
+        Path to the fold table.
+    """
+    logger.info("Starting spatial fold generation...")
+
+    f_cfg = cfg["autocorr"]["folds"]
+    k = f_cfg.get("k", 5)
+    lat_col = f_cfg.get("lat_column", "lat_lowestmode")
+    lon_col = f_cfg.get("lon_column", "lon_lowestmode")
+    target_col = f_cfg.get("target")
+    columns = ["shot_number", lat_col, lon_col] + ([target_col] if target_col else [])
+    shots = pads.dataset(str(f_cfg["shots"]), format="parquet").to_table(columns=columns)
+
+    xy, crs = metric_xy(shots[lon_col].to_numpy(), shots[lat_col].to_numpy(), f_cfg.get("crs"))
+    target = shots[target_col].to_numpy(zero_copy_only=False).astype(np.float64) if target_col else None
+    out = make_folds(xy, k=k, method=f_cfg.get("method", "square"), size=f_cfg.get("block_size", 5000.0),
+                     n_clusters=f_cfg.get("n_clusters"), target=target, bins=f_cfg.get("bins", 10),
+                     buffer=f_cfg.get("buffer", 0.0), seed=f_cfg.get("seed", 0))
+
+    summary = fold_summary(out["fold"], k, target, out["buffer"])
+    logger.info(f"Folds ({crs}):\n{summary.to_string(index=False)}")
+
+    out_path = Path(f_cfg["output"])
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.table({"shot_number": shots["shot_number"], **{name: pa.array(v) for name, v in out.items()}})
+    pq.write_table(table.replace_schema_metadata({"crs": crs, "k": str(k)}), out_path)
+    logger.info(f"Spatial folds written to {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "autocorr": {
+            "folds": {
+                "shots": "data/processed/eo/gedi/GEDI_L2A",
+                "output": "data/features/gedi_folds.parquet",
+                "k": 5,
+                "method": "hex",
+                "block_size": 10000,
+                "target": "rh98",
+                "buffer": 2000,
+            }
+        }
+    }
+    run(dummy_cfg)
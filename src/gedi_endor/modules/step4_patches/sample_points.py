@@ -0,0 +1,299 @@
+# modules/step4_patches/sample_points.py
+
+import itertools
+import logging
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Spatial dimension names tried in order when opening a feature store
+Y_DIMS = ("y", "lat", "latitude")
+X_DIMS = ("x", "lon", "longitude")
+
+
+# -----------------------------
+# Shot input
+# -----------------------------
+def iter_shot_batches(path, columns, batch_size):
+    """
+    Stream GEDI shots from a Parquet file or directory in batches of
+    roughly `batch_size` rows, reading only `columns`.
+    """
+    dataset = pads.dataset(str(path), format="parquet")
+    buffer, n = [], 0
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        buffer.append(batch)
+        n += batch.num_rows
+        if n >= batch_size:
+            yield pa.Table.from_batches(buffer).to_pandas()
+            buffer, n = [], 0
+    if buffer:
+        yield pa.Table.from_batches(buffer).to_pandas()
+
+
+# -----------------------------
+# Feature stores
+# -----------------------------
+class FeatureStore:
+    """
+    A gridded EO Zarr store prepared for point sampling: regular y/x axes,
+    the Zarr chunk grid, and the data variables flattened into feature
+    columns (leading dims such as band/time become one column per index).
+    """
+
+    def __init__(self, path, name=None, variables=None):
+        self.path = Path(path)
+        self.name = name or self.path.stem
+        self.ds = xr.open_zarr(self.path)
+
+        self.ydim = next(d for d in Y_DIMS if d in self.ds.dims)
+        self.xdim = next(d for d in X_DIMS if d in self.ds.dims)
+        y = self.ds[self.ydim].values
+        x = self.ds[self.xdim].values
+        self.ny, self.nx = len(y), len(x)
+        self.y0, self.x0 = float(y[0]), float(x[0])
+        self.dy = float(y[1] - y[0]) if self.ny > 1 else 1.0
+        self.dx = float(x[1] - x[0]) if self.nx > 1 else 1.0
+
+        self.variables = [
+            v for v in (variables or self.ds.data_vars)
+            if self.ydim in self.ds[v].dims and self.xdim in self.ds[v].dims
+        ]
+        if not self.variables:
+            raise ValueError(f"{self.path} has no variables on ({self.ydim}, {self.xdim})")
+
+        # Chunk grid of the first variable drives the grouping of shots
+        first = self.ds[self.variables[0]]
+        chunks = dict(zip(first.dims, first.encoding.get("chunks") or first.shape))
+        self.chy, self.chx = chunks[self.ydim], chunks[self.xdim]
+        self.n_chunks_x = -(-self.nx // self.chx)
+
+        self.columns = [c for v in self.variables for c in self.variable_columns(v)]
+        self.transformer = self._make_transformer()
+
+    def variable_columns(self, v, skip=()):
+        """Column names of one variable: one per index of its leading dims other than `skip`."""
+        da = self.ds[v]
+        lead = [d for d in da.dims if d not in (self.ydim, self.xdim, *skip)]
+        if not lead:
+            return [f"{self.name}_{v}"]
+        labels = [
+            [str(c) for c in (da[d].values if d in da.coords else range(da.sizes[d]))]
+            for d in lead
+        ]
+        return [f"{self.name}_{v}_{'_'.join(combo)}" for combo in itertools.product(*labels)]
+
+    def _make_transformer(self):
+        """WGS84 -> store CRS transformer, or None if the grid is geographic."""
+        if "spatial_ref" in self.ds.coords:
+            crs = self.ds["spatial_ref"].attrs.get("crs_wkt")
+        else:
+            crs = self.ds.attrs.get("crs")
+        if crs is None:
+            return None
+        from pyproj import CRS, Transformer
+        crs = CRS.from_user_input(crs)
+        if crs.is_geographic:
+            return None
+        return Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+    def project(self, lon, lat):
+        """Transform WGS84 lon/lat to the store's CRS (no-op if geographic)."""
+        if self.transformer is None:
+            return lon, lat
+        return self.transformer.transform(lon, lat)
+
+    def fractional_index(self, lon, lat):
+        """Fractional (row, col) of points, with pixel centres at integers."""
+        x, y = self.project(lon, lat)
+        return (np.asarray(y) - self.y0) / self.dy, (np.asarray(x) - self.x0) / self.dx
+
+    def read_block(self, cy, cx, halo):
+        """
+        Read one Zarr chunk plus `halo` pixels on each side for all variables.
+
+        Returns:
+            (block, row_offset, col_offset) with block shaped (features, rows, cols).
+        """
+        r0 = max(cy * self.chy - halo, 0)
+        r1 = min((cy + 1) * self.chy + halo, self.ny)
+        c0 = max(cx * self.chx - halo, 0)
+        c1 = min((cx + 1) * self.chx + halo, self.nx)
+        return self.read_window(slice(r0, r1), slice(c0, c1)), r0, c0
+
+    def read_window(self, ys, xs):
+        """All features of a pixel window as a (features, rows, cols) float32 block, in column order."""
+        sub = self.ds[self.variables].isel({self.ydim: ys, self.xdim: xs}).load()
+        layers = []
+        for v in self.variables:
+            da = sub[v]
+            lead = [d for d in da.dims if d not in (self.ydim, self.xdim)]
+            arr = da.transpose(*lead, self.ydim, self.xdim).values.astype(np.float32)
+            layers.append(arr.reshape(-1, arr.shape[-2], arr.shape[-1]))
+        return np.concatenate(layers, axis=0)
+
+
+# -----------------------------
+# Vectorized gathers
+# -----------------------------
+def gather_nearest(block, fy, fx):
+    iy = np.floor(fy + 0.5).astype(np.int64)
+    ix = np.floor(fx + 0.5).astype(np.int64)
+    return block[:, iy, ix]
+
+
+def gather_bilinear(block, fy, fx):
+    _, h, w = block.shape
+    y0 = np.floor(fy).astype(np.int64)
+    x0 = np.floor(fx).astype(np.int64)
+    wy = (fy - y0).astype(np.float32)
+    wx = (fx - x0).astype(np.float32)
+    y0c, y1c = np.clip(y0, 0, h - 1), np.clip(y0 + 1, 0, h - 1)
+    x0c, x1c = np.clip(x0, 0, w - 1), np.clip(x0 + 1, 0, w - 1)
+    return (block[:, y0c, x0c] * (1 - wy) * (1 - wx) + block[:, y0c, x1c] * (1 - wy) * wx
+            + block[:, y1c, x0c] * wy * (1 - wx) + block[:, y1c, x1c] * wy * wx)
+
+
+def gather_mean(block, fy, fx, window):
+    """NaN-aware mean over a window x window footprint centred on each point."""
+    _, h, w = block.shape
+    iy = np.floor(fy + 0.5).astype(np.int64)
+    ix = np.floor(fx + 0.5).astype(np.int64)
+    r = window // 2
+    acc = np.zeros((block.shape[0], len(iy)), dtype=np.float64)
+    cnt = np.zeros_like(acc)
+    for oy in range(-r, r + 1):
+        yy = iy + oy
+        for ox in range(-r, r + 1):
+            xx = ix + ox
+            inside = (yy >= 0) & (yy < h) & (xx >= 0) & (xx < w)
+            v = block[:, np.clip(yy, 0, h - 1), np.clip(xx, 0, w - 1)]
+            valid = inside & ~np.isnan(v)
+            acc += np.where(valid, v, 0.0)
+            cnt += valid
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (acc / cnt).astype(np.float32)
+
+
+def sample_store(store, lon, lat, method="nearest", window=3):
+    """
+    Sample every feature of a store at the given points.
+
+    Points are grouped by the Zarr chunk they fall in; each chunk (plus the
+    halo the method needs) is read once and all of its points are gathered
+    with fancy indexing.
+
+    Returns:
+        float32 array (n_points, n_features); NaN for points off the grid.
+    """
+    n = len(lon)
+    out = np.full((n, len(store.columns)), np.nan, dtype=np.float32)
+    fy, fx = store.fractional_index(lon, lat)
+    iy = np.floor(fy + 0.5)
+    ix = np.floor(fx + 0.5)
+    inside = (iy >= 0) & (iy < store.ny) & (ix >= 0) & (ix < store.nx)
+    if not inside.any():
+        return out
+
+    halo = {"nearest": 0, "bilinear": 1, "mean": window // 2}[method]
+    pts = np.flatnonzero(inside)
+    chunk_id = (iy[pts] // store.chy).astype(np.int64) * store.n_chunks_x + (ix[pts] // store.chx).astype(np.int64)
+    order = np.argsort(chunk_id, kind="stable")
+    pts, chunk_id = pts[order], chunk_id[order]
+    uniq, starts = np.unique(chunk_id, return_index=True)
+    ends = np.append(starts[1:], len(pts))
+
+    for cid, s, e in zip(uniq, starts, ends):
+        cy, cx = divmod(int(cid), store.n_chunks_x)
+        block, r0, c0 = store.read_block(cy, cx, halo)
+        idx = pts[s:e]
+        ly, lx = fy[idx] - r0, fx[idx] - c0
+        if method == "nearest":
+            vals = gather_nearest(block, ly, lx)
+        elif method == "bilinear":
+            vals = gather_bilinear(block, ly, lx)
+        else:
+            vals = gather_mean(block, ly, lx, window)
+        out[idx] = vals.T
+    return out
+
+
+# -----------------------------
+# Orchestrator
+# -----------------------------
+def run(cfg):
+    """
+    Sample EO features at GEDI shot locations into a partitioned Parquet dataset.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - features:
+                - shots: GEDI Parquet file or directory
+                - stores: list of feature Zarr paths, or dict of name -> path
+                - output: output directory (one part-*.parquet per shot batch)
+                - method: "nearest" (default), "bilinear" or "mean"
+                - window: footprint size in pixels for "mean" (default 3)
+                - batch_size: shots per batch (default 1,000,000)
+                - lat_column / lon_column: default lat_lowestmode / lon_lowestmode
+    Returns:
+        Path to the output dataset directory.
+    """
+    logger.info("Starting GEDI point sampling...")
+
+    feat_cfg = cfg["features"]
+    method = feat_cfg.get("method", "nearest")
+    if method not in ("nearest", "bilinear", "mean"):
+        raise ValueError(f"Unknown sampling method '{method}'")
+    window = feat_cfg.get("window", 3)
+    batch_size = feat_cfg.get("batch_size", 1_000_000)
+    lat_col = feat_cfg.get("lat_column", "lat_lowestmode")
+    lon_col = feat_cfg.get("lon_column", "lon_lowestmode")
+
+    stores_cfg = feat_cfg["stores"]
+    if isinstance(stores_cfg, dict):
+        stores = [FeatureStore(p, name=name) for name, p in stores_cfg.items()]
+    else:
+        stores = [FeatureStore(p) for p in stores_cfg]
+    logger.info(f"Sampling {sum(len(s.columns) for s in stores)} features from {len(stores)} stores ({method})")
+
+    output_dir = Path(feat_cfg["output"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    n_total = 0
+    for part, shots in enumerate(iter_shot_batches(feat_cfg["shots"], ["shot_number", lat_col, lon_col], batch_size)):
+        shots = shots.sort_values("shot_number", kind="stable")
+        lon = shots[lon_col].to_numpy(dtype=np.float64)
+        lat = shots[lat_col].to_numpy(dtype=np.float64)
+
+        columns = {"shot_number": pa.array(shots["shot_number"].to_numpy())}
+        for store in stores:
+            values = sample_store(store, lon, lat, method=method, window=window)
+            for j, col in enumerate(store.columns):
+                columns[col] = pa.array(values[:, j])
+
+        out_file = output_dir / f"part-{part:05d}.parquet"
+        pq.write_table(pa.table(columns), out_file)
+        n_total += len(shots)
+        logger.info(f"Wrote {len(shots)} shots to {out_file}")
+
+    logger.info(f"GEDI point sampling completed: {n_total} shots -> {output_dir}")
+    return output_dir
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "features": {
+            "shots": "data/processed/eo/gedi/GEDI_L2A",
+            "stores": ["data/processed/eo/s2/s2_2019-01-01_2019-12-31_median_20190401_20190630.zarr"],
+            "output": "data/features/gedi_eo_features",
+            "method": "bilinear",
+        }
+    }
+    run(dummy_cfg)
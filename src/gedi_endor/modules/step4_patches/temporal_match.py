@@ -0,0 +1,246 @@
+# modules/step4_patches/temporal_match.py
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .sample_points import FeatureStore, iter_shot_batches
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# GEDI delta_time is seconds since this epoch
+GEDI_EPOCH = np.datetime64("2018-01-01T00:00:00", "s")
+
+
+def shot_times(values):
+    """Convert a GEDI time column (delta_time seconds or datetimes) to datetime64[s]."""
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[s]")
+    return GEDI_EPOCH + np.round(values).astype("timedelta64[s]")
+
+
+# -----------------------------
+# Per-chunk matching index
+# -----------------------------
+def build_chunk_index(valid):
+    """
+    Build the nearest-valid-observation index for one chunk.
+
+    Args:
+        valid: bool array (time, rows, cols) of usable observations.
+
+    Returns:
+        (prev, nxt) int32 arrays shaped like `valid`: for every time step,
+        the index of the last valid observation at or before it (-1 if none)
+        and of the first valid observation at or after it (T if none).
+    """
+    n_t = valid.shape[0]
+    steps = np.arange(n_t, dtype=np.int32)[:, None, None]
+    prev = np.maximum.accumulate(np.where(valid, steps, -1), axis=0)
+    nxt = np.minimum.accumulate(np.where(valid, steps, n_t)[::-1], axis=0)[::-1]
+    return prev, nxt
+
+
+def query_chunk_index(times, prev, nxt, t_query, ly, lx):
+    """
+    Find, for each query, the valid observation nearest in time at its pixel.
+
+    Args:
+        times: sorted datetime64[s] acquisition times (T,)
+        prev, nxt: output of build_chunk_index
+        t_query: datetime64[s] shot times
+        ly, lx: integer pixel indices within the chunk
+
+    Returns:
+        (t_index, offset_s): matched time index (-1 if none) and signed
+        offset observation - shot in seconds.
+    """
+    n_t = len(times)
+    tsec = times.astype(np.int64)
+    qsec = t_query.astype(np.int64)
+    i = np.searchsorted(tsec, qsec, side="left")
+
+    before = np.where(i > 0, prev[np.clip(i - 1, 0, n_t - 1), ly, lx], -1)
+    after = np.where(i < n_t, nxt[np.clip(i, 0, n_t - 1), ly, lx], n_t)
+
+    d_before = np.where(before >= 0, qsec - tsec[np.clip(before, 0, n_t - 1)], np.iinfo(np.int64).max)
+    d_after = np.where(after < n_t, tsec[np.clip(after, 0, n_t - 1)] - qsec, np.iinfo(np.int64).max)
+
+    use_after = d_after < d_before
+    t_index = np.where(use_after, after, before)
+    offset = np.where(use_after, d_after, -d_before)
+    t_index = np.where((before < 0) & (after >= n_t), -1, t_index)
+    return t_index, offset
+
+
+# -----------------------------
+# Time-series stores
+# -----------------------------
+class TimeSeriesStore(FeatureStore):
+    """
+    A Zarr store of (time, ..., y, x) variables. Leading dims other than time
+    (e.g. the band of an S1 stack) are flattened into columns as in FeatureStore.
+    """
+
+    def __init__(self, path, name=None, variables=None, mask_variable=None):
+        super().__init__(path, name=name, variables=variables)
+        self.variables = [v for v in self.variables if "time" in self.ds[v].dims and v != mask_variable]
+        if not self.variables:
+            raise ValueError(f"{self.path} has no (time, y, x) variables")
+        self.columns = [c for v in self.variables for c in self.variable_columns(v, skip=("time",))]
+        self.mask_variable = mask_variable
+
+        times = pd.to_datetime(self.ds["time"].values).values.astype("datetime64[s]")
+        self.time_order = np.argsort(times, kind="stable")
+        self.times = times[self.time_order]
+
+    def read_series(self, cy, cx):
+        """
+        Read the full time series of one chunk.
+
+        Returns:
+            (values, valid, r0, c0): values float32 (features, time, rows, cols)
+            in column order, valid bool (time, rows, cols).
+        """
+        r0, r1 = cy * self.chy, min((cy + 1) * self.chy, self.ny)
+        c0, c1 = cx * self.chx, min((cx + 1) * self.chx, self.nx)
+        names = self.variables + ([self.mask_variable] if self.mask_variable else [])
+        sub = self.ds[names].isel({self.ydim: slice(r0, r1), self.xdim: slice(c0, c1), "time": self.time_order}).load()
+        layers = []
+        for v in self.variables:
+            da = sub[v]
+            lead = [d for d in da.dims if d not in ("time", self.ydim, self.xdim)]
+            arr = da.transpose("time", *lead, self.ydim, self.xdim).values.astype(np.float32)
+            arr = arr.reshape(arr.shape[0], -1, arr.shape[-2], arr.shape[-1])
+            layers.append(np.moveaxis(arr, 1, 0))
+        values = np.concatenate(layers, axis=0)
+        valid = np.isfinite(values).all(axis=0)
+        if self.mask_variable:
+            mask = sub[self.mask_variable].transpose("time", ..., self.ydim, self.xdim).values.astype(bool)
+            valid &= mask.reshape(mask.shape[0], -1, mask.shape[-2], mask.shape[-1]).all(axis=1)
+        return values, valid, r0, c0
+
+
+def match_store(store, lon, lat, t_shot, max_days):
+    """
+    Match every shot to the nearest-in-time valid observation of a store.
+
+    Returns:
+        (values, offset_days): float32 (n, n_features) matched values and
+        float32 (n,) signed offsets in days; NaN where nothing is within
+        ±max_days or the shot is off the grid.
+    """
+    n = len(lon)
+    values = np.full((n, len(store.columns)), np.nan, dtype=np.float32)
+    offset_days = np.full(n, np.nan, dtype=np.float32)
+
+    fy, fx = store.fractional_index(lon, lat)
+    iy = np.floor(fy + 0.5)
+    ix = np.floor(fx + 0.5)
+    inside = (iy >= 0) & (iy < store.ny) & (ix >= 0) & (ix < store.nx)
+    pts = np.flatnonzero(inside)
+    if len(pts) == 0:
+        return values, offset_days
+    iy, ix = iy[pts].astype(np.int64), ix[pts].astype(np.int64)
+
+    chunk_id = (iy // store.chy) * store.n_chunks_x + ix // store.chx
+    order = np.argsort(chunk_id, kind="stable")
+    uniq, starts = np.unique(chunk_id[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    max_s = int(max_days * 86400)
+
+    for cid, s, e in zip(uniq, starts, ends):
+        cy, cx = divmod(int(cid), store.n_chunks_x)
+        series, valid, r0, c0 = store.read_series(cy, cx)
+        prev, nxt = build_chunk_index(valid)
+
+        sel = order[s:e]
+        idx = pts[sel]
+        ly, lx = iy[sel] - r0, ix[sel] - c0
+        t_index, offset = query_chunk_index(store.times, prev, nxt, t_shot[idx], ly, lx)
+
+        ok = (t_index >= 0) & (np.abs(offset) <= max_s)
+        hit = idx[ok]
+        values[hit] = series[:, t_index[ok], ly[ok], lx[ok]].T
+        offset_days[hit] = offset[ok] / 86400.0
+    return values, offset_days
+
+
+# -----------------------------
+# Orchestrator
+# -----------------------------
+def run(cfg):
+    """
+    Match GEDI shots to the nearest cloud-free observation of each EO time series.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - temporal_match:
+                - shots: GEDI Parquet file or directory
+                - stores: dict of name -> {"path": zarr path, "mask_variable": optional
+                  bool/0-1 variable marking valid (e.g. cloud-free) observations}
+                - max_days: match tolerance in days (default 16)
+                - output: output directory (one part-*.parquet per shot batch)
+                - time_column: default "delta_time" (GEDI seconds since 2018-01-01)
+                - batch_size, lat_column, lon_column: as for sample_points
+    Returns:
+        Path to the output dataset directory.
+    """
+    logger.info("Starting nearest-in-time EO matching...")
+
+    tm_cfg = cfg["temporal_match"]
+    max_days = tm_cfg.get("max_days", 16)
+    batch_size = tm_cfg.get("batch_size", 1_000_000)
+    time_col = tm_cfg.get("time_column", "delta_time")
+    lat_col = tm_cfg.get("lat_column", "lat_lowestmode")
+    lon_col = tm_cfg.get("lon_column", "lon_lowestmode")
+
+    stores = [
+        TimeSeriesStore(spec["path"], name=name, mask_variable=spec.get("mask_variable"))
+        for name, spec in tm_cfg["stores"].items()
+    ]
+    output_dir = Path(tm_cfg["output"])
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    columns_in = ["shot_number", lat_col, lon_col, time_col]
+    for part, shots in enumerate(iter_shot_batches(tm_cfg["shots"], columns_in, batch_size)):
+        shots = shots.sort_values("shot_number", kind="stable")
+        lon = shots[lon_col].to_numpy(dtype=np.float64)
+        lat = shots[lat_col].to_numpy(dtype=np.float64)
+        t_shot = shot_times(shots[time_col].to_numpy())
+
+        columns = {"shot_number": pa.array(shots["shot_number"].to_numpy())}
+        for store in stores:
+            values, offset_days = match_store(store, lon, lat, t_shot, max_days)
+            for j, col in enumerate(store.columns):
+                columns[col] = pa.array(values[:, j])
+            columns[f"{store.name}_dt_days"] = pa.array(offset_days)
+            logger.info(f"{store.name}: matched {np.isfinite(offset_days).sum()}/{len(lon)} shots within ±{max_days} days")
+
+        out_file = output_dir / f"part-{part:05d}.parquet"
+        pq.write_table(pa.table(columns), out_file)
+        logger.info(f"Wrote {len(shots)} shots to {out_file}")
+
+    logger.info("Nearest-in-time EO matching completed.")
+    return output_dir
+
+
+if __name__ == "__main__":
+    dummy_cfg = {
+        "temporal_match": {
+            "shots": "data/processed/eo/gedi/GEDI_L2A",
+            "stores": {
+                "S1": {"path": "data/raw/eo/s1/s1_timeseries_2019-01-01_2019-12-31.zarr"},
+                "S2": {"path": "data/raw/eo/s2/s2_2019-01-01_2019-12-31.zarr", "mask_variable": "clear"},
+            },
+            "max_days": 16,
+            "output": "data/features/gedi_eo_nearest",
+        }
+    }
+    run(dummy_cfg)
@@ -0,0 +1,385 @@
+# modules/step5_model/ensemble.py
+
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from chunked import map_tasks
+
+from step5_model.tables import feature_table, fold_rows, split_rows
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Estimator kinds and the parameter that sets their training budget
+# (boosting iterations or trees); all of them grow incrementally with warm_start
+KINDS = {
+    "hgb": ("sklearn.ensemble", "HistGradientBoostingRegressor", "max_iter"),
+    "rf": ("sklearn.ensemble", "RandomForestRegressor", "n_estimators"),
+    "extra": ("sklearn.ensemble", "ExtraTreesRegressor", "n_estimators"),
+}
+
+# Default (first, last) rung budgets per kind, in the kind's own unit:
+# boosting iterations need many more steps than forests need trees
+RESOURCES = {"hgb": (25, 400), "rf": (10, 250), "extra": (10, 250)}
+
+# Free /dev/shm required per byte of shared arrays before using it
+SHM_HEADROOM = 1.25
+
+
+# -----------------------------
+# Shared feature matrix
+# -----------------------------
+def scratch_dir(nbytes, base=None):
+    """
+    Directory for the shared arrays: RAM-backed /dev/shm when it has room
+    for nbytes (plus headroom), else the temp dir. A /dev/shm too small for
+    the memory maps (64 MB by default in Docker) fails with SIGBUS on first
+    touch rather than with an error, so the free space is checked up front.
+    """
+    if base is None:
+        base = tempfile.gettempdir()
+        if os.path.isdir("/dev/shm"):
+            if shutil.disk_usage("/dev/shm").free > SHM_HEADROOM * nbytes:
+                base = "/dev/shm"
+            else:
+                logger.info(f"/dev/shm lacks room for {nbytes / 1024**2:.0f} MB; sharing the arrays from {base}")
+    return Path(tempfile.mkdtemp(prefix="gedi_ensemble_", dir=base))
+
+
+def share_table(df, inputs, targets, train_rows, val_rows, directory):
+    """
+    Write the inputs and targets of the training then validation rows to
+    memory-mapped .npy files, one column at a time.
+
+    Training rows come first, so workers slice contiguous views
+    (x[:n_train], x[n_train:]) of the same pages instead of receiving
+    pickled copies or fancy-indexing their own.
+
+    Returns:
+        dict of x and y file paths, n (rows) and n_train.
+    """
+    order = np.concatenate([train_rows, val_rows])
+    paths = {"x": str(directory / "x.npy"), "y": str(directory / "y.npy"),
+             "n": len(order), "n_train": len(train_rows)}
+    x = np.lib.format.open_memmap(paths["x"], mode="w+", dtype=np.float32, shape=(len(order), len(inputs)))
+    for k, c in enumerate(inputs):
+        x[:, k] = df[c].to_numpy(dtype=np.float32)[order]
+    y = np.lib.format.open_memmap(paths["y"], mode="w+", dtype=np.float32, shape=(len(order), len(targets)))
+    for k, t in enumerate(targets):
+        y[:, k] = df[t].to_numpy(dtype=np.float32)[order]
+    x.flush(), y.flush()
+    del x, y
+    return paths
+
+
+# Arrays mapped by this worker process, keyed by file path
+_SHARED = {}
+
+
+def shared(path):
+    # Copy-on-write: the forest splitters need writable buffers but never
+    # write to them, so the pages stay shared with every other worker
+    if path not in _SHARED:
+        _SHARED[path] = np.load(path, mmap_mode="c")
+    return _SHARED[path]
+
+
+# -----------------------------
+# Members and configurations
+# -----------------------------
+def expand_grid(grid):
+    """
+    Configurations from a list of {"kind": ..., param: value or [values]}
+    entries: the product of the listed values within each entry.
+    """
+    configs = []
+    for entry in grid:
+        entry = dict(entry)
+        kind = entry.pop("kind", "hgb")
+        if kind not in KINDS:
+            raise ValueError(f"Unknown estimator kind {kind!r}; expected one of {sorted(KINDS)}")
+        keys = sorted(entry)
+        values = [entry[k] if isinstance(entry[k], (list, tuple)) else [entry[k]] for k in keys]
+        for combo in itertools.product(*values):
+            configs.append({"kind": kind, **dict(zip(keys, combo))})
+    return configs
+
+
+def make_estimator(config, seed, threads):
+    import importlib
+
+    params = dict(config)
+    module, name, _ = KINDS[params.pop("kind")]
+    cls = getattr(importlib.import_module(module), name)
+    if cls.__name__ == "HistGradientBoostingRegressor":
+        # the rung budget, not an internal validation split, decides when to stop
+        params.setdefault("early_stopping", False)
+    else:
+        params["n_jobs"] = threads
+    return cls(warm_start=True, random_state=seed, **params)
+
+
+def _fit_task(member, resource, shared_paths, target, threads):
+    """
+    Grow one member to `resource` iterations/trees and score it on the
+    validation rows; runs in a worker. The member is read from and saved
+    back to its own file, so warm starts carry over between rungs.
+    """
+    import joblib
+    from threadpoolctl import threadpool_limits
+
+    x, y = shared(shared_paths["x"]), shared(shared_paths["y"])
+    n_train = shared_paths["n_train"]
+    path = Path(member["path"])
+    t0 = time.perf_counter()
+    with threadpool_limits(threads):
+        if path.exists():
+            estimator = joblib.load(path)
+        else:
+            estimator = make_estimator(member["config"], member["seed"], threads)
+        estimator.set_params(**{KINDS[member["config"]["kind"]][2]: resource})
+        estimator.fit(x[:n_train], y[:n_train, target])
+        score = float("nan")
+        if len(x) > n_train:
+            pred = estimator.predict(x[n_train:])
+            score = float(np.sqrt(np.mean((pred - y[n_train:, target]) ** 2)))
+    joblib.dump(estimator, path)
+    return score, time.perf_counter() - t0
+
+
+# -----------------------------
+# Successive halving
+# -----------------------------
+def _finite(value):
+    """JSON-safe score: NaN (no validation rows) becomes None."""
+    return None if np.isnan(value) else float(value)
+
+
+def rung_budgets(min_resource, max_resource, eta=3):
+    """Resources of successive rungs: min_resource * eta^i, ending at max_resource."""
+    if not 0 < min_resource <= max_resource:
+        raise ValueError("Need 0 < min_resource <= max_resource")
+    budgets = []
+    r = min_resource
+    while r < max_resource:
+        budgets.append(int(r))
+        r *= eta
+    return budgets + [int(max_resource)]
+
+
+def _ranked(live, members):
+    """Config ids of `live` by mean validation RMSE of their members (NaN last), and the scores."""
+    scores = {i: np.mean([m["score"] for m in members if m["config_id"] == i]) for i in live}
+    return sorted(live, key=lambda i: (np.isnan(scores[i]), scores[i])), scores
+
+
+def train_ensemble(shared_paths, target, configs, out_dir, name, seeds=1, resources=None, eta=3,
+                   n_configs=1, workers=1):
+    """
+    Successive halving over configurations, each trained as `seeds`
+    ensemble members.
+
+    Boosting iterations and trees are different units (a 25-iteration
+    boosted model is far from converged, a 25-tree forest nearly is), so
+    configurations only compete with those of the same kind, on that
+    kind's rung budgets (resources: kind -> (first, last), see
+    RESOURCES). At every rung the surviving members grow to the rung
+    budget (continuing from their previous fit) and the best 1/eta of
+    each kind's configurations by mean validation RMSE over their members
+    go on. The finalists of all kinds, each trained to its full budget,
+    are then compared and the best n_configs form the ensemble. Members
+    of a rung run in parallel across kinds, each worker mapping the shared
+    matrix copy-on-write.
+
+    Returns:
+        (members, history): member dicts (config, seed, path, score) and one
+        record per kind and rung.
+    """
+    if shared_paths["n_train"] == shared_paths["n"] and len(configs) > n_configs:
+        raise ValueError("Successive halving needs validation rows to rank configurations")
+    resources = {**RESOURCES, **(resources or {})}
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    members = [{"config": c, "config_id": i, "seed": s, "path": str(out_dir / f"{name}_c{i}_s{s}.joblib")}
+               for i, c in enumerate(configs) for s in range(seeds)]
+    for m in members:
+        # a member file left by an earlier run would be warm-started
+        Path(m["path"]).unlink(missing_ok=True)
+
+    kinds = sorted({c["kind"] for c in configs})
+    budgets = {k: rung_budgets(*resources[k], eta) for k in kinds}
+    live = {k: {i for i, c in enumerate(configs) if c["kind"] == k} for k in kinds}
+    history = []
+    for rung in range(max(len(b) for b in budgets.values())):
+        active = [k for k in kinds if rung < len(budgets[k])]
+        todo = [(m, budgets[m["config"]["kind"]][rung]) for m in members
+                if m["config"]["kind"] in active and m["config_id"] in live[m["config"]["kind"]]]
+        t0 = time.perf_counter()
+        results = map_tasks(_fit_task, [(m, budget, shared_paths, target, threads) for m, budget in todo], workers)
+        for (m, _), (score, seconds) in zip(todo, results):
+            m["score"], m["seconds"] = score, m.get("seconds", 0.0) + seconds
+        seconds = time.perf_counter() - t0
+        for k in active:
+            ranked, scores = _ranked(live[k], members)
+            last = rung == len(budgets[k]) - 1
+            keep = len(ranked) if last else math.ceil(len(ranked) / eta)
+            history.append({"kind": k, "rung": rung, "resource": budgets[k][rung],
+                            "members": len(ranked) * seeds, "seconds": seconds,
+                            "scores": {str(i): _finite(scores[i]) for i in ranked}, "kept": ranked[:keep]})
+            logger.info(f"Rung {rung} {k}: {len(ranked)} configs at {budgets[k][rung]}, "
+                        f"best RMSE {scores[ranked[0]]:.4g} (config {ranked[0]}), keeping {keep}")
+            live[k] = set(ranked[:keep])
+
+    # Finalists are all at their kind's full budget, so they compare fairly
+    ranked, scores = _ranked(set().union(*live.values()), members)
+    chosen = set(ranked[:n_configs])
+    history.append({"kind": "final", "scores": {str(i): _finite(scores[i]) for i in ranked},
+                    "kept": ranked[:n_configs]})
+    logger.info(f"Finalists {[(configs[i]['kind'], round(float(scores[i]), 4)) for i in ranked]}; "
+                f"keeping {sorted(chosen)}")
+    for m in members:
+        if m["config_id"] not in chosen:
+            Path(m["path"]).unlink(missing_ok=True)
+    return [m for m in members if m["config_id"] in chosen], history
+
+
+# -----------------------------
+# Ensembles
+# -----------------------------
+def load_ensemble(manifest):
+    """(estimators, manifest dict) from an ensemble manifest written by run."""
+    import joblib
+
+    with open(manifest) as f:
+        meta = json.load(f)
+    base = Path(manifest).parent
+    return [joblib.load(base / m["file"]) for m in meta["members"]], meta
+
+
+def predict_ensemble(estimators, x):
+    """(n_members, n) member predictions; their mean is the ensemble estimate."""
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    return np.stack([e.predict(x) for e in estimators])
+
+
+def run(cfg):
+    """
+    Train tabular ensembles (scikit-learn) on the step4 feature tables.
+
+    The feature table is read once and written to memory-mapped arrays
+    (RAM-backed /dev/shm when available), which every worker maps
+    copy-on-write, so member fits fan out over a process pool without
+    pickling or copying the data. Configurations are pruned by successive
+    halving: weak ones are dropped after a small budget of trees or
+    boosting iterations, and the survivors continue from where they
+    stopped. Each estimator kind is halved on its own budget scale and
+    the finalists of all kinds are compared at their full budgets. One
+    ensemble is trained per target.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - model.ensemble:
+                - features: feature Parquet dataset(s) of step4 (joined on
+                  shot_number)
+                - targets: optional GEDI Parquet holding the target columns
+                - target: target column(s), e.g. ["rh98", "agbd"]
+                - feature_columns: input columns (default: all numeric ones)
+                - grid: list of {"kind": "hgb"|"rf"|"extra", param: value or
+                  [values]}; lists expand into configurations
+                - seeds: members per configuration (default 5)
+                - resources: {kind: [first, last]} rung budgets in
+                  iterations (hgb) or trees (rf, extra), overriding
+                  RESOURCES; configurations only compete within a kind
+                  until the finalists of all kinds are compared
+                - eta: rung growth and pruning factor (default 3)
+                - n_configs: best finalist configurations kept (default 1)
+                - folds / fold: optional step3 spatial fold table and the
+                  held-out fold (default: random split)
+                - val_fraction: held-out share of the random split (default 0.1)
+                - workers: process count (default 1)
+                - scratch_dir: directory for the shared arrays (default
+                  /dev/shm when it has room, else the temp dir)
+                - output_dir: member files and <target>_ensemble.json manifests
+                - seed (default 0)
+    Returns:
+        dict of target -> manifest path.
+    """
+    logger.info("Starting step5 ensemble training...")
+
+    ens_cfg = cfg["model"]["ensemble"]
+    targets = ens_cfg["target"]
+    targets = [targets] if isinstance(targets, str) else list(targets)
+    out_dir = Path(ens_cfg["output_dir"])
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    df, inputs = feature_table(ens_cfg, targets)
+    data = {"rows": np.flatnonzero(np.isfinite(df[targets].to_numpy(dtype=np.float32)).all(axis=1)),
+            "shot_number": df["shot_number"].to_numpy()}
+    if ens_cfg.get("folds"):
+        train_rows, val_rows = fold_rows(data, ens_cfg["folds"], ens_cfg.get("fold", 0))
+    else:
+        train_rows, val_rows = split_rows(data["rows"], ens_cfg.get("val_fraction", 0.1), ens_cfg.get("seed", 0))
+
+    configs = expand_grid(ens_cfg.get("grid", [{"kind": "hgb"}]))
+    workers = ens_cfg.get("workers", 1)
+    nbytes = (len(train_rows) + len(val_rows)) * (len(inputs) + len(targets)) * np.dtype(np.float32).itemsize
+    scratch = scratch_dir(nbytes, ens_cfg.get("scratch_dir"))
+    try:
+        shared_paths = share_table(df, inputs, targets, train_rows, val_rows, scratch)
+        del df
+        logger.info(f"{len(train_rows)} training / {len(val_rows)} validation samples x {len(inputs)} features "
+                    f"shared from {scratch}; {len(configs)} configurations x {ens_cfg.get('seeds', 5)} seeds, "
+                    f"{workers} workers")
+        manifests = {}
+        for k, target in enumerate(targets):
+            t0 = time.perf_counter()
+            members, history = train_ensemble(
+                shared_paths, k, configs, out_dir, target, seeds=ens_cfg.get("seeds", 5),
+                resources=ens_cfg.get("resources"), eta=ens_cfg.get("eta", 3),
+                n_configs=ens_cfg.get("n_configs", 1), workers=workers)
+            manifest = out_dir / f"{target}_ensemble.json"
+            with open(manifest, "w") as f:
+                json.dump({
+                    "inputs": inputs,
+                    "target": target,
+                    "members": [{"file": Path(m["path"]).name, "config": m["config"], "seed": m["seed"],
+                                 "val_rmse": _finite(m["score"])} for m in members],
+                    "history": history,
+                }, f, indent=2)
+            logger.info(f"{target}: {len(members)} members in {time.perf_counter() - t0:.1f}s -> {manifest}")
+            manifests[target] = manifest
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    logger.info("Step5 ensemble training completed.")
+    return manifests
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step5_model.ensemble
+    dummy_cfg = {
+        "model": {
+            "ensemble": {
+                "features": ["data/features/gedi_eo_features", "data/features/gedi_eo_nearest"],
+                "targets": "data/processed/eo/gedi/GEDI_L2A",
+                "target": ["rh98", "agbd"],
+                "grid": [
+                    {"kind": "hgb", "learning_rate": [0.05, 0.1], "max_leaf_nodes": [31, 63], "max_features": [0.5, 1.0]},
+                    {"kind": "extra", "max_features": [0.3, 0.6], "min_samples_leaf": [1, 5]},
+                ],
+                "seeds": 5,
+                "folds": "data/autocorr/gedi_folds.parquet",
+                "workers": 8,
+                "output_dir": "data/models/ensemble",
+            }
+        }
+    }
+    run(dummy_cfg)
@@ -0,0 +1,250 @@
+# modules/step5_model/export.py
+
+import copy
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+from step5_model.models import load_checkpoint
+from step5_model.predict import Predictor, meta_path
+from step5_model.train import load_data
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+VARIANTS = ("float", "int8", "onnx")
+
+# Largest allowed difference between the float TorchScript and eager models
+# (relative to the target std); anything above is an export bug
+FLOAT_TOLERANCE = 1e-4
+
+
+# -----------------------------
+# Variants
+# -----------------------------
+def quantization_engine():
+    """Select the best available int8 kernel backend (x86/fbgemm, else qnnpack on Arm)."""
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    return None
+
+
+def quantize_int8(model):
+    """
+    Dynamic int8 quantization: Linear weights stored as int8, activations
+    quantized on the fly per batch. Convolutions stay float.
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def save_torchscript(model, example, path):
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example, check_trace=False)
+    torch.jit.save(traced, str(path))
+
+
+def save_onnx(model, example, path, opset=17):
+    torch.onnx.export(model, (example,), str(path), input_names=["x"], output_names=["y"],
+                      dynamic_axes={"x": {0: "batch"}, "y": {0: "batch"}}, opset_version=opset)
+
+
+def write_meta(path, meta, variant):
+    keys = ("model", "inputs", "targets", "input_shape")
+    with open(meta_path(path), "w") as f:
+        json.dump({**{k: meta[k] for k in keys}, "variant": variant}, f, indent=2)
+
+
+# -----------------------------
+# Checks and benchmark
+# -----------------------------
+def agreement(reference, candidate, y_std):
+    """Max absolute difference and RMSE (in target std units) of a variant against the float model."""
+    diff = candidate - reference
+    return {"max_abs": np.nanmax(np.abs(diff), axis=0).tolist(),
+            "rmse_std": (np.sqrt(np.nanmean(diff**2, axis=0)) / y_std).tolist()}
+
+
+def accuracy(pred, y):
+    """RMSE per target against observed values."""
+    return np.sqrt(np.nanmean((pred - y) ** 2, axis=0)).tolist()
+
+
+def time_predictor(predictor, x, batch_sizes, repeats=5):
+    """
+    Median latency (ms) of one forward pass per batch size and throughput
+    (samples/s) at the largest; predictor is called as predictor(x, batch_size).
+    """
+    out = {"latency_ms": {}}
+    for b in batch_sizes:
+        batch = x[:b]
+        predictor(batch, b)  # warm-up
+        runs = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            predictor(batch, b)
+            runs.append(time.perf_counter() - t0)
+        out["latency_ms"][int(b)] = 1e3 * float(np.median(runs))
+    largest = min(max(batch_sizes), len(x))
+    out["samples_per_s"] = largest / (out["latency_ms"][int(max(batch_sizes))] / 1e3)
+    return out
+
+
+def check_inputs(model, meta, data_cfg=None, n=10_000, seed=0):
+    """
+    Inputs (and targets) for the agreement checks: a sample of real
+    training data when data_cfg is given, else random inputs drawn from
+    the model's input statistics.
+    """
+    rng = np.random.default_rng(seed)
+    if data_cfg:
+        data = load_data(data_cfg)
+        rows = np.sort(rng.choice(data["rows"], min(n, len(data["rows"])), replace=False))
+        x = data["x"][rows] if isinstance(data["x"], np.ndarray) else data["x"].get_orthogonal_selection((rows,))
+        return np.asarray(x, dtype=np.float32), data["y"][rows]
+    mean, std = model[0].mean.numpy(), model[0].std.numpy()
+    shape = (n, *meta["input_shape"])
+    return (mean + std * rng.standard_normal(shape)).astype(np.float32), None
+
+
+def export_model(checkpoint, out_dir, variants=("float", "int8"), data_cfg=None, n_check=10_000,
+                 tolerance=0.05, batch_sizes=(1, 64, 4096), threads=None):
+    """
+    Export a trained checkpoint and check every variant against the float model.
+
+    Variants are TorchScript float ("float"), TorchScript with dynamic int8
+    Linear layers ("int8") and ONNX ("onnx", checked with onnxruntime when
+    installed). Each artifact gets a sidecar JSON with the model inputs and
+    targets so predict.Predictor can load it alone. Every variant is run
+    on the check inputs and compared with the eager float model (and the
+    observed targets when data_cfg is given), and timed per batch size.
+
+    Returns:
+        Report dict of variant -> {path, agreement, accuracy, ok, latency_ms, samples_per_s}.
+    """
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        raise ValueError(f"Unknown export variants {sorted(unknown)}; expected some of {VARIANTS}")
+    if threads:
+        torch.set_num_threads(int(threads))
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model, meta = load_checkpoint(checkpoint)
+    name = Path(checkpoint).stem
+    y_std = model[2].std.numpy()
+
+    x, y = check_inputs(model, meta, data_cfg, n_check)
+    with torch.inference_mode():
+        reference = model(torch.from_numpy(x)).numpy()
+    report = {"eager": {"accuracy": accuracy(reference, y) if y is not None else None}}
+    example = torch.from_numpy(x[:2])
+
+    for variant in variants:
+        if variant == "onnx":
+            path = out_dir / f"{name}.onnx"
+            save_onnx(model, example, path)
+        else:
+            path = out_dir / f"{name}_{variant}.pt"
+            if variant == "int8":
+                engine = quantization_engine()
+                logger.info(f"int8 kernels: {engine}")
+                save_torchscript(quantize_int8(model), example, path)
+            else:
+                save_torchscript(model, example, path)
+        write_meta(path, meta, variant)
+        try:
+            predictor = Predictor(path, threads=threads)
+        except ImportError as e:
+            logger.warning(f"Exported {path} but cannot check it: {e}")
+            report[variant] = {"path": str(path), "ok": None}
+            continue
+
+        pred = predictor(x)
+        entry = {"path": str(path), "agreement": agreement(reference, pred, y_std),
+                 "accuracy": accuracy(pred, y) if y is not None else None}
+        limit = FLOAT_TOLERANCE if variant == "float" else tolerance
+        entry["ok"] = max(entry["agreement"]["rmse_std"]) <= limit
+        entry.update(time_predictor(predictor, x, batch_sizes))
+        report[variant] = entry
+        if variant == "float" and not entry["ok"]:
+            raise RuntimeError(f"{path.name} disagrees with the eager model: {entry['agreement']}")
+        if not entry["ok"]:
+            logger.warning(f"{path.name} deviates from the float model by {max(entry['agreement']['rmse_std']):.3g} "
+                           f"target std (tolerance {tolerance})")
+
+    def eager(batch, batch_size=None):
+        with torch.inference_mode():
+            return model(torch.from_numpy(np.ascontiguousarray(batch))).numpy()
+
+    report["eager"].update(time_predictor(eager, x, batch_sizes))
+
+    for variant, entry in report.items():
+        if "latency_ms" not in entry:
+            continue
+        latency = ", ".join(f"b{b}: {ms:.2f}ms" for b, ms in entry["latency_ms"].items())
+        acc = ""
+        if entry.get("accuracy") is not None:
+            delta = np.subtract(entry["accuracy"], report["eager"]["accuracy"])
+            acc = f", RMSE delta vs float {', '.join(f'{d:+.4g}' for d in delta)}"
+        dev = f", deviation {max(entry['agreement']['rmse_std']):.2e} std" if "agreement" in entry else ""
+        logger.info(f"{variant}: {entry['samples_per_s']:.0f} samples/s ({latency}){dev}{acc}")
+    with open(out_dir / f"{name}_export.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def run(cfg):
+    """
+    Export a trained step5 model to fast CPU inference artifacts.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - model.export:
+                - checkpoint: checkpoint written by train.run
+                - output_dir: artifact directory (default: <checkpoint dir>/export)
+                - variants: any of "float", "int8", "onnx" (default ["float", "int8"])
+                - data: optional training-data config (as model.train) to
+                  check against real samples and observed targets
+                - n_check: samples used for checks and timing (default 10,000)
+                - tolerance: largest accepted RMSE of a variant against the
+                  float model, in target std units (default 0.05)
+                - batch_sizes: batch sizes timed (default [1, 64, 4096])
+                - threads: intra-op threads for timing (default: torch default)
+    Returns:
+        Report dict (also written as <name>_export.json).
+    """
+    logger.info("Starting model export...")
+
+    exp_cfg = cfg["model"]["export"]
+    checkpoint = Path(exp_cfg["checkpoint"])
+    out_dir = Path(exp_cfg.get("output_dir") or checkpoint.parent / "export")
+    report = export_model(checkpoint, out_dir, variants=exp_cfg.get("variants", ("float", "int8")),
+                          data_cfg=exp_cfg.get("data"), n_check=exp_cfg.get("n_check", 10_000),
+                          tolerance=exp_cfg.get("tolerance", 0.05),
+                          batch_sizes=exp_cfg.get("batch_sizes", (1, 64, 4096)), threads=exp_cfg.get("threads"))
+    logger.info(f"Model export completed -> {out_dir}")
+    return report
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step5_model.export
+    dummy_cfg = {
+        "model": {
+            "export": {
+                "checkpoint": "data/models/rh98_mlp.pt",
+                "variants": ["float", "int8", "onnx"],
+                "data": {
+                    "features": ["data/features/gedi_eo_features"],
+                    "targets": "data/processed/eo/gedi/GEDI_L2A",
+                    "target": ["rh98"],
+                },
+            }
+        }
+    }
+    run(dummy_cfg)
@@ -0,0 +1,115 @@
+# modules/step5_model/models.py
+
+import logging
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+# -----------------------------
+# Model definitions
+# -----------------------------
+class Standardize(nn.Module):
+    """
+    Input standardization with the training statistics kept as buffers, so
+    saved and exported models take raw features. NaN inputs become 0 (the
+    training mean).
+    """
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float32))
+        self.register_buffer("std", torch.as_tensor(std, dtype=torch.float32))
+
+    def forward(self, x):
+        # where/isnan rather than nan_to_num so the graph exports to ONNX
+        z = (x - self.mean) / self.std
+        return torch.where(torch.isnan(z), torch.zeros_like(z), z)
+
+
+class Rescale(nn.Module):
+    """Output scaling to target units (inverse of the training target standardization)."""
+
+    def __init__(self, mean, std):
+        super().__init__()
+        self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float32))
+        self.register_buffer("std", torch.as_tensor(std, dtype=torch.float32))
+
+    def forward(self, x):
+        return x * self.std + self.mean
+
+
+class MLP(nn.Module):
+    """Fully connected regressor for per-shot feature vectors."""
+
+    def __init__(self, n_inputs, n_outputs, hidden=(256, 256), dropout=0.1):
+        super().__init__()
+        layers = []
+        for width in hidden:
+            layers += [nn.Linear(n_inputs, width), nn.GELU(), nn.Dropout(dropout)]
+            n_inputs = width
+        layers.append(nn.Linear(n_inputs, n_outputs))
+        self.net = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.net(x)
+
+
+class PatchCNN(nn.Module):
+    """Small convolutional regressor for (channel, y, x) patches centred on shots."""
+
+    def __init__(self, n_inputs, n_outputs, hidden=(32, 64), dropout=0.1):
+        super().__init__()
+        layers = []
+        for width in hidden:
+            layers += [nn.Conv2d(n_inputs, width, 3, padding=1), nn.BatchNorm2d(width), nn.GELU()]
+            n_inputs = width
+        self.features = nn.Sequential(*layers)
+        self.head = nn.Sequential(nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Dropout(dropout),
+                                  nn.Linear(n_inputs, n_outputs))
+
+    def forward(self, x):
+        return self.head(self.features(x))
+
+
+MODELS = {"mlp": MLP, "cnn": PatchCNN}
+
+
+def build_model(spec, n_inputs, n_outputs, x_stats, y_stats):
+    """
+    Model from a spec dict ({"kind": "mlp"|"cnn", "hidden": [...], "dropout": ...}),
+    wrapped in input standardization (x_stats: (mean, std)) and output
+    rescaling (y_stats), so it maps raw features to target units.
+    """
+    spec = dict(spec or {})
+    kind = spec.pop("kind", "mlp")
+    if kind not in MODELS:
+        raise ValueError(f"Unknown model kind {kind!r}; expected one of {sorted(MODELS)}")
+    if "hidden" in spec:
+        spec["hidden"] = tuple(spec["hidden"])
+    return nn.Sequential(Standardize(*x_stats), MODELS[kind](n_inputs, n_outputs, **spec), Rescale(*y_stats))
+
+
+# -----------------------------
+# Checkpoints
+# -----------------------------
+def save_checkpoint(path, model, meta):
+    """
+    Save the state dict with what is needed to rebuild the model: meta
+    holds the model spec and the input/output names and shapes.
+    """
+    torch.save({"state_dict": model.state_dict(), "meta": meta}, path)
+
+
+def load_checkpoint(path):
+    """(model in eval mode, meta) from a checkpoint written by save_checkpoint."""
+    ckpt = torch.load(path, map_location="cpu", weights_only=False)
+    meta = ckpt["meta"]
+    state = ckpt["state_dict"]
+    model = build_model(meta["model"], meta["input_shape"][0], len(meta["targets"]),
+                        (state["0.mean"], state["0.std"]), (state["2.mean"], state["2.std"]))
+    model.load_state_dict(ckpt["state_dict"])
+    return model.eval(), meta
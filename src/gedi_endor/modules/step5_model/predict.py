@@ -0,0 +1,192 @@
+# modules/step5_model/predict.py
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import chunk_windows, map_tasks
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+DEFAULT_BATCH = 65536
+
+
+# -----------------------------
+# Exported artifacts
+# -----------------------------
+def meta_path(artifact):
+    """Sidecar metadata (inputs, targets, input shape) written next to an exported artifact."""
+    artifact = Path(artifact)
+    return artifact.with_name(artifact.name + ".json")
+
+
+class Predictor:
+    """
+    Exported model artifact: TorchScript (.pt, float or int8) or ONNX
+    (.onnx, run with onnxruntime), with the metadata of its sidecar.
+    Calling it maps a float32 (n, *input_shape) array of raw features to
+    (n, n_targets) predictions in target units.
+    """
+
+    def __init__(self, path, threads=None):
+        self.path = Path(path)
+        with open(meta_path(self.path)) as f:
+            self.meta = json.load(f)
+        self.inputs, self.targets = self.meta["inputs"], self.meta["targets"]
+        if self.path.suffix == ".onnx":
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = int(threads)
+            self._session = ort.InferenceSession(str(self.path), options, providers=["CPUExecutionProvider"])
+            self._model = None
+        else:
+            import torch
+
+            if threads:
+                torch.set_num_threads(int(threads))
+            self._model = torch.jit.load(str(self.path), map_location="cpu").eval()
+            self._session = None
+
+    def __call__(self, x, batch_size=DEFAULT_BATCH):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        out = np.empty((len(x), len(self.targets)), dtype=np.float32)
+        for s in range(0, len(x), batch_size):
+            batch = x[s:s + batch_size]
+            if self._session is not None:
+                out[s:s + len(batch)] = self._session.run(None, {"x": batch})[0]
+            else:
+                import torch
+
+                with torch.inference_mode():
+                    out[s:s + len(batch)] = self._model(torch.from_numpy(batch)).numpy()
+        return out
+
+
+# -----------------------------
+# Wall-to-wall prediction
+# -----------------------------
+def feature_stores(stores):
+    from step4_patches.sample_points import FeatureStore
+
+    if isinstance(stores, dict):
+        return [FeatureStore(p, name=name) for name, p in stores.items()]
+    return [FeatureStore(p) for p in stores]
+
+
+def _predict_task(artifact, stores, out_path, windows, opts):
+    """Predict the pixels of some chunks and write them by region; runs in a worker."""
+    predictor = Predictor(artifact, threads=opts["threads"])
+    stores = feature_stores(stores)
+    columns = [c for s in stores for c in s.columns]
+    order = [columns.index(c) for c in predictor.inputs]
+    for ys, xs in windows:
+        block = np.concatenate([s.read_window(ys, xs) for s in stores], axis=0)[order]
+        rows, cols = block.shape[1:]
+        x = block.reshape(len(order), -1).T
+        has_data = np.isfinite(x).any(axis=1)
+        pred = np.full((len(x), len(predictor.targets)), np.nan, dtype=np.float32)
+        if has_data.any():
+            pred[has_data] = predictor(x[has_data], opts["batch_size"])
+        out = xr.Dataset({t: (("y", "x"), pred[:, k].reshape(rows, cols)) for k, t in enumerate(predictor.targets)})
+        out.to_zarr(out_path, region={"y": ys, "x": xs})
+    return len(windows)
+
+
+def predict_store(artifact, stores, out_path, tile=None, workers=1, batch_size=DEFAULT_BATCH):
+    """
+    Wall-to-wall prediction of a feature-vector model over gridded feature
+    stores sharing one grid.
+
+    Pixels are read chunk by chunk with the same column layout as the
+    step4 sampler (so the model's input names select and order them),
+    predicted in batches and written by region into a store with one
+    variable per target. Pixels without any feature are NaN.
+
+    Returns:
+        Number of chunks predicted.
+    """
+    import dask.array as dsa
+
+    predictor = Predictor(artifact)
+    if len(predictor.meta["input_shape"]) != 1:
+        raise ValueError(f"{Path(artifact).name} takes patches; wall-to-wall prediction needs a feature-vector model")
+    opened = feature_stores(stores)
+    columns = [c for s in opened for c in s.columns]
+    missing = [c for c in predictor.inputs if c not in columns]
+    if missing:
+        raise ValueError(f"Feature stores lack model inputs: {missing[:10]}{' ...' if len(missing) > 10 else ''}")
+    first = opened[0]
+    for s in opened[1:]:
+        if (s.ny, s.nx) != (first.ny, first.nx):
+            raise ValueError(f"{s.path.name} is not on the grid of {first.path.name}")
+
+    shape = (first.ny, first.nx)
+    chunks = (tile or first.chy, tile or first.chx)
+    template = xr.Dataset(
+        {t: (("y", "x"), dsa.zeros(shape, dtype=np.float32, chunks=chunks)) for t in predictor.targets},
+        coords={"y": first.ds[first.ydim].values, "x": first.ds[first.xdim].values},
+        attrs={"model": Path(artifact).name},
+    )
+    if "spatial_ref" in first.ds.variables:
+        template = template.assign_coords(spatial_ref=first.ds["spatial_ref"])
+    template.to_zarr(out_path, mode="w", compute=False)
+
+    windows = chunk_windows(shape, chunks)
+    n_tasks = max(1, min(len(windows), workers * 4))
+    groups = [windows[k::n_tasks] for k in range(n_tasks)]
+    stores = stores if isinstance(stores, dict) else [str(p) for p in stores]
+    opts = {"threads": max(1, (os.cpu_count() or 1) // workers), "batch_size": batch_size}
+    return sum(map_tasks(_predict_task, [(str(artifact), stores, str(out_path), g, opts) for g in groups], workers))
+
+
+def run(cfg):
+    """
+    Predict targets wall to wall with an exported model artifact.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - model.predict:
+                - artifact: exported model (.pt TorchScript or .onnx, see export)
+                - stores: feature Zarr stores as given to the step4 sampler
+                  (list of paths, or dict of name -> path)
+                - output: output Zarr store
+                - tile: chunk size override in pixels (default: first store's chunks)
+                - workers: process count (default 1)
+                - batch_size: pixels per forward pass (default 65536)
+    Returns:
+        Path to the output store.
+    """
+    logger.info("Starting wall-to-wall prediction...")
+
+    pred_cfg = cfg["model"]["predict"]
+    out_path = Path(pred_cfg["output"])
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    workers = pred_cfg.get("workers", 1)
+    t0 = time.perf_counter()
+    n = predict_store(pred_cfg["artifact"], pred_cfg["stores"], out_path, tile=pred_cfg.get("tile"),
+                      workers=workers, batch_size=pred_cfg.get("batch_size", DEFAULT_BATCH))
+    logger.info(f"Predicted {n} chunks in {time.perf_counter() - t0:.1f}s ({workers} workers) -> {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step5_model.predict
+    dummy_cfg = {
+        "model": {
+            "predict": {
+                "artifact": "data/models/export/rh98_mlp_int8.pt",
+                "stores": ["data/processed/eo/s2/s2_2019-01-01_2019-12-31_median_20190401_20190630.zarr"],
+                "output": "data/predictions/rh98.zarr",
+                "workers": 4,
+            }
+        }
+    }
+    run(dummy_cfg)
@@ -0,0 +1,74 @@
+# modules/step5_model/tables.py
+
+import logging
+from pathlib import Path
+
+import numpy as np
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+# -----------------------------
+# Shot tables (shared by the torch and scikit-learn trainers)
+# -----------------------------
+def read_parquet(paths, columns=None):
+    paths = [paths] if isinstance(paths, (str, Path)) else paths
+    frames = [pq.read_table(p, columns=columns).to_pandas() for p in paths]
+    out = frames[0]
+    for frame in frames[1:]:
+        out = out.merge(frame, on="shot_number", how="inner")
+    return out
+
+
+def feature_table(data_cfg, targets):
+    """
+    (DataFrame, input columns) of the step4 feature tables joined with the
+    target columns (from data_cfg["targets"] when given). Inputs are
+    data_cfg["feature_columns"], or every other numeric column.
+    """
+    df = read_parquet(data_cfg["features"])
+    if data_cfg.get("targets"):
+        df = df.merge(read_parquet(data_cfg["targets"], columns=["shot_number", *targets]),
+                      on="shot_number", how="inner")
+    inputs = data_cfg.get("feature_columns") or [
+        c for c in df.columns
+        if c != "shot_number" and c not in targets and np.issubdtype(df[c].dtype, np.number)]
+    return df, inputs
+
+
+# -----------------------------
+# Validation splits
+# -----------------------------
+def split_rows(rows, val_fraction, seed=0):
+    """Random (train, validation) split of sample rows."""
+    rng = np.random.default_rng(seed)
+    rows = rng.permutation(rows)
+    n_val = int(round(len(rows) * val_fraction))
+    return np.sort(rows[n_val:]), np.sort(rows[:n_val])
+
+
+def fold_rows(data, folds_path, fold):
+    """
+    (train, validation) split of sample rows from a step3 spatial fold
+    table: fold `fold` is held out and its buffer shots are dropped from
+    training. Samples without a fold are left out of both.
+
+    Args:
+        data: dict with rows (candidate sample rows) and shot_number (per sample)
+    """
+    from step3_autocorr.folds import fold_masks
+
+    if data["shot_number"] is None:
+        raise ValueError("Spatial folds need shot_number in the training data")
+    table = read_parquet(folds_path, columns=["shot_number", "fold", "buffer"])
+    table = table.set_index("shot_number").reindex(data["shot_number"][data["rows"]])
+    known = table["fold"].notna().to_numpy()
+    if not known.any():
+        raise ValueError(f"No training sample has a fold in {folds_path}")
+    if not known.all():
+        logger.warning(f"{(~known).sum()} samples have no fold and are not used")
+    rows = data["rows"][known]
+    train, test = fold_masks(table["fold"].to_numpy()[known], table["buffer"].to_numpy()[known], fold)
+    return rows[train], rows[test]
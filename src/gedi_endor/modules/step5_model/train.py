@@ -0,0 +1,393 @@
+# modules/step5_model/train.py
+
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from step5_model.models import build_model, save_checkpoint
+from step5_model.tables import feature_table, fold_rows, split_rows
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# CPU feature flags (x86 /proc/cpuinfo "flags", Arm "Features") with native bf16 arithmetic
+BF16_FLAGS = {"avx512_bf16", "amx_bf16", "bf16"}
+
+# Patches read to estimate per-channel input statistics
+STATS_SAMPLES = 4096
+
+
+# -----------------------------
+# CPU performance settings
+# -----------------------------
+def cpu_flags():
+    """Feature flags of the first CPU in /proc/cpuinfo (empty where unavailable)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def configure_cpu(cpu_cfg):
+    """
+    Apply the thread settings of a CPU performance mode and resolve its
+    switches.
+
+    Args:
+        cpu_cfg: dict with threads (intra-op), interop_threads, bf16
+            (True/False/"auto": on when the CPU has native bf16),
+            channels_last and compile
+    Returns:
+        dict of the resolved settings.
+    """
+    cpu_cfg = cpu_cfg or {}
+    if cpu_cfg.get("threads"):
+        torch.set_num_threads(int(cpu_cfg["threads"]))
+    if cpu_cfg.get("interop_threads"):
+        try:
+            torch.set_num_interop_threads(int(cpu_cfg["interop_threads"]))
+        except RuntimeError as e:
+            # only possible before the first inter-op parallel work of the process
+            logger.warning(f"Could not set inter-op threads: {e}")
+    bf16 = cpu_cfg.get("bf16", "auto")
+    if bf16 == "auto":
+        bf16 = bool(cpu_flags() & BF16_FLAGS)
+    settings = {
+        "bf16": bool(bf16),
+        "channels_last": bool(cpu_cfg.get("channels_last", True)),
+        "compile": bool(cpu_cfg.get("compile", False)),
+        "threads": torch.get_num_threads(),
+        "interop_threads": torch.get_num_interop_threads(),
+    }
+    logger.info(f"CPU mode: {settings['threads']} intra-op / {settings['interop_threads']} inter-op threads, "
+                f"bf16 {'on' if settings['bf16'] else 'off'}, channels-last {'on' if settings['channels_last'] else 'off'}, "
+                f"compile {'on' if settings['compile'] else 'off'}")
+    return settings
+
+
+# -----------------------------
+# Training data
+# -----------------------------
+class ArrayBatches(torch.utils.data.Dataset):
+    """
+    Dataset whose items are whole batches: a list of positions in `rows`
+    gives the (x, y) tensors of those samples.
+
+    x is a numpy array (tabular features, in memory) or a Zarr array
+    (patches, read batch by batch with an orthogonal selection), so large
+    patch stores are never loaded whole.
+    """
+
+    def __init__(self, x, y, rows):
+        self.x, self.y, self.rows = x, y, np.asarray(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, positions):
+        idx = np.sort(self.rows[np.asarray(positions)])
+        x = self.x[idx] if isinstance(self.x, np.ndarray) else self.x.get_orthogonal_selection((idx,))
+        return torch.from_numpy(np.asarray(x, dtype=np.float32)), torch.from_numpy(self.y[idx])
+
+
+def load_data(train_cfg):
+    """
+    Training arrays from the step4 feature tables or a patch store.
+
+    Returns:
+        dict with x (numpy or Zarr array), y (n, n_targets) float32, rows
+        (samples with finite targets), inputs (feature names or patch
+        channels), targets, input_shape and shot_number (None for patch
+        stores without a shot_number array).
+    """
+    targets = train_cfg["target"]
+    targets = [targets] if isinstance(targets, str) else list(targets)
+
+    if train_cfg.get("patches"):
+        import zarr
+
+        group = zarr.open_group(train_cfg["patches"], mode="r")
+        x = group[train_cfg.get("patch_variable", "patches")]
+        y = np.stack([np.asarray(group[t][:], dtype=np.float32) for t in targets], axis=1)
+        inputs = [str(c) for c in group["channel"][:]] if "channel" in group else list(range(x.shape[1]))
+        input_shape = tuple(x.shape[1:])
+        shots = group["shot_number"][:] if "shot_number" in group else None
+    else:
+        df, inputs = feature_table(train_cfg, targets)
+        x = df[inputs].to_numpy(dtype=np.float32)
+        y = df[targets].to_numpy(dtype=np.float32)
+        input_shape = (len(inputs),)
+        shots = df["shot_number"].to_numpy()
+
+    rows = np.flatnonzero(np.isfinite(y).all(axis=1))
+    logger.info(f"{len(rows)} samples with {len(targets)} target(s), input shape {input_shape}")
+    return {"x": x, "y": y, "rows": rows, "inputs": inputs, "targets": targets, "input_shape": input_shape,
+            "shot_number": shots}
+
+
+def input_stats(data, rows, seed=0):
+    """
+    Mean and std of the inputs over training rows: per feature for tables,
+    per channel (from up to STATS_SAMPLES patches) for patches.
+    """
+    if isinstance(data["x"], np.ndarray):
+        x = data["x"][rows]
+        mean, std = np.nanmean(x, axis=0), np.nanstd(x, axis=0)
+    else:
+        sample = np.sort(np.random.default_rng(seed).choice(rows, min(len(rows), STATS_SAMPLES), replace=False))
+        x = np.asarray(data["x"].get_orthogonal_selection((sample,)), dtype=np.float32)
+        axes = (0,) + tuple(range(2, x.ndim))
+        mean = np.nanmean(x, axis=axes).reshape((-1,) + (1,) * (x.ndim - 2))
+        std = np.nanstd(x, axis=axes).reshape(mean.shape)
+    mean = np.nan_to_num(mean)
+    std = np.where(np.isfinite(std) & (std > 0), std, 1.0)
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def target_stats(data, rows):
+    y = data["y"][rows]
+    std = y.std(axis=0)
+    return y.mean(axis=0), np.where(std > 0, std, 1.0)
+
+
+def make_loader(data, rows, batch_size, shuffle=True, num_workers=0, seed=0):
+    """
+    DataLoader yielding (x, y) batches of `rows`. Batches are assembled in
+    the dataset (one read per batch), in num_workers background processes
+    when set.
+    """
+    from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
+
+    dataset = ArrayBatches(data["x"], data["y"], rows)
+    if shuffle:
+        sampler = RandomSampler(dataset, generator=torch.Generator().manual_seed(seed))
+    else:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        num_workers=num_workers,
+        # "spawn": open zarr patch stores and torch thread pools do not survive a fork
+        multiprocessing_context="spawn" if num_workers else None,
+        persistent_workers=num_workers > 0,
+    )
+
+
+# -----------------------------
+# Training loop
+# -----------------------------
+def _memory_layout(x, settings):
+    if settings["channels_last"] and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def scaled_mse(pred, y, y_std):
+    """MSE in standardized target units, so targets of different scales weigh alike."""
+    return (((pred - y) / y_std) ** 2).mean()
+
+
+def train_epoch(model, loader, optimizer, settings, y_std, accumulate=1):
+    """
+    One pass over the loader with gradient accumulation over `accumulate`
+    micro-batches.
+
+    Returns:
+        dict with samples, loss, data-wait and compute seconds.
+    """
+    model.train()
+    wait = compute = loss_sum = 0.0
+    n = steps = 0
+    optimizer.zero_grad(set_to_none=True)
+    batches = iter(loader)
+    while True:
+        t0 = time.perf_counter()
+        batch = next(batches, None)
+        t1 = time.perf_counter()
+        wait += t1 - t0
+        if batch is None:
+            break
+        x, y = batch
+        x = _memory_layout(x, settings)
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=settings["bf16"]):
+            pred = model(x)
+        loss = scaled_mse(pred.float(), y, y_std)
+        (loss / accumulate).backward()
+        steps += 1
+        if steps % accumulate == 0:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        loss_sum += loss.item() * len(y)
+        n += len(y)
+        compute += time.perf_counter() - t1
+    if steps % accumulate:
+        # remaining micro-batches of the epoch
+        t1 = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        compute += time.perf_counter() - t1
+    return {"samples": n, "loss": loss_sum / max(n, 1), "wait_s": wait, "compute_s": compute}
+
+
+@torch.inference_mode()
+def evaluate(model, loader, settings, y_std):
+    """Scaled MSE and per-target RMSE (target units) over a loader."""
+    model.eval()
+    sq = torch.zeros(len(y_std))
+    n = 0
+    for x, y in loader:
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=settings["bf16"]):
+            pred = model(_memory_layout(x, settings))
+        sq += ((pred.float() - y) ** 2).sum(dim=0)
+        n += len(y)
+    mse = sq / max(n, 1)
+    return {"loss": float((mse / y_std**2).mean()), "rmse": mse.sqrt().tolist()}
+
+
+def fit(model, train_loader, val_loader, settings, y_std, epochs=10, lr=1e-3, weight_decay=1e-4,
+        accumulate=1, label="model"):
+    """
+    Train a model, logging per-epoch throughput and where the time went.
+
+    Returns:
+        List of per-epoch dicts (samples/s, data-wait and compute time,
+        train and validation loss).
+    """
+    train_model = model
+    if settings["channels_last"]:
+        model.to(memory_format=torch.channels_last)
+    if settings["compile"]:
+        train_model = torch.compile(model)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+    y_std = torch.as_tensor(y_std, dtype=torch.float32)
+
+    history = []
+    for epoch in range(1, epochs + 1):
+        t0 = time.perf_counter()
+        stats = train_epoch(train_model, train_loader, optimizer, settings, y_std, accumulate)
+        elapsed = time.perf_counter() - t0
+        stats.update(epoch=epoch, elapsed_s=elapsed, samples_per_s=stats["samples"] / elapsed)
+        if val_loader is not None:
+            val = evaluate(train_model, val_loader, settings, y_std)
+            stats.update(val_loss=val["loss"], val_rmse=val["rmse"])
+        busy = stats["wait_s"] + stats["compute_s"]
+        wait_share = stats["wait_s"] / busy if busy > 0 else 0.0
+        stats["bound"] = "I/O" if wait_share > 0.5 else "compute"
+        history.append(stats)
+        val_msg = f", val loss {stats['val_loss']:.4f}" if "val_loss" in stats else ""
+        logger.info(f"{label} epoch {epoch}/{epochs}: loss {stats['loss']:.4f}{val_msg}, "
+                    f"{stats['samples_per_s']:.0f} samples/s, data wait {stats['wait_s']:.1f}s ({wait_share:.0%}) "
+                    f"vs compute {stats['compute_s']:.1f}s -> {stats['bound']}-bound")
+    return history
+
+
+def run(cfg):
+    """
+    Train a step5 regression model on CPU.
+
+    Inputs are either the per-shot feature tables of step4 (an MLP) or a
+    patch store (a CNN). The CPU performance mode sets the thread pools,
+    runs forward passes under bf16 autocast where the CPU supports it,
+    keeps patch batches and conv weights channels-last, and can compile
+    the model; batch_size x accumulate gives the effective batch. Every
+    epoch logs samples/s and the split between waiting for data and
+    computing, to tell I/O-bound from compute-bound runs.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - model.train:
+                - features: feature Parquet dataset(s) of step4 (joined on
+                  shot_number)
+                - targets: optional GEDI Parquet holding the target columns
+                  (otherwise they are read from the features)
+                - patches: patch Zarr store instead of features, with a
+                  (sample, channel, y, x) "patches" array and one array per
+                  target
+                - target: target column(s), e.g. ["rh98", "agbd"]
+                - feature_columns: input columns (default: all numeric ones)
+                - model: {"kind": "mlp"|"cnn", "hidden": [...], "dropout": ...}
+                - epochs (default 10), batch_size (default 1024),
+                  accumulate (micro-batches per optimizer step, default 1),
+                  lr (default 1e-3), weight_decay (default 1e-4)
+                - val_fraction: share of samples held out (default 0.1)
+                - folds: optional step3 spatial fold table; validates on
+                  fold `fold` (default 0) instead of a random split
+                - num_workers: data loading processes (default 0)
+                - seed (default 0)
+                - cpu: threads, interop_threads, bf16 ("auto"), channels_last
+                  (default True), compile (default False)
+                - output: checkpoint path (.pt)
+    Returns:
+        Path to the checkpoint.
+    """
+    logger.info("Starting step5 model training...")
+
+    train_cfg = cfg["model"]["train"]
+    seed = train_cfg.get("seed", 0)
+    torch.manual_seed(seed)
+    settings = configure_cpu(train_cfg.get("cpu"))
+
+    data = load_data(train_cfg)
+    if train_cfg.get("folds"):
+        train_rows, val_rows = fold_rows(data, train_cfg["folds"], train_cfg.get("fold", 0))
+    else:
+        train_rows, val_rows = split_rows(data["rows"], train_cfg.get("val_fraction", 0.1), seed)
+    x_stats = input_stats(data, train_rows, seed)
+    y_stats = target_stats(data, train_rows)
+    spec = train_cfg.get("model", {"kind": "cnn" if train_cfg.get("patches") else "mlp"})
+    model = build_model(spec, data["input_shape"][0], len(data["targets"]), x_stats, y_stats)
+
+    batch_size = train_cfg.get("batch_size", 1024)
+    accumulate = train_cfg.get("accumulate", 1)
+    num_workers = train_cfg.get("num_workers", 0)
+    train_loader = make_loader(data, train_rows, batch_size, True, num_workers, seed)
+    val_loader = make_loader(data, val_rows, batch_size, False, num_workers) if len(val_rows) else None
+    logger.info(f"{len(train_rows)} training / {len(val_rows)} validation samples, "
+                f"effective batch {batch_size * accumulate} ({accumulate} x {batch_size})")
+
+    history = fit(model, train_loader, val_loader, settings, y_stats[1],
+                  epochs=train_cfg.get("epochs", 10), lr=train_cfg.get("lr", 1e-3),
+                  weight_decay=train_cfg.get("weight_decay", 1e-4), accumulate=accumulate)
+
+    out_path = Path(train_cfg["output"])
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    meta = {
+        "model": spec,
+        "inputs": data["inputs"],
+        "targets": data["targets"],
+        "input_shape": list(data["input_shape"]),
+        "cpu": settings,
+        "history": history,
+    }
+    save_checkpoint(out_path, model.to(memory_format=torch.contiguous_format), meta)
+    logger.info(f"Saved model to {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step5_model.train
+    dummy_cfg = {
+        "model": {
+            "train": {
+                "features": ["data/features/gedi_eo_features", "data/features/gedi_eo_nearest"],
+                "targets": "data/processed/eo/gedi/GEDI_L2A",
+                "target": ["rh98"],
+                "model": {"kind": "mlp", "hidden": [256, 256], "dropout": 0.1},
+                "epochs": 20,
+                "batch_size": 2048,
+                "accumulate": 4,
+                "num_workers": 2,
+                "cpu": {"threads": 32, "interop_threads": 2, "bf16": "auto", "compile": True},
+                "output": "data/models/rh98_mlp.pt",
+            }
+        }
+    }
+    run(dummy_cfg)
@@ -0,0 +1,285 @@
+# modules/step5_model/uncertainty.py
+
+import glob
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import chunk_windows, map_tasks, store_chunks
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Histogram bins per variable and pixel for the quantile sketches
+DEFAULT_BINS = 128
+DEFAULT_QUANTILES = (5, 50, 95)
+
+
+# -----------------------------
+# Mergeable per-pixel accumulator
+# -----------------------------
+class PixelEnsembleStats:
+    """
+    Per-pixel count, Welford mean / sum of squared deviations, min, max and
+    a fixed-range histogram of every variable over ensemble members or MC
+    samples, updated one member at a time.
+
+    Memory is (n_vars, y, x, bins) counts plus a few (n_vars, y, x)
+    arrays, whatever the number of members. Partial results merge exactly
+    (Chan et al. for the moments, addition for the histograms), so members
+    can also be split across workers. Quantiles are read from the
+    histograms, interpolated within a bin and clipped to the exact min/max;
+    they are within one bin width of the sample quantile (inverted-CDF
+    definition).
+
+    Args:
+        shape: (y, x) size of the tile
+        ranges: (n_vars, 2) histogram [min, max] per variable
+        bins: histogram bins per variable and pixel
+    """
+
+    def __init__(self, shape, ranges, bins=DEFAULT_BINS):
+        self.ranges = np.asarray(ranges, dtype=np.float64).reshape(-1, 2)
+        self.bins = bins
+        full = (len(self.ranges),) + tuple(shape)
+        self.count = np.zeros(full, dtype=np.int32)
+        self.mean = np.zeros(full)
+        self.m2 = np.zeros(full)
+        self.min = np.full(full, np.inf)
+        self.max = np.full(full, -np.inf)
+        self.hist = np.zeros(full + (bins,), dtype=np.int32)
+
+    def update(self, values):
+        """
+        Args:
+            values: (n_vars, y, x) prediction of one member; NaN pixels are skipped
+        """
+        values = np.asarray(values, dtype=np.float64)
+        ok = np.isfinite(values)
+        self.count += ok
+        x = np.where(ok, values, 0.0)
+        delta = np.where(ok, x - self.mean, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean += np.where(ok, delta / self.count, 0.0)
+        self.m2 += delta * np.where(ok, x - self.mean, 0.0)
+        np.fmin(self.min, np.where(ok, x, np.inf), out=self.min)
+        np.fmax(self.max, np.where(ok, x, -np.inf), out=self.max)
+
+        lo, hi = self.ranges[:, 0, None, None], self.ranges[:, 1, None, None]
+        b = np.clip(((x - lo) / (hi - lo) * self.bins).astype(np.int64), 0, self.bins - 1)
+        # One value per pixel, so the flat indices are unique and += is safe
+        flat = np.arange(x.size).reshape(x.shape) * self.bins + b
+        self.hist.reshape(-1)[flat[ok]] += 1
+        return self
+
+    def merge(self, other):
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            w = np.where(n > 0, other.count / n, 0.0)
+        self.mean += delta * w
+        self.m2 += other.m2 + delta ** 2 * self.count * w
+        self.count = n
+        np.fmin(self.min, other.min, out=self.min)
+        np.fmax(self.max, other.max, out=self.max)
+        self.hist += other.hist
+        return self
+
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+    def quantile(self, q):
+        """Quantile q (0-100) of every variable and pixel, from the histograms."""
+        hist = self.hist
+        cum = np.cumsum(hist, axis=-1)
+        target = q / 100.0 * self.count
+        idx = np.minimum((cum < target[..., None]).sum(axis=-1), self.bins - 1)
+        in_bin = np.take_along_axis(hist, idx[..., None], axis=-1)[..., 0]
+        below = np.take_along_axis(cum, idx[..., None], axis=-1)[..., 0] - in_bin
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(in_bin > 0, (target - below) / in_bin, 0.5)
+        lo, hi = self.ranges[:, 0, None, None], self.ranges[:, 1, None, None]
+        value = lo + (idx + np.clip(frac, 0, 1)) * (hi - lo) / self.bins
+        # Exact extremes are known; keep interpolated quantiles inside them
+        value = np.clip(value, self.min, self.max)
+        return np.where(self.count > 0, value, np.nan)
+
+    def layers(self, names, quantiles=DEFAULT_QUANTILES):
+        """Uncertainty layers as {name: (y, x) array}."""
+        out = {}
+        std = self.std()
+        qs = {q: self.quantile(q) for q in quantiles}
+        for k, name in enumerate(names):
+            out[f"{name}_mean"] = np.where(self.count[k] > 0, self.mean[k], np.nan).astype(np.float32)
+            out[f"{name}_std"] = std[k].astype(np.float32)
+            for q, value in qs.items():
+                out[f"{name}_p{q:g}".replace(".", "_")] = value[k].astype(np.float32)
+            out[f"{name}_n"] = self.count[k].astype(np.int16)
+        return out
+
+
+# -----------------------------
+# Member sources
+# -----------------------------
+def member_paths(members):
+    """Member stores from a list of paths and/or glob patterns, in sorted order."""
+    members = [members] if isinstance(members, (str, Path)) else list(members)
+    paths = []
+    for m in members:
+        paths += sorted(glob.glob(str(m))) or [str(m)]
+    return paths
+
+
+def open_members(paths, member_dim=None):
+    """
+    Lazily opened member stores as a list of (dataset, selection) pairs:
+    one per store, or one per index along member_dim of a single store.
+    """
+    datasets = [xr.open_zarr(p) for p in paths]
+    if member_dim is None:
+        return [(ds, {}) for ds in datasets]
+    return [(ds, {member_dim: m}) for ds in datasets for m in range(ds.sizes[member_dim])]
+
+
+def member_block(ds, sel, variables, ys, xs):
+    """(n_vars, y, x) tile of one member."""
+    block = ds[variables].isel(sel).isel(y=ys, x=xs).load()
+    return np.stack([block[v].transpose("y", "x").values for v in variables])
+
+
+# -----------------------------
+# Chunked engine
+# -----------------------------
+def _range_task(paths, member_dim, variables, windows):
+    """Min/max of every variable over all members in some chunks (for the histogram ranges)."""
+    lo = np.full(len(variables), np.inf)
+    hi = np.full(len(variables), -np.inf)
+    members = open_members(paths, member_dim)
+    for ys, xs in windows:
+        for ds, sel in members:
+            block = member_block(ds, sel, variables, ys, xs)
+            lo = np.fmin(lo, np.min(block, axis=(1, 2), initial=np.inf, where=np.isfinite(block)))
+            hi = np.fmax(hi, np.max(block, axis=(1, 2), initial=-np.inf, where=np.isfinite(block)))
+    return lo, hi
+
+
+def _aggregate_task(paths, member_dim, out_path, variables, windows, opts):
+    """Stream the members of some chunks through the accumulator and write the layers; runs in a worker."""
+    members = open_members(paths, member_dim)
+    for ys, xs in windows:
+        stats = PixelEnsembleStats((ys.stop - ys.start, xs.stop - xs.start), opts["ranges"], opts["bins"])
+        for ds, sel in members:
+            stats.update(member_block(ds, sel, variables, ys, xs))
+        out = xr.Dataset({name: (("y", "x"), v) for name, v in stats.layers(variables, opts["quantiles"]).items()})
+        out.to_zarr(out_path, region={"y": ys, "x": xs})
+    return len(windows)
+
+
+def run(cfg):
+    """
+    Per-pixel ensemble mean, standard deviation and quantile intervals.
+
+    Member predictions are read tile by tile: for each tile every member's
+    prediction is loaded in turn and folded into a PixelEnsembleStats
+    (Welford moments and histogram quantile sketches), then the uncertainty
+    layers of the tile are written by region into the output store. Only
+    one member tile is held at a time, so memory depends on the tile size
+    and bins, not on the ensemble size. Tiles are processed in a process
+    pool (one task per group of tiles).
+
+    Args:
+        cfg: dict-like configuration containing:
+            - model.uncertainty:
+                - members: member prediction Zarr stores (list of paths and/or
+                  glob patterns), each with the variables on y/x
+                - member_dim: dimension holding the members/MC samples when
+                  they are stacked in the store(s) instead (e.g. "member")
+                - variables: predicted variables (default: all on y/x)
+                - output: output Zarr store
+                - quantiles: percentiles to map (default [5, 50, 95])
+                - bins: histogram bins per variable and pixel (default 128)
+                - ranges: optional {variable: [min, max]} histogram ranges
+                  (otherwise found with a min/max pass over the members)
+                - tile: chunk size override in pixels (default: member chunks)
+                - workers: process count (default 1)
+    Returns:
+        Path to the output store.
+    """
+    import dask.array as dsa
+
+    logger.info("Starting ensemble uncertainty aggregation...")
+
+    unc_cfg = cfg["model"]["uncertainty"]
+    paths = member_paths(unc_cfg["members"])
+    member_dim = unc_cfg.get("member_dim")
+    out_path = Path(unc_cfg["output"])
+    workers = unc_cfg.get("workers", 1)
+    bins = unc_cfg.get("bins", DEFAULT_BINS)
+    quantiles = list(unc_cfg.get("quantiles", DEFAULT_QUANTILES))
+
+    with xr.open_zarr(paths[0]) as ds:
+        variables = unc_cfg.get("variables") or [
+            v for v in ds.data_vars if "y" in ds[v].dims and "x" in ds[v].dims]
+        first = ds[variables[0]]
+        enc = store_chunks(first)
+        tile = unc_cfg.get("tile")
+        chunks = (tile or enc["y"], tile or enc["x"])
+        shape = (ds.sizes["y"], ds.sizes["x"])
+        n_members = len(paths) * (ds.sizes[member_dim] if member_dim else 1)
+        coords = {"y": ds["y"].values, "x": ds["x"].values}
+        spatial_ref = ds["spatial_ref"] if "spatial_ref" in ds.variables else None
+
+    windows = chunk_windows(shape, chunks)
+    n_tasks = max(1, min(len(windows), workers * 4))
+    groups = [windows[k::n_tasks] for k in range(n_tasks)]
+    logger.info(f"{n_members} members, {len(variables)} variables, {shape[0]} x {shape[1]} pixels, "
+                f"{len(windows)} tiles")
+
+    ranges = unc_cfg.get("ranges", {})
+    if any(v not in ranges for v in variables):
+        parts = map_tasks(_range_task, [(paths, member_dim, variables, g) for g in groups], workers)
+        lo = np.min([p[0] for p in parts], axis=0)
+        hi = np.max([p[1] for p in parts], axis=0)
+        ranges = {**{v: [lo[k], hi[k] if hi[k] > lo[k] else lo[k] + 1] for k, v in enumerate(variables)}, **ranges}
+    range_list = [ranges[v] for v in variables]
+
+    # Metadata-only template, filled tile by tile
+    names = list(PixelEnsembleStats((1, 1), range_list, 1).layers(variables, quantiles))
+    template = xr.Dataset(
+        {name: (("y", "x"), dsa.zeros(shape, dtype=np.int16 if name.endswith("_n") else np.float32, chunks=chunks))
+         for name in names},
+        coords=coords,
+        attrs={"members": n_members, "quantiles": quantiles, "bins": bins,
+               "ranges": {v: [float(r[0]), float(r[1])] for v, r in zip(variables, range_list)}},
+    )
+    if spatial_ref is not None:
+        template = template.assign_coords(spatial_ref=spatial_ref)
+    template.to_zarr(out_path, mode="w", compute=False)
+
+    opts = {"ranges": range_list, "bins": bins, "quantiles": quantiles}
+    t0 = time.perf_counter()
+    n = sum(map_tasks(_aggregate_task, [(paths, member_dim, str(out_path), variables, g, opts) for g in groups], workers))
+    elapsed = time.perf_counter() - t0
+    logger.info(f"Aggregated {n_members} members over {n} tiles in {elapsed:.1f}s ({workers} workers) -> {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step5_model.uncertainty
+    dummy_cfg = {
+        "model": {
+            "uncertainty": {
+                "members": "data/predictions/members/agbd_member_*.zarr",
+                "variables": ["agbd", "canopy_height"],
+                "output": "data/predictions/agbd_uncertainty.zarr",
+                "quantiles": [5, 50, 95],
+                "ranges": {"agbd": [0, 600], "canopy_height": [0, 60]},
+                "workers": 4,
+            }
+        }
+    }
+    run(dummy_cfg)
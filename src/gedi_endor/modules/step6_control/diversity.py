@@ -0,0 +1,449 @@
+# modules/step6_control/diversity.py
+
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+from chunked import chunk_windows, map_tasks, select_time, store_chunks
+
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Pairwise distances held in memory at once (windows x points x points), per worker
+DISTANCE_BUDGET = 4_000_000
+
+DIVERSITY_VARIABLES = ("FRic", "FEve", "FDiv", "n_valid")
+
+
+# -----------------------------
+# Window geometry
+# -----------------------------
+def window_points(block, size):
+    """
+    Trait vectors of every size x size window of a halo block.
+
+    Args:
+        block: (n_traits, rows + size - 1, cols + size - 1) array, NaN for missing
+        size: odd window width in pixels
+
+    Returns:
+        (rows, cols, size * size, n_traits) array; point k of window (i, j) is
+        block pixel (i + k // size, j + k % size).
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    win = sliding_window_view(block, (size, size), axis=(1, 2))   # (d, rows, cols, size, size)
+    d, rows, cols = win.shape[:3]
+    return np.ascontiguousarray(win.transpose(1, 2, 3, 4, 0)).reshape(rows, cols, size * size, d)
+
+
+# -----------------------------
+# Batched indices
+# -----------------------------
+def mst_edges(points, valid):
+    """
+    Minimum spanning tree edge lengths of many point sets at once.
+
+    Prim's algorithm on the complete Euclidean graph, one step for all
+    windows per iteration, so the Python loop runs n - 1 times per batch
+    instead of once per window.
+
+    Args:
+        points: (B, n, d) trait vectors
+        valid: (B, n) bool, points to include
+
+    Returns:
+        (B, n - 1) edge lengths, NaN past each window's n_valid - 1 edges.
+    """
+    b, n, _ = points.shape
+    # Centred per window so the Gram-matrix distances lose little to cancellation in float32
+    p = np.where(valid[..., None], points, np.nan).astype(np.float32)
+    with np.errstate(invalid="ignore"):
+        p -= np.nanmean(p, axis=1, keepdims=True)
+    p[~valid] = 0.0
+    sq = np.einsum("bnd,bnd->bn", p, p)
+    dist = p @ p.transpose(0, 2, 1)
+    dist *= -2.0
+    dist += sq[:, :, None]
+    dist += sq[:, None, :]
+    np.sqrt(np.clip(dist, 0.0, None, out=dist), out=dist)
+    dist[~(valid[:, :, None] & valid[:, None, :])] = np.inf
+
+    rows = np.arange(b)
+    start = np.argmax(valid, axis=1)
+    in_tree = ~valid
+    in_tree[rows, start] = True
+    best = dist[rows, start].copy()
+    best[in_tree] = np.inf
+    edges = np.full((b, max(n - 1, 0)), np.nan)
+    for k in range(n - 1):
+        j = np.argmin(best, axis=1)
+        e = best[rows, j]
+        ok = np.isfinite(e)
+        if not ok.any():
+            break
+        edges[ok, k] = e[ok]
+        in_tree[rows[ok], j[ok]] = True
+        np.minimum(best, dist[rows, j], out=best)
+        best[in_tree] = np.inf
+    return edges
+
+
+def functional_evenness(edges, n_valid):
+    """
+    FEve (Villeger et al. 2008) from MST edge lengths, equal weights per
+    pixel; NaN for windows whose pixels all share one trait vector.
+    """
+    total = np.nansum(edges, axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pew = edges / total
+        inv = 1.0 / (n_valid - 1.0)
+        feve = (np.nansum(np.minimum(pew, inv[:, None]), axis=1) - inv) / (1.0 - inv)
+    return np.where((n_valid >= 3) & (total[:, 0] > 0), feve, np.nan)
+
+
+def functional_divergence(points, valid, centroid):
+    """
+    FDiv (Villeger et al. 2008), equal weights per pixel.
+
+    Args:
+        centroid: (B, d) centre of gravity of each window's hull vertices
+    """
+    dist = np.sqrt(np.sum((points - centroid[:, None, :]) ** 2, axis=2))
+    dist = np.where(valid, dist, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nanmean(dist, axis=1)
+        dev = dist - mean[:, None]
+        weight = 1.0 / valid.sum(axis=1)
+        delta = np.nansum(dev, axis=1) * weight
+        delta_abs = np.nansum(np.abs(dev), axis=1) * weight
+        return (delta + mean) / (delta_abs + mean)
+
+
+def hull_row(points, valid, n_valid, min_points):
+    """
+    Convex hull volume and vertex centroid of a row of windows.
+
+    Returns:
+        (volume (B,), centroid (B, d)); volume is 0 and the centroid NaN for
+        windows whose traits are coplanar or duplicated.
+    """
+    from scipy.spatial import ConvexHull, QhullError
+
+    b, _, d = points.shape
+    volume = np.full(b, np.nan)
+    centroid = np.full((b, d), np.nan)
+    for j in np.flatnonzero(n_valid >= min_points):
+        p = points[j][valid[j]]
+        try:
+            h = ConvexHull(p)
+        except QhullError:
+            volume[j] = 0.0
+            continue
+        volume[j] = h.volume
+        centroid[j] = p[h.vertices].mean(axis=0)
+    return volume, centroid
+
+
+def functional_diversity(block, size, min_points=None, distance_budget=DISTANCE_BUDGET):
+    """
+    FRic, FEve and FDiv of every window of a halo block, treating each
+    valid pixel in the window as an equally weighted individual in trait
+    space.
+
+    Args:
+        block: (n_traits, rows + size - 1, cols + size - 1) standardized traits
+        size: odd window width in pixels
+        min_points: fewest valid pixels per window (default n_traits + 1, at least 3)
+
+    Returns:
+        dict of DIVERSITY_VARIABLES -> (rows, cols) arrays.
+    """
+    d = block.shape[0]
+    min_points = min_points or max(d + 1, 3)
+    pts = window_points(block, size)
+    rows, cols, n, _ = pts.shape
+    valid = np.isfinite(pts).all(axis=3)
+    pts = np.where(valid[..., None], pts, 0.0)
+    n_valid = valid.sum(axis=2)
+
+    fric = np.full((rows, cols), np.nan)
+    feve = np.full((rows, cols), np.nan)
+    fdiv = np.full((rows, cols), np.nan)
+    batch = max(1, distance_budget // (n * n))
+    for i in range(rows):
+        if d == 1:
+            lo = np.where(valid[i], pts[i, :, :, 0], np.inf).min(axis=1)
+            hi = np.where(valid[i], pts[i, :, :, 0], -np.inf).max(axis=1)
+            volume, centroid = hi - lo, (0.5 * (hi + lo))[:, None]
+        else:
+            volume, centroid = hull_row(pts[i], valid[i], n_valid[i], min_points)
+        enough = n_valid[i] >= min_points
+        fric[i] = np.where(enough, volume, np.nan)
+        fdiv[i] = np.where(enough, functional_divergence(pts[i], valid[i], centroid), np.nan)
+        for c0 in range(0, cols, batch):
+            cs = slice(c0, c0 + batch)
+            edges = mst_edges(pts[i, cs], valid[i, cs])
+            feve[i, cs] = np.where(enough[cs], functional_evenness(edges, n_valid[i, cs]), np.nan)
+
+    stats = {
+        "FRic": fric.astype(np.float32),
+        "FEve": feve.astype(np.float32),
+        "FDiv": fdiv.astype(np.float32),
+        "n_valid": n_valid.astype(np.int16),
+    }
+    return stats
+
+
+# -----------------------------
+# Chunked engine
+# -----------------------------
+def read_halo(sub, traits, ys, xs, halo, shape):
+    """(n_traits, rows + 2 halo, cols + 2 halo) block around a chunk, NaN beyond the raster."""
+    ny, nx = shape
+    r0, r1 = max(ys.start - halo, 0), min(ys.stop + halo, ny)
+    c0, c1 = max(xs.start - halo, 0), min(xs.stop + halo, nx)
+    data = sub.isel(y=slice(r0, r1), x=slice(c0, c1)).load()
+    block = np.full((len(traits), ys.stop - ys.start + 2 * halo, xs.stop - xs.start + 2 * halo), np.nan)
+    top, left = r0 - (ys.start - halo), c0 - (xs.start - halo)
+    for k, t in enumerate(traits):
+        block[k, top:top + r1 - r0, left:left + c1 - c0] = data[t].transpose("y", "x").values
+    return block
+
+
+def _moments_task(store_path, traits, time_sel, windows):
+    """Per-trait count, sum and sum of squares over some chunks (for standardization)."""
+    count = np.zeros(len(traits))
+    total = np.zeros(len(traits))
+    sumsq = np.zeros(len(traits))
+    with xr.open_zarr(store_path) as ds:
+        sub = select_time(ds, traits, time_sel)
+        for ys, xs in windows:
+            block = sub.isel(y=ys, x=xs).load()
+            for k, t in enumerate(traits):
+                v = block[t].values.astype(np.float64)
+                v = v[np.isfinite(v)]
+                count[k] += v.size
+                total[k] += v.sum()
+                sumsq[k] += (v * v).sum()
+    return count, total, sumsq
+
+
+def _diversity_task(store_path, out_path, traits, time_sel, windows, opts):
+    """Compute and write the indices of some chunks; runs in a worker."""
+    halo = opts["size"] // 2
+    with xr.open_zarr(store_path) as ds:
+        sub = select_time(ds, traits, time_sel)
+        shape = (ds.sizes["y"], ds.sizes["x"])
+        for ys, xs in windows:
+            block = read_halo(sub, traits, ys, xs, halo, shape)
+            block = (block - opts["mean"][:, None, None]) / opts["scale"][:, None, None]
+            stats = functional_diversity(block, opts["size"], opts["min_points"], opts["distance_budget"])
+            out = xr.Dataset({name: (("y", "x"), v) for name, v in stats.items()})
+            out.to_zarr(out_path, region={"y": ys, "x": xs})
+    return len(windows)
+
+
+def run(cfg):
+    """
+    Moving-window functional richness, evenness and divergence of trait rasters.
+
+    Every pixel's window x window neighbourhood is treated as a community of
+    equally weighted pixels in trait space (traits standardized with their
+    raster-wide mean and standard deviation, so windows are comparable):
+
+        FRic: convex hull volume of the window's trait vectors
+        FEve: regularity of the minimum spanning tree edge lengths
+        FDiv: divergence from the centre of gravity of the hull vertices
+
+    Chunks are read with a halo of window // 2 pixels, so windows at chunk
+    edges see their full neighbourhood, and processed independently in a
+    process pool (one task per group of chunks). Within a chunk the windows
+    are strided views of the halo block, so each pixel is read and
+    standardized once however many windows contain it; the MST (Prim's
+    algorithm) and FDiv run vectorized across rows of windows, leaving
+    qhull as the only per-window call.
+
+    Args:
+        cfg: dict-like configuration containing:
+            - control.diversity:
+                - input: trait Zarr store (y, x) or (time, y, x)
+                - traits: trait variables (default: all on y/x)
+                - output: output Zarr store
+                - window: odd window width in pixels (default 5)
+                - min_points: fewest valid pixels per window (default traits + 1, at least 3)
+                - standardize: z-score traits before computing (default True)
+                - time: time step to use for (time, y, x) stores (nearest)
+                - tile: chunk size override in pixels (default: input chunks)
+                - workers: process count (default 1)
+                - distance_budget: MST distances per batch (default 4M)
+    Returns:
+        Path to the output store.
+    """
+    import dask.array as dsa
+
+    logger.info("Starting functional diversity mapping...")
+
+    div_cfg = cfg["control"]["diversity"]
+    store_path = str(div_cfg["input"])
+    out_path = Path(div_cfg["output"])
+    workers = div_cfg.get("workers", 1)
+    size = div_cfg.get("window", 5)
+    time_sel = div_cfg.get("time")
+    if size < 3 or size % 2 == 0:
+        raise ValueError(f"window must be an odd number of pixels >= 3, got {size}")
+
+    ds = xr.open_zarr(store_path)
+    traits = div_cfg.get("traits") or [v for v in ds.data_vars if "y" in ds[v].dims and "x" in ds[v].dims]
+    first = ds[traits[0]]
+    enc = store_chunks(first)
+    tile = div_cfg.get("tile")
+    chunks = (tile or enc["y"], tile or enc["x"])
+    shape = (ds.sizes["y"], ds.sizes["x"])
+    windows = chunk_windows(shape, chunks)
+    n_tasks = max(1, min(len(windows), workers * 4))
+    groups = [windows[k::n_tasks] for k in range(n_tasks)]
+    logger.info(f"{len(traits)} traits, {shape[0]} x {shape[1]} pixels, {size} x {size} windows, "
+                f"{len(windows)} chunks")
+
+    mean, scale = np.zeros(len(traits)), np.ones(len(traits))
+    if div_cfg.get("standardize", True):
+        parts = map_tasks(_moments_task, [(store_path, traits, time_sel, g) for g in groups], workers)
+        count, total, sumsq = (sum(p[k] for p in parts) for k in range(3))
+        mean = total / np.maximum(count, 1)
+        std = np.sqrt(np.maximum(sumsq / np.maximum(count, 1) - mean ** 2, 0.0))
+        scale = np.where(std > 0, std, 1.0)
+        logger.info("Trait mean / std: " + ", ".join(f"{t} {m:.4g} / {s:.4g}" for t, m, s in zip(traits, mean, scale)))
+
+    # Metadata-only template, filled chunk by chunk
+    template = xr.Dataset(
+        {name: (("y", "x"), dsa.zeros(shape, dtype=np.int16 if name == "n_valid" else np.float32, chunks=chunks))
+         for name in DIVERSITY_VARIABLES},
+        coords={"y": ds["y"].values, "x": ds["x"].values},
+        attrs={"source": Path(store_path).name, "traits": list(traits), "window": size,
+               "trait_mean": mean.tolist(), "trait_scale": scale.tolist()},
+    )
+    if "spatial_ref" in ds.variables:
+        template = template.assign_coords(spatial_ref=ds["spatial_ref"])
+    template.to_zarr(out_path, mode="w", compute=False)
+    ds.close()
+
+    opts = {"size": size, "mean": mean, "scale": scale, "min_points": div_cfg.get("min_points"),
+            "distance_budget": div_cfg.get("distance_budget", DISTANCE_BUDGET)}
+    t0 = time.perf_counter()
+    parts = map_tasks(_diversity_task, [(store_path, str(out_path), traits, time_sel, g, opts) for g in groups], workers)
+    elapsed = time.perf_counter() - t0
+    n_pixels = shape[0] * shape[1]
+    logger.info(f"Processed {sum(parts)} chunks in {elapsed:.1f}s ({n_pixels / max(elapsed, 1e-9) / 1e3:.1f}k windows/s, "
+                f"{workers} workers) -> {out_path}")
+    return out_path
+
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def naive_diversity(block, size, min_points=None):
+    """Per-window reference: qhull, MST and FDiv for every window separately."""
+    from scipy.spatial import ConvexHull, QhullError
+    from scipy.spatial.distance import pdist, squareform
+
+    d = block.shape[0]
+    min_points = min_points or max(d + 1, 3)
+    pts = window_points(block, size)
+    rows, cols = pts.shape[:2]
+    out = {name: np.full((rows, cols), np.nan) for name in ("FRic", "FEve", "FDiv")}
+    for i in range(rows):
+        for j in range(cols):
+            p = pts[i, j][np.isfinite(pts[i, j]).all(axis=1)]
+            s = len(p)
+            if s < min_points:
+                continue
+            try:
+                h = ConvexHull(p)
+                out["FRic"][i, j] = h.volume
+                dg = np.linalg.norm(p - p[h.vertices].mean(axis=0), axis=1)
+                out["FDiv"][i, j] = dg.mean() / (np.abs(dg - dg.mean()).mean() + dg.mean())
+            except QhullError:
+                out["FRic"][i, j] = 0.0
+            # Prim's algorithm on the dense distances: scipy's sparse MST would
+            # read the zero distances of duplicate points as missing edges
+            dist = squareform(pdist(p))
+            in_tree = np.zeros(s, dtype=bool)
+            in_tree[0] = True
+            best = dist[0].copy()
+            edges = np.empty(s - 1)
+            for k in range(s - 1):
+                nearest = np.flatnonzero(~in_tree)[np.argmin(best[~in_tree])]
+                edges[k] = best[nearest]
+                in_tree[nearest] = True
+                best = np.minimum(best, dist[nearest])
+            total = edges.sum()
+            if total == 0:
+                # All points coincide: evenness is undefined, as in functional_evenness
+                continue
+            pew = edges / total
+            inv = 1.0 / (s - 1)
+            out["FEve"][i, j] = (np.minimum(pew, inv).sum() - inv) / (1 - inv)
+    return out
+
+
+def synthetic_traits(shape=(256, 256), n_traits=3, smooth=4.0, gap_fraction=0.02, seed=0):
+    """Spatially autocorrelated random trait stack (n_traits, y, x) with NaN gaps."""
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    traits = np.stack([gaussian_filter(rng.normal(size=shape), smooth) for _ in range(n_traits)])
+    traits += 0.1 * traits.std() * rng.normal(size=traits.shape)
+    traits[:, rng.random(shape) < gap_fraction] = np.nan
+    return traits
+
+
+def benchmark(size=256, n_traits=3, window=5, tile=64, workers=(1, 4), check=32, seed=0):
+    """
+    Time the engine on a synthetic trait stack and check it against the
+    per-window reference on a check x check corner.
+
+    Returns:
+        dict of workers -> windows per second, plus "naive" for the reference.
+    """
+    traits = synthetic_traits((size, size), n_traits, seed=seed)
+    halo = window // 2
+    rates = {}
+
+    corner = np.pad(traits[:, :check + 2 * halo, :check + 2 * halo], ((0, 0), (halo, 0), (halo, 0)),
+                    constant_values=np.nan)[:, :check + 2 * halo, :check + 2 * halo]
+    t0 = time.perf_counter()
+    ref = naive_diversity(corner, window)
+    rates["naive"] = ref["FRic"].size / (time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    fast = functional_diversity(corner, window)
+    rate = fast["FRic"].size / (time.perf_counter() - t0)
+    for name in ("FRic", "FEve", "FDiv"):
+        err = np.nanmax(np.abs(fast[name] - ref[name]) / np.maximum(np.abs(ref[name]), 1e-6))
+        same_nan = np.array_equal(np.isnan(fast[name]), np.isnan(ref[name]))
+        logger.info(f"{name}: max relative difference to reference {err:.2e}, NaN pattern equal: {same_nan}")
+    logger.info(f"Reference {rates['naive']:.0f} windows/s, vectorized {rate:.0f} windows/s (single chunk)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = Path(tmp) / "traits.zarr"
+        coords = {"y": np.arange(size)[::-1] + 0.5, "x": np.arange(size) + 0.5}
+        xr.Dataset({f"trait_{k}": (("y", "x"), t.astype(np.float32)) for k, t in enumerate(traits)},
+                   coords=coords).chunk({"y": tile, "x": tile}).to_zarr(store)
+        for n in workers:
+            cfg = {"control": {"diversity": {"input": str(store), "output": str(Path(tmp) / f"fd_{n}.zarr"),
+                                             "window": window, "workers": n}}}
+            t0 = time.perf_counter()
+            run(cfg)
+            rates[n] = size * size / (time.perf_counter() - t0)
+            logger.info(f"{n} workers: {rates[n]:.0f} windows/s ({rates[n] / rates['naive']:.1f}x reference)")
+    return rates
+
+
+if __name__ == "__main__":
+    # Run from modules/ so the top-level imports resolve: python -m step6_control.diversity
+    benchmark()
@@ -0,0 +1,64 @@
+# modules/step6_control/grid.py
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+
+def grid_transform(ds):
+    """Affine transform of a store's regular y/x pixel-centre coordinates."""
+    from rasterio.transform import from_origin
+
+    x, y = ds["x"].values, ds["y"].values
+    dx = float(x[1] - x[0]) if len(x) > 1 else 1.0
+    dy = float(y[0] - y[1]) if len(y) > 1 else 1.0
+    return from_origin(x[0] - dx / 2, y[0] + dy / 2, dx, dy)
+
+
+def grid_crs(ds):
+    """CRS WKT of a store written with rioxarray, or None."""
+    if "spatial_ref" in ds.variables:
+        return ds["spatial_ref"].attrs.get("crs_wkt")
+    return ds.attrs.get("crs")
+
+
+def read_polygons(path, ds):
+    """Polygons of a vector file in the store's CRS."""
+    import geopandas as gpd
+
+    gdf = gpd.read_file(path)
+    crs = grid_crs(ds)
+    if crs is not None and gdf.crs is not None:
+        gdf = gdf.to_crs(crs)
+    return gdf
+
+
+def polygon_mask(ds, path):
+    """Rasterize the polygons of a vector file onto the store's y/x grid (True inside)."""
+    from rasterio.features import geometry_mask
+
+    gdf = read_polygons(path, ds)
+    return geometry_mask(list(gdf.geometry), out_shape=(ds.sizes["y"], ds.sizes["x"]),
+                         transform=grid_transform(ds), invert=True)
+
+
+def rasterize_labels(ds, gdf, labels):
+    """
+    Burn integer labels of polygons onto the store's y/x grid.
+
+    Args:
+        gdf: GeoDataFrame in the store's CRS
+        labels: (n_polygons,) positive int labels; 0 marks unlabelled pixels
+
+    Returns:
+        int32 (y, x) label grid. Where polygons overlap, the later one wins.
+    """
+    from rasterio.features import rasterize
+
+    shapes = ((geom, int(label)) for geom, label in zip(gdf.geometry, labels)
+              if geom is not None and not geom.is_empty)
+    return rasterize(shapes, out_shape=(ds.sizes["y"], ds.sizes["x"]), transform=grid_transform(ds),
+                     fill=0, dtype=np.int32)
@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import sys
+from pathlib import Path
+
+# The pipeline packages import each other by top-level name (step1_gedi, chunked, ...)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src" / "gedi_endor" / "modules"))
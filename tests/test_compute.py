@@ -0,0 +1,98 @@
+# tests/test_compute.py
+
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from step2_eo import compute
+
+WINDOWS = [("2019-01-01", "2019-06-30"), ("2019-07-01", "2019-12-31")]
+COMPOSITES = ["median", "mean"]
+
+
+def make_inputs(root, n_files=3, corrupt=False):
+    for k in range(n_files):
+        compute.synthetic_s2(root / "raw" / "s2" / f"s2_tile{k}.zarr", n_time=12, size=16, seed=k)
+    if corrupt:
+        bad = root / "raw" / "s2" / "s2_tile9.zarr"
+        bad.mkdir(parents=True)
+        (bad / "zarr.json").write_text("not a zarr store")
+
+
+def run_compute(root, name, workers, **compute_cfg):
+    cfg = {
+        "input_dir": str(root / "raw"),
+        "output_dir": str(root / name),
+        "eo": {
+            "sources": ["S2"],
+            "composites": COMPOSITES,
+            "phenology_windows": WINDOWS,
+            "compute": {"workers": workers, **compute_cfg},
+        },
+    }
+    return compute.run(cfg)
+
+
+def expected_names(stems):
+    return sorted(f"{stem}_{comp}_{start.replace('-', '')}_{end.replace('-', '')}.zarr"
+                  for stem in stems for comp in COMPOSITES for start, end in WINDOWS)
+
+
+@pytest.fixture
+def two_cpus(monkeypatch):
+    """Let run() use a process pool on single-core machines."""
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+
+
+def test_serial_and_parallel_write_identical_outputs(tmp_path, two_cpus):
+    make_inputs(tmp_path)
+    serial = run_compute(tmp_path, "serial", 1)
+    parallel = run_compute(tmp_path, "parallel", 2)
+    assert (serial["workers"], parallel["workers"]) == (1, 2)
+    assert serial["ok"] == parallel["ok"] == 3
+
+    names = sorted(p.name for p in (tmp_path / "serial" / "s2").glob("*.zarr"))
+    assert names == expected_names(["s2_tile0", "s2_tile1", "s2_tile2"])
+    assert names == sorted(p.name for p in (tmp_path / "parallel" / "s2").glob("*.zarr"))
+    for name in names:
+        a = xr.open_zarr(tmp_path / "serial" / "s2" / name).load()
+        b = xr.open_zarr(tmp_path / "parallel" / "s2" / name).load()
+        assert a.equals(b), name
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_corrupt_input_fails_alone(tmp_path, two_cpus, workers):
+    make_inputs(tmp_path, corrupt=True)
+    summary = run_compute(tmp_path, "out", workers)
+
+    assert summary["items"] == 4 and summary["ok"] == 3
+    assert summary["failed"] == ["S2/s2_tile9.zarr"]
+    names = sorted(p.name for p in (tmp_path / "out" / "s2").glob("*.zarr"))
+    assert names == expected_names(["s2_tile0", "s2_tile1", "s2_tile2"])
+
+
+def _allocate(n_bytes):
+    return np.ones(n_bytes, dtype=np.uint8).sum()
+
+
+def test_worker_address_space_limit(tmp_path):
+    limit = 2 * 1024**3
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=ctx, initializer=compute._init_worker, initargs=(limit,)) as pool:
+        assert pool.submit(resource.getrlimit, resource.RLIMIT_AS).result() == (limit, limit)
+        assert pool.submit(_allocate, 1024**2).result() == 1024**2
+        with pytest.raises(MemoryError):
+            pool.submit(_allocate, limit).result()
+
+
+def test_worker_memory_limit_applies_in_run(tmp_path, two_cpus):
+    make_inputs(tmp_path, n_files=2)
+    # Far below what a worker needs to load a store: every file fails, the run does not
+    summary = run_compute(tmp_path, "out", 2, worker_memory_gb=0.05)
+    assert summary["workers"] == 2
+    assert summary["failed"] == ["S2/s2_tile0.zarr", "S2/s2_tile1.zarr"]
@@ -0,0 +1,72 @@
+# tests/test_diversity.py
+
+import warnings
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from step6_control import diversity
+
+WINDOW = 5
+HALO = WINDOW // 2
+
+
+def traits_block(n_traits, shape=(14, 13), seed=0):
+    traits = diversity.synthetic_traits(shape, n_traits, smooth=1.5, gap_fraction=0.08, seed=seed)
+    traits[:, :4, :4] = 1.0                             # flat patch: degenerate hulls, zero MST edges
+    return traits
+
+
+def assert_matches(fast, ref):
+    # The engine's float32 Gram-matrix distances put duplicate pixels ~1e-3 apart,
+    # which moves FEve by about as much
+    atol = {"FRic": 1e-4, "FEve": 2e-3, "FDiv": 1e-4}
+    for name in ("FRic", "FEve", "FDiv"):
+        np.testing.assert_array_equal(np.isnan(fast[name]), np.isnan(ref[name]), err_msg=name)
+        np.testing.assert_allclose(fast[name], ref[name], rtol=2e-3, atol=atol[name], equal_nan=True, err_msg=name)
+    assert np.isfinite(ref["FRic"]).sum() > ref["FRic"].size // 2
+
+
+@pytest.mark.parametrize("n_traits", [2, 4])
+@pytest.mark.parametrize("distance_budget", [diversity.DISTANCE_BUDGET, 2000])
+def test_functional_diversity_matches_per_window(n_traits, distance_budget):
+    block = traits_block(n_traits)
+
+    fast = diversity.functional_diversity(block, WINDOW, distance_budget=distance_budget)
+    ref = diversity.naive_diversity(block, WINDOW)
+
+    assert fast["FRic"].shape == (block.shape[1] - WINDOW + 1, block.shape[2] - WINDOW + 1)
+    assert_matches(fast, ref)
+    windows = diversity.window_points(block, WINDOW)
+    np.testing.assert_array_equal(fast["n_valid"], np.isfinite(windows).all(axis=3).sum(axis=2))
+
+
+def test_flat_windows_have_undefined_evenness():
+    block = np.ones((3, WINDOW + 2, WINDOW + 2))
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        ref = diversity.naive_diversity(block, WINDOW)
+    fast = diversity.functional_diversity(block, WINDOW)
+    assert np.isnan(ref["FEve"]).all() and np.isnan(fast["FEve"]).all()
+    np.testing.assert_array_equal(ref["FRic"], 0.0)
+
+
+@pytest.mark.parametrize("n_traits", [2, 4])
+def test_run_matches_per_window(tmp_path, n_traits):
+    traits = traits_block(n_traits, shape=(11, 9), seed=1)
+    ny, nx = traits.shape[1:]
+    coords = {"y": np.arange(ny)[::-1] + 0.5, "x": np.arange(nx) + 0.5}
+    xr.Dataset({f"trait_{k}": (("y", "x"), t.astype(np.float32)) for k, t in enumerate(traits)},
+               coords=coords).chunk({"y": 4, "x": 4}).to_zarr(tmp_path / "traits.zarr")
+    cfg = {"control": {"diversity": {"input": str(tmp_path / "traits.zarr"), "output": str(tmp_path / "fd.zarr"),
+                                     "window": WINDOW}}}
+
+    with xr.open_zarr(diversity.run(cfg)) as out:
+        fast = {name: out[name].values for name in ("FRic", "FEve", "FDiv")}
+
+    # Raster-wide z-scores, NaN beyond the edges, one window per pixel
+    t = traits.astype(np.float32).astype(np.float64)
+    z = (t - np.nanmean(t, axis=(1, 2))[:, None, None]) / np.nanstd(t, axis=(1, 2))[:, None, None]
+    padded = np.pad(z, ((0, 0), (HALO, HALO), (HALO, HALO)), constant_values=np.nan)
+    assert_matches(fast, diversity.naive_diversity(padded, WINDOW))
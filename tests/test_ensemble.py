@@ -0,0 +1,110 @@
+# tests/test_ensemble.py
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+joblib = pytest.importorskip("joblib")
+pytest.importorskip("sklearn")
+
+from step5_model import ensemble
+
+RESOURCES = {"hgb": (3, 27), "rf": (2, 6)}
+GRID = [{"kind": "hgb", "learning_rate": [0.01, 0.1, 0.3], "max_depth": 3},
+        {"kind": "rf", "max_depth": [1, 4]}]
+
+
+def tiny_table(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=(n, 3))
+    df = pd.DataFrame({"shot_number": np.arange(n), "a": x[:, 0], "b": x[:, 1], "c": x[:, 2]})
+    df["rh98"] = 20 + 4 * x[:, 0] - 3 * x[:, 1] ** 2 + rng.normal(0, 0.2, n)
+    df["pai"] = 2 + x[:, 2] + rng.normal(0, 0.1, n)
+    return df
+
+
+def test_share_table_orders_training_rows_first(tmp_path):
+    df = tiny_table(20)
+    train, val = np.array([1, 4, 7, 8, 15]), np.array([0, 3])
+    paths = ensemble.share_table(df, ["a", "b", "c"], ["rh98", "pai"], train, val, tmp_path)
+
+    assert (paths["n"], paths["n_train"]) == (7, 5)
+    x, y = ensemble.shared(paths["x"]), ensemble.shared(paths["y"])
+    assert x is ensemble.shared(paths["x"])                # mapped once per process
+    order = np.concatenate([train, val])
+    np.testing.assert_array_equal(x, df[["a", "b", "c"]].to_numpy(np.float32)[order])
+    np.testing.assert_array_equal(y, df[["rh98", "pai"]].to_numpy(np.float32)[order])
+
+    # Copy-on-write: writes stay in this process, the file other workers map is untouched
+    assert isinstance(x, np.memmap) and x.flags.writeable
+    x[0, 0] = -999.0
+    assert np.load(paths["x"])[0, 0] == np.float32(df["a"].iloc[1])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_successive_halving_rungs_and_survivors(tmp_path, workers):
+    df = tiny_table()
+    train, val = np.arange(160), np.arange(160, 200)
+    shared_paths = ensemble.share_table(df, ["a", "b", "c"], ["rh98"], train, val,
+                                        ensemble.scratch_dir(1, tmp_path))
+    configs = ensemble.expand_grid(GRID)
+    assert len(configs) == 5
+    out = tmp_path / "members"
+    out.mkdir()
+    # A member file from an earlier run must not be warm-started
+    (out / "rh98_c0_s0.joblib").write_text("stale")
+
+    members, history = ensemble.train_ensemble(shared_paths, 0, configs, out, "rh98", seeds=2,
+                                               resources=RESOURCES, eta=3, n_configs=1, workers=workers)
+
+    for kind in RESOURCES:
+        rungs = [h for h in history if h["kind"] == kind]
+        assert [h["resource"] for h in rungs] == ensemble.rung_budgets(*RESOURCES[kind], 3)
+        n_configs = sum(c["kind"] == kind for c in configs)
+        for h in rungs:
+            assert h["members"] == n_configs * 2 and len(h["scores"]) == n_configs
+            n_configs = len(h["kept"]) if h is rungs[-1] else -(-n_configs // 3)
+            assert len(h["kept"]) == n_configs
+    final = history[-1]
+    assert final["kind"] == "final" and len(final["scores"]) == 2 and len(final["kept"]) == 1
+
+    chosen = final["kept"][0]
+    assert [(m["config_id"], m["seed"]) for m in members] == [(chosen, 0), (chosen, 1)]
+    kind = configs[chosen]["kind"]
+    for m in members:
+        estimator = joblib.load(m["path"])
+        assert estimator.get_params()[ensemble.KINDS[kind][2]] == RESOURCES[kind][1]
+        pred = estimator.predict(df[["a", "b", "c"]].to_numpy(np.float32)[val])
+        assert m["score"] == pytest.approx(np.sqrt(np.mean((pred - df["rh98"].to_numpy(np.float32)[val]) ** 2)),
+                                           rel=1e-5)
+    # Dropped members are deleted, only the ensemble is left
+    assert sorted(p.name for p in out.iterdir()) == sorted(f"rh98_c{chosen}_s{s}.joblib" for s in range(2))
+
+
+def test_run_writes_manifests_and_removes_shared_arrays(tmp_path):
+    df = tiny_table()
+    df.drop(columns=["rh98", "pai"]).to_parquet(tmp_path / "features.parquet")
+    df[["shot_number", "rh98", "pai"]].to_parquet(tmp_path / "gedi.parquet")
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    cfg = {"model": {"ensemble": {
+        "features": str(tmp_path / "features.parquet"), "targets": str(tmp_path / "gedi.parquet"),
+        "target": ["rh98", "pai"], "grid": GRID, "seeds": 2, "resources": RESOURCES, "n_configs": 2,
+        "scratch_dir": str(scratch), "output_dir": str(tmp_path / "out"),
+    }}}
+
+    manifests = ensemble.run(cfg)
+
+    assert list(scratch.iterdir()) == []
+    for target, path in manifests.items():
+        estimators, meta = ensemble.load_ensemble(path)
+        assert meta["target"] == target and meta["inputs"] == ["a", "b", "c"]
+        assert len(estimators) == 4 == len({m["file"] for m in meta["members"]})
+        pred = ensemble.predict_ensemble(estimators, df[["a", "b", "c"]].to_numpy())
+        assert pred.shape == (4, len(df))
+        assert np.corrcoef(pred.mean(axis=0), df[target])[0, 1] > 0.8
+    files = sorted(p.name for p in (tmp_path / "out").glob("*.joblib"))
+    assert files == sorted(m["file"] for path in manifests.values()
+                           for m in json.loads(path.read_text())["members"])
@@ -0,0 +1,140 @@
+# tests/test_export.py
+
+import json
+
+import numpy as np
+import pytest
+import xarray as xr
+
+torch = pytest.importorskip("torch")
+
+from step5_model.export import FLOAT_TOLERANCE, export_model
+from step5_model.models import build_model, load_checkpoint, save_checkpoint
+from step5_model.predict import Predictor, meta_path, predict_store
+from step5_model.train import fit, make_loader
+
+# Model inputs in another order than the store's columns (s2_red, s2_nir, s2_sar_VV, s2_sar_VH)
+INPUTS = ["s2_nir", "s2_sar_VH", "s2_red", "s2_sar_VV"]
+TARGETS = ["rh98", "agbd"]
+SPEC = {"kind": "mlp", "hidden": [64, 64], "dropout": 0.0}
+
+
+def truth(x):
+    nir, vh, red, vv = x.T
+    rh98 = 30 * (nir - red) / (nir + red) + 0.5 * vh
+    return np.stack([rh98, 4 * rh98 + 2 * vv], axis=1).astype(np.float32)
+
+
+def sample_inputs(n, rng):
+    return np.stack([rng.uniform(0.2, 0.5, n), rng.normal(-15, 2, n), rng.uniform(0.02, 0.1, n),
+                     rng.normal(-8, 2, n)], axis=1).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def checkpoint(tmp_path_factory):
+    """A small MLP fitted on synthetic features, saved as a training checkpoint."""
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    x = sample_inputs(2000, rng)
+    y = truth(x)
+    data = {"x": x, "y": y}
+    model = build_model(SPEC, len(INPUTS), len(TARGETS), (x.mean(0), x.std(0)), (y.mean(0), y.std(0)))
+    settings = {"bf16": False, "channels_last": False, "compile": False}
+    fit(model, make_loader(data, np.arange(len(x)), 64), None, settings, y.std(0), epochs=5, lr=3e-3)
+    path = tmp_path_factory.mktemp("models") / "rh98_mlp.pt"
+    save_checkpoint(path, model, {"model": SPEC, "inputs": INPUTS, "targets": TARGETS, "input_shape": [len(INPUTS)]})
+    return path
+
+
+@pytest.fixture(scope="module")
+def exported(checkpoint):
+    out_dir = checkpoint.parent / "export"
+    report = export_model(checkpoint, out_dir, variants=("float", "int8"), n_check=2000, batch_sizes=(1, 64))
+    return out_dir, report
+
+
+def eager_predict(checkpoint, x):
+    model, _ = load_checkpoint(checkpoint)
+    with torch.inference_mode():
+        return model(torch.from_numpy(np.array(x, dtype=np.float32))).numpy()
+
+
+def deviation(pred, reference, checkpoint):
+    """RMSE of a variant against the eager model, in target std units (as export_model checks it)."""
+    model, _ = load_checkpoint(checkpoint)
+    return np.sqrt(np.mean((pred - reference) ** 2, axis=0)) / model[2].std.numpy()
+
+
+def test_variants_agree_with_eager_model(checkpoint, exported):
+    out_dir, report = exported
+    assert report["float"]["ok"] and report["int8"]["ok"]
+    assert max(report["float"]["agreement"]["rmse_std"]) <= FLOAT_TOLERANCE
+    assert max(report["int8"]["agreement"]["rmse_std"]) <= 0.05
+    assert set(report["float"]["latency_ms"]) == {1, 64}
+    with open(out_dir / "rh98_mlp_export.json") as f:
+        assert json.load(f)["int8"]["path"] == report["int8"]["path"]
+
+    # Independently, on inputs the export checks did not see
+    x = sample_inputs(500, np.random.default_rng(1))
+    reference = eager_predict(checkpoint, x)
+    assert deviation(Predictor(report["float"]["path"])(x), reference, checkpoint).max() <= FLOAT_TOLERANCE
+    assert deviation(Predictor(report["int8"]["path"])(x, batch_size=37), reference, checkpoint).max() <= 0.05
+
+
+@pytest.mark.parametrize("variant", ["float", "int8"])
+def test_sidecar_meta_round_trip(exported, variant):
+    _, report = exported
+    path = report[variant]["path"]
+    with open(meta_path(path)) as f:
+        sidecar = json.load(f)
+
+    predictor = Predictor(path)
+
+    assert sidecar == {"model": SPEC, "inputs": INPUTS, "targets": TARGETS, "input_shape": [4], "variant": variant}
+    assert predictor.meta == sidecar
+    assert predictor.inputs == INPUTS and predictor.targets == TARGETS
+    assert predictor(sample_inputs(3, np.random.default_rng(2))).shape == (3, len(TARGETS))
+
+
+def write_store(path, ny=11, nx=9, seed=3):
+    """Feature store with the model inputs as variables and a band dimension; NaN gaps."""
+    rng = np.random.default_rng(seed)
+    x = sample_inputs(ny * nx, rng).reshape(ny, nx, 4)
+    x[rng.random((ny, nx)) < 0.1] = np.nan                # pixels without any feature
+    x[rng.random((ny, nx)) < 0.1, 2] = np.nan             # pixels missing one feature
+    ds = xr.Dataset(
+        {"red": (("y", "x"), x[..., 2]), "nir": (("y", "x"), x[..., 0]),
+         "sar": (("band", "y", "x"), np.stack([x[..., 3], x[..., 1]]))},
+        coords={"band": ["VV", "VH"], "y": 100.0 - 10.0 * np.arange(ny), "x": 10.0 * np.arange(nx)},
+    )
+    ds.chunk({"band": -1, "y": 5, "x": 4}).to_zarr(path, mode="w")
+    return x                                              # (y, x, input) in INPUTS order
+
+
+@pytest.mark.parametrize("variant, workers", [("float", 1), ("int8", 1), ("float", 2)])
+def test_predict_store_matches_eager(tmp_path, checkpoint, exported, variant, workers):
+    _, report = exported
+    x = write_store(tmp_path / "s2.zarr")
+    ny, nx = x.shape[:2]
+
+    n = predict_store(report[variant]["path"], [tmp_path / "s2.zarr"], tmp_path / "pred.zarr", tile=4,
+                      workers=workers)
+
+    assert n == 3 * 3
+    flat = x.reshape(-1, 4)
+    empty = np.isnan(flat).all(axis=1)
+    reference = eager_predict(checkpoint, flat)
+    reference[empty] = np.nan
+    with xr.open_zarr(tmp_path / "pred.zarr") as out:
+        pred = np.stack([out[t].values.reshape(-1) for t in TARGETS], axis=1)
+        assert out["rh98"].shape == (ny, nx)
+    np.testing.assert_array_equal(np.isnan(pred), np.isnan(reference))
+    limit = FLOAT_TOLERANCE if variant == "float" else 0.05
+    assert deviation(pred[~empty], reference[~empty], checkpoint).max() <= limit
+
+
+def test_predict_store_needs_every_input(tmp_path, exported):
+    _, report = exported
+    write_store(tmp_path / "s2.zarr")
+    with pytest.raises(ValueError, match="lack model inputs"):
+        predict_store(report["float"]["path"], {"s1": tmp_path / "s2.zarr"}, tmp_path / "pred.zarr")
@@ -0,0 +1,111 @@
+# tests/test_folds.py
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial import cKDTree
+
+from step3_autocorr.folds import fold_masks, hex_cells, make_folds, metric_xy, run
+
+K = 5
+SIZE = 5000.0
+BUFFER = 1500.0
+
+
+def synthetic_shots(n=6000, seed=0):
+    """GEDI-like shots over a 60 x 40 km area: dense ground tracks plus clusters, with a spatial target trend."""
+    rng = np.random.default_rng(seed)
+    n_track = n // 2
+    track = rng.integers(0, 12, n_track)
+    along = rng.uniform(0, 40_000, n_track)
+    tracks = np.column_stack([track * 5000.0 + 1200 + 0.1 * along, along])
+    centres = rng.uniform([0, 0], [60_000, 40_000], (15, 2))
+    clusters = centres[rng.integers(0, 15, n - n_track)] + rng.normal(0, 2000, (n - n_track, 2))
+    xy = np.vstack([tracks, clusters]) + [500_000.0, 4_400_000.0]
+    target = 10 + xy[:, 0] / 3000 - 500_000 / 3000 + rng.gamma(2.0, 3.0, n)
+    return xy, target
+
+
+@pytest.fixture(scope="module")
+def shots():
+    return synthetic_shots()
+
+
+@pytest.fixture(scope="module", params=["square", "hex", "kmeans"])
+def folds(request, shots):
+    xy, target = shots
+    return request.param, make_folds(xy, k=K, method=request.param, size=SIZE, target=target, buffer=BUFFER)
+
+
+def test_no_training_shot_within_buffer_of_test(shots, folds):
+    xy, _ = shots
+    _, out = folds
+    for f in range(K):
+        train, test = fold_masks(out["fold"], out["buffer"], f)
+        tree = cKDTree(xy[test])
+        dist, _ = tree.query(xy[train], distance_upper_bound=BUFFER)
+        assert np.isinf(dist).all(), f"fold {f}: training shots within the buffer"
+        # Only shots that are within the buffer are dropped
+        dropped = ~test & ~train
+        assert dropped.any()
+        dist, _ = tree.query(xy[dropped])
+        assert (dist <= BUFFER).all(), f"fold {f}: shots dropped outside the buffer"
+
+
+def test_blocks_stay_whole(shots, folds):
+    xy, _ = shots
+    method, out = folds
+    table = pd.DataFrame({"block": out["block"], "fold": out["fold"]})
+    assert (table.groupby("block")["fold"].nunique() == 1).all()
+    assert set(np.unique(out["fold"])) == set(range(K))
+    if method == "square":
+        extent = pd.DataFrame(xy // SIZE).groupby(out["block"]).nunique()
+        assert (extent == 1).all().all()
+
+
+def test_folds_are_balanced(shots, folds):
+    _, target = shots
+    _, out = folds
+    counts = np.bincount(out["fold"], minlength=K)
+    assert counts.max() <= 1.05 * len(target) / K
+    assert counts.min() >= 0.95 * len(target) / K
+    # Every target quintile is dealt out about evenly
+    quintile = np.searchsorted(np.quantile(target, [0.2, 0.4, 0.6, 0.8]), target)
+    share = pd.crosstab(quintile, out["fold"], normalize="index").to_numpy()
+    assert np.abs(share - 1 / K).max() < 0.03
+
+
+def test_hex_cells_are_nearest_centres(shots):
+    xy, _ = shots
+    q, r = hex_cells(xy, SIZE)
+    radius = SIZE / np.sqrt(3)
+    centres = np.column_stack([radius * np.sqrt(3) * (q + r / 2), radius * 1.5 * r])
+    assert (np.linalg.norm(xy - centres, axis=1) <= radius + 1e-6).all()
+    # No other hexagon centre (they lie on the triangular lattice SIZE apart) is nearer
+    lattice = np.unique(centres, axis=0)
+    offsets = SIZE * np.array([[np.cos(a), np.sin(a)] for a in np.radians(np.arange(0, 360, 60))])
+    lattice = np.vstack([lattice] + [lattice + o for o in offsets])
+    nearest, _ = cKDTree(lattice).query(xy)
+    np.testing.assert_allclose(np.linalg.norm(xy - centres, axis=1), nearest, atol=1e-6)
+
+
+def test_run_writes_fold_table(tmp_path, shots):
+    pytest.importorskip("pyproj")
+    xy, target = shots
+    lon, lat = -105.5 + (xy[:, 0] - 500_000) / 85_000, 39.7 + (xy[:, 1] - 4_400_000) / 111_000
+    pd.DataFrame({"shot_number": np.arange(len(xy), dtype=np.int64) + 10**15, "lat_lowestmode": lat,
+                  "lon_lowestmode": lon, "rh98": target}).to_parquet(tmp_path / "shots.parquet")
+    cfg = {"autocorr": {"folds": {"shots": str(tmp_path / "shots.parquet"), "output": str(tmp_path / "folds.parquet"),
+                                  "k": K, "method": "hex", "block_size": SIZE, "target": "rh98",
+                                  "buffer": BUFFER}}}
+
+    table = pd.read_parquet(run(cfg))
+
+    assert list(table.columns) == ["shot_number", "block", "fold", "buffer"]
+    assert table["shot_number"].is_unique and len(table) == len(xy)
+    metric, crs = metric_xy(lon, lat)
+    assert crs == "EPSG:32613"
+    for f in range(K):
+        train, test = fold_masks(table["fold"], table["buffer"], f)
+        dist, _ = cKDTree(metric[test]).query(metric[train], distance_upper_bound=BUFFER)
+        assert np.isinf(dist).all()
@@ -0,0 +1,105 @@
+# tests/test_harmony.py
+
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from step1_gedi.harmony import HarmonyJobManager, JobLedger, LEDGER_NAME, job_specs
+from step1_gedi.harmony_mock import MockHarmony
+
+TIMEFRAME = {"start": "2019-04-01", "end": "2019-04-30"}
+
+
+def run_against(mock, output_dir, specs):
+    """Run a fresh manager (ledger read from disk) against the mock, on the mock's previous port if any."""
+    async def main():
+        port = int(mock.url.rsplit(":", 1)[1]) if mock.url else 0
+        root = await mock.start(port=port)
+        try:
+            manager = HarmonyJobManager(output_dir, JobLedger(output_dir / LEDGER_NAME), root=root,
+                                        poll_interval=0.01, timeout=30)
+            return await manager.run_async(specs)
+        finally:
+            await mock.stop()
+
+    return asyncio.run(main())
+
+
+def read_ledger(output_dir):
+    with open(output_dir / LEDGER_NAME) as f:
+        return json.load(f)
+
+
+def test_result_pages_are_all_downloaded(tmp_path):
+    mock = MockHarmony(granules_per_job=5, page_size=2, file_size=64)
+    specs = job_specs(["GEDI02_A"], TIMEFRAME, variables=["rh"])
+
+    failed = run_against(mock, tmp_path, specs)
+
+    assert failed == {}
+    entry = read_ledger(tmp_path)[specs[0]["key"]]
+    assert entry["status"] == "successful"
+    # 5 results over 3 status pages of 2 links
+    assert len(entry["files"]) == 5
+    assert all(f["done"] for f in entry["files"].values())
+    assert sorted(mock.downloads) == sorted(entry["files"])
+    for name in entry["files"]:
+        assert (tmp_path / "GEDI02_A" / name).stat().st_size == 64
+
+
+def test_resume_from_ledger(tmp_path):
+    mock = MockHarmony(granules_per_job=4, page_size=3, file_size=64)
+    specs = job_specs(["GEDI02_A", "GEDI02_B"], TIMEFRAME, variables=["rh"])
+    assert run_against(mock, tmp_path, specs) == {}
+    submitted = list(mock.requests)
+
+    # Interrupt one job mid-download: one file lost, not marked done
+    ledger = read_ledger(tmp_path)
+    key = specs[1]["key"]
+    lost = sorted(ledger[key]["files"])[1]
+    ledger[key]["files"][lost]["done"] = False
+    (tmp_path / "GEDI02_B" / lost).unlink()
+    with open(tmp_path / LEDGER_NAME, "w") as f:
+        json.dump(ledger, f)
+    mock.downloads.clear()
+
+    assert run_against(mock, tmp_path, specs) == {}
+
+    # The job is resumed, not submitted again, and only the lost file is fetched
+    assert mock.requests == submitted
+    assert mock.downloads == [lost]
+    assert (tmp_path / "GEDI02_B" / lost).exists()
+    assert all(f["done"] for f in read_ledger(tmp_path)[key]["files"].values())
+
+    # A complete ledger runs nothing
+    assert run_against(mock, tmp_path, specs) == {}
+    assert mock.requests == submitted
+    assert mock.downloads == [lost]
+
+
+def test_failed_job_is_resubmitted(tmp_path):
+    mock = MockHarmony(granules_per_job=2, file_size=64, fail_products=["GEDI02_B"])
+    specs = job_specs(["GEDI02_A", "GEDI02_B"], TIMEFRAME, variables=["rh"])
+    key_a, key_b = (s["key"] for s in specs)
+
+    failed = run_against(mock, tmp_path, specs)
+
+    assert list(failed) == [key_b]
+    ledger = read_ledger(tmp_path)
+    assert ledger[key_a]["status"] == "successful"
+    assert ledger[key_b]["status"] == "failed"
+    failed_job = ledger[key_b]["job_id"]
+
+    mock.fail_products.clear()
+    assert run_against(mock, tmp_path, specs) == {}
+
+    # Only the failed job is submitted again, as a new job
+    assert sorted(r["product"] for r in mock.requests) == ["GEDI02_A", "GEDI02_B", "GEDI02_B"]
+    entry = read_ledger(tmp_path)[key_b]
+    assert entry["status"] == "successful"
+    assert entry["job_id"] not in (None, failed_job)
+    assert len(entry["files"]) == 2
+    assert all((tmp_path / "GEDI02_B" / name).exists() for name in entry["files"])
@@ -0,0 +1,127 @@
+# tests/test_memory_budget.py
+
+import logging
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+# Tight budget for the synthetic run; without it the stages below peak at
+# several times this much
+BUDGET = "64MB"
+
+
+def make_synthetic(root, n_time=36, size=300, n_shots=2_000_000, seed=0):
+    """Synthetic S2 cube (compute input) and GEDI shot table (gedi_filter input)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+    s2_dir = Path(root) / "raw" / "s2"
+    s2_dir.mkdir(parents=True, exist_ok=True)
+    times = pd.date_range("2019-01-01", periods=n_time, freq="10D")
+    ds = xr.Dataset(
+        {b: (("time", "y", "x"), rng.uniform(0.01, 0.5, (n_time, size, size)).astype(np.float32))
+         for b in ("B3", "B4", "B8", "B11")},
+        coords={"time": times, "y": np.arange(size)[::-1] * 10.0, "x": np.arange(size) * 10.0},
+    )
+    ds.chunk({"time": 1, "y": size, "x": size}).to_zarr(s2_dir / "s2_synthetic.zarr", mode="w")
+
+    gedi_dir = Path(root) / "raw" / "gedi" / "GEDI_L2A"
+    gedi_dir.mkdir(parents=True, exist_ok=True)
+    table = pa.table({
+        "shot_number": np.arange(n_shots, dtype=np.int64),
+        "lat_lowestmode": rng.uniform(39, 41, n_shots),
+        "lon_lowestmode": rng.uniform(-106, -104, n_shots),
+        "quality_flag": rng.integers(0, 2, n_shots).astype(np.int8),
+        "sensitivity": rng.uniform(0.5, 1.0, n_shots),
+        "rh98": rng.uniform(0, 40, n_shots),
+        "pai": rng.uniform(0, 6, n_shots),
+        "fhd_normal": rng.uniform(0, 4, n_shots),
+    })
+    pq.write_table(table, gedi_dir / "GEDI_L2A_synthetic.parquet", row_group_size=50_000)
+
+
+def stage_configs(root, budget):
+    out = Path(root) / ("budget" if budget else "unbounded")
+    compute_cfg = {
+        "input_dir": str(Path(root) / "raw"),
+        "output_dir": str(out / "eo"),
+        "eo": {
+            "sources": ["S2"],
+            "composites": ["median", "mean"],
+            "phenology_windows": [("2019-01-01", "2019-06-30"), ("2019-07-01", "2019-12-31")],
+        },
+        "memory_budget": budget,
+    }
+    filter_cfg = {
+        "input_dir": str(Path(root) / "raw" / "gedi"),
+        "output_dir": str(out / "gedi"),
+        "product_filters": {
+            "GEDI_L2A": {"quality_flag": lambda x: x == 1, "sensitivity": lambda x: x > 0.9},
+        },
+        "memory_budget": budget,
+    }
+    return compute_cfg, filter_cfg
+
+
+def _run_stages(root, budget, queue):
+    """Child process: run the stages and report (baseline RSS, peak RSS) in bytes."""
+    from memory_budget import current_rss, peak_rss
+    from step2_eo.compute import run as compute_eo
+    from step2_eo.gedi_filter import run as filter_gedi
+
+    compute_cfg, filter_cfg = stage_configs(root, budget)
+    # Import the libraries the stages load lazily, so the baseline includes them
+    import dask.array, pyarrow.parquet, xarray, zarr  # noqa: F401
+    baseline = current_rss()
+    filter_gedi(filter_cfg)
+    compute_eo(compute_cfg)
+    queue.put((baseline, peak_rss()))
+
+
+def measure(root, budget):
+    """Peak RSS above the post-import baseline of a fresh process running the stages."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_stages, args=(root, budget, queue))
+    proc.start()
+    baseline, peak = queue.get()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"Stage process failed with exit code {proc.exitcode}")
+    return peak - baseline
+
+
+def check_outputs_equal(root):
+    import pyarrow.parquet as pq
+    import xarray as xr
+
+    for name in ("gedi/GEDI_L2A/GEDI_L2A_synthetic.parquet",):
+        a = pq.read_table(Path(root) / "budget" / name)
+        b = pq.read_table(Path(root) / "unbounded" / name)
+        assert a.equals(b), f"{name} differs between budgeted and unbounded runs"
+    for path in sorted((Path(root) / "unbounded" / "eo" / "s2").glob("*.zarr")):
+        a = xr.open_zarr(Path(root) / "budget" / "eo" / "s2" / path.name).load()
+        b = xr.open_zarr(path).load()
+        assert a.equals(b), f"{path.name} differs between budgeted and unbounded runs"
+
+
+def test_memory_budget():
+    from memory_budget import parse_size
+
+    with tempfile.TemporaryDirectory() as root:
+        make_synthetic(root)
+        unbounded = measure(root, None)
+        budgeted = measure(root, BUDGET)
+        logging.info(f"Peak RSS above baseline: {unbounded / 1024**2:.0f} MB unbounded, "
+                     f"{budgeted / 1024**2:.0f} MB with a {BUDGET} budget")
+        check_outputs_equal(root)
+    assert budgeted <= parse_size(BUDGET), f"Peak {budgeted / 1024**2:.0f} MB exceeds the {BUDGET} budget"
+    assert budgeted < unbounded
+
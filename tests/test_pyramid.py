@@ -0,0 +1,130 @@
+# tests/test_pyramid.py
+
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from pyramid import build_pyramid, open_level
+
+SHAPE = (37, 29)
+RESAMPLING = {"agbd": "mean", "landcover": "mode", "n_obs": "nearest", "ndvi": "mean", "count": "mean"}
+
+
+def make_base(path, shape=SHAPE, seed=0):
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    agbd = rng.gamma(2.0, 50.0, shape).astype(np.float32)
+    agbd[rng.random(shape) < 0.2] = np.nan
+    agbd[:6, :6] = np.nan                                 # whole blocks without data
+    ds = xr.Dataset(
+        {
+            "agbd": (("y", "x"), agbd),
+            "landcover": (("y", "x"), rng.integers(1, 4, shape).astype(np.uint8)),
+            "n_obs": (("y", "x"), rng.integers(0, 50, shape).astype(np.int16)),
+            "count": (("y", "x"), rng.integers(0, 9, shape).astype(np.int32)),
+            "ndvi": (("time", "y", "x"), rng.uniform(-0.2, 0.9, (3, ny, nx)).astype(np.float32)),
+        },
+        coords={"time": pd.date_range("2020-01-01", periods=3, freq="YS"),
+                "y": 1000.0 - 10.0 * np.arange(ny), "x": 500.0 + 10.0 * np.arange(nx)},
+    )
+    ds.chunk({"time": 1, "y": 8, "x": 8}).to_zarr(path, mode="w")
+    return ds
+
+
+def coarsen2(a, method):
+    """Reference 2x2 reduction, block by block (odd edges from the pixels that exist)."""
+    *lead, h, w = a.shape
+    dtype = np.float64 if method == "mean" else a.dtype
+    out = np.empty((*lead, math.ceil(h / 2), math.ceil(w / 2)), dtype=dtype)
+    for i in range(out.shape[-2]):
+        for j in range(out.shape[-1]):
+            block = a[..., 2 * i:2 * i + 2, 2 * j:2 * j + 2].reshape(*lead, -1).astype(dtype)
+            for idx in np.ndindex(*lead):
+                values = block[idx]
+                if method == "nearest":
+                    out[idx + (i, j)] = values[0]
+                    continue
+                valid = values[~np.isnan(values)] if np.issubdtype(dtype, np.floating) else values
+                if method == "mean":
+                    out[idx + (i, j)] = valid.mean() if len(valid) else np.nan
+                else:
+                    # most frequent, ties to the first in row-major order
+                    counts = [np.count_nonzero(valid == v) for v in valid]
+                    out[idx + (i, j)] = valid[int(np.argmax(counts))]
+    return out
+
+
+def check_levels(out_path, base, levels):
+    assert xr.open_zarr(out_path).attrs["multiscales"][0]["shape"] == list(SHAPE)
+    with open_level(out_path, 0) as level0:
+        xr.testing.assert_equal(level0["agbd"].load(), base["agbd"])
+    ref = {v: base[v].transpose(..., "y", "x").values for v in RESAMPLING}
+    for k in range(1, levels + 1):
+        ref = {v: coarsen2(a, RESAMPLING[v]) for v, a in ref.items()}
+        with open_level(out_path, k) as level:
+            assert (level.sizes["y"], level.sizes["x"]) == tuple(math.ceil(s / 2**k) for s in SHAPE)
+            assert level["count"].dtype == np.float32 and level["landcover"].dtype == np.uint8
+            for v, expected in ref.items():
+                np.testing.assert_allclose(level[v].transpose(..., "y", "x").values, expected, rtol=1e-5,
+                                           equal_nan=True, err_msg=f"level {k} {v}")
+            # Pixel centres of the coarse grid, same outer corner as the base
+            x = 500.0 - 5.0 + 10.0 * 2**k * (np.arange(level.sizes["x"]) + 0.5)
+            np.testing.assert_allclose(level["x"].values, x)
+            np.testing.assert_array_equal(level["time"].values, base["time"].values)
+
+
+def test_levels_equal_direct_coarsening(tmp_path):
+    base = make_base(tmp_path / "base.zarr")
+
+    n = build_pyramid(tmp_path / "base.zarr", tmp_path / "pyr.zarr", resampling=RESAMPLING, tile=8, min_chunk=2)
+
+    # 37 x 29 -> 2 x 1 after 5 halvings; two levels per pass of 8-pixel tiles
+    assert n == math.ceil(37 / 8) * math.ceil(29 / 8)
+    check_levels(tmp_path / "pyr.zarr", base, 5)
+
+    # Without NaNs, every full 2^k block of a level is the plain mean of its base pixels
+    with open_level(tmp_path / "pyr.zarr", 3) as level:
+        direct = base["ndvi"].coarsen(y=8, x=8, boundary="trim").mean()
+        np.testing.assert_allclose(level["ndvi"].values[:, :direct.sizes["y"], :direct.sizes["x"]], direct.values,
+                                   rtol=1e-5)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_incremental_update_equals_full_build(tmp_path, workers):
+    make_base(tmp_path / "base.zarr")
+    build_pyramid(tmp_path / "base.zarr", tmp_path / "pyr.zarr", resampling=RESAMPLING, tile=8, min_chunk=2)
+
+    # Rewrite part of the base, then rebuild only the tiles covering it
+    rng = np.random.default_rng(1)
+    ys, xs = slice(9, 20), slice(3, 14)
+    patch = xr.Dataset({
+        "agbd": (("y", "x"), rng.gamma(2.0, 80.0, (11, 11)).astype(np.float32)),
+        "landcover": (("y", "x"), np.full((11, 11), 3, dtype=np.uint8)),
+        "n_obs": (("y", "x"), rng.integers(50, 99, (11, 11)).astype(np.int16)),
+        "count": (("y", "x"), rng.integers(0, 9, (11, 11)).astype(np.int32)),
+        "ndvi": (("time", "y", "x"), rng.uniform(-0.2, 0.9, (3, 11, 11)).astype(np.float32)),
+    })
+    patch.to_zarr(tmp_path / "base.zarr", region={"time": slice(0, 3), "y": ys, "x": xs})
+    base = xr.open_zarr(tmp_path / "base.zarr").load()
+
+    n = build_pyramid(tmp_path / "base.zarr", tmp_path / "pyr.zarr", resampling=RESAMPLING, tile=8, min_chunk=2,
+                      regions=[{"y": [ys.start, ys.stop], "x": [xs.start, xs.stop]}], workers=workers)
+
+    assert n == 2 * 2                                     # base tiles rows 8-23, columns 0-15
+    check_levels(tmp_path / "pyr.zarr", base, 5)
+
+
+def test_incremental_with_other_settings_rebuilds(tmp_path):
+    make_base(tmp_path / "base.zarr")
+    build_pyramid(tmp_path / "base.zarr", tmp_path / "pyr.zarr", resampling=RESAMPLING, tile=8, min_chunk=2)
+    base = make_base(tmp_path / "base.zarr", seed=2)
+
+    # A different tile size cannot be patched: every level is rebuilt from the new base
+    n = build_pyramid(tmp_path / "base.zarr", tmp_path / "pyr.zarr", resampling=RESAMPLING, tile=16, min_chunk=2,
+                      regions=[{"y": [0, 1], "x": [0, 1]}])
+
+    assert n == math.ceil(37 / 16) * math.ceil(29 / 16)
+    check_levels(tmp_path / "pyr.zarr", base, 5)
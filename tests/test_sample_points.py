@@ -0,0 +1,132 @@
+# tests/test_sample_points.py
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import xarray as xr
+
+from step4_patches import sample_points
+
+NY, NX = 21, 23
+Y0, X0, STEP = 40.0, -105.0, 0.01  # y decreasing, as in north-up rasters
+
+
+def field(r, c, band):
+    """Bilinear in (row, col), so bilinear interpolation reproduces it exactly."""
+    return 1.0 + band + 0.5 * r - 0.25 * c + 0.01 * r * c
+
+
+def make_store(path, holes=False):
+    r, c = np.meshgrid(np.arange(NY), np.arange(NX), indexing="ij")
+    values = np.stack([field(r, c, b) for b in range(2)]).astype(np.float32)
+    if holes:
+        values[:, 5, 5] = np.nan
+        values[:, 12, 17] = np.nan
+    ds = xr.Dataset(
+        {"elev": (("y", "x"), values[0] * 10), "refl": (("band", "y", "x"), values)},
+        coords={"band": [1, 2], "y": Y0 - STEP * np.arange(NY), "x": X0 + STEP * np.arange(NX)},
+    )
+    ds.chunk({"band": 1, "y": 8, "x": 8}).to_zarr(path, mode="w")
+    return values
+
+
+def random_points(n=500, seed=0):
+    """Fractional (row, col) covering the grid, its half-pixel rim and beyond, as lon/lat."""
+    rng = np.random.default_rng(seed)
+    fy = rng.uniform(-2, NY + 1, n)
+    fx = rng.uniform(-2, NX + 1, n)
+    return fy, fx, X0 + STEP * fx, Y0 - STEP * fy
+
+
+def window_mean(values, iy, ix, window):
+    """Brute-force NaN-aware mean over the part of the window inside the grid."""
+    r = window // 2
+    block = values[:, max(iy - r, 0):iy + r + 1, max(ix - r, 0):ix + r + 1]
+    return np.nanmean(block.reshape(len(values), -1), axis=1)
+
+
+@pytest.fixture
+def store(tmp_path):
+    make_store(tmp_path / "feat.zarr")
+    return sample_points.FeatureStore(tmp_path / "feat.zarr", name="f")
+
+
+def test_columns_and_fractional_index(store):
+    assert store.columns == ["f_elev", "f_refl_1", "f_refl_2"]
+    assert (store.chy, store.chx, store.n_chunks_x) == (8, 8, 3)
+    fy, fx, lon, lat = random_points(20)
+    gy, gx = store.fractional_index(lon, lat)
+    np.testing.assert_allclose(gy, fy, atol=1e-9)
+    np.testing.assert_allclose(gx, fx, atol=1e-9)
+
+
+def test_nearest_and_bilinear_match_the_field(store):
+    fy, fx, lon, lat = random_points()
+    iy, ix = np.floor(fy + 0.5), np.floor(fx + 0.5)
+    inside = (iy >= 0) & (iy < NY) & (ix >= 0) & (ix < NX)
+    assert 100 < inside.sum() < len(fy)
+
+    nearest = sample_points.sample_store(store, lon, lat, method="nearest")
+    assert np.isnan(nearest[~inside]).all()
+    np.testing.assert_allclose(nearest[inside, 0], 10 * field(iy[inside], ix[inside], 0), rtol=1e-6)
+    for b in range(2):
+        np.testing.assert_allclose(nearest[inside, 1 + b], field(iy[inside], ix[inside], b), rtol=1e-6)
+
+    # Exact inside the pixel-centre hull; on the half-pixel rim the edge value is held
+    bilinear = sample_points.sample_store(store, lon, lat, method="bilinear")
+    assert np.isnan(bilinear[~inside]).all()
+    cy, cx = np.clip(fy[inside], 0, NY - 1), np.clip(fx[inside], 0, NX - 1)
+    for b in range(2):
+        np.testing.assert_allclose(bilinear[inside, 1 + b], field(cy, cx, b), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("window", [3, 5])
+def test_window_mean_across_chunk_edges_and_gaps(tmp_path, window):
+    values = make_store(tmp_path / "feat.zarr", holes=True)
+    store = sample_points.FeatureStore(tmp_path / "feat.zarr", name="f", variables=["refl"])
+    # Every pixel centre, so windows straddle every chunk boundary and both holes
+    iy, ix = np.meshgrid(np.arange(NY), np.arange(NX), indexing="ij")
+    iy, ix = iy.ravel(), ix.ravel()
+
+    out = sample_points.sample_store(store, X0 + STEP * ix, Y0 - STEP * iy, method="mean", window=window)
+
+    ref = np.stack([window_mean(values, a, b, window) for a, b in zip(iy, ix)])
+    np.testing.assert_allclose(out, ref, rtol=1e-6, atol=1e-6)
+    # Away from the holes and edges the mean of a bilinear field is its centre value
+    r = window // 2
+    core = (iy >= r) & (iy < NY - r) & (ix >= r) & (ix < NX - r) & (np.abs(iy - 5) > r) & (np.abs(iy - 12) > r)
+    np.testing.assert_allclose(out[core, 0], field(iy[core], ix[core], 0), rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("batch_size", [64, 10_000])
+def test_run_batches_cover_every_shot_once(tmp_path, batch_size):
+    make_store(tmp_path / "feat.zarr")
+    fy, fx, lon, lat = random_points(300, seed=3)
+    shots = pd.DataFrame({
+        "shot_number": np.random.default_rng(3).permutation(len(lon)).astype(np.uint64),
+        "lat_lowestmode": lat,
+        "lon_lowestmode": lon,
+    })
+    shot_dir = tmp_path / "shots"
+    shot_dir.mkdir()
+    for k, start in enumerate(range(0, len(shots), 100)):
+        shots.iloc[start:start + 100].to_parquet(shot_dir / f"granule{k}.parquet")
+
+    cfg = {"features": {"shots": str(shot_dir), "stores": {"f": str(tmp_path / "feat.zarr")},
+                        "method": "bilinear", "batch_size": batch_size, "output": str(tmp_path / "out")}}
+    out = sample_points.run(cfg)
+
+    parts = sorted(out.glob("part-*.parquet"))
+    sizes = [pq.read_metadata(p).num_rows for p in parts]
+    assert sum(sizes) == len(shots)
+    assert all(s >= batch_size for s in sizes[:-1])
+    assert (len(parts) == 1) == (batch_size >= len(shots))
+
+    table = pq.read_table(out).to_pandas().sort_values("shot_number")
+    assert list(table.columns) == ["shot_number", "f_elev", "f_refl_1", "f_refl_2"]
+    ref = shots.sort_values("shot_number")
+    store = sample_points.FeatureStore(tmp_path / "feat.zarr", name="f")
+    expected = sample_points.sample_store(store, ref["lon_lowestmode"].to_numpy(), ref["lat_lowestmode"].to_numpy(),
+                                          method="bilinear")
+    np.testing.assert_array_equal(table[store.columns].to_numpy(), expected)
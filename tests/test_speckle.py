@@ -0,0 +1,90 @@
+# tests/test_speckle.py
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from step2_eo import speckle
+
+SIZE, N_TIME, WINDOW = 40, 6, 5
+
+
+def stack_with_gaps(n_time=N_TIME, seed=0):
+    stack, _ = speckle.synthetic_stack(n_time, SIZE, patch=8, seed=seed)
+    rng = np.random.default_rng(seed)
+    stack[rng.random(stack.shape) < 0.03] = np.nan
+    return stack
+
+
+def write_store(path, data, dims, chunk=16):
+    coords = {"y": np.arange(SIZE)[::-1] + 0.5, "x": np.arange(SIZE) + 0.5}
+    if "time" in dims:
+        coords["time"] = np.arange(data.shape[dims.index("time")])
+    if "band" in dims:
+        coords["band"] = [1, 2]
+    chunks = {d: (chunk if d in ("y", "x") else 1) for d in dims}
+    xr.Dataset({"backscatter": (dims, data)}, coords=coords).chunk(chunks).to_zarr(path)
+    return path
+
+
+def filtered(out_path):
+    with xr.open_zarr(out_path) as ds:
+        return ds["backscatter"].values, dict(ds.attrs)
+
+
+@pytest.mark.parametrize("method, spatial", [("lee", "boxcar"), ("quegan", "boxcar"), ("quegan", "lee")])
+@pytest.mark.parametrize("tile", [None, 12])
+def test_chunked_store_matches_whole_array(tmp_path, method, spatial, tile):
+    stack = stack_with_gaps()
+    path = write_store(tmp_path / "s1.zarr", stack, ("time", "y", "x"))
+
+    n = speckle.filter_store(path, tmp_path / "out.zarr", method=method, window=WINDOW, spatial=spatial, tile=tile)
+    out, attrs = filtered(tmp_path / "out.zarr")
+
+    assert n == (9 if tile is None else 16)
+    full = stack.astype(np.float64)
+    if method == "quegan":
+        expected = speckle.quegan_filter(full, WINDOW, spatial=spatial)
+    else:
+        expected = speckle.lee_filter(full, WINDOW)
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(stack))
+    np.testing.assert_allclose(out, expected.astype(np.float32), rtol=1e-5, equal_nan=True)
+    assert attrs["speckle_filter"] == method
+
+
+def test_band_dimension_is_filtered_per_band(tmp_path):
+    stack = np.stack([stack_with_gaps(seed=1), stack_with_gaps(seed=2)], axis=1)     # (time, band, y, x)
+    path = write_store(tmp_path / "s1.zarr", stack, ("time", "band", "y", "x"))
+
+    speckle.filter_store(path, tmp_path / "out.zarr", method="quegan", window=WINDOW)
+    out, _ = filtered(tmp_path / "out.zarr")
+
+    assert out.shape == stack.shape
+    for b in range(2):
+        expected = speckle.quegan_filter(stack[:, b].astype(np.float64), WINDOW)
+        np.testing.assert_allclose(out[:, b], expected.astype(np.float32), rtol=1e-5, equal_nan=True)
+
+
+def test_store_without_time_falls_back_to_lee(tmp_path):
+    image = stack_with_gaps(n_time=1)[0]
+    path = write_store(tmp_path / "s1.zarr", image, ("y", "x"))
+
+    speckle.filter_store(path, tmp_path / "out.zarr", method="quegan", window=WINDOW)
+    out, attrs = filtered(tmp_path / "out.zarr")
+
+    assert attrs["speckle_filter"] == "lee"
+    expected = speckle.lee_filter(image.astype(np.float64), WINDOW)
+    np.testing.assert_allclose(out, expected.astype(np.float32), rtol=1e-5, equal_nan=True)
+
+
+def test_db_input_is_filtered_in_linear_power(tmp_path):
+    stack = stack_with_gaps()
+    db = (10 * np.log10(stack)).astype(np.float32)
+    path = write_store(tmp_path / "s1.zarr", db, ("time", "y", "x"))
+
+    speckle.filter_store(path, tmp_path / "out.zarr", method="quegan", window=WINDOW, db=True)
+    out, _ = filtered(tmp_path / "out.zarr")
+
+    linear = 10.0 ** (db.astype(np.float64) / 10.0)
+    expected = 10 * np.log10(speckle.quegan_filter(linear, WINDOW))
+    np.testing.assert_allclose(out, expected.astype(np.float32), atol=1e-4, equal_nan=True)
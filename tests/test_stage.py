@@ -0,0 +1,42 @@
+# tests/test_stage.py
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from step1_gedi import stage
+
+
+def write_product(root, product, granule, shots, values, statistics=True):
+    path = root / product / f"GEDI_{product}_2019108002011_{granule}_T03909_02_003_01_V002.parquet"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.table({"shot_number": pa.array(shots, pa.int64()), f"{product}_count": pa.array(values, pa.int64())})
+    pq.write_table(table, path, write_statistics=statistics)
+
+
+def test_join_keeps_source_type_without_statistics(tmp_path):
+    write_product(tmp_path, "L2A", "O01959_01", [3, 1, 2], [1, 2, 3])
+    write_product(tmp_path, "L2A", "O01960_01", [6, 5, 4], [4, 5, 300_000], statistics=False)
+    write_product(tmp_path, "L2B", "O01959_01", [1, 2, 3], [7, 8, 9])
+    write_product(tmp_path, "L2B", "O01960_01", [4, 5, 6], [10, 11, 12])
+    products = {"L2A": ["L2A_count"], "L2B": ["L2B_count"]}
+
+    granules = stage.discover_granules(tmp_path, products)
+    schema = stage.plan_schema(granules, products)
+    # L2A_count has no statistics in one file, so it cannot be narrowed; L2B_count can
+    assert schema.field("L2A_count").type == pa.int64()
+    assert schema.field("L2B_count").type == pa.uint8()
+
+    table = stage.join_granule(granules["O01960_01"], products, schema)
+    assert table.column("shot_number").to_pylist() == [4, 5, 6]
+    assert table.column("L2A_count").to_pylist() == [300_000, 5, 4]
+    assert table.column("L2B_count").to_pylist() == [10, 11, 12]
+
+
+def test_join_refuses_to_wrap_values(tmp_path):
+    write_product(tmp_path, "L2A", "O01959_01", [1, 2], [5, 300])
+    products = {"L2A": ["L2A_count"]}
+    files = stage.discover_granules(tmp_path, products)["O01959_01"]
+    narrow = pa.schema([("shot_number", pa.uint64()), ("L2A_count", pa.uint8())])
+    with pytest.raises(pa.ArrowInvalid):
+        stage.join_granule(files, products, narrow)
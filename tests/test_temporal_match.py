@@ -0,0 +1,126 @@
+# tests/test_temporal_match.py
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import xarray as xr
+
+from step4_patches import temporal_match
+
+BANDS = [1, 2]  # rioxarray band numbers, as fetch_s1 stores them
+
+
+def make_store(path, ny=9, nx=11, n_t=12, seed=0):
+    """
+    A (time, band, y, x) stack laid out like fetch_s1 writes it, with times out
+    of order, cloud-style gaps, and a (time, y, x) validity mask.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.permutation(n_t) * 11, unit="D")
+    t = np.arange(n_t, dtype=np.float32)[:, None, None, None]
+    b = np.arange(len(BANDS), dtype=np.float32)[None, :, None, None]
+    y = np.arange(ny, dtype=np.float32)[None, None, :, None]
+    x = np.arange(nx, dtype=np.float32)[None, None, None, :]
+    values = 1000 * t + 100 * b + 10 * y + x / 10
+    values = np.broadcast_to(values, (n_t, len(BANDS), ny, nx)).copy()
+    values[rng.random(values.shape) < 0.15] = np.nan
+    clear = rng.random((n_t, ny, nx)) > 0.2
+    ds = xr.Dataset(
+        {
+            "backscatter": (("time", "band", "y", "x"), values),
+            "clear": (("time", "y", "x"), clear),
+        },
+        coords={"time": times, "band": BANDS, "y": 45.0 - 0.01 * np.arange(ny), "x": -110.0 + 0.01 * np.arange(nx)},
+    )
+    ds.chunk({"time": 1, "band": 1, "y": 4, "x": 4}).to_zarr(path, mode="w")
+    return ds
+
+
+def reference(ds, lon, lat, t_shot, max_days):
+    """Brute force: nearest pixel, then the valid observation nearest in time (ties go to the earlier one)."""
+    ds = ds.sortby("time")
+    values = ds["backscatter"].values
+    valid = np.isfinite(values).all(axis=1) & ds["clear"].values
+    times = ds["time"].values.astype("datetime64[s]").astype(np.int64)
+    out = np.full((len(lon), len(BANDS)), np.nan, dtype=np.float32)
+    days = np.full(len(lon), np.nan, dtype=np.float32)
+    iy = np.floor((lat - 45.0) / -0.01 + 0.5).astype(int)
+    ix = np.floor((lon + 110.0) / 0.01 + 0.5).astype(int)
+    for k in range(len(lon)):
+        if not (0 <= iy[k] < values.shape[2] and 0 <= ix[k] < values.shape[3]):
+            continue
+        cand = np.flatnonzero(valid[:, iy[k], ix[k]])
+        if len(cand) == 0:
+            continue
+        offset = times[cand] - t_shot[k].astype(np.int64)
+        best = min(range(len(cand)), key=lambda i: (abs(offset[i]), offset[i] > 0))
+        if abs(offset[best]) > max_days * 86400:
+            continue
+        out[k] = values[cand[best], :, iy[k], ix[k]]
+        days[k] = offset[best] / 86400.0
+    return out, days
+
+
+def make_shots(n=400, seed=1):
+    rng = np.random.default_rng(seed)
+    lat = 45.0 - rng.uniform(-0.02, 0.10, n)
+    lon = -110.0 + rng.uniform(-0.02, 0.12, n)
+    delta = (np.datetime64("2019-01-01T00:00:00", "s") - temporal_match.GEDI_EPOCH).astype(np.int64)
+    delta_time = delta + rng.uniform(-20, 140, n) * 86400
+    return lon, lat, delta_time
+
+
+def test_band_dim_becomes_columns(tmp_path):
+    make_store(tmp_path / "s1.zarr")
+    store = temporal_match.TimeSeriesStore(tmp_path / "s1.zarr", name="S1", mask_variable="clear")
+    assert store.variables == ["backscatter"]
+    assert store.columns == ["S1_backscatter_1", "S1_backscatter_2"]
+
+    series, valid, r0, c0 = store.read_series(1, 2)
+    assert (r0, c0) == (4, 8)
+    assert series.shape == (2, 12, 4, 3) and valid.shape == (12, 4, 3)
+    assert np.all(np.diff(store.times.astype(np.int64)) > 0)
+
+
+def test_match_store_against_brute_force(tmp_path):
+    ds = make_store(tmp_path / "s1.zarr")
+    store = temporal_match.TimeSeriesStore(tmp_path / "s1.zarr", name="S1", mask_variable="clear")
+    lon, lat, delta_time = make_shots()
+    t_shot = temporal_match.shot_times(delta_time)
+
+    values, days = temporal_match.match_store(store, lon, lat, t_shot, max_days=8)
+    ref_values, ref_days = reference(ds, lon, lat, t_shot, max_days=8)
+
+    assert np.isfinite(days).sum() > 50 and np.isnan(days).sum() > 50
+    np.testing.assert_array_equal(np.isnan(days), np.isnan(ref_days))
+    np.testing.assert_allclose(days, ref_days, atol=1e-4)
+    np.testing.assert_array_equal(values, ref_values)
+
+
+def test_run_writes_band_columns(tmp_path):
+    ds = make_store(tmp_path / "s1.zarr")
+    lon, lat, delta_time = make_shots(n=300)
+    shots = pd.DataFrame({
+        "shot_number": np.arange(len(lon), dtype=np.uint64)[::-1],
+        "lat_lowestmode": lat,
+        "lon_lowestmode": lon,
+        "delta_time": delta_time,
+    })
+    shots.to_parquet(tmp_path / "shots.parquet")
+    cfg = {
+        "temporal_match": {
+            "shots": str(tmp_path / "shots.parquet"),
+            "stores": {"S1": {"path": str(tmp_path / "s1.zarr"), "mask_variable": "clear"}},
+            "max_days": 8,
+            "batch_size": 128,
+            "output": str(tmp_path / "out"),
+        }
+    }
+    out = temporal_match.run(cfg)
+
+    table = pq.read_table(out).to_pandas().sort_values("shot_number")
+    assert list(table.columns) == ["shot_number", "S1_backscatter_1", "S1_backscatter_2", "S1_dt_days"]
+    order = np.argsort(shots["shot_number"].to_numpy())
+    ref_values, ref_days = reference(ds, lon[order], lat[order], temporal_match.shot_times(delta_time[order]), 8)
+    np.testing.assert_array_equal(table[["S1_backscatter_1", "S1_backscatter_2"]].to_numpy(), ref_values)
+    np.testing.assert_allclose(table["S1_dt_days"].to_numpy(), ref_days, atol=1e-4)
@@ -0,0 +1,120 @@
+# tests/test_train.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+torch = pytest.importorskip("torch")
+zarr = pytest.importorskip("zarr")
+
+from step5_model.models import build_model, load_checkpoint, save_checkpoint
+from step5_model.train import fit, input_stats, load_data, make_loader, run, target_stats
+
+CPU = {"threads": 1, "bf16": False, "compile": False}
+
+
+def write_tables(tmp_path, n=240, seed=0):
+    """Feature and target Parquet tables of n shots; rh98 is a noisy linear function of the features."""
+    rng = np.random.default_rng(seed)
+    shots = np.arange(n, dtype=np.int64) * 7 + 1000
+    x = rng.normal(size=(n, 4)).astype(np.float32)
+    x[rng.random(x.shape) < 0.05] = np.nan
+    rh98 = 20 + np.nan_to_num(x) @ np.array([3.0, -2.0, 1.0, 0.5]) + rng.normal(0, 0.1, n)
+    rh98[:5] = np.nan                                      # shots without a target
+    features = pd.DataFrame({"shot_number": shots, **{f"b{k}": x[:, k] for k in range(4)}})
+    features.to_parquet(tmp_path / "features.parquet")
+    pd.DataFrame({"shot_number": shots[::-1], "rh98": rh98[::-1]}).to_parquet(tmp_path / "gedi.parquet")
+    return features, rh98
+
+
+def write_patches(tmp_path, n=96, channels=3, size=5, seed=0):
+    """Patch store with a (sample, channel, y, x) array, one target and the channel names."""
+    rng = np.random.default_rng(seed)
+    patches = rng.normal(size=(n, channels, size, size)).astype(np.float32)
+    agbd = 100 + 20 * patches[:, 0].mean(axis=(1, 2)) - 10 * patches[:, 2, 2, 2]
+    group = zarr.open_group(str(tmp_path / "patches.zarr"), mode="w")
+    group.create_array("patches", data=patches, chunks=(16, channels, size, size))
+    group.create_array("agbd", data=agbd.astype(np.float32))
+    group.create_array("shot_number", data=np.arange(n, dtype=np.int64))
+    group.create_array("channel", data=np.array(["B04", "B08", "VV"]))
+    return patches, agbd
+
+
+def predict(model, x):
+    with torch.inference_mode():
+        return model(torch.from_numpy(np.array(x, dtype=np.float32))).numpy()
+
+
+def test_fit_on_table(tmp_path):
+    features, rh98 = write_tables(tmp_path)
+    cfg = {"model": {"train": {
+        "features": str(tmp_path / "features.parquet"),
+        "targets": str(tmp_path / "gedi.parquet"),
+        "target": "rh98",
+        "model": {"kind": "mlp", "hidden": [32], "dropout": 0.0},
+        "epochs": 15, "batch_size": 32, "accumulate": 2, "lr": 1e-2,
+        "cpu": CPU,
+        "output": str(tmp_path / "models" / "rh98.pt"),
+    }}}
+
+    model, meta = load_checkpoint(run(cfg))
+
+    assert meta["inputs"] == ["b0", "b1", "b2", "b3"] and meta["targets"] == ["rh98"]
+    assert meta["input_shape"] == [4]
+    history = meta["history"]
+    assert [h["epoch"] for h in history] == list(range(1, 16))
+    assert history[0]["samples"] == 235 - round(0.1 * 235)    # 5 shots without a target
+    assert history[-1]["loss"] < 0.25 * history[0]["loss"]
+    assert history[-1]["val_loss"] < history[0]["val_loss"]
+    # Raw features in, target units out (standardization is part of the model)
+    ok = np.isfinite(rh98)
+    pred = predict(model, features[meta["inputs"]].to_numpy())[:, 0]
+    assert np.isfinite(pred).all()
+    assert np.sqrt(np.mean((pred[ok] - rh98[ok]) ** 2)) < 0.5 * rh98[ok].std()
+
+
+@pytest.mark.parametrize("num_workers", [0, 1])
+def test_fit_on_patch_store(tmp_path, num_workers):
+    patches, agbd = write_patches(tmp_path)
+    cfg = {"model": {"train": {
+        "patches": str(tmp_path / "patches.zarr"),
+        "target": ["agbd"],
+        "model": {"kind": "cnn", "hidden": [8], "dropout": 0.0},
+        "epochs": 3, "batch_size": 16, "num_workers": num_workers,
+        "cpu": {**CPU, "channels_last": True},
+        "output": str(tmp_path / "agbd_cnn.pt"),
+    }}}
+
+    model, meta = load_checkpoint(run(cfg))
+
+    assert meta["inputs"] == ["B04", "B08", "VV"] and meta["input_shape"] == [3, 5, 5]
+    assert all(h["samples"] == 86 for h in meta["history"])   # 96 - 10 held out
+    assert predict(model, patches[:7]).shape == (7, 1)
+
+
+@pytest.mark.parametrize("source", ["table", "patches"])
+def test_checkpoint_round_trip(tmp_path, source):
+    if source == "table":
+        write_tables(tmp_path)
+        train_cfg = {"features": str(tmp_path / "features.parquet"), "targets": str(tmp_path / "gedi.parquet"),
+                     "target": ["rh98"]}
+        spec = {"kind": "mlp", "hidden": [16, 8], "dropout": 0.2}
+    else:
+        write_patches(tmp_path)
+        train_cfg = {"patches": str(tmp_path / "patches.zarr"), "target": ["agbd"]}
+        spec = {"kind": "cnn", "hidden": [4, 8], "dropout": 0.2}
+    data = load_data(train_cfg)
+    rows = data["rows"]
+    model = build_model(spec, data["input_shape"][0], 1, input_stats(data, rows), target_stats(data, rows))
+    settings = {"bf16": False, "channels_last": False, "compile": False}
+    fit(model, make_loader(data, rows, 32), None, settings, target_stats(data, rows)[1], epochs=2)
+    path = tmp_path / "model.pt"
+    meta = {"model": spec, "inputs": data["inputs"], "targets": data["targets"],
+            "input_shape": list(data["input_shape"])}
+
+    save_checkpoint(path, model, meta)
+    loaded, loaded_meta = load_checkpoint(path)
+
+    assert loaded_meta == meta and not loaded.training
+    x = data["x"][np.sort(rows[:40])]
+    np.testing.assert_array_equal(predict(loaded, x), predict(model.eval(), x))
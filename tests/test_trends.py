@@ -0,0 +1,98 @@
+# tests/test_trends.py
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy import stats
+from scipy.special import ndtr
+
+from step6_control import trends
+
+TIMES = pd.date_range("2015-01-01", periods=14, freq="QS")
+
+
+def make_cube(ny=6, nx=7, seed=0):
+    """Integer-valued (time, y, x) series with a trend, ties, gaps, an empty and a single-observation pixel."""
+    rng = np.random.default_rng(seed)
+    n_t = len(TIMES)
+    values = np.round(rng.normal(0, 2, (n_t, ny, nx)) + rng.normal(0, 1, (ny, nx)) * np.arange(n_t)[:, None, None])
+    values[:, 0, 0] = 3.0                               # constant: every pair tied
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 1, 1] = np.nan                            # no observation
+    values[1:, 2, 2] = np.nan                           # one observation
+    return values.astype(np.float32)
+
+
+def reference(series, years, alpha=0.05):
+    """Theil-Sen by scipy and a brute-force Mann-Kendall test (with tie correction) of one pixel."""
+    ok = ~np.isnan(series)
+    y, t = series[ok].astype(np.float64), years[ok]
+    n = len(y)
+    if n < 2:
+        return None
+    slope, intercept, _, _ = stats.theilslopes(y, t)
+    s = sum(np.sign(y[b] - y[a]) for a in range(n) for b in range(a + 1, n))
+    _, counts = np.unique(y, return_counts=True)
+    var = (n * (n - 1) * (2 * n + 5) - sum(c * (c - 1) * (2 * c + 5) for c in counts)) / 18.0
+    z = (s - np.sign(s)) / np.sqrt(var) if var > 0 else np.nan
+    p = 2 * ndtr(-abs(z))
+    trend = np.sign(z) if p < alpha else 0
+    return {"sen_slope": slope, "sen_intercept": intercept, "mk_s": s, "mk_z": z, "mk_p": p,
+            "mk_trend": trend, "n_obs": n}
+
+
+def assert_matches_reference(out, values, years):
+    """out: name -> (n,) arrays for the columns of values (T, n)."""
+    for k in range(values.shape[1]):
+        ref = reference(values[:, k], years)
+        if ref is None:
+            assert np.isnan(out["sen_slope"][k])
+            continue
+        for name, expected in ref.items():
+            np.testing.assert_allclose(out[name][k], expected, rtol=1e-4, atol=1e-4, err_msg=f"{name}, pixel {k}")
+
+
+@pytest.mark.parametrize("pair_budget", [trends.PAIR_BUDGET, 100])
+def test_trend_stats_match_reference(pair_budget):
+    values = make_cube().reshape(len(TIMES), -1)
+    years = ((TIMES - TIMES[0]) / pd.Timedelta(days=365.25)).to_numpy()
+
+    out = trends.trend_stats(values, years, pair_budget=pair_budget)
+
+    assert_matches_reference(out, values, years)
+    assert (out["mk_trend"] != 0).any() and (out["mk_trend"] == 0).any()
+    assert np.isnan(out["mk_p"][0])                    # all-tied pixel has no variance
+
+
+def test_run_matches_reference_by_pixel(tmp_path):
+    cube = make_cube()
+    ny, nx = cube.shape[1:]
+    ds = xr.Dataset({"NDVI": (("time", "y", "x"), cube)},
+                    coords={"time": TIMES, "y": np.arange(ny) * -10.0, "x": np.arange(nx) * 10.0})
+    ds.chunk({"time": -1, "y": 4, "x": 4}).to_zarr(tmp_path / "cube.zarr")
+    cfg = {"control": {"trends": {
+        "input": str(tmp_path / "cube.zarr"),
+        "variable": "NDVI",
+        "output": str(tmp_path / "trends.zarr"),
+        "before": ["2015-01-01", "2016-12-31"],
+        "after": ["2017-01-01", "2018-12-31"],
+    }}}
+
+    out_path = trends.run(cfg)
+
+    with xr.open_zarr(out_path) as out:
+        assert out["sen_slope"].shape == (ny, nx)
+        np.testing.assert_array_equal(out["x"].values, ds["x"].values)
+        result = {name: out[name].values.reshape(-1) for name in out.data_vars}
+    values = cube.reshape(len(TIMES), -1)
+    years = ((TIMES - TIMES[0]) / pd.Timedelta(days=365.25)).to_numpy()
+    assert_matches_reference(result, values, years)
+
+    before = (TIMES >= "2015-01-01") & (TIMES <= "2016-12-31")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # the empty pixel
+        delta = np.nanmean(values[~before], axis=0) - np.nanmean(values[before], axis=0)
+    np.testing.assert_allclose(result["delta"], delta, rtol=1e-5, equal_nan=True)
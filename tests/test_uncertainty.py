@@ -0,0 +1,116 @@
+# tests/test_uncertainty.py
+
+import warnings
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from step5_model.uncertainty import PixelEnsembleStats, run
+
+QUANTILES = (5, 50, 95)
+
+
+def make_members(n_members=23, shape=(6, 7), seed=0):
+    """(member, var, y, x) predictions with pixel-varying spread, NaNs and a pixel that is always NaN."""
+    rng = np.random.default_rng(seed)
+    centre = rng.uniform(50, 300, shape)
+    agbd = centre + rng.gamma(2.0, 1.0, shape) * rng.normal(0, 10, (n_members,) + shape)
+    height = np.round(rng.uniform(0, 35, (n_members,) + shape))   # ties
+    values = np.stack([agbd, height], axis=1)
+    values[rng.random(values.shape) < 0.15] = np.nan
+    values[:, :, 0, 0] = np.nan
+    return values
+
+
+def data_ranges(values):
+    """Histogram ranges spanning every member (the quantile bound holds inside them)."""
+    return [(np.nanmin(v), np.nanmax(v)) for v in values.transpose(1, 0, 2, 3)]
+
+
+def expected(values, q):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # the empty pixel
+        return np.nanpercentile(values, q, axis=0, method="inverted_cdf")
+
+
+def check_moments(stats, values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        np.testing.assert_array_equal(stats.count, np.isfinite(values).sum(axis=0))
+        ok = stats.count > 0
+        np.testing.assert_allclose(stats.mean[ok], np.nanmean(values, axis=0)[ok], rtol=1e-12)
+        np.testing.assert_allclose(stats.std(), np.nanstd(values, axis=0, ddof=1), rtol=1e-9, equal_nan=True)
+        np.testing.assert_array_equal(stats.min[ok], np.nanmin(values, axis=0)[ok])
+        np.testing.assert_array_equal(stats.max[ok], np.nanmax(values, axis=0)[ok])
+
+
+def test_streaming_moments_match_numpy():
+    values = make_members()
+    stats = PixelEnsembleStats(values.shape[2:], data_ranges(values))
+    for member in values:
+        stats.update(member)
+    check_moments(stats, values)
+
+
+def test_merged_partials_match_numpy():
+    values = make_members()
+    parts = []
+    for split in (values[:5], values[5:6], values[6:]):
+        part = PixelEnsembleStats(values.shape[2:], data_ranges(values))
+        for member in split:
+            part.update(member)
+        parts.append(part)
+    stats = parts[0].merge(parts[1]).merge(parts[2])
+    check_moments(stats, values)
+    # An empty partial changes nothing
+    stats.merge(PixelEnsembleStats(values.shape[2:], data_ranges(values)))
+    check_moments(stats, values)
+
+
+@pytest.mark.parametrize("bins", [16, 128])
+def test_quantiles_within_one_bin(bins):
+    values = make_members()
+    ranges = data_ranges(values)
+    stats = PixelEnsembleStats(values.shape[2:], ranges, bins)
+    for member in values:
+        stats.update(member)
+    width = np.diff(ranges, axis=1)[:, 0, None, None] / bins
+    for q in QUANTILES:
+        got, ref = stats.quantile(q), expected(values, q)
+        np.testing.assert_array_equal(np.isnan(got), np.isnan(ref))
+        ok = ~np.isnan(ref)
+        assert (np.abs(got - ref)[ok] <= np.broadcast_to(width, ref.shape)[ok] + 1e-9).all(), q
+
+
+def test_run_layers(tmp_path):
+    values = make_members(n_members=9, shape=(9, 11))
+    ny, nx = values.shape[2:]
+    coords = {"y": np.arange(ny)[::-1] + 0.5, "x": np.arange(nx) + 0.5}
+    for m, member in enumerate(values):
+        xr.Dataset({"agbd": (("y", "x"), member[0]), "height": (("y", "x"), member[1])},
+                   coords=coords).chunk({"y": 4, "x": 5}).to_zarr(tmp_path / f"member_{m}.zarr")
+    stacked = xr.Dataset({"agbd": (("member", "y", "x"), values[:, 0]), "height": (("member", "y", "x"), values[:, 1])},
+                         coords=coords).chunk({"member": 1, "y": 4, "x": 5})
+    stacked.to_zarr(tmp_path / "stacked.zarr")
+
+    bins = 64
+    for name, members, member_dim in [("files", str(tmp_path / "member_*.zarr"), None),
+                                      ("stacked", [str(tmp_path / "stacked.zarr")], "member")]:
+        cfg = {"model": {"uncertainty": {"members": members, "member_dim": member_dim, "bins": bins,
+                                         "output": str(tmp_path / f"unc_{name}.zarr"), "quantiles": list(QUANTILES)}}}
+        with xr.open_zarr(run(cfg)) as out:
+            assert out.attrs["members"] == len(values)
+            for k, v in enumerate(("agbd", "height")):
+                lo, hi = out.attrs["ranges"][v]
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    np.testing.assert_allclose(out[f"{v}_mean"], np.nanmean(values[:, k], axis=0), rtol=1e-5)
+                    np.testing.assert_allclose(out[f"{v}_std"], np.nanstd(values[:, k], axis=0, ddof=1),
+                                               rtol=1e-4, equal_nan=True)
+                np.testing.assert_array_equal(out[f"{v}_n"], np.isfinite(values[:, k]).sum(axis=0))
+                for q in QUANTILES:
+                    ref = expected(values[:, k], q)
+                    got = out[f"{v}_p{q}"].values
+                    np.testing.assert_array_equal(np.isnan(got), np.isnan(ref))
+                    assert np.nanmax(np.abs(got - ref)) <= (hi - lo) / bins + 1e-3, (name, v, q)
@@ -0,0 +1,112 @@
+# tests/test_zonal.py
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("rasterio")
+from shapely.geometry import box
+
+from step6_control import zonal
+
+PIXEL = 10.0
+# Zones as (xmin, ymin, xmax, ymax) on pixel edges; the last lies off every raster
+ZONES = [(0, 0, 40, 30), (40, 0, 110, 60), (10, 60, 70, 90), (500, 500, 520, 520)]
+
+
+def write_raster(path, ny, nx, seed):
+    rng = np.random.default_rng(seed)
+    agbd = rng.gamma(2.0, 40.0, (ny, nx))
+    agbd[rng.random((ny, nx)) < 0.1] = np.nan
+    height = np.round(rng.uniform(0, 30, (ny, nx)))
+    ds = xr.Dataset({"agbd": (("y", "x"), agbd), "height": (("y", "x"), height)},
+                    coords={"y": (ny - 0.5 - np.arange(ny)) * PIXEL, "x": (np.arange(nx) + 0.5) * PIXEL})
+    ds.chunk({"y": 4, "x": 5}).to_zarr(path, mode="w")
+    return ds
+
+
+def write_zones(path, zones=ZONES):
+    gpd.GeoDataFrame({"unit_id": [f"u{k}" for k in range(len(zones))]},
+                     geometry=[box(*z) for z in zones], crs="EPSG:32613").to_file(path, driver="GeoJSON")
+
+
+def reference(ds, zones=ZONES):
+    """Per-zone statistics by pandas groupby over the pixel centres inside each zone."""
+    yy, xx = np.meshgrid(ds["y"].values, ds["x"].values, indexing="ij")
+    label = np.zeros(yy.shape, dtype=int)
+    for k, (x0, y0, x1, y1) in enumerate(zones, start=1):
+        label[(xx > x0) & (xx < x1) & (yy > y0) & (yy < y1)] = k
+    df = pd.DataFrame({"zone": label.ravel(), **{v: ds[v].values.ravel() for v in ds.data_vars}})
+    df = df[df["zone"] > 0]
+    return df.groupby("zone"), df
+
+
+def check_table(table, ds, percentiles=(10, 50, 90), bins=zonal.DEFAULT_BINS):
+    groups, df = reference(ds)
+    assert list(table["zone"]) == list(range(1, len(ZONES) + 1))
+    table = table.set_index("zone")
+    for v in ds.data_vars:
+        agg = groups[v].agg(["count", "sum", "mean", "std", "min", "max"]).reindex(table.index)
+        agg[["count", "sum"]] = agg[["count", "sum"]].fillna(0)
+        for stat in agg.columns:
+            np.testing.assert_allclose(table[f"{v}_{stat}"], agg[stat], rtol=1e-9, equal_nan=True,
+                                       err_msg=f"{v}_{stat}")
+        width = (np.nanmax(ds[v].values) - np.nanmin(ds[v].values)) / bins
+        for q in percentiles:
+            expected = groups[v].apply(lambda s: np.percentile(s.dropna(), q, method="inverted_cdf")
+                                       if s.notna().any() else np.nan).reindex(table.index)
+            got = table[f"{v}_p{q}"]
+            assert np.array_equal(got.isna(), expected.isna())
+            assert (np.abs(got - expected).dropna() <= width + 1e-9).all(), f"{v}_p{q}"
+    # The off-raster zone is empty
+    assert table.loc[len(ZONES), "agbd_count"] == 0
+
+
+def run_zonal(tmp_path, raster):
+    cfg = {"control": {"zonal": {
+        "input": str(raster),
+        "zones": str(tmp_path / "units.geojson"),
+        "id_field": "unit_id",
+        "output": str(tmp_path / "out" / "unit_stats.parquet"),
+        "percentiles": [10, 50, 90],
+    }}}
+    return pd.read_parquet(zonal.run(cfg))
+
+
+def test_zonal_matches_groupby(tmp_path):
+    ds = write_raster(tmp_path / "a.zarr", 9, 11, seed=0)
+    write_zones(tmp_path / "units.geojson")
+
+    table = run_zonal(tmp_path, tmp_path / "a.zarr")
+
+    check_table(table, ds)
+    assert list(table["unit_id"]) == ["u0", "u1", "u2", "u3"]
+    np.testing.assert_allclose(table["area"].iloc[:3], [12, 42, 18] * np.array(PIXEL ** 2))
+
+
+def test_label_grid_is_rebuilt_for_another_grid(tmp_path):
+    write_zones(tmp_path / "units.geojson")
+    labels_path = tmp_path / "out" / "units_labels.zarr"
+
+    ds_a = write_raster(tmp_path / "a.zarr", 9, 11, seed=0)
+    check_table(run_zonal(tmp_path, tmp_path / "a.zarr"), ds_a)
+    built = labels_path.stat().st_mtime_ns
+
+    # Same grid: the label grid is reused
+    check_table(run_zonal(tmp_path, tmp_path / "a.zarr"), ds_a)
+    assert labels_path.stat().st_mtime_ns == built
+
+    # Another shape over the same zones file: rebuilt, not misapplied
+    ds_b = write_raster(tmp_path / "b.zarr", 12, 8, seed=1)
+    check_table(run_zonal(tmp_path, tmp_path / "b.zarr"), ds_b)
+    with xr.open_zarr(labels_path) as grid:
+        assert grid["label"].shape == (12, 8)
+
+    # Edited zones: rebuilt
+    moved = ZONES[:2] + [(0, 30, 40, 60)] + ZONES[3:]
+    write_zones(tmp_path / "units.geojson", moved)
+    table = run_zonal(tmp_path, tmp_path / "b.zarr")
+    groups, _ = reference(ds_b, moved)
+    np.testing.assert_array_equal(table["height_count"].iloc[:3], groups["height"].count().reindex([1, 2, 3]))